@@ -0,0 +1,81 @@
+"""
+ASGI config for MrDoc project.
+
+It exposes the ASGI callable as a module-level variable named ``application``.
+
+AI streaming views are served by async views under ASGI (see
+``app_ai/views_async.py``), so an open chat stream costs a coroutine instead
+of a worker thread. Run it with any ASGI server, e.g.::
+
+    uvicorn MrDoc.asgi:application --host 0.0.0.0 --port 10086
+
+For more information on this file, see
+https://docs.djangoproject.com/en/4.2/howto/deployment/asgi/
+"""
+
+import asyncio
+import os
+
+from asgiref.sync import sync_to_async
+from django.core import signals
+from django.core.asgi import get_asgi_application
+from django.core.handlers.asgi import ASGIHandler
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'MrDoc.settings')
+os.environ.setdefault('MRDOC_ASGI', '1')
+
+
+class DisconnectCancelMiddleware:
+    """
+    Cancel the request task when the client disconnects.
+
+    Django 4.2 does not listen for ``http.disconnect`` while a streaming
+    response is being sent, so a closed browser tab would keep the upstream
+    LLM request running until it finishes. Once the request body has been
+    read, this middleware waits for the next ASGI message and cancels the
+    view when it is a disconnect; the async views close their upstream
+    connection when cancelled.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        body_read = asyncio.Event()
+        disconnected = False
+
+        async def app_receive():
+            message = await receive()
+            if message['type'] != 'http.request' or not message.get('more_body', False):
+                body_read.set()
+            return message
+
+        app_task = asyncio.ensure_future(self.app(scope, app_receive, send))
+
+        async def listen_for_disconnect():
+            nonlocal disconnected
+            await body_read.wait()
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                disconnected = True
+                app_task.cancel()
+
+        listener = asyncio.ensure_future(listen_for_disconnect())
+        try:
+            await app_task
+        except asyncio.CancelledError:
+            if not disconnected:
+                raise
+            # The cancelled handler never reaches response.close(), send
+            # request_finished here so database connections are released.
+            await sync_to_async(signals.request_finished.send, thread_sensitive=True)(
+                sender=ASGIHandler
+            )
+        finally:
+            listener.cancel()
+
+
+application = DisconnectCancelMiddleware(get_asgi_application())
@@ -12,6 +12,7 @@ https://docs.djangoproject.com/en/2.1/ref/settings/
 """
 
 import os
+import tempfile
 from configparser import ConfigParser,RawConfigParser
 from loguru import logger
 
@@ -276,13 +277,33 @@ HAYSTACK_CONNECTIONS = {
 }
 
 # 当添加、修改、删除数据时，自动生成索引
-HAYSTACK_SIGNAL_PROCESSOR = 'haystack.signals.RealtimeSignalProcessor'
+# 默认在请求内实时更新索引；配置 [search] index_queue = True 时文档变更后加入全文索引队列，
+# 由 process_index_queue 命令在后台批量更新索引，未配置时以环境变量 MRDOC_INDEX_WORKER=1 表示已启动后台命令（docker_mrdoc.sh）
+if CONFIG.getboolean('search','index_queue',fallback=os.environ.get('MRDOC_INDEX_WORKER') == '1'):
+    HAYSTACK_SIGNAL_PROCESSOR = 'app_doc.search.index_queue.QueuedSignalProcessor'
+else:
+    HAYSTACK_SIGNAL_PROCESSOR = 'haystack.signals.RealtimeSignalProcessor'
 # 自定义高亮
 HAYSTACK_CUSTOM_HIGHLIGHTER = "app_doc.search.highlight.MyHighLighter"
 
 # Selenium 调用的driver类型 默认为Chromium
 CHROMIUM_DRIVER = CONFIG.get('selenium','driver',fallback='CHROMIUM')
 CHROMIUM_DRIVER_PATH = CONFIG.get('selenium','driver_path',fallback=None)
+# PDF渲染服务的浏览器会话数量、每个会话处理的任务数和排队的任务数上限
+PDF_RENDER_POOL_SIZE = CONFIG.getint('selenium','pool_size',fallback=2)
+PDF_RENDER_MAX_JOBS = CONFIG.getint('selenium','max_jobs',fallback=50)
+PDF_RENDER_QUEUE_SIZE = CONFIG.getint('selenium','queue_size',fallback=8)
+
+# 文集导出任务默认在请求内执行，配置 [export] async = True 时由 process_export_jobs 命令在后台执行；
+# 未配置时以环境变量 MRDOC_EXPORT_WORKER=1 表示已启动后台命令（docker_mrdoc.sh）
+EXPORT_JOB_ASYNC = CONFIG.getboolean('export','async',fallback=os.environ.get('MRDOC_EXPORT_WORKER') == '1')
+# 各导出类型同时执行的任务数
+EXPORT_JOB_CONCURRENCY = {
+    export_type:CONFIG.getint('export','{}_concurrency'.format(export_type),fallback=default)
+    for export_type,default in (('epub',2),('pdf',1),('docx',2),('md',2),('md_batch',1))
+}
+# 导出文件缓存的大小上限，超过时按最近使用时间淘汰，单位为 MB
+EXPORT_CACHE_MAX_SIZE = CONFIG.getint('export','cache_size',fallback=2048) * 1024 * 1024
 
 INTERNAL_IPS = ('127.0.0.1', '::1')
 # Django Debug Toolbar 工具，站点开启调试的时候启用
@@ -328,9 +349,39 @@ CORS_ALLOW_HEADERS = list(default_headers) + [
     'access-control-allow-origin',
 ]
 
+# AI接口
+# 每个上游服务（API地址）的连接池大小、异步连接数上限、连接超时和读取超时秒数
+AI_HTTP_OPTIONS = {
+    'pool_size': CONFIG.getint('ai','pool_size',fallback=20),
+    'async_pool_size': CONFIG.getint('ai','async_pool_size',fallback=1000),
+    'connect_timeout': CONFIG.getfloat('ai','connect_timeout',fallback=10),
+    'read_timeout': CONFIG.getfloat('ai','read_timeout',fallback=300),
+}
+# 单独配置的上游服务，配置节名称为 ai:主机名[:端口]
+AI_HTTP_UPSTREAMS = {
+    section[3:]:{name:CONFIG.getfloat(section,name) for name in AI_HTTP_OPTIONS if CONFIG.has_option(section,name)}
+    for section in CONFIG.sections() if section.startswith('ai:')
+}
+# AI接口全局每分钟请求数上限，同时进行的流式生成数量上限（全局和每个用户），-1 表示不限制；
+# 流式生成的最长秒数，开始超过该时长两倍的生成不再计入并发数
+AI_GLOBAL_RATE_LIMIT = CONFIG.getint('ai','global_rate_limit',fallback=-1)
+AI_MAX_STREAMS = CONFIG.getint('ai','max_streams',fallback=-1)
+AI_USER_MAX_STREAMS = CONFIG.getint('ai','user_max_streams',fallback=-1)
+AI_STREAM_MAX_DURATION = CONFIG.getint('ai','stream_max_duration',fallback=600)
+# 打开会话时从 Dify 同步消息的最小间隔秒数
+AI_MESSAGE_SYNC_INTERVAL = CONFIG.getint('ai','message_sync_interval',fallback=300)
+# 流式生成视图使用异步版本，默认在以 ASGI 方式部署时（MrDoc/asgi.py）启用；
+# WSGI 方式下异步流式响应会被完整缓冲后才返回，不应启用
+AI_ASYNC_VIEWS = CONFIG.getboolean('ai','async_views',fallback=os.environ.get('MRDOC_ASGI') == '1')
+
 # 附件预览
 # LibreOffice 路径
 LIBREOFFICE_PATH = CONFIG.get('preview','libreoffice_path',fallback='soffice')
+# LibreOffice 每批转换的最大秒数和文件数上限
+LIBREOFFICE_TIMEOUT = CONFIG.getint('preview','timeout',fallback=60)
+LIBREOFFICE_BATCH_SIZE = CONFIG.getint('preview','batch_size',fallback=20)
+# LibreOffice 的用户配置目录和转换中的临时文件所在的文件夹，不能位于可公开访问的媒体目录下
+LIBREOFFICE_WORK_DIR = CONFIG.get('preview','work_dir',fallback=os.path.join(tempfile.gettempdir(),'mrdoc_office_convert'))
 # LibreOffice预览格式
 PREVIEW_SUFFIX_OFFICE = ['opt','csv','doc','docx','odp','ods','ppt','pptx','tsv','wps','xls','xlsx','txt']
 # 附件预览格式
@@ -3,3 +3,6 @@ from django.apps import AppConfig
 
 class AppAdminConfig(AppConfig):
     name = 'app_admin'
+
+    def ready(self):
+        import app_admin.signals # 注册信号处理
@@ -3,9 +3,8 @@
 # @创建者：州的先生
 # #日期：2019/11/16
 # 博客地址：zmister.com
-from app_admin.models import SysSetting
 from django.conf import settings
-from app_admin.utils import decrypt_data
+from app_admin.setting_utils import get_setting_snapshot
 
 # 系统设置 - 上下文变量
 def sys_setting(request):
@@ -17,10 +16,6 @@ def sys_setting(request):
     # 站点地图状态
     setting_dict['sitemap'] = settings.SITEMAP
     # 获取系统设置状态
-    datas = SysSetting.objects.filter(types__in=["basic","doc","ai"])
-    for data in datas:
-        if data.name in ['ai_dify_chat_api_key', 'ai_dify_dataset_api_key', 'ai_dify_textgenerate_api_key']:
-            setting_dict[data.name] = decrypt_data(data.value)
-        else:
-            setting_dict[data.name] = data.value
+    # 从系统设置快照读取，加密的设置项在模板中使用时才解密
+    setting_dict.update(get_setting_snapshot().by_types("basic","doc","ai"))
     return setting_dict
\ No newline at end of file
@@ -1,6 +1,6 @@
 from django.core.exceptions import PermissionDenied # 权限拒绝异常
 from django.http import Http404,JsonResponse
-from app_admin.models import SysSetting
+from app_admin.setting_utils import get_setting
 from app_api.models import UserToken
 from django import VERSION as django_version
 
@@ -21,12 +21,8 @@ def superuser_only(function):
 def open_register(function):
     '''只有开放注册才能访问'''
     def _inner(request,*args,**kwargs):
-        try:
-            status = SysSetting.objects.get(name='close_register')
-        except:
-            # 如果不存在close_register这个属性，那么表示是开放注册的
-            return function(request, *args, **kwargs)
-        if status.value == 'on':
+        # 如果不存在close_register这个属性，那么表示是开放注册的
+        if get_setting('close_register') == 'on':
             raise Http404
         return function(request, *args, **kwargs)
 
@@ -47,13 +43,9 @@ def check_headers(function):
 # 开放前台文集导出
 def allow_report_file(function):
     def _inner(request,*args,**kwargs):
-        try:
-            status = SysSetting.objects.get(name='enable_project_report')
-        except:
-            # 如果不存在enable_project_report这个属性，那么表示是禁止导出的
-            raise Http404
+        # 如果不存在enable_project_report这个属性，那么表示是禁止导出的
         # 启用导出
-        if status.value == 'on':
+        if get_setting('enable_project_report') == 'on':
             return function(request, *args, **kwargs)
         else:
             raise Http404
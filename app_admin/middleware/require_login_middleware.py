@@ -4,7 +4,7 @@
 # #日期：2020/5/8
 # 博客地址：zmister.com
 
-from app_admin.models import SysSetting
+from app_admin.setting_utils import get_setting
 from django.contrib.auth.decorators import login_required
 import re
 
@@ -37,8 +37,8 @@ class RequiredLoginMiddleware():
             return None
 
         try:
-            # 获取数据库的设置值
-            data = SysSetting.objects.get(name='require_login').value
+            # 获取系统设置值
+            data = get_setting('require_login')
             # 如果设置值为on，表示开启了验证
             if data == 'on':
                 is_exceptions = False
@@ -0,0 +1,112 @@
+# coding:utf-8
+# @文件: setting_utils.py
+# 系统设置读取
+# 系统设置在进程内保存为只读快照，通过共享缓存中的版本号判断是否需要重新加载，
+# 设置项保存或删除后更新版本号，其他进程在下次读取时重新加载
+
+from django.core.cache import cache
+from django.utils.functional import SimpleLazyObject
+from app_admin.models import SysSetting
+from loguru import logger
+from types import MappingProxyType
+import threading
+import time
+
+# 系统设置版本号的缓存键
+SETTING_VERSION_KEY = 'sys_setting_version'
+# 加密保存的设置项
+ENCRYPTED_SETTINGS = ('ai_dify_chat_api_key', 'ai_dify_dataset_api_key', 'ai_dify_textgenerate_api_key')
+
+
+# 系统设置快照
+class SettingSnapshot():
+    def __init__(self,version,rows):
+        self.version = version
+        # 设置名称 → (类型, 值)
+        self.rows = MappingProxyType({name:(types,value) for name,types,value in rows})
+        self._decrypted = {}
+
+    # 获取设置值，指定 types 时类型不一致视为不存在
+    def get(self,name,default=None,types=None):
+        row = self.rows.get(name)
+        if row is None or (types is not None and row[0] != types):
+            return default
+        return row[1]
+
+    # 获取解密后的设置值，解密结果在快照内缓存
+    def get_decrypted(self,name,default=''):
+        if name in self._decrypted:
+            return self._decrypted[name]
+        value = self.get(name)
+        if value:
+            from app_admin.utils import decrypt_data
+            try:
+                value = decrypt_data(value)
+            except Exception:
+                logger.exception("解密系统设置{}出错".format(name))
+                value = default
+        else:
+            value = default
+        self._decrypted[name] = value
+        return value
+
+    # 获取指定类型的全部设置，加密设置项的值在使用时才解密
+    def by_types(self,*types):
+        data = {}
+        for name,(t,value) in self.rows.items():
+            if t not in types:
+                continue
+            if name in ENCRYPTED_SETTINGS:
+                data[name] = SimpleLazyObject(lambda name=name: self.get_decrypted(name))
+            else:
+                data[name] = value
+        return data
+
+
+_snapshot = None
+_snapshot_lock = threading.Lock()
+
+
+# 获取系统设置版本号
+def get_setting_version():
+    version = cache.get(SETTING_VERSION_KEY)
+    if version is None:
+        version = int(time.time() * 1000)
+        if cache.add(SETTING_VERSION_KEY,version,None) is False:
+            version = cache.get(SETTING_VERSION_KEY,version)
+    return version
+
+
+# 更新系统设置版本号，使所有进程的设置快照失效
+def bump_setting_version():
+    global _snapshot
+    try:
+        cache.incr(SETTING_VERSION_KEY)
+    except ValueError:
+        cache.set(SETTING_VERSION_KEY,int(time.time() * 1000),None)
+    _snapshot = None
+
+
+# 获取系统设置快照
+def get_setting_snapshot():
+    global _snapshot
+    version = get_setting_version()
+    snapshot = _snapshot
+    if snapshot is not None and snapshot.version == version:
+        return snapshot
+    with _snapshot_lock:
+        snapshot = _snapshot
+        if snapshot is None or snapshot.version != version:
+            snapshot = SettingSnapshot(version,SysSetting.objects.values_list('name','types','value'))
+            _snapshot = snapshot
+    return snapshot
+
+
+# 获取系统设置值
+def get_setting(name,default=None,types=None):
+    return get_setting_snapshot().get(name,default,types)
+
+
+# 获取解密后的系统设置值
+def get_decrypted_setting(name,default=''):
+    return get_setting_snapshot().get_decrypted(name,default)
@@ -0,0 +1,14 @@
+# coding:utf-8
+# 管理APP的信号处理
+
+from django.db.models.signals import post_save,post_delete
+from django.dispatch import receiver
+from app_admin.models import SysSetting
+from app_admin.setting_utils import bump_setting_version
+
+
+# 系统设置保存或删除后，更新系统设置版本号
+@receiver(post_save,sender=SysSetting)
+@receiver(post_delete,sender=SysSetting)
+def sys_setting_changed(sender,instance,**kwargs):
+    bump_setting_version()
@@ -1,3 +1,133 @@
-from django.test import TestCase
+from django.test import TestCase,RequestFactory
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.cache import cache
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from app_admin.models import SysSetting,RegisterCode
+from app_doc.models import Project,Doc,ProjectCollaborator
+from app_admin.setting_utils import get_setting,get_setting_snapshot,get_decrypted_setting
+from app_admin.utils import encrypt_data
+from app_admin.context_processors import sys_setting
+from app_doc.util_upload_img import img_upload
+from PIL import Image as PILImage
+import tempfile
+import shutil
+import io
 
 # Create your tests here.
+
+
+# 系统设置快照
+class SysSettingSnapshotTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        SysSetting.objects.create(name='require_login',value='on',types='basic')
+        SysSetting.objects.create(name='ai_dify_chat_api_key',value=encrypt_data('key'),types='ai')
+
+    def test_snapshot_cached(self):
+        self.assertEqual(get_setting('require_login'),'on')
+        with self.assertNumQueries(0):
+            self.assertEqual(get_setting('require_login',types='basic'),'on')
+            self.assertIsNone(get_setting('require_login',types='doc'))
+            self.assertEqual(get_setting('not_exists','default'),'default')
+            self.assertEqual(get_decrypted_setting('ai_dify_chat_api_key'),'key')
+
+    def test_snapshot_refresh(self):
+        snapshot = get_setting_snapshot()
+        SysSetting.objects.update_or_create(name='require_login',defaults={'value':'off','types':'basic'})
+        self.assertIsNot(get_setting_snapshot(),snapshot)
+        self.assertEqual(get_setting('require_login'),'off')
+
+    def test_context_processor(self):
+        request = RequestFactory().get('/')
+        sys_setting(request)
+        with self.assertNumQueries(0):
+            setting_dict = sys_setting(request)
+        self.assertEqual(setting_dict['require_login'],'on')
+        self.assertEqual(str(setting_dict['ai_dify_chat_api_key']),'key')
+
+
+# 后台文集管理列表的查询次数不随文集数量增加
+class AdminProjectListTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.admin = User.objects.create_superuser(username='admin',password='admin_pwd',email='admin@mrdoc.pro')
+        self.client.login(username='admin',password='admin_pwd')
+
+    def add_project(self):
+        user = User.objects.create_user(username='user{}'.format(Project.objects.count()))
+        pro = Project.objects.create(name='pro',intro='',create_user=user)
+        Doc.objects.create(name='doc',top_doc=pro.id,status=0,create_user=user)
+        ProjectCollaborator.objects.create(project=pro,user=self.admin)
+
+    def test_admin_project(self):
+        self.add_project()
+        self.client.post('/admin/project_manage/',{'limit':20})
+        with CaptureQueriesContext(connection) as before:
+            self.client.post('/admin/project_manage/',{'limit':20})
+        for i in range(3):
+            self.add_project()
+        with CaptureQueriesContext(connection) as after:
+            data = self.client.post('/admin/project_manage/',{'limit':20}).json()['data']
+        self.assertEqual(len(after),len(before))
+        self.assertEqual([(d['doc_total'],d['colla_total']) for d in data],[(1,1)] * 4)
+
+
+# 用户注册，开启注册码时更新注册码的使用次数
+class RegisterTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.admin = User.objects.create_superuser(username='admin',password='admin_pwd',email='admin@mrdoc.pro')
+
+    def register(self, username, **data):
+        session = self.client.session
+        session['CheckCode'] = 'abcd'
+        session.save()
+        data = dict(username=username,email=username + '@mrdoc.pro',password='reg_pwd',check_code='ABCD',**data)
+        return self.client.post('/register/',data)
+
+    def test_register(self):
+        resp = self.register('reguser1')
+        self.assertRedirects(resp,'/',fetch_redirect_response=False)
+        self.assertTrue(User.objects.filter(username='reguser1').exists())
+
+    def test_register_code(self):
+        SysSetting.objects.create(name='enable_register_code',value='on',types='basic')
+        RegisterCode.objects.create(code='code1',all_cnt=1,create_user=self.admin)
+        # 注册码无效时不创建用户
+        resp = self.register('reguser1',register_code='code2')
+        self.assertEqual(resp.status_code,200)
+        self.assertFalse(User.objects.filter(username='reguser1').exists())
+        resp = self.register('reguser1',register_code='code1')
+        self.assertRedirects(resp,'/',fetch_redirect_response=False)
+        code = RegisterCode.objects.get(code='code1')
+        self.assertEqual((code.used_cnt,code.status,code.user_list),(1,0,'reguser1@mrdoc.pro,'))
+        # 注册码使用次数已达限制
+        self.client.logout()
+        resp = self.register('reguser2',register_code='code1')
+        self.assertEqual(resp.status_code,200)
+        self.assertFalse(User.objects.filter(username='reguser2').exists())
+
+
+# 后台图片管理，超级管理员可以预览所有用户图片的缩略图
+class AdminImageTest(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree,self.media_root,True)
+        override = self.settings(MEDIA_ROOT=self.media_root)
+        override.enable()
+        self.addCleanup(override.disable)
+        output = io.BytesIO()
+        PILImage.new('RGB',(800,600),(10,20,30)).save(output,format='PNG')
+        user = User.objects.create_user(username='img_user')
+        self.url = img_upload(SimpleUploadedFile('a.png',output.getvalue()),'',user)['url']
+        User.objects.create_superuser(username='admin',password='admin_pwd',email='admin@mrdoc.pro')
+        self.client.login(username='admin',password='admin_pwd')
+
+    def test_preview(self):
+        data = self.client.get('/admin/api/imgs/').json()['data']
+        self.assertEqual(data[0]['file_path'],self.url)
+        resp = self.client.get(data[0]['preview'])
+        self.assertEqual(resp.status_code,200)
+        self.assertEqual(resp['Content-Type'],'image/webp')
@@ -32,6 +32,7 @@ urlpatterns = [
     path('admin_center/',views.admin_center,name="admin_center"), # 后台管理
     path('admin/center_menu/',views.admin_center_menu,name="admin_center_menu"), # 后台管理菜单数据
     path('admin_overview/',views.admin_overview,name="admin_overview"), # 后台管理仪表盘
+    path('api/search_index_status/',views.admin_search_index_status,name="admin_search_index_status"), # 全文索引队列状态
     # 注册邀请码及接口
     path('admin_register_code/', views.admin_register_code, name='register_code_manage'),  # 注册邀请码管理
     path('api/register_code/', views.AdminRegisterCodeApi.as_view(), name="api_admin_register_code"),  # 注册邀请码接口
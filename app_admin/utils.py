@@ -9,7 +9,7 @@ from django.conf import settings
 from django.urls import resolve,Resolver404
 from email.mime.text import MIMEText
 from email.header import Header
-from app_admin.models import SysSetting
+from app_admin.setting_utils import get_setting
 from loguru import logger
 from cryptography.fernet import Fernet
 import random
@@ -26,23 +26,19 @@ def generate_vcode(n=6):
 
 # 发送电子邮件
 def send_email(to_email,vcode_str):
-    email_enable = SysSetting.objects.get(types="basic",name='enable_email')
-    if email_enable.value == 'on':
-        smtp_host = SysSetting.objects.get(types='email',name='smtp_host').value
-        send_emailer = SysSetting.objects.get(types='email', name='send_emailer').value
-        smtp_port = SysSetting.objects.get(types='email', name='smtp_port').value
-        username = SysSetting.objects.get(types='email', name='username').value
-        pwd = SysSetting.objects.get(types='email', name='pwd').value
-        ssl = SysSetting.objects.get(types='email',name='smtp_ssl').value
+    if get_setting('enable_email',types='basic') == 'on':
+        smtp_host = get_setting('smtp_host',types='email')
+        send_emailer = get_setting('send_emailer',types='email')
+        smtp_port = get_setting('smtp_port',types='email')
+        username = get_setting('username',types='email')
+        pwd = get_setting('pwd',types='email')
+        ssl = get_setting('smtp_ssl',types='email')
         # print(smtp_host,smtp_port,send_emailer,username,pwd)
 
         msg_from = send_emailer  # 发件人邮箱
         passwd = dectry(pwd)  # 发件人邮箱密码
         msg_to = to_email  # 收件人邮箱
-        try:
-            sitename = SysSetting.objects.get(types="basic",name="site_name").value
-        except:
-            sitename = "MrDoc"
+        sitename = get_setting('site_name','MrDoc',types='basic')
         subject = "MrDoc - 重置密码验证码"
         content = "你的验证码为：{}，验证码30分钟内有效！".format(vcode_str)
         msg = MIMEText(content, _subtype='html', _charset='utf-8')
@@ -22,6 +22,11 @@ from app_api.permissions_app import SuperUserPermission # 自定义权限
 from app_admin.decorators import superuser_only,open_register
 from app_doc.models import *
 from app_doc.views import jsonXssFilter
+from app_doc.access_utils import sync_project_role_users,bump_access_version
+from app_doc.stats_utils import attach_project_stats
+from app_doc.search.index_queue import get_index_queue_stats
+from app_doc.image_utils import delete_images
+from app_admin.setting_utils import get_setting
 from app_admin.models import *
 from app_admin.utils import *
 from loguru import logger
@@ -72,8 +77,7 @@ def log_in(request):
                 errormsg = _('密码长度不符！')
                 return render(request, 'login.html', locals())
             # 判断是否需要验证码
-            require_login_check_code = SysSetting.objects.filter(types="basic",name="enable_login_check_code")
-            if (len(require_login_check_code) > 0) and (require_login_check_code[0].value == 'on'):
+            if get_setting('enable_login_check_code',types='basic') == 'on':
                 checkcode = request.POST.get("check_code", None)
                 if checkcode.lower() != request.session['CheckCode'].lower():
                     errormsg = _('验证码错误！')
@@ -146,8 +150,8 @@ def register(request):
             if len(password) > 50:
                 errormsg = _('密码长度不符！')
                 return render(request, 'register.html', locals())
-            is_register_code = SysSetting.objects.filter(types='basic', name='enable_register_code', value='on')
-            if is_register_code.exists(): # 开启了注册码设置
+            enable_register_code = get_setting('enable_register_code',types='basic') == 'on' # 是否开启了注册码设置
+            if enable_register_code:
                 register_code = request.POST.get("register_code", None)
                 if len(register_code) > 255:
                     errormsg = _('注册码无效!')
@@ -194,7 +198,7 @@ def register(request):
                         # 登录用户
                         user = authenticate(username=username, password=password)
                         # 注册码数据更新
-                        if is_register_code.exists():
+                        if enable_register_code:
                             r_all_cnt = register_code_value.all_cnt # 注册码的最大使用次数
                             r_used_cnt = register_code_value.used_cnt + 1 # 更新注册码的已使用次数
                             r_use_user = register_code_value.user_list # 注册码的使用用户
@@ -342,10 +346,7 @@ def send_email_test(request):
 
     msg_from = send_emailer  # 发件人邮箱
     msg_to = send_emailer  # 收件人邮箱
-    try:
-        sitename = SysSetting.objects.get(types="basic", name="site_name").value
-    except:
-        sitename = "MrDoc"
+    sitename = get_setting('site_name','MrDoc',types='basic')
     subject = "{sitename} - 邮箱配置测试".format(sitename=sitename)
     content = "此邮件由管理员配置【{sitename}】邮箱信息时发出！".format(sitename=sitename)
     msg = MIMEText(content, _subtype='html', _charset='utf-8')
@@ -391,6 +392,12 @@ def admin_overview(request):
     else:
         pass
 
+# 后台管理 - 全文索引队列状态
+@superuser_only
+@require_GET
+def admin_search_index_status(request):
+    return JsonResponse({'status':True,'data':get_index_queue_stats()})
+
 # 后台管理 - 用户管理HTML
 @superuser_only
 @logger.catch()
@@ -589,9 +596,9 @@ def admin_project(request):
         limit = request.POST.get('limit', 10)
         # 获取文集列表
         if kw == '':
-            project_list = Project.objects.all().order_by('-create_time')
+            project_list = Project.objects.select_related('create_user').order_by('-create_time')
         else:
-            project_list = Project.objects.filter(
+            project_list = Project.objects.select_related('create_user').filter(
                 Q(intro__icontains=kw) | Q(name__icontains=kw),
             ).order_by('-create_time')
         paginator = Paginator(project_list, limit)
@@ -602,15 +609,16 @@ def admin_project(request):
         except EmptyPage:
             pros = paginator.page(paginator.num_pages)
         table_data = []
-        for project in pros:
+        # 批量获取当前页文集的文档数量和协作者数量
+        for project in attach_project_stats(pros,doc_status=None,collaborators=True):
             item = {
                 'id': project.id,
                 'name': project.name,
                 'intro': project.intro,
-                'doc_total': Doc.objects.filter(top_doc=project.id).count(),
+                'doc_total': project.doc_cnt,
                 'role': project.role,
                 'role_value': project.role_value,
-                'colla_total': ProjectCollaborator.objects.filter(project=project).count(),
+                'colla_total': project.colla_cnt,
                 'is_top':project.is_top,
                 'create_user':project.create_user.username,
                 'create_time': project.create_time,
@@ -620,7 +628,7 @@ def admin_project(request):
         resp_data = {
             "code": 0,
             "msg": "ok",
-            "count": project_list.count(),
+            "count": paginator.count,
             "data": table_data
         }
         return JsonResponse(resp_data)
@@ -655,6 +663,7 @@ def admin_project_role(request,pro_id):
                     modify_time=datetime.datetime.now()
                 )
             pro = Project.objects.get(id=int(pro_id))
+            sync_project_role_users(pro) # 同步文集的指定可见用户
             return render(request, 'app_admin/admin_project_role.html', locals())
         else:
             raise Http404
@@ -719,6 +728,7 @@ def admin_project_colla_config(request,pro_id):
                 user = User.objects.get(username=username)
                 pro_colla = ProjectCollaborator.objects.filter(project=project[0], user=user)
                 pro_colla.update(role=role)
+                bump_access_version()
                 return JsonResponse({'status':True,'data':_('修改成功')})
             except:
                 logger.exception(_("修改协作权限出错"))
@@ -1090,7 +1100,7 @@ class AdminImageList(APIView):
         page = PageNumberPagination()  # 实例化一个分页器
         page.page_size = limit
         page_imgs = page.paginate_queryset(img_data, request, view=self)  # 进行分页查询
-        serializer = ImageSerializer(page_imgs, many=True)  # 对分页后的结果进行序列化处理
+        serializer = ImageSerializer(page_imgs, many=True, context={'request': request})  # 对分页后的结果进行序列化处理
         resp = {
             'code': 0,
             'data': serializer.data,
@@ -1103,13 +1113,8 @@ class AdminImageList(APIView):
     def delete(self,request):
         ids = request.data.get('id','').split(',')
         try:
-            image = Image.objects.filter(id__in=ids)  # 查询附件
-            for a in image:  # 遍历附件
-                file_path = settings.BASE_DIR + a.file_path
-                is_exist = os.path.exists(file_path)
-                if is_exist:
-                    os.remove(file_path)
-            image.delete()  # 删除数据库记录
+            image = Image.objects.filter(id__in=ids)  # 查询图片
+            delete_images(image)  # 删除数据库记录，没有其他图片引用时删除文件
             return JsonResponse({'code': 0, 'data': _('删除成功')})
         except Exception as e:
             logger.exception("删除图片异常")
@@ -1123,13 +1128,8 @@ class AdminImageDetail(APIView):
     # 删除图片
     def delete(self,request,id):
         try:
-            image = Image.objects.filter(id=id)  # 查询附件
-            for a in image:  # 遍历附件
-                file_path = settings.BASE_DIR + a.file_path
-                is_exist = os.path.exists(file_path)
-                if is_exist:
-                    os.remove(file_path)
-            image.delete()  # 删除数据库记录
+            image = Image.objects.filter(id=id)  # 查询图片
+            delete_images(image)  # 删除数据库记录，没有其他图片引用时删除文件
             return JsonResponse({'code': 0, 'data': _('删除成功')})
         except Exception as e:
             logger.exception("删除图片异常")
@@ -0,0 +1,260 @@
+# coding:utf-8
+# @文件: client_utils.py
+# AI接口客户端
+# Dify 和 OpenAI 兼容接口的客户端按 (接口地址, 密钥指纹) 缓存复用，在首次使用时创建；
+# 同一接口地址的客户端共用一个保持长连接的连接池，连接池大小和超时由 [ai] 配置指定；
+# 会话保存的加密密钥解密后在内存中缓存，AI接入设置保存后清空缓存；
+# 异步客户端的连接池与事件循环绑定，按事件循环分别缓存
+
+from django.conf import settings
+from dify_client import Client as DifyClient, AsyncClient as AsyncDifyClient, errors as dify_errors
+from dify_client._clientx import IGNORED_STREAM_EVENTS, _check_stream_content_type
+from httpx_sse import connect_sse, aconnect_sse
+from pydantic import PrivateAttr
+from collections import OrderedDict
+from urllib.parse import urlsplit
+from app_admin.utils import decrypt_data
+import threading
+import hashlib
+import asyncio
+import weakref
+import httpx
+
+# 新版 openai 使用 httpx2 作为 HTTP 客户端
+try:
+    import httpx2 as openai_httpx
+except ImportError:
+    import httpx as openai_httpx
+
+# 缓存的客户端和解密密钥的数量上限
+AI_CLIENT_CACHE_SIZE = 128
+
+
+# 使用指定连接池的 Dify 客户端
+class PooledDifyClient(DifyClient):
+    _http_client = PrivateAttr()
+
+    def __init__(self, http_client, **data):
+        super().__init__(**data)
+        self._http_client = http_client
+
+    # endpoint 为相对路径（如 /messages）时拼接接口地址
+    def _prepare_endpoint(self, endpoint):
+        if endpoint.startswith('/'):
+            return self.api_base.rstrip('/') + endpoint
+        return endpoint
+
+    def request(self, endpoint, method, content=None, data=None, files=None, json=None,
+                params=None, headers=None, **kwargs):
+        merged_headers = dict(headers or {})
+        self._prepare_auth_headers(merged_headers)
+        response = self._http_client.request(
+            method, self._prepare_endpoint(endpoint), content=content, data=data, files=files, json=json,
+            params=params, headers=merged_headers, **kwargs
+        )
+        dify_errors.raise_for_status(response)
+        return response
+
+    def request_stream(self, endpoint, method, content=None, data=None, files=None, json=None,
+                       params=None, headers=None, **kwargs):
+        merged_headers = dict(headers or {})
+        self._prepare_auth_headers(merged_headers)
+        with connect_sse(self._http_client, method, self._prepare_endpoint(endpoint), headers=merged_headers,
+                         content=content, data=data, files=files, json=json, params=params, **kwargs) as event_source:
+            if not _check_stream_content_type(event_source.response):
+                event_source.response.read()
+                dify_errors.raise_for_status(event_source.response)
+            for sse in event_source.iter_sse():
+                dify_errors.raise_for_status(sse)
+                if sse.event in IGNORED_STREAM_EVENTS or sse.data in IGNORED_STREAM_EVENTS:
+                    continue
+                yield sse
+
+
+# 使用指定连接池的 Dify 异步客户端
+class PooledAsyncDifyClient(AsyncDifyClient):
+    _http_client = PrivateAttr()
+
+    def __init__(self, http_client, **data):
+        super().__init__(**data)
+        self._http_client = http_client
+
+    def _prepare_endpoint(self, endpoint):
+        if endpoint.startswith('/'):
+            return self.api_base.rstrip('/') + endpoint
+        return endpoint
+
+    async def arequest(self, endpoint, method, content=None, data=None, files=None, json=None,
+                       params=None, headers=None, **kwargs):
+        merged_headers = dict(headers or {})
+        self._prepare_auth_headers(merged_headers)
+        response = await self._http_client.request(
+            method, self._prepare_endpoint(endpoint), content=content, data=data, files=files, json=json,
+            params=params, headers=merged_headers, **kwargs
+        )
+        dify_errors.raise_for_status(response)
+        return response
+
+    async def arequest_stream(self, endpoint, method, content=None, data=None, files=None, json=None,
+                              params=None, headers=None, **kwargs):
+        merged_headers = dict(headers or {})
+        self._prepare_auth_headers(merged_headers)
+        async with aconnect_sse(self._http_client, method, self._prepare_endpoint(endpoint), headers=merged_headers,
+                                content=content, data=data, files=files, json=json, params=params,
+                                **kwargs) as event_source:
+            if not _check_stream_content_type(event_source.response):
+                await event_source.response.aread()
+                dify_errors.raise_for_status(event_source.response)
+            async for sse in event_source.aiter_sse():
+                dify_errors.raise_for_status(sse)
+                if sse.event in IGNORED_STREAM_EVENTS or sse.data in IGNORED_STREAM_EVENTS:
+                    continue
+                yield sse
+
+
+# 上游服务的连接池配置
+def get_upstream_options(api_base):
+    options = dict(settings.AI_HTTP_OPTIONS)
+    options.update(settings.AI_HTTP_UPSTREAMS.get(urlsplit(api_base).netloc, {}))
+    return options
+
+
+# API密钥的指纹，客户端缓存中不保存明文密钥
+def key_fingerprint(api_key):
+    return hashlib.sha256((api_key or '').encode('utf-8')).hexdigest()[:16]
+
+
+# AI接口客户端注册表
+class AIClientRegistry():
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.http_clients = {} # (HTTP库, 接口源地址) → 连接池
+        self.clients = OrderedDict() # (客户端类型, 接口地址, 密钥指纹) → 客户端
+        self.api_keys = OrderedDict() # 加密密钥 → 明文密钥
+        self.loop_clients = weakref.WeakKeyDictionary() # 事件循环 → {键: 异步连接池或客户端}
+
+    # 获取接口地址的连接池，module 为 httpx 或 openai 使用的 HTTP 库
+    def get_http_client(self, api_base, module=httpx):
+        parts = urlsplit(api_base)
+        key = (module.__name__, parts.scheme, parts.netloc)
+        with self.lock:
+            http_client = self.http_clients.get(key)
+            if http_client is None:
+                options = get_upstream_options(api_base)
+                pool_size = int(options['pool_size'])
+                http_client = module.Client(
+                    limits=module.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+                    timeout=module.Timeout(options['read_timeout'], connect=options['connect_timeout']),
+                )
+                self.http_clients[key] = http_client
+            return http_client
+
+    # 获取当前事件循环中缓存的异步连接池或客户端，不存在时调用 build 创建
+    def get_loop_client(self, key, build):
+        loop = asyncio.get_running_loop()
+        with self.lock:
+            clients = self.loop_clients.setdefault(loop, {})
+            client = clients.get(key)
+        if client is None:
+            client = build()
+            with self.lock:
+                client = clients.setdefault(key, client)
+        return client
+
+    # 获取接口地址的异步连接池
+    def get_async_http_client(self, api_base, module=httpx):
+        parts = urlsplit(api_base)
+
+        def build():
+            options = get_upstream_options(api_base)
+            # 异步流式请求的连接数上限，空闲的长连接数与同步连接池相同
+            return module.AsyncClient(
+                limits=module.Limits(
+                    max_connections=int(options['async_pool_size']),
+                    max_keepalive_connections=int(options['pool_size'])
+                ),
+                timeout=module.Timeout(options['read_timeout'], connect=options['connect_timeout']),
+            )
+        return self.get_loop_client((module.__name__, parts.scheme, parts.netloc), build)
+
+    # 获取缓存的客户端，不存在时调用 build 创建
+    def get_client(self, key, build):
+        with self.lock:
+            client = self.clients.get(key)
+            if client is not None:
+                self.clients.move_to_end(key)
+                return client
+        client = build()
+        with self.lock:
+            client = self.clients.setdefault(key, client)
+            while len(self.clients) > AI_CLIENT_CACHE_SIZE:
+                self.clients.popitem(last=False)
+        return client
+
+    # 获取 Dify 客户端
+    def get_dify_client(self, api_base, api_key):
+        return self.get_client(
+            ('dify', api_base, key_fingerprint(api_key)),
+            lambda: PooledDifyClient(self.get_http_client(api_base), api_key=api_key, api_base=api_base)
+        )
+
+    # 获取 OpenAI 兼容接口客户端
+    def get_openai_client(self, base_url, api_key):
+        from openai import OpenAI
+        return self.get_client(
+            ('openai', base_url, key_fingerprint(api_key)),
+            lambda: OpenAI(
+                base_url=base_url or None, api_key=api_key,
+                http_client=self.get_http_client(base_url, openai_httpx)
+            )
+        )
+
+    # 获取 Dify 异步客户端，需在事件循环中调用
+    def get_async_dify_client(self, api_base, api_key):
+        return PooledAsyncDifyClient(self.get_async_http_client(api_base), api_key=api_key, api_base=api_base)
+
+    # 获取 OpenAI 兼容接口异步客户端，需在事件循环中调用
+    def get_async_openai_client(self, base_url, api_key):
+        from openai import AsyncOpenAI
+        return self.get_loop_client(
+            ('openai', base_url, key_fingerprint(api_key)),
+            lambda: AsyncOpenAI(
+                base_url=base_url or None, api_key=api_key,
+                http_client=self.get_async_http_client(base_url, openai_httpx)
+            )
+        )
+
+    # 解密API密钥，解密结果在内存中缓存
+    def decrypt_api_key(self, encrypted_key):
+        with self.lock:
+            api_key = self.api_keys.get(encrypted_key)
+            if api_key is not None:
+                self.api_keys.move_to_end(encrypted_key)
+                return api_key
+        api_key = decrypt_data(encrypted_key)
+        with self.lock:
+            self.api_keys[encrypted_key] = api_key
+            while len(self.api_keys) > AI_CLIENT_CACHE_SIZE:
+                self.api_keys.popitem(last=False)
+        return api_key
+
+    # 清空缓存的客户端和密钥，连接池可能正被进行中的流式请求使用，不主动关闭
+    def reset(self):
+        with self.lock:
+            self.http_clients.clear()
+            self.clients.clear()
+            self.api_keys.clear()
+            self.loop_clients.clear()
+
+
+_ai_clients = None
+_ai_clients_lock = threading.Lock()
+
+
+# 获取进程内的AI接口客户端注册表
+def get_ai_clients():
+    global _ai_clients
+    with _ai_clients_lock:
+        if _ai_clients is None:
+            _ai_clients = AIClientRegistry()
+    return _ai_clients
@@ -0,0 +1,139 @@
+# coding:utf-8
+# @文件: message_utils.py
+# Dify会话消息记录
+# 会话的消息记录从本地消息表按 (创建时间, ID) 倒序分页读取，游标为上一页最早一条消息的创建时间和ID；
+# 本地消息表与 Dify 增量同步：从最新一页向前拉取，遇到上次同步的最后一条消息为止，
+# 拉取的消息通过一次 bulk_create(update_conflicts=True) 写入，已保存的消息按 (Dify消息ID, 角色) 更新；
+# 发送失败或中断时保存的用户消息没有 Dify 消息ID，同步到内容相同的提问时删除，避免重复显示
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Q
+from django.utils import timezone
+from app_ai.models import DifyMessage
+import datetime
+
+# 每页消息数量的默认值和上限
+MESSAGE_PAGE_SIZE = 20
+MESSAGE_PAGE_SIZE_MAX = 100
+# 从 Dify 拉取消息时每页的数量
+DIFY_MESSAGE_PAGE_SIZE = 100
+
+MESSAGE_FIELDS = ('id', 'role', 'content', 'message_id', 'created_at')
+
+
+# 消息分页游标
+def message_cursor(created_at, pk):
+    if timezone.is_aware(created_at):
+        created_at = timezone.make_naive(created_at, datetime.timezone.utc)
+    return '{}_{}'.format(created_at.strftime('%Y%m%d%H%M%S%f'), pk)
+
+
+# 解析消息分页游标，返回 (创建时间, ID)，格式错误时抛出 ValueError
+def parse_message_cursor(cursor):
+    value, pk = cursor.split('_')
+    created_at = datetime.datetime.strptime(value, '%Y%m%d%H%M%S%f')
+    if settings.USE_TZ:
+        created_at = timezone.make_aware(created_at, datetime.timezone.utc)
+    return created_at, int(pk)
+
+
+# 获取会话的一页消息
+def get_message_page(conversation, cursor=None, limit=MESSAGE_PAGE_SIZE):
+    """
+    cursor 为空时返回最新的 limit 条消息，否则返回游标之前的 limit 条消息，
+    返回 {'data': 按时间正序排列的消息列表, 'has_more': 是否有更早的消息, 'cursor': 获取更早消息的游标}
+    """
+    messages = DifyMessage.objects.filter(conversation=conversation)
+    if cursor:
+        created_at, pk = parse_message_cursor(cursor)
+        messages = messages.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=pk))
+    rows = list(messages.order_by('-created_at', '-id').values(*MESSAGE_FIELDS)[:limit + 1])
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    rows.reverse()
+    return {
+        'data': rows,
+        'has_more': has_more,
+        'cursor': message_cursor(rows[0]['created_at'], rows[0]['id']) if has_more else None,
+    }
+
+
+# 会话是否需要从 Dify 同步消息
+def need_sync(conversation):
+    if not conversation.conversation_id:
+        return False
+    if conversation.synced_at is None:
+        return True
+    return timezone.now() - conversation.synced_at > datetime.timedelta(seconds=settings.AI_MESSAGE_SYNC_INTERVAL)
+
+
+# 将 Dify 消息的时间戳转换为本地保存的时间
+def dify_timestamp(value):
+    created_at = datetime.datetime.fromtimestamp(value, tz=datetime.timezone.utc)
+    if not settings.USE_TZ:
+        created_at = timezone.make_naive(created_at)
+    return created_at
+
+
+# 从 Dify 拉取上次同步之后的消息，按时间正序返回
+def fetch_new_messages(conversation, dify_client, user_identifier):
+    pages = []
+    first_id = None
+    while True:
+        params = {
+            'conversation_id': conversation.conversation_id,
+            'user': user_identifier,
+            'limit': DIFY_MESSAGE_PAGE_SIZE,
+        }
+        if first_id:
+            params['first_id'] = first_id
+        data = dify_client.request(endpoint='/messages', method='GET', params=params).json()
+        page = data.get('data') or []
+        ids = [msg.get('id') for msg in page]
+        if conversation.last_message_id in ids:
+            pages.append(page[ids.index(conversation.last_message_id) + 1:])
+            break
+        pages.append(page)
+        if not page or not data.get('has_more'):
+            break
+        # 继续拉取更早的一页
+        first_id = ids[0]
+    return [msg for page in reversed(pages) for msg in page]
+
+
+# 从 Dify 增量同步会话消息，返回同步的 Dify 消息数量
+def sync_conversation_messages(conversation, dify_client, user_identifier):
+    if not conversation.conversation_id:
+        return 0
+    new_messages = fetch_new_messages(conversation, dify_client, user_identifier)
+    rows = []
+    for msg in new_messages:
+        created_at = dify_timestamp(msg.get('created_at') or 0)
+        # 每条 Dify 消息包含用户的提问和助手的回答
+        for role, content in (('user', msg.get('query')), ('assistant', msg.get('answer'))):
+            if content:
+                rows.append(DifyMessage(
+                    conversation=conversation, role=role, content=content,
+                    message_id=msg.get('id'), created_at=created_at
+                ))
+    if rows:
+        # 删除已同步提问对应的、没有 Dify 消息ID的用户消息
+        queries = {row.content for row in rows if row.role == 'user'}
+        if queries:
+            DifyMessage.objects.filter(
+                conversation=conversation, role='user', message_id__isnull=True, content__in=queries
+            ).delete()
+        # MySQL 的 ON DUPLICATE KEY UPDATE 不指定唯一字段
+        unique_fields = ['message_id', 'role']
+        if not connection.features.supports_update_conflicts_with_target:
+            unique_fields = None
+        DifyMessage.objects.bulk_create(
+            rows, update_conflicts=True,
+            unique_fields=unique_fields, update_fields=['content', 'created_at']
+        )
+    if new_messages:
+        conversation.last_message_id = new_messages[-1].get('id')
+    conversation.synced_at = timezone.now()
+    conversation.save(update_fields=['last_message_id', 'synced_at'])
+    return len(new_messages)
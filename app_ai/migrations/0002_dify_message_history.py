@@ -0,0 +1,41 @@
+# Generated by Django 4.2.30 on 2026-10-18 05:25
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app_ai', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='difymessage',
+            options={'ordering': ['created_at', 'id'], 'verbose_name': 'Dify对话消息', 'verbose_name_plural': 'Dify对话消息'},
+        ),
+        migrations.AddField(
+            model_name='difyconversation',
+            name='last_message_id',
+            field=models.CharField(blank=True, max_length=255, null=True, verbose_name='最后同步的Dify消息ID'),
+        ),
+        migrations.AddField(
+            model_name='difyconversation',
+            name='synced_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='消息同步时间'),
+        ),
+        migrations.AlterField(
+            model_name='difymessage',
+            name='created_at',
+            field=models.DateTimeField(default=django.utils.timezone.now, verbose_name='创建时间'),
+        ),
+        migrations.AddIndex(
+            model_name='difymessage',
+            index=models.Index(fields=['conversation', 'created_at', 'id'], name='dify_message_conv_created'),
+        ),
+        migrations.AddConstraint(
+            model_name='difymessage',
+            constraint=models.UniqueConstraint(fields=('message_id', 'role'), name='dify_message_unique_id_role'),
+        ),
+    ]
@@ -1,5 +1,6 @@
 from django.db import models
 from django.contrib.auth import get_user_model
+from django.utils import timezone
 
 User = get_user_model()
 
@@ -39,6 +40,17 @@ class DifyConversation(models.Model):
         auto_now=True,
         verbose_name='更新时间'
     )
+    last_message_id = models.CharField(
+        max_length=255,
+        null=True,
+        blank=True,
+        verbose_name='最后同步的Dify消息ID'
+    )
+    synced_at = models.DateTimeField(
+        null=True,
+        blank=True,
+        verbose_name='消息同步时间'
+    )
 
     class Meta:
         db_table = 'dify_conversation'
@@ -77,8 +89,9 @@ class DifyMessage(models.Model):
         blank=True,
         verbose_name='Dify消息ID'
     )
+    # 从 Dify 同步的消息使用 Dify 中的创建时间
     created_at = models.DateTimeField(
-        auto_now_add=True,
+        default=timezone.now,
         verbose_name='创建时间'
     )
 
@@ -86,7 +99,15 @@ class DifyMessage(models.Model):
         db_table = 'dify_message'
         verbose_name = 'Dify对话消息'
         verbose_name_plural = verbose_name
-        ordering = ['created_at']
+        ordering = ['created_at', 'id']
+        indexes = [
+            # 按会话分页读取消息
+            models.Index(fields=['conversation', 'created_at', 'id'], name='dify_message_conv_created'),
+        ]
+        constraints = [
+            # 同一条 Dify 消息的提问和回答各保存一行
+            models.UniqueConstraint(fields=['message_id', 'role'], name='dify_message_unique_id_role'),
+        ]
 
     def __str__(self):
         return f"{self.role}: {self.content[:50]}"
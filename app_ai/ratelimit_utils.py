@@ -0,0 +1,160 @@
+# coding:utf-8
+# @文件: ratelimit_utils.py
+# AI接口请求频率和并发数限制
+# 请求频率按固定时间窗口计数，每个窗口只有一个计数器，通过 cache.add 创建、cache.incr 原子递增，多进程共用同一计数；
+# 同时进行的流式生成按开始时间分段计数，开始时递增、结束时递减，进程异常退出未递减的计数在两个分段后不再计入；
+# 数据库缓存和文件缓存的 incr 为先读后写，改为在 cache.add 实现的锁内读写计数器；
+# 等待计数器锁超时或计数器写入失败时不计数并放行请求（fail-open），避免缓存故障导致AI功能不可用
+
+from django.core.cache import cache,caches
+from django.core.cache.backends.db import DatabaseCache
+from django.core.cache.backends.filebased import FileBasedCache
+from django.http.response import JsonResponse
+from asgiref.sync import sync_to_async
+from contextlib import contextmanager
+from loguru import logger
+import math
+import time
+
+# 请求频率限制的时间窗口，秒数
+RATE_LIMIT_WINDOW = 60
+# 达到流式生成并发上限时建议客户端等待的秒数
+STREAM_RETRY_AFTER = 10
+# 计数器锁的有效期，秒数，持有锁的进程异常退出时锁在到期后失效
+COUNTER_LOCK_TIMEOUT = 5
+# 等待计数器锁的最长秒数
+COUNTER_LOCK_WAIT = 2
+# 计数器写入失败时的最多重试次数
+COUNTER_WRITE_RETRIES = 5
+
+
+# 计数器锁等待超时或计数器写入失败
+class CounterUnavailable(Exception):
+    pass
+
+
+# 缓存的 incr 是否为原子操作（Redis、Memcached 和本地内存缓存）
+def atomic_incr_supported():
+    return not isinstance(caches['default'], (DatabaseCache, FileBasedCache))
+
+
+# 计数器锁，超过 wait 秒未获取到锁时抛出 CounterUnavailable
+@contextmanager
+def counter_lock(key, wait=None):
+    lock_key = '{}_lock'.format(key)
+    deadline = time.monotonic() + (COUNTER_LOCK_WAIT if wait is None else wait)
+    while not cache.add(lock_key, 1, COUNTER_LOCK_TIMEOUT):
+        if time.monotonic() >= deadline:
+            raise CounterUnavailable('等待计数器锁超时：{}'.format(key))
+        time.sleep(0.002)
+    try:
+        yield
+    finally:
+        cache.delete(lock_key)
+
+
+# 计数器加上 delta 并返回新值，计数器不存在时从 0 开始并设置有效期 timeout；
+# create 为 False 时不创建计数器，计数器不存在（已过期）时返回 None；
+# 计数器锁等待超时或写入失败时计数器不变，返回 None，调用方按未计数放行
+def incr_counter(key, delta=1, timeout=None, create=True):
+    if atomic_incr_supported():
+        try:
+            return cache.incr(key, delta)
+        except ValueError:
+            if not create:
+                return None
+            cache.add(key, 0, timeout)
+            return cache.incr(key, delta)
+    try:
+        with counter_lock(key):
+            value = cache.get(key)
+            if value is None and not create:
+                return None
+            value = (value or 0) + delta
+            # 数据库缓存写入冲突（如 SQLite 的写锁）时 set 不报错，确认写入成功
+            for i in range(COUNTER_WRITE_RETRIES):
+                cache.set(key, value, timeout)
+                if cache.get(key) == value:
+                    return value
+            raise CounterUnavailable('计数器写入失败：{}'.format(key))
+    except CounterUnavailable as e:
+        logger.warning('{}，本次不计数'.format(e))
+        return None
+
+
+# 记录一次请求，超过每个时间窗口 limit 次的限制时返回需要等待的秒数，否则返回 None
+def hit_rate_limit(name, limit, window=RATE_LIMIT_WINDOW):
+    now = time.time()
+    window_start = int(now // window) * window
+    count = incr_counter('ai_rate_{}_{}'.format(name, window_start), timeout=window + 1)
+    if count is not None and count > limit:
+        return max(1, math.ceil(window_start + window - now))
+    return None
+
+
+# 流式生成名额
+class StreamLease():
+    def __init__(self, keys):
+        self.keys = keys # 已递增的计数器
+        self.released = False
+
+    # 释放名额，重复调用只释放一次
+    def release(self):
+        if self.released:
+            return
+        self.released = True
+        for key in self.keys:
+            incr_counter(key, -1, create=False)
+
+
+# 获取流式生成名额
+def acquire_stream(limits, duration):
+    """
+    limits：[(名称, 上限)]，如每个用户和全局的并发上限；
+    duration：流式生成的最长秒数，计数按该时长分段，只统计当前和上一分段开始的生成；
+    全部未达到上限时返回 StreamLease，否则返回 None
+    """
+    bucket = int(time.time() // duration)
+    lease = StreamLease([])
+    for name, limit in limits:
+        key = 'ai_streams_{}_{}'.format(name, bucket)
+        count = incr_counter(key, timeout=duration * 2 + 1)
+        if count is None:
+            continue
+        lease.keys.append(key)
+        previous = cache.get('ai_streams_{}_{}'.format(name, bucket - 1), 0)
+        if count + max(previous, 0) > limit:
+            lease.release()
+            return None
+    return lease
+
+
+# 迭代完成、出错或被关闭时释放名额的流式内容，支持同步和异步生成器
+def leased_stream(stream, lease):
+    if hasattr(stream, '__aiter__'):
+        return _aleased_stream(stream, lease)
+    return _leased_stream(stream, lease)
+
+
+def _leased_stream(stream, lease):
+    try:
+        yield from stream
+    finally:
+        lease.release()
+
+
+async def _aleased_stream(stream, lease):
+    try:
+        async for chunk in stream:
+            yield chunk
+    finally:
+        await stream.aclose()
+        if lease.keys:
+            await sync_to_async(lease.release)()
+
+
+# 超过限制时的响应，Retry-After 为建议等待的秒数
+def rate_limited_response(retry_after, message='已超过请求频率限制，请稍后再使用！'):
+    response = JsonResponse({'status': False, 'data': message}, status=429)
+    response['Retry-After'] = str(retry_after)
+    return response
@@ -1,3 +1,515 @@
-from django.test import TestCase
+from django.test import TestCase,RequestFactory,override_settings
+from django.urls import path,include
+from django.core.cache import cache
+from django.conf import settings
+from django.contrib.auth.models import User
+from app_admin.models import SysSetting
+from app_admin.utils import encrypt_data
+from app_ai.models import DifyConversation,DifyMessage
+from app_ai.client_utils import get_ai_clients,get_upstream_options
+from app_ai.views import get_dify_client,check_rate_limit,acquire_stream_lease,dify_send_message
+from app_ai.ratelimit_utils import hit_rate_limit,leased_stream,incr_counter,COUNTER_WRITE_RETRIES
+from app_ai.message_utils import get_message_page,sync_conversation_messages
+from app_ai import views_async
+from asgiref.sync import sync_to_async
+from MrDoc.asgi import application
+from http.server import ThreadingHTTPServer,BaseHTTPRequestHandler
+from urllib.parse import urlsplit,parse_qs
+from unittest import mock
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import asyncio
+import subprocess
+import tempfile
+import shutil
+import json
+import time
+import sys
+import os
 
 # Create your tests here.
+
+# 异步视图测试使用的路由
+urlpatterns = [
+    path('ai/text_generate/',views_async.ai_text_genarate),
+    path('',include('MrDoc.urls')),
+]
+
+
+# 模拟的 Dify 接口服务
+class FakeDifyHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    requests = []
+
+    def do_GET(self):
+        self.requests.append((self.path,self.headers.get('Authorization'),self.client_address[1]))
+        body = json.dumps({'opening_statement':'hello'}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type','application/json')
+        self.send_header('Content-Length',str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+# AI接口客户端
+class AIClientRegistryTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        get_ai_clients().reset()
+        self.addCleanup(get_ai_clients().reset)
+        FakeDifyHandler.requests = []
+        self.server = ThreadingHTTPServer(('127.0.0.1',0),FakeDifyHandler)
+        threading.Thread(target=self.server.serve_forever,daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.api_base = 'http://127.0.0.1:{}/v1'.format(self.server.server_address[1])
+        SysSetting.objects.create(name='ai_dify_api_address',value=self.api_base,types='ai')
+        SysSetting.objects.create(name='ai_dify_chat_api_key',value=encrypt_data('app-key'),types='ai')
+        self.user = User.objects.create_superuser(username='ai_user',password='ai_pwd')
+        self.client.login(username='ai_user',password='ai_pwd')
+
+    def test_client_reuse(self):
+        self.assertIs(get_dify_client(),get_dify_client())
+        for i in range(3):
+            data = self.client.get('/ai/dify/app/info/').json()
+            self.assertTrue(data['status'])
+            self.assertEqual(data['data']['opening_statement'],'hello')
+        # 请求使用会话的密钥，并复用同一个长连接
+        self.assertEqual({r[:2] for r in FakeDifyHandler.requests},{('/v1/parameters?user=user_{}'.format(self.user.id),'Bearer app-key')})
+        self.assertEqual(len({r[2] for r in FakeDifyHandler.requests}),1)
+        # 不同密钥使用不同的客户端，共用连接池
+        other = get_ai_clients().get_dify_client(self.api_base,'other-key')
+        self.assertIsNot(other,get_dify_client())
+        self.assertIs(other._http_client,get_dify_client()._http_client)
+        # OpenAI 客户端在首次使用时才创建
+        self.assertFalse([k for k in get_ai_clients().clients if k[0] == 'openai'])
+
+    def test_decrypt_cache(self):
+        conversation = DifyConversation(
+            user=self.user,app_api_key=encrypt_data('conv-key'),dify_api_address=self.api_base
+        )
+        with mock.patch('app_ai.client_utils.decrypt_data',wraps=lambda v: 'conv-key') as decrypt:
+            for i in range(3):
+                self.assertEqual(get_dify_client(conversation).api_key,'conv-key')
+        self.assertEqual(decrypt.call_count,1)
+
+    def test_config_reset(self):
+        client = get_dify_client()
+        resp = self.client.post('/ai/config/',{'data':json.dumps([
+            {'name':'ai_dify_chat_api_key','value':'new-key','type':'ai'},
+        ])})
+        self.assertEqual(resp.json()['code'],0)
+        self.assertFalse(get_ai_clients().clients)
+        self.assertEqual(get_dify_client().api_key,'new-key')
+        self.assertIsNot(get_dify_client(),client)
+
+    def test_upstream_options(self):
+        netloc = self.api_base.split('/')[2]
+        with self.settings(AI_HTTP_UPSTREAMS={netloc:{'pool_size':2.0}}):
+            self.assertEqual(get_upstream_options(self.api_base)['pool_size'],2.0)
+            self.assertEqual(get_upstream_options('https://api.dify.ai/v1')['pool_size'],20)
+
+
+# 模拟的 Dify 流式接口，每隔 interval 秒返回一条消息
+class FakeStreamUpstream():
+    def __init__(self, events=5, interval=0.2):
+        self.events = events
+        self.interval = interval
+        self.finished = 0 # 完整返回的请求数
+        self.aborted = 0 # 客户端提前断开的请求数
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle,'127.0.0.1',0)
+        self.api_base = 'http://127.0.0.1:{}/v1'.format(self.server.sockets[0].getsockname()[1])
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def handle(self, reader, writer):
+        head = await reader.readuntil(b'\r\n\r\n')
+        length = [int(l.split(b':')[1]) for l in head.split(b'\r\n') if l.lower().startswith(b'content-length:')]
+        await reader.readexactly(length[0] if length else 0)
+        writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nConnection: close\r\n\r\n')
+        try:
+            for i in range(self.events):
+                event = {'event':'message','task_id':'t','message_id':'m','answer':str(i),'created_at':0}
+                writer.write('data: {}\n\n'.format(json.dumps(event)).encode('utf-8'))
+                await writer.drain()
+                # 等待下一条消息期间检查客户端是否已断开连接
+                try:
+                    if await asyncio.wait_for(reader.read(1),self.interval) == b'':
+                        self.aborted += 1
+                        return
+                except asyncio.TimeoutError:
+                    pass
+            self.finished += 1
+        except ConnectionError:
+            self.aborted += 1
+        finally:
+            writer.close()
+
+
+# 通过 ASGI 应用发送请求，收到 disconnect_after 个数据块后模拟客户端断开连接，返回 (状态码, 数据块列表)
+async def asgi_post(path, body, cookie='', disconnect_after=None):
+    scope = {
+        'type':'http','asgi':{'version':'3.0'},'http_version':'1.1','method':'POST','scheme':'http',
+        'path':path,'raw_path':path.encode('utf-8'),'query_string':b'','root_path':'',
+        'headers':[(b'host',b'testserver'),(b'content-type',b'application/json'),(b'cookie',cookie.encode('utf-8'))],
+        'client':('127.0.0.1',0),'server':('testserver',80),
+    }
+    disconnected = asyncio.Event()
+    body_sent = False
+    status = None
+    chunks = []
+
+    async def receive():
+        nonlocal body_sent
+        if not body_sent:
+            body_sent = True
+            return {'type':'http.request','body':body,'more_body':False}
+        await disconnected.wait()
+        return {'type':'http.disconnect'}
+
+    async def send(message):
+        nonlocal status
+        if message['type'] == 'http.response.start':
+            status = message['status']
+        elif message.get('body'):
+            chunks.append(message['body'])
+            if disconnect_after and len(chunks) >= disconnect_after:
+                disconnected.set()
+
+    await application(scope,receive,send)
+    return status,chunks
+
+
+# AI流式生成的异步视图
+@override_settings(ROOT_URLCONF='app_ai.tests')
+class AsyncStreamViewTest(TestCase):
+    def setUp(self):
+        get_ai_clients().reset()
+        self.addCleanup(get_ai_clients().reset)
+        self.upstream = None
+        SysSetting.objects.create(name='ai_frame',value='1',types='ai')
+        SysSetting.objects.create(name='ai_dify_textgenerate_api_key',value=encrypt_data('app-key'),types='ai')
+        User.objects.create_superuser(username='ai_user',password='ai_pwd')
+        self.client.login(username='ai_user',password='ai_pwd')
+        self.cookie = 'sessionid={}'.format(self.client.cookies['sessionid'].value)
+        self.body = json.dumps({'inputs':{'query':'hello'}}).encode('utf-8')
+
+    async def start_upstream(self, events, interval):
+        self.upstream = FakeStreamUpstream(events,interval)
+        await self.upstream.start()
+        await SysSetting.objects.acreate(name='ai_dify_api_address',value=self.upstream.api_base,types='ai')
+        cache.clear()
+
+    async def test_login_required(self):
+        status,chunks = await asgi_post('/ai/text_generate/',self.body)
+        self.assertEqual(status,302)
+
+    async def test_concurrent_streams(self):
+        # 每个请求约 1 秒，并发的请求共用事件循环，不额外占用线程
+        await self.start_upstream(events=5,interval=0.2)
+        threads = threading.active_count()
+        peak_threads = threads
+
+        async def sample_threads():
+            nonlocal peak_threads
+            while True:
+                peak_threads = max(peak_threads,threading.active_count())
+                await asyncio.sleep(0.05)
+
+        sampler = asyncio.ensure_future(sample_threads())
+        start = time.perf_counter()
+        try:
+            results = await asyncio.gather(*[asgi_post('/ai/text_generate/',self.body,self.cookie) for i in range(50)])
+        finally:
+            sampler.cancel()
+            await self.upstream.stop()
+        elapsed = time.perf_counter() - start
+        for status,chunks in results:
+            self.assertEqual(status,200)
+            answers = [json.loads(c.decode('utf-8')[6:])['answer'] for c in chunks]
+            self.assertEqual(answers,['0','1','2','3','4'])
+        self.assertEqual(self.upstream.finished,50)
+        self.assertLess(elapsed,3)
+        self.assertLessEqual(peak_threads - threads,2)
+
+    async def test_disconnect_cancels_upstream(self):
+        await self.start_upstream(events=50,interval=0.2)
+        start = time.perf_counter()
+        try:
+            status,chunks = await asgi_post('/ai/text_generate/',self.body,self.cookie,disconnect_after=2)
+            for i in range(20):
+                if self.upstream.aborted:
+                    break
+                await asyncio.sleep(0.05)
+        finally:
+            await self.upstream.stop()
+        self.assertEqual(status,200)
+        self.assertEqual(len(chunks),2)
+        # 客户端断开后上游请求随即关闭，而不是等待 10 秒的完整生成
+        self.assertEqual(self.upstream.aborted,1)
+        self.assertEqual(self.upstream.finished,0)
+        self.assertLess(time.perf_counter() - start,2)
+
+
+# 多进程同时请求的计数进程，使用数据库缓存在进程间共享计数
+RATE_LIMIT_WORKER = """
+import sys,time,django
+from django.conf import settings
+mode,db_path,start_at,count,limit = sys.argv[1],sys.argv[2],float(sys.argv[3]),int(sys.argv[4]),int(sys.argv[5])
+settings.configure(
+    DATABASES={'default':{'ENGINE':'django.db.backends.sqlite3','NAME':db_path,'OPTIONS':{'timeout':60}}},
+    CACHES={'default':{'BACKEND':'django.core.cache.backends.db.DatabaseCache','LOCATION':'ai_rate_cache'}},
+    USE_TZ=True,
+)
+django.setup()
+if mode == 'setup':
+    from django.core.management import call_command
+    call_command('createcachetable')
+    sys.exit()
+from app_ai import ratelimit_utils
+from app_ai.ratelimit_utils import hit_rate_limit,acquire_stream
+# 只检查计数是否准确，测试机负载较高时不因等待锁超时而放行（fail-open 由 test_counter_unavailable 测试）
+ratelimit_utils.COUNTER_LOCK_WAIT = ratelimit_utils.COUNTER_LOCK_TIMEOUT = 60
+time.sleep(max(0,start_at - time.time()))
+if mode == 'rate':
+    print(sum(hit_rate_limit('contention',limit,86400) is None for i in range(count)))
+else:
+    print(sum(acquire_stream([('contention',limit)],86400) is not None for i in range(count)))
+"""
+
+
+# AI接口请求频率和并发数限制
+class RateLimitTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.factory = RequestFactory()
+        self.users = [User.objects.create_user(username='rate_user{}'.format(i),password='pwd') for i in range(2)]
+
+    def make_request(self, user):
+        request = self.factory.post('/ai/text_generate/')
+        request.user = user
+        return request
+
+    def test_user_limit(self):
+        SysSetting.objects.create(name='ai_write_rate_limit',value='2',types='ai')
+        request = self.make_request(self.users[0])
+        self.assertIsNone(check_rate_limit(request))
+        self.assertIsNone(check_rate_limit(request))
+        resp = check_rate_limit(request)
+        self.assertEqual(resp.status_code,429)
+        self.assertEqual(json.loads(resp.content)['status'],False)
+        self.assertTrue(1 <= int(resp['Retry-After']) <= 60)
+        # 其他用户不受影响
+        self.assertIsNone(check_rate_limit(self.make_request(self.users[1])))
+
+    def test_global_limit(self):
+        with self.settings(AI_GLOBAL_RATE_LIMIT=3):
+            results = [check_rate_limit(self.make_request(self.users[i % 2])) for i in range(4)]
+        self.assertEqual([r is None for r in results],[True,True,True,False])
+
+    def test_stream_limit(self):
+        with self.settings(AI_MAX_STREAMS=3,AI_USER_MAX_STREAMS=2):
+            leases = [acquire_stream_lease(self.make_request(self.users[0]))[0] for i in range(2)]
+            lease,resp = acquire_stream_lease(self.make_request(self.users[0]))
+            self.assertIsNone(lease)
+            self.assertEqual(resp.status_code,429)
+            self.assertEqual(resp['Retry-After'],'10')
+            # 全局上限
+            lease,resp = acquire_stream_lease(self.make_request(self.users[1]))
+            self.assertIsNone(resp)
+            self.assertIsNotNone(acquire_stream_lease(self.make_request(self.users[1]))[1])
+            # 流式内容结束后释放名额，重复释放不影响计数
+            self.assertEqual(list(leased_stream(iter(['a','b']),leases[0])),['a','b'])
+            leases[0].release()
+            self.assertIsNone(acquire_stream_lease(self.make_request(self.users[1]))[1])
+            self.assertIsNotNone(acquire_stream_lease(self.make_request(self.users[1]))[1])
+
+    def send_stream_message(self):
+        conversation = DifyConversation.objects.create(
+            user=self.users[0],conversation_id='conv-1',app_api_key=encrypt_data('app-key')
+        )
+        request = self.factory.post('/ai/dify/messages/send/',json.dumps({
+            'conversation_id':conversation.id,'query':'hello','response_mode':'streaming'
+        }),content_type='application/json')
+        request.user = self.users[0]
+        return request
+
+    @override_settings(AI_MAX_STREAMS=0)
+    def test_stream_limit_saves_no_message(self):
+        # 达到流式生成并发上限时不保存用户消息
+        resp = dify_send_message(self.send_stream_message())
+        self.assertEqual(resp.status_code,429)
+        self.assertFalse(DifyMessage.objects.exists())
+
+    @override_settings(AI_MAX_STREAMS=0)
+    async def test_async_stream_limit_saves_no_message(self):
+        request = await sync_to_async(self.send_stream_message)()
+        resp = await views_async.dify_send_message(request)
+        self.assertEqual(resp.status_code,429)
+        self.assertFalse(await DifyMessage.objects.aexists())
+
+    @mock.patch('app_ai.ratelimit_utils.atomic_incr_supported',return_value=False)
+    @mock.patch('app_ai.ratelimit_utils.COUNTER_LOCK_WAIT',0.05)
+    def test_counter_unavailable(self, atomic):
+        # 等待计数器锁超时时不计数并放行
+        window_start = int(time.time() // 60) * 60
+        for start in (window_start,window_start + 60):
+            cache.add('ai_rate_locked_{}_lock'.format(start),1,120)
+        start = time.monotonic()
+        self.assertEqual([hit_rate_limit('locked',1) for i in range(3)],[None] * 3)
+        self.assertLess(time.monotonic() - start,2)
+        # 计数器写入失败时重试有限次数后放行
+        with mock.patch.object(cache,'set') as cache_set:
+            self.assertIsNone(incr_counter('ai_rate_unwritable'))
+        self.assertEqual(cache_set.call_count,COUNTER_WRITE_RETRIES)
+        self.assertIsNone(cache.get('ai_rate_unwritable_lock'))
+
+    def test_thread_contention(self):
+        with ThreadPoolExecutor(16) as executor:
+            results = list(executor.map(lambda i: hit_rate_limit('threads',50),range(400)))
+        self.assertEqual(sum(r is None for r in results),50)
+
+    def test_process_contention(self):
+        work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree,work_dir,True)
+        script = os.path.join(work_dir,'worker.py')
+        with open(script,'w') as f:
+            f.write(RATE_LIMIT_WORKER)
+        db_path = os.path.join(work_dir,'cache.sqlite3')
+        env = dict(os.environ,PYTHONPATH=str(settings.BASE_DIR))
+
+        def run_workers(mode,count,limit):
+            start_at = str(time.time() + 2)
+            procs = [
+                subprocess.Popen([sys.executable,script,mode,db_path,start_at,str(count),str(limit)],
+                                 env=env,stdout=subprocess.PIPE)
+                for i in range(6)
+            ]
+            return [int(p.communicate(timeout=120)[0]) for p in procs]
+
+        subprocess.run([sys.executable,script,'setup',db_path,'0','0','0'],env=env,check=True)
+        # 6 个进程同时各请求 30 次，总共只有 50 次通过
+        self.assertEqual(sum(run_workers('rate',30,50)),50)
+        # 6 个进程同时各获取 10 个流式生成名额，总共只有 20 个
+        self.assertEqual(sum(run_workers('streams',10,20)),20)
+
+
+# 模拟的 Dify 消息列表接口，first_id 之前的消息按 limit 分页，页内按时间正序
+class FakeDifyMessagesHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    messages = []
+    requests = []
+
+    def do_GET(self):
+        params = {k:v[0] for k,v in parse_qs(urlsplit(self.path).query).items()}
+        self.requests.append(params)
+        ids = [m['id'] for m in self.messages]
+        end = ids.index(params['first_id']) if 'first_id' in params else len(ids)
+        start = max(0,end - int(params.get('limit',20)))
+        body = json.dumps({
+            'limit':int(params.get('limit',20)),'has_more':start > 0,'data':self.messages[start:end]
+        }).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type','application/json')
+        self.send_header('Content-Length',str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+# 会话消息记录
+class MessageHistoryTest(TestCase):
+    def setUp(self):
+        get_ai_clients().reset()
+        self.addCleanup(get_ai_clients().reset)
+        FakeDifyMessagesHandler.messages = [self.dify_message(i) for i in range(250)]
+        FakeDifyMessagesHandler.requests = []
+        self.server = ThreadingHTTPServer(('127.0.0.1',0),FakeDifyMessagesHandler)
+        threading.Thread(target=self.server.serve_forever,daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        api_base = 'http://127.0.0.1:{}/v1'.format(self.server.server_address[1])
+        SysSetting.objects.create(name='ai_dify_api_address',value=api_base,types='ai')
+        self.user = User.objects.create_user(username='msg_user',password='msg_pwd')
+        self.client.login(username='msg_user',password='msg_pwd')
+        self.conversation = DifyConversation.objects.create(
+            user=self.user,conversation_id='conv-1',app_api_key=encrypt_data('app-key'),dify_api_address=api_base
+        )
+
+    def dify_message(self, i):
+        return {'id':'m{}'.format(i),'query':'q{}'.format(i),'answer':'a{}'.format(i),'created_at':1700000000 + i}
+
+    def get_messages(self, **params):
+        return self.client.get('/ai/dify/messages/',dict(conversation_id='conv-1',**params)).json()
+
+    def test_first_open(self):
+        # 通过 MrDoc 发送的消息已保存在本地，同步时不重复保存
+        DifyMessage.objects.create(conversation=self.conversation,role='user',content='q249',message_id='m249')
+        data = self.get_messages(limit=20)
+        self.assertTrue(data['status'])
+        # 首次打开时分 3 页拉取全部消息
+        self.assertEqual(len(FakeDifyMessagesHandler.requests),3)
+        self.assertEqual(DifyMessage.objects.filter(conversation=self.conversation).count(),500)
+        page = data['data']
+        self.assertEqual(len(page['data']),20)
+        self.assertEqual([m['content'] for m in page['data'][-4:]],['q248','a248','q249','a249'])
+        self.assertTrue(page['has_more'])
+        # 按游标读取更早的消息，不再请求 Dify
+        page = self.get_messages(limit=20,cursor=page['cursor'])['data']
+        self.assertEqual(page['data'][-1]['content'],'a239')
+        self.assertEqual(len(FakeDifyMessagesHandler.requests),3)
+
+    def test_paginate(self):
+        sync_conversation_messages(self.conversation,get_dify_client(self.conversation),'user_1')
+        contents = []
+        cursor = None
+        while True:
+            with self.assertNumQueries(1):
+                page = get_message_page(self.conversation,cursor,30)
+            contents = [m['content'] for m in page['data']] + contents
+            if not page['has_more']:
+                break
+            cursor = page['cursor']
+        self.assertEqual(contents,[c for i in range(250) for c in ('q{}'.format(i),'a{}'.format(i))])
+
+    def test_incremental_sync(self):
+        self.get_messages()
+        FakeDifyMessagesHandler.requests = []
+        # 同步间隔内重新打开会话不请求 Dify
+        self.get_messages()
+        self.assertEqual(FakeDifyMessagesHandler.requests,[])
+        # 只拉取上次同步之后的消息，一次写入（另外一次查询删除未完成的用户消息）
+        FakeDifyMessagesHandler.messages += [self.dify_message(i) for i in range(250,253)]
+        self.conversation.refresh_from_db()
+        with self.assertNumQueries(3):
+            self.assertEqual(sync_conversation_messages(self.conversation,get_dify_client(self.conversation),'user_1'),3)
+        self.assertEqual(len(FakeDifyMessagesHandler.requests),1)
+        self.assertNotIn('first_id',FakeDifyMessagesHandler.requests[0])
+        data = self.get_messages(sync='1',limit=2)['data']
+        self.assertEqual([m['content'] for m in data['data']],['q252','a252'])
+        self.assertEqual(DifyMessage.objects.filter(conversation=self.conversation).count(),506)
+
+    def test_unfinished_message(self):
+        # 中断的发送只保存了没有 Dify 消息ID的用户消息，同步后由 Dify 的记录代替
+        self.get_messages()
+        DifyMessage.objects.create(conversation=self.conversation,role='user',content='q250')
+        DifyMessage.objects.create(conversation=self.conversation,role='user',content='not sent')
+        FakeDifyMessagesHandler.messages.append(self.dify_message(250))
+        data = self.get_messages(sync='1',limit=3)['data']
+        self.assertEqual(
+            [(m['content'],m['message_id']) for m in data['data']],[('q250','m250'),('a250','m250'),('not sent',None)]
+        )
+        self.assertEqual(DifyMessage.objects.filter(conversation=self.conversation,content='q250').count(),1)
+
+    def test_bad_cursor(self):
+        self.assertEqual(self.client.get('/ai/dify/messages/',{'conversation_id':'conv-1','cursor':'x'}).status_code,400)
@@ -5,7 +5,7 @@ from django.http.response import JsonResponse
 from django.utils.translation import gettext_lazy as _
 from django.core.cache import cache
 from app_admin.decorators import superuser_only,open_register
-from app_admin.models import SysSetting
+from app_admin.setting_utils import get_setting
 from loguru import logger
 import json
 import sys
@@ -14,4 +14,4 @@ import datetime
 
 # 获取系统配置
 def get_sys_value(types, name, default=None):
-    return getattr(SysSetting.objects.filter(types=types, name=name).first(), 'value', default)
\ No newline at end of file
+    return get_setting(name, default, types=types)
\ No newline at end of file
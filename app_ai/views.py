@@ -1,6 +1,6 @@
 # coding:utf-8
 from django.shortcuts import render
-from django.core.cache import cache
+from django.conf import settings
 from django.http.response import JsonResponse,StreamingHttpResponse
 from django.utils.translation import gettext_lazy as _
 from django.views.decorators.csrf import csrf_exempt
@@ -17,18 +17,21 @@ from rest_framework import filters
 from django_filters.rest_framework import DjangoFilterBackend
 from app_admin.decorators import superuser_only,open_register
 from app_admin.models import SysSetting
-from app_admin.utils import encrypt_data,decrypt_data
+from app_admin.utils import encrypt_data
+from app_admin.setting_utils import get_setting,get_decrypted_setting
 from app_api.auth_app import AppMustAuth
 from app_api.permissions_app import SuperUserPermission
 from app_doc.models import Doc, Project
 from app_ai.utils import get_sys_value
 from app_ai.models import DifyConversation, DifyMessage
+from app_ai.client_utils import get_ai_clients
+from app_ai.message_utils import get_message_page,need_sync,sync_conversation_messages,MESSAGE_PAGE_SIZE,MESSAGE_PAGE_SIZE_MAX
+from app_ai.ratelimit_utils import hit_rate_limit,acquire_stream,leased_stream,rate_limited_response,STREAM_RETRY_AFTER
 from loguru import logger
 import json
 import sys
 import os
 import datetime
-import time
 from dotenv import load_dotenv
 
 # 加载 .env 文件
@@ -51,44 +54,58 @@ def get_user_identifier(request):
 
 
 
-# 文本生成动态速率限制装饰器
-def dynamic_rate_limit(view_func):
-    """动态速率限制装饰器，基于 request.user 进行限制"""
-
-    def wrapped_view(request, *args, **kwargs):
-        # 从数据库中获取速率限制值
-        rate_limit_value = get_sys_setting_value('ai_write_rate_limit', '-1')
-
-        if rate_limit_value == '-1':
-            return view_func(request, *args, **kwargs)
-
-        # 获取用户标识符
-        user_identifier = get_user_identifier(request)
-
-        # 解析速率限制
+# 检查请求频率，超过每个用户或全局的限制时返回错误响应，否则返回 None
+def check_rate_limit(request):
+    limits = []
+    # 每个用户每分钟的请求数，从系统设置中获取
+    rate_limit_value = get_sys_setting_value('ai_write_rate_limit', '-1')
+    if rate_limit_value != '-1':
         try:
             num_requests = int(rate_limit_value)
         except (ValueError, TypeError):
             num_requests = 5
-        duration = 60
-
-        # 生成缓存键
-        cache_key = f'ai_text_rate_limit_{user_identifier}_{request.path}'
-
-        # 获取当前时间和请求记录
-        current_time = time.time()
-        request_times = cache.get(cache_key, [])
+        limits.append(('{}_{}'.format(get_user_identifier(request), request.path), num_requests))
+    # 全局每分钟的请求数
+    if settings.AI_GLOBAL_RATE_LIMIT >= 0:
+        limits.append(('global', settings.AI_GLOBAL_RATE_LIMIT))
+
+    for name, limit in limits:
+        retry_after = hit_rate_limit(name, limit)
+        if retry_after is not None:
+            return rate_limited_response(retry_after)
+    return None
+
+
+# 获取流式生成名额，返回 (名额, None)，达到并发上限时返回 (None, 错误响应)
+def acquire_stream_lease(request):
+    limits = []
+    if settings.AI_USER_MAX_STREAMS >= 0:
+        limits.append((get_user_identifier(request), settings.AI_USER_MAX_STREAMS))
+    if settings.AI_MAX_STREAMS >= 0:
+        limits.append(('global', settings.AI_MAX_STREAMS))
+    lease = acquire_stream(limits, settings.AI_STREAM_MAX_DURATION)
+    if lease is None:
+        return None, rate_limited_response(STREAM_RETRY_AFTER, '同时进行的AI生成数量已达上限，请稍后再使用！')
+    return lease, None
+
+
+# 服务器发送事件（SSE）响应，生成结束或客户端断开时释放流式生成名额
+def event_stream_response(event_stream, lease):
+    return StreamingHttpResponse(
+        leased_stream(event_stream, lease),
+        content_type='text/event-stream',
+        headers={'X-Accel-Buffering': 'no'}
+    )
 
-        # 删除超过时间窗口的请求记录
-        request_times = [t for t in request_times if current_time - t < duration]
 
-        # 检查请求次数是否超过限制
-        if len(request_times) >= num_requests:
-            return JsonResponse({'status': False, 'data': '已超过请求频率限制，请稍后再使用！'})
+# 文本生成动态速率限制装饰器
+def dynamic_rate_limit(view_func):
+    """动态速率限制装饰器，基于 request.user 进行限制"""
 
-        # 添加当前请求时间到记录中
-        request_times.append(current_time)
-        cache.set(cache_key, request_times, duration)
+    def wrapped_view(request, *args, **kwargs):
+        limited = check_rate_limit(request)
+        if limited is not None:
+            return limited
 
         # 调用原始视图函数
         return view_func(request, *args, **kwargs)
@@ -124,14 +141,15 @@ def ai_config(request):
                     )
                 else:
                     pass
+            # 清空缓存的AI接口客户端，使新的接口地址和密钥生效
+            get_ai_clients().reset()
             return JsonResponse({'code': 0, })
         except Exception as e:
             logger.exception("保存AI配置异常")
             return JsonResponse({'code',4})
 
 
-from openai import OpenAI
-from dify_client import Client as DifyClient, models
+from dify_client import models
 
 try:
     from http import HTTPMethod
@@ -144,10 +162,11 @@ except ImportError:
 AI_KEY = os.getenv("AI_KEY", "")
 AI_BASE_URL = os.getenv("AI_BASE_URL", "")
 
-client = OpenAI(
-    base_url=AI_BASE_URL,
-    api_key=AI_KEY
-)
+
+# 获取 OpenAI 兼容接口客户端，在首次使用时创建
+def get_openai_client():
+    return get_ai_clients().get_openai_client(AI_BASE_URL, AI_KEY)
+
 
 # AI文本写作
 @csrf_exempt
@@ -179,7 +198,7 @@ def ai_text_genarate(request):
         try:
             if ai_frame == '1':  # Dify
                 # 获取配置并创建客户端
-                api_key = decrypt_data(get_sys_setting_value('ai_dify_textgenerate_api_key'))
+                api_key = get_decrypted_setting('ai_dify_textgenerate_api_key')
                 dify_client = get_dify_client(api_key=api_key)
 
                 logger.info(f"Dify API 地址: {get_dify_api_address()}")
@@ -200,11 +219,10 @@ def ai_text_genarate(request):
             logger.exception("AI文本生成失败")
             yield f"event: error\ndata: {json.dumps({'message': str(e)})}\n\n"
 
-    return StreamingHttpResponse(
-        event_stream(),
-        content_type='text/event-stream',
-        headers={'X-Accel-Buffering': 'no'}
-    )
+    lease, limited = acquire_stream_lease(request)
+    if limited is not None:
+        return limited
+    return event_stream_response(event_stream(), lease)
 
 
 # AI文本写作（OpenAI 兼容）
@@ -224,7 +242,7 @@ def openai_text_generate(request):
 
         try:
             # 发起流式请求
-            response = client.chat.completions.create(
+            response = get_openai_client().chat.completions.create(
                 model="ds-r1",
                 messages=[
                     {'role': 'system', 'content': "你是一个软件测试专家"},
@@ -249,18 +267,16 @@ def openai_text_generate(request):
             logger.exception("OpenAI 文本生成失败")
             yield f"event: error\ndata: {json.dumps({'message': str(e)})}\n\n"
 
-    return StreamingHttpResponse(
-        event_stream(),
-        content_type='text/event-stream',
-        headers={'X-Accel-Buffering': 'no'}
-    )
+    lease, limited = acquire_stream_lease(request)
+    if limited is not None:
+        return limited
+    return event_stream_response(event_stream(), lease)
 
 # ================== Dify 会话管理 ==================
 
 def get_sys_setting_value(name, default=''):
     """从系统设置获取配置值的通用函数"""
-    setting = SysSetting.objects.filter(types='ai', name=name).first()
-    return getattr(setting, 'value', default)
+    return get_setting(name, default, types='ai')
 
 
 def get_dify_api_address():
@@ -270,8 +286,7 @@ def get_dify_api_address():
 
 def get_dify_chat_api_key():
     """从系统设置获取并解密 Dify Chat API Key"""
-    encrypted_key = get_sys_setting_value('ai_dify_chat_api_key')
-    return decrypt_data(encrypted_key) if encrypted_key else ''
+    return get_decrypted_setting('ai_dify_chat_api_key')
 
 
 def get_dify_client(conversation=None, api_key=None):
@@ -283,17 +298,17 @@ def get_dify_client(conversation=None, api_key=None):
         api_key: 明文 API Key（可选，如果提供则直接使用）
 
     Returns:
-        DifyClient 实例
+        DifyClient 实例（按接口地址和密钥缓存复用）
     """
     dify_api_address = get_dify_api_address()
 
     if api_key is None:
         if conversation:
-            api_key = decrypt_data(conversation.app_api_key)
+            api_key = get_ai_clients().decrypt_api_key(conversation.app_api_key)
         else:
             api_key = get_dify_chat_api_key()
 
-    return DifyClient(api_key=api_key, api_base=dify_api_address)
+    return get_ai_clients().get_dify_client(dify_api_address, api_key)
 
 
 def get_conversation_or_404(conversation_id, user, use_db_id=False):
@@ -470,55 +485,69 @@ def dify_rename_conversation(request):
 @csrf_exempt
 @login_required
 def dify_get_messages(request):
-    """获取会话的消息列表"""
+    """
+    获取会话的消息列表，从本地消息记录按游标分页读取
+
+    参数：conversation_id（Dify 会话ID，必填）、cursor（上一页返回的游标，为空时返回最新一页）、
+    limit（每页消息数量，默认20，最大100）、sync（为 1 时先从 Dify 同步消息）
+    返回：{'status': True, 'data': {'data': 消息列表, 'has_more': 是否有更早的消息, 'cursor': 获取更早消息的游标}}，
+    消息列表按时间正序排列，每条消息包含 id（本地消息ID）、role（user 或 assistant）、content、
+    message_id（Dify 消息ID，同一轮问答的用户消息和助手回复相同，未完成的消息为 null）、created_at；
+    每条 Dify 消息拆分为用户消息和助手回复两条记录
+    """
     if request.method != 'GET':
         return error_response('仅支持 GET 请求', 405)
 
     try:
         conversation_id = request.GET.get('conversation_id')
+        cursor = request.GET.get('cursor')
 
         if not conversation_id:
             return error_response('conversation_id 参数必填', 400)
+        try:
+            limit = min(max(int(request.GET.get('limit', MESSAGE_PAGE_SIZE)), 1), MESSAGE_PAGE_SIZE_MAX)
+        except ValueError:
+            return error_response('limit 参数错误', 400)
 
         # 获取会话
         conversation, error = get_conversation_or_404(conversation_id, request.user)
         if error:
             return error
 
-        # 从 Dify API 获取消息列表
-        dify_client = get_dify_client(conversation)
-        user_identifier = get_user_identifier(request)
-
-        response = dify_client.request(
-            endpoint="/messages",
-            method=HTTPMethod.GET,
-            params={
-                "conversation_id": conversation_id,
-                "user": user_identifier
-            }
-        )
+        # 打开会话时按间隔从 Dify 增量同步消息，sync=1 时立即同步
+        if not cursor and (request.GET.get('sync') == '1' or need_sync(conversation)):
+            try:
+                sync_conversation_messages(conversation, get_dify_client(conversation), get_user_identifier(request))
+            except Exception:
+                logger.exception("同步会话消息失败")
 
-        messages_data = response.json()
-
-        # 同步消息到本地数据库
-        if messages_data.get('data'):
-            for msg in messages_data['data']:
-                DifyMessage.objects.update_or_create(
-                    message_id=msg.get('id'),
-                    defaults={
-                        'conversation': conversation,
-                        'role': 'user' if msg.get('query') else 'assistant',
-                        'content': msg.get('query') or msg.get('answer', ''),
-                    }
-                )
-
-        return success_response(messages_data)
+        try:
+            page = get_message_page(conversation, cursor, limit)
+        except ValueError:
+            return error_response('cursor 参数错误', 400)
+        return success_response(page)
 
     except Exception as e:
         logger.exception("获取消息列表失败")
         return error_response(str(e))
 
 
+# 保存会话ID（第一次发送时）和助手回复，用户消息和助手回复记录 Dify 消息ID，同步消息时不重复保存
+def save_chat_result(conversation, user_message, conversation_id, message_id, answer):
+    if not conversation.conversation_id and conversation_id:
+        conversation.conversation_id = conversation_id
+        conversation.save()
+    if message_id:
+        DifyMessage.objects.filter(pk=user_message.pk).update(message_id=message_id)
+    if answer:
+        DifyMessage.objects.create(
+            conversation=conversation,
+            role='assistant',
+            content=answer,
+            message_id=message_id
+        )
+
+
 @csrf_exempt
 @login_required
 @dynamic_rate_limit
@@ -527,6 +556,7 @@ def dify_send_message(request):
     if request.method != 'POST':
         return error_response('仅支持 POST 请求', 405)
 
+    lease = None
     try:
         data = json.loads(request.body)
         conversation_db_id = data.get('conversation_id')  # 数据库 ID
@@ -546,8 +576,14 @@ def dify_send_message(request):
         dify_client = get_dify_client(conversation)
         user_identifier = get_user_identifier(request)
 
+        # 流式模式先获取流式生成名额，达到并发上限时不保存用户消息
+        if response_mode != 'blocking':
+            lease, limited = acquire_stream_lease(request)
+            if limited is not None:
+                return limited
+
         # 保存用户消息到数据库
-        DifyMessage.objects.create(
+        user_message = DifyMessage.objects.create(
             conversation=conversation,
             role='user',
             content=query
@@ -564,19 +600,8 @@ def dify_send_message(request):
             )
             result = dify_client.chat_messages(chat_request)
 
-            # 更新会话 ID（如果是第一次发送）
-            if not conversation.conversation_id and result.conversation_id:
-                conversation.conversation_id = result.conversation_id
-                conversation.save()
-
-            # 保存助手回复
-            if result.answer:
-                DifyMessage.objects.create(
-                    conversation=conversation,
-                    role='assistant',
-                    content=result.answer,
-                    message_id=result.id
-                )
+            # 更新会话 ID（如果是第一次发送），保存助手回复
+            save_chat_result(conversation, user_message, result.conversation_id, result.message_id, result.answer)
 
             return success_response(result.model_dump())
 
@@ -600,8 +625,8 @@ def dify_send_message(request):
                         # 记录 conversation_id 和 message_id
                         if hasattr(chunk, 'conversation_id') and chunk.conversation_id:
                             conv_id = chunk.conversation_id
-                        if hasattr(chunk, 'id') and chunk.id:
-                            message_id = chunk.id
+                        if hasattr(chunk, 'message_id') and chunk.message_id:
+                            message_id = chunk.message_id
 
                         # 累积答案
                         if hasattr(chunk, 'answer') and chunk.answer:
@@ -610,32 +635,20 @@ def dify_send_message(request):
                         # 转发数据
                         yield f"data: {json.dumps(chunk.model_dump())}\n\n"
 
-                    # 更新会话 ID
-                    if not conversation.conversation_id and conv_id:
-                        conversation.conversation_id = conv_id
-                        conversation.save()
-
-                    # 保存完整的助手回复
-                    if full_answer:
-                        DifyMessage.objects.create(
-                            conversation=conversation,
-                            role='assistant',
-                            content=full_answer,
-                            message_id=message_id
-                        )
+                    # 更新会话 ID，保存完整的助手回复
+                    save_chat_result(conversation, user_message, conv_id, message_id, full_answer)
 
                 except Exception as e:
                     logger.exception("流式发送消息失败")
                     yield f"event: error\ndata: {json.dumps({'message': str(e)})}\n\n"
 
-            return StreamingHttpResponse(
-                event_stream(),
-                content_type='text/event-stream',
-                headers={'X-Accel-Buffering': 'no'}
-            )
+            return event_stream_response(event_stream(), lease)
 
     except Exception as e:
         logger.exception("发送消息失败")
+        # 未开始流式响应时释放已获取的名额
+        if lease is not None:
+            lease.release()
         return error_response(str(e))
 
 
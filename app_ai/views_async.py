@@ -0,0 +1,232 @@
+# coding:utf-8
+# @文件: views_async.py
+# AI流式生成的异步视图
+# 以 ASGI 方式部署时（MrDoc/asgi.py）代替 views.py 中的同名视图，等待上游生成内容时只占用协程而不占用线程；
+# 数据库和系统设置的读写通过 sync_to_async 执行，客户端断开连接时取消视图任务，同时关闭上游请求
+
+from django.contrib.auth.views import redirect_to_login
+from asgiref.sync import sync_to_async
+from dify_client import models
+from app_admin.setting_utils import get_decrypted_setting
+from app_ai.models import DifyMessage
+from app_ai.client_utils import get_ai_clients
+from app_ai.views import check_rate_limit,acquire_stream_lease,event_stream_response,get_user_identifier,\
+    get_conversation_or_404,get_dify_api_address,get_sys_setting_value,save_chat_result,success_response,error_response,\
+    AI_KEY,AI_BASE_URL
+from functools import wraps
+from loguru import logger
+import json
+
+
+# 异步视图装饰器：免除CSRF检查、要求登录并检查请求频率
+def async_ai_view(view_func):
+    @wraps(view_func)
+    async def wrapped_view(request, *args, **kwargs):
+        if not await sync_to_async(lambda: request.user.is_authenticated)():
+            return redirect_to_login(request.get_full_path())
+        limited = await sync_to_async(check_rate_limit)(request)
+        if limited is not None:
+            return limited
+        return await view_func(request, *args, **kwargs)
+
+    wrapped_view.csrf_exempt = True
+    return wrapped_view
+
+
+# 获取流式生成名额后返回 SSE 响应，达到并发上限时返回错误响应
+async def leased_event_stream_response(request, event_stream):
+    lease, limited = await sync_to_async(acquire_stream_lease)(request)
+    if limited is not None:
+        return limited
+    return event_stream_response(event_stream(), lease)
+
+
+# 获取 Dify 异步客户端，conversation 为 None 时使用 api_key
+async def get_async_dify_client(conversation=None, api_key=None):
+    api_base = await sync_to_async(get_dify_api_address)()
+    if api_key is None:
+        if conversation:
+            api_key = get_ai_clients().decrypt_api_key(conversation.app_api_key)
+        else:
+            api_key = await sync_to_async(get_decrypted_setting)('ai_dify_chat_api_key')
+    return get_ai_clients().get_async_dify_client(api_base, api_key)
+
+
+# AI文本写作
+@async_ai_view
+async def ai_text_genarate(request):
+    """AI 文本生成（使用 Dify）"""
+    async def event_stream():
+        ai_frame = await sync_to_async(get_sys_setting_value)('ai_frame')
+
+        # 解析请求数据
+        try:
+            request_json = json.loads(request.body)
+            user_query = request_json.get('inputs', {}).get('query', '')
+            if not user_query:
+                yield f"event: error\ndata: {json.dumps({'message': '请求参数 query 不能为空'})}\n\n"
+                return
+        except (KeyError, AttributeError, json.JSONDecodeError) as e:
+            logger.error(f"解析请求数据失败: {e}")
+            yield f"event: error\ndata: {json.dumps({'message': f'请求数据格式错误: {str(e)}'})}\n\n"
+            return
+
+        # 处理 Dify 文本生成
+        try:
+            if ai_frame == '1':  # Dify
+                api_key = await sync_to_async(get_decrypted_setting)('ai_dify_textgenerate_api_key')
+                dify_client = await get_async_dify_client(api_key=api_key)
+                completion_request = models.CompletionRequest(
+                    inputs=models.CompletionInputs(query=user_query, inputs=user_query),
+                    response_mode=models.ResponseMode.STREAMING,
+                    user=request.user.username
+                )
+                async for chunk in await dify_client.acompletion_messages(completion_request):
+                    yield f"data: {json.dumps(chunk.model_dump())}\n\n"
+        except Exception as e:
+            logger.exception("AI文本生成失败")
+            yield f"event: error\ndata: {json.dumps({'message': str(e)})}\n\n"
+
+    return await leased_event_stream_response(request, event_stream)
+
+
+# AI文本写作（OpenAI 兼容）
+@async_ai_view
+async def openai_text_generate(request):
+    """AI 文本生成（使用 OpenAI 兼容 API）"""
+    async def event_stream():
+        try:
+            user_input = json.loads(request.body)['inputs']['query']
+        except (KeyError, TypeError, json.JSONDecodeError) as e:
+            logger.error(f"解析请求数据失败: {e}")
+            yield f"event: error\ndata: {json.dumps({'message': f'请求数据格式错误: {str(e)}'})}\n\n"
+            return
+
+        try:
+            client = get_ai_clients().get_async_openai_client(AI_BASE_URL, AI_KEY)
+            response = await client.chat.completions.create(
+                model="ds-r1",
+                messages=[
+                    {'role': 'system', 'content': "你是一个软件测试专家"},
+                    {'role': 'user', 'content': user_input}
+                ],
+                stream=True
+            )
+            # 退出时关闭上游响应（包括客户端断开连接时）
+            async with response:
+                async for chunk in response:
+                    if chunk and chunk.choices and chunk.choices[0].delta.content:
+                        event_data = {
+                            "event": "message",
+                            "answer": chunk.choices[0].delta.content
+                        }
+                        yield f"data: {json.dumps(event_data)}\n\n"
+
+            # 流式结束标志
+            yield f"data: {json.dumps({'event': 'message_end'})}\n\n"
+
+        except Exception as e:
+            logger.exception("OpenAI 文本生成失败")
+            yield f"event: error\ndata: {json.dumps({'message': str(e)})}\n\n"
+
+    return await leased_event_stream_response(request, event_stream)
+
+
+# 发送消息到会话
+@async_ai_view
+async def dify_send_message(request):
+    """发送消息到会话（支持流式和阻塞模式）"""
+    if request.method != 'POST':
+        return error_response('仅支持 POST 请求', 405)
+
+    lease = None
+    try:
+        data = json.loads(request.body)
+        conversation_db_id = data.get('conversation_id')  # 数据库 ID
+        query = data.get('query')
+        inputs = data.get('inputs', {})
+        response_mode = data.get('response_mode', 'blocking')
+
+        if not conversation_db_id or not query:
+            return error_response('conversation_id 和 query 参数必填', 400)
+
+        conversation, error = await sync_to_async(get_conversation_or_404)(
+            conversation_db_id, request.user, use_db_id=True
+        )
+        if error:
+            return error
+
+        dify_client = await get_async_dify_client(conversation)
+        user_identifier = await sync_to_async(get_user_identifier)(request)
+
+        # 流式模式先获取流式生成名额，达到并发上限时不保存用户消息
+        if response_mode != 'blocking':
+            lease, limited = await sync_to_async(acquire_stream_lease)(request)
+            if limited is not None:
+                return limited
+
+        # 保存用户消息到数据库
+        user_message = await sync_to_async(DifyMessage.objects.create)(
+            conversation=conversation,
+            role='user',
+            content=query
+        )
+
+        # 阻塞模式
+        if response_mode == 'blocking':
+            chat_request = models.ChatRequest(
+                inputs=inputs,
+                query=query,
+                user=user_identifier,
+                response_mode=models.ResponseMode.BLOCKING,
+                conversation_id=conversation.conversation_id or None
+            )
+            result = await dify_client.achat_messages(chat_request)
+            await sync_to_async(save_chat_result)(
+                conversation, user_message, result.conversation_id, result.message_id, result.answer
+            )
+            return success_response(result.model_dump())
+
+        # 流式模式
+        async def event_stream():
+            try:
+                chat_request = models.ChatRequest(
+                    inputs=inputs,
+                    query=query,
+                    user=user_identifier,
+                    response_mode=models.ResponseMode.STREAMING,
+                    conversation_id=conversation.conversation_id or None
+                )
+
+                answer_parts = []
+                message_id = None
+                conv_id = None
+
+                async for chunk in await dify_client.achat_messages(chat_request):
+                    # 记录 conversation_id 和 message_id
+                    if getattr(chunk, 'conversation_id', None):
+                        conv_id = chunk.conversation_id
+                    if getattr(chunk, 'message_id', None):
+                        message_id = chunk.message_id
+                    # 累积答案
+                    if getattr(chunk, 'answer', None):
+                        answer_parts.append(chunk.answer)
+                    yield f"data: {json.dumps(chunk.model_dump())}\n\n"
+
+                await sync_to_async(save_chat_result)(
+                    conversation, user_message, conv_id, message_id, ''.join(answer_parts)
+                )
+
+            except Exception as e:
+                logger.exception("流式发送消息失败")
+                yield f"event: error\ndata: {json.dumps({'message': str(e)})}\n\n"
+
+        return event_stream_response(event_stream(), lease)
+
+    except Exception as e:
+        logger.exception("发送消息失败")
+        # 未开始流式响应时释放已获取的名额
+        if lease is not None:
+            await sync_to_async(lease.release)()
+        return error_response(str(e))
+
@@ -6,10 +6,12 @@
 
 from rest_framework import serializers
 from rest_framework.serializers import ModelSerializer,SerializerMethodField
+from rest_framework.authentication import SessionAuthentication
 from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 from app_doc.models import *
 from app_admin.models import RegisterCode
+from app_doc.image_utils import thumbnail_url
 
 
 # 用户序列化器
@@ -50,7 +52,10 @@ class ProjectSerializer(ModelSerializer):
     def get_username(self,obj):
         return obj.create_user.username
 
+    # 列表中的文集由 attach_project_stats 批量附加文档数量
     def get_doc_total(self,obj):
+        if hasattr(obj,'doc_cnt'):
+            return obj.doc_cnt
         return Doc.objects.filter(top_doc=obj.id).count()
 
 # 协作文集序列化器
@@ -114,6 +119,8 @@ class DocTempSerializer(ModelSerializer):
 # 图片序列化器
 class ImageSerializer(ModelSerializer):
     username = serializers.SerializerMethodField(label="用户名")
+    thumbnail = serializers.SerializerMethodField(label="缩略图")
+    preview = serializers.SerializerMethodField(label="预览图")
     class Meta:
         model = Image
         fields = ('__all__')
@@ -121,6 +128,18 @@ class ImageSerializer(ModelSerializer):
     def get_username(self,obj):
         return obj.user.username
 
+    # 缩略图地址需要登录访问，通过 token 认证的请求在缩略图未生成时返回原图地址
+    def image_url(self,obj,size):
+        request = self.context.get('request')
+        generate = request is not None and isinstance(request.successful_authenticator,SessionAuthentication)
+        return thumbnail_url(obj.file_path,size,generate=generate)
+
+    def get_thumbnail(self,obj):
+        return self.image_url(obj,'s')
+
+    def get_preview(self,obj):
+        return self.image_url(obj,'m')
+
 # 图片分组序列化器
 class ImageGroupSerializer(ModelSerializer):
     class Meta:
@@ -1,3 +1,67 @@
 from django.test import TestCase
+from django.core.cache import cache
+from django.contrib.auth.models import User
+from django.core.files.uploadedfile import SimpleUploadedFile
+from app_api.models import UserToken,AppUserToken
+from app_doc.models import Project,Doc
+from app_doc.test_utils import ConstantQueriesMixin
+from app_doc.util_upload_img import img_upload
+from app_doc.image_utils import get_thumbnail,media_file_path
+from PIL import Image as PILImage
+import tempfile
+import shutil
+import io
+import os
 
 # Create your tests here.
+
+
+# 文集列表接口的查询次数不随文集数量增加
+class ProjectListApiTest(ConstantQueriesMixin,TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='api_user',password='api_pwd')
+        UserToken.objects.create(user=self.user,token='api_token')
+        self.add_items()
+
+    def add_items(self):
+        pro = Project.objects.create(name='pro',intro='',create_user=self.user)
+        Doc.objects.create(name='doc',top_doc=pro.id,status=1,create_user=self.user)
+        Doc.objects.create(name='draft',top_doc=pro.id,status=0,create_user=self.user)
+
+    def test_token_get_projects(self):
+        resp = self.assertConstantQueries(lambda: self.client.get('/api/get_projects/',{'token':'api_token'})).json()
+        self.assertEqual([p['total'] for p in resp['data']],[1] * 4)
+
+    def test_app_projects(self):
+        self.client.login(username='api_user',password='api_pwd')
+        resp = self.assertConstantQueries(lambda: self.client.get('/api_app/projects/',{'range':'self'})).json()
+        self.assertEqual([p['doc_total'] for p in resp['data']],[2] * 4)
+        self.assertEqual(resp['data'][0]['username'],'api_user')
+        resp = self.assertConstantQueries(lambda: self.client.get('/api_app/projects/')).json()
+        self.assertEqual([p['doc_total'] for p in resp['data']],[2] * 7)
+
+
+# 通过 token 获取图片列表，缩略图未生成时返回原图地址
+class AppImageTest(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree,self.media_root,True)
+        override = self.settings(MEDIA_ROOT=self.media_root)
+        override.enable()
+        self.addCleanup(override.disable)
+        output = io.BytesIO()
+        PILImage.new('RGB',(800,600),(10,20,30)).save(output,format='PNG')
+        user = User.objects.create_user(username='img_user')
+        AppUserToken.objects.create(user=user,token='app_token')
+        self.url = img_upload(SimpleUploadedFile('a.png',output.getvalue()),'',user)['url']
+
+    def test_token_images(self):
+        image = self.client.get('/api_app/images/',{'token':'app_token'}).json()['data'][0]
+        self.assertEqual((image['thumbnail'],image['preview']),(self.url,self.url))
+        self.assertTrue(os.path.exists(media_file_path(image['thumbnail'])))
+        # 缩略图生成后返回缩略图地址
+        get_thumbnail(self.url,'s')
+        image = self.client.get('/api_app/images/',{'token':'app_token'}).json()['data'][0]
+        self.assertTrue(image['thumbnail'].startswith('/media/thumbnails/s/'))
+        self.assertEqual(image['preview'],self.url)
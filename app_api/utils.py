@@ -1,14 +1,13 @@
 from app_doc.models import Project,ProjectCollaborator
-from django.utils.html import strip_tags
-import markdown
+from app_doc.render_utils import attach_doc_summary
 
 # 用户有浏览和、新增权限的文集列表
 def read_add_projects(user):
     # 用户的协作文集ID列表
-    colla_list = [i.project.id for i in ProjectCollaborator.objects.filter(user=user)]
+    colla_list = ProjectCollaborator.objects.filter(user=user).values_list('project_id',flat=True)
 
     # 用户自己的文集ID列表
-    self_list = [i.id for i in Project.objects.filter(create_user=user)]
+    self_list = Project.objects.filter(create_user=user).values_list('id',flat=True)
 
     # 合并上述文集ID列表
     view_list = list(
@@ -21,10 +20,10 @@ def read_add_projects(user):
 # 用户有浏览、新增、和修改所有文档权限的文集列表
 def read_add_edit_projects(user):
     # 用户的协作文集ID列表
-    colla_list = [i.project.id for i in ProjectCollaborator.objects.filter(user=user,role=1)]
+    colla_list = ProjectCollaborator.objects.filter(user=user,role=1).values_list('project_id',flat=True)
 
     # 用户自己的文集ID列表
-    self_list = [i.id for i in Project.objects.filter(create_user=user)]
+    self_list = Project.objects.filter(create_user=user).values_list('id',flat=True)
 
     # 合并上述文集ID列表
     view_list = list(
@@ -34,15 +33,8 @@ def read_add_edit_projects(user):
     return view_list
 
 # 摘取文档部分正文
+# 列表中的文档由 attach_doc_summary 批量附加摘要
 def remove_doc_tag(doc):
-    try:
-        if doc.editor_mode == 3: # 富文本文档
-            result = strip_tags(doc.content)[:100]
-        elif doc.editor_mode == 4:
-            result = "此为表格文档，进入文档查看详细内容"
-        else: # 其他文档
-            result = strip_tags(markdown.markdown(doc.pre_content))[:100]
-    except Exception as e:
-        result = doc.pre_content[:100]
-    result = result.replace("&nbsp;",'')
-    return result
\ No newline at end of file
+    if not hasattr(doc,'summary'):
+        attach_doc_summary([doc])
+    return doc.summary[:100]
\ No newline at end of file
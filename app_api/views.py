@@ -13,7 +13,9 @@ from django.utils.translation import gettext_lazy as _
 from django.db.models import Q
 from app_doc.util_upload_img import upload_generation_dir,base_img_upload,url_img_upload,img_upload
 from app_doc.util_upload_file import handle_attachment_upload
-from app_doc.utils import find_doc_next,find_doc_previous
+from app_doc.toc_utils import get_toc_nodes,build_toc_tree,bump_toc_version,get_adjacent_docs
+from app_doc.stats_utils import attach_project_stats
+from app_doc.render_utils import attach_doc_summary
 from app_api.models import UserToken
 from app_doc.models import Project, Doc, DocHistory, Image, ProjectCollaborator
 from app_api.serializers_app import ImageSerializer,ProjectSerializer
@@ -165,14 +167,15 @@ def get_projects(request):
                                               id__in=view_list).order_by(f'{sort}{sort_name}')
 
         project_list =  []
-        for project in projects:
+        # 批量获取文集的已发布文档数量
+        for project in attach_project_stats(projects):
             item = {
                 'id':project.id, # 文集ID
                 'name':project.name, # 文集名称
                 'icon': project.icon,  # 文集图标
                 'type':project.role, # 文集状态
                 'desc': project.intro,  # 文集简介
-                'total': Doc.objects.filter(top_doc=project.id, status=1).count(),
+                'total': project.doc_cnt,
                 'create_time': project.create_time
             }
             project_list.append(item)
@@ -270,61 +273,19 @@ def get_level_docs(request):
         if int(pid) not in view_list:
             return JsonResponse({'status': False, 'data': _('无文集权限')})
 
-        # 查询存在上级文档的文档
-        parent_id_list = Doc.objects.filter(top_doc=pid,status=1).exclude(parent_doc=0).values_list('parent_doc',flat=True)
-        # 获取存在上级文档的上级文档ID
-        # print(parent_id_list)
-        doc_list = []
-        doc_cnt = 0
-        # 获取一级文档
-        top_docs = Doc.objects.filter(top_doc=pid,parent_doc=0,status=1).values('id','name','editor_mode','parent_doc').order_by('sort')
-        # 遍历一级文档
-        for doc in top_docs:
-            top_item = {
-                'id':doc['id'],
-                'name':doc['name'],
-                'editor_mode':doc['editor_mode'],
-                'parent_doc':doc['parent_doc'],
-                'top_doc':pid,
-                'sub':[]
+        # 文集的文档目录
+        nodes = get_toc_nodes(pid)
+        def make_item(node):
+            return {
+                'id': node['id'],
+                'name': node['name'],
+                'editor_mode': node['editor_mode'],
+                'parent_doc': node['parent_doc'],
+                'top_doc': pid,
+                'sub': []
             }
-            doc_cnt += 1
-            # 如果一级文档存在下级文档，查询其二级文档
-            if doc['id'] in parent_id_list:
-                # 获取二级文档
-                sec_docs = Doc.objects.filter(top_doc=pid,parent_doc=doc['id'],status=1).values('id','name','editor_mode','parent_doc').order_by('sort')
-                for doc in sec_docs:
-                    sec_item = {
-                        'id': doc['id'],
-                        'name': doc['name'],
-                        'editor_mode':doc['editor_mode'],
-                        'parent_doc': doc['parent_doc'],
-                        'top_doc':pid,
-                        'sub': []
-                    }
-                    doc_cnt += 1
-                    # 如果二级文档存在下级文档，查询第三级文档
-                    if doc['id'] in parent_id_list:
-                        # 获取三级文档
-                        thr_docs = Doc.objects.filter(top_doc=pid,parent_doc=doc['id'],status=1).values('id','name','editor_mode','parent_doc').order_by('sort')
-                        for doc in thr_docs:
-                            item = {
-                                'id': doc['id'],
-                                'name': doc['name'],
-                                'editor_mode': doc['editor_mode'],
-                                'parent_doc': doc['parent_doc'],
-                                'top_doc':pid,
-                                'sub': []
-                            }
-                            doc_cnt += 1
-                            sec_item['sub'].append(item)
-                        top_item['sub'].append(sec_item)
-                    else:
-                        top_item['sub'].append(sec_item)
-                doc_list.append(top_item)
-            # 如果一级文档没有下级文档，直接保存
-            else:
-                doc_list.append(top_item)
+        doc_list = build_toc_tree(nodes,make_item)
+        doc_cnt = len(nodes)
 
         # 不需要分页
         if is_page is False:
@@ -390,7 +351,8 @@ def get_self_docs(request):
             return JsonResponse({'status': True, 'data': []})
 
         doc_list = []
-        for doc in docs_page:
+        # 批量读取文档摘要
+        for doc in attach_doc_summary(docs_page):
             project = Project.objects.get(id=doc.top_doc)
             item = {
                 'id': doc.id,  # 文档ID
@@ -467,18 +429,8 @@ def get_doc_previous_next(request):
         if project.id not in view_list:
             return JsonResponse({'status': False, 'data': _('无权限')})
 
-        try:
-            previous_doc = find_doc_previous(did)
-            previous_doc_id = previous_doc.id
-        except Exception as e:
-            logger.error("获取上一篇文档异常")
-            previous_doc_id = None
-        try:
-            next_doc = find_doc_next(did)
-            next_doc_id = next_doc.id
-        except Exception as e:
-            logger.error("获取下一篇文档异常")
-            next_doc_id = None
+        # 从文集阅读顺序中获取上下篇文档
+        previous_doc_id,next_doc_id = get_adjacent_docs(project.id,doc.id)
         return JsonResponse({'status': True, 'data': {'next':next_doc_id,'previous':previous_doc_id}})
     except Exception as e:
         logger.exception("获取文档上下篇文档异常")
@@ -633,6 +585,7 @@ def modify_doc(request):
                 )
             elif doc.editor_mode == 4: # 在线表格
                 pass
+            bump_toc_version(doc.top_doc) # 更新文集目录缓存
             return JsonResponse({'status': True, 'data': 'ok'})
         else:
             return JsonResponse({'status':False,'data':'非法请求'})
@@ -747,6 +700,7 @@ def delete_doc(request):
                 status=3,
                 modify_time=datetime.datetime.now(),
             )
+            bump_toc_version(doc.top_doc) # 更新文集目录缓存
             return JsonResponse({'status': True, 'data': 'ok'})
         else:
             return JsonResponse({'status':False,'data':'非法请求'})
@@ -20,6 +20,9 @@ from app_doc.models import *
 from app_api.serializers_app import *
 from app_api.auth_app import AppAuth,AppMustAuth
 from app_doc.views import validateTitle
+from app_doc.toc_utils import bump_toc_version,get_adjacent_docs
+from app_doc.access_utils import get_project_access,check_project_access,ACCESS_DENY,ACCESS_VIEWCODE
+from app_doc.stats_utils import attach_project_stats
 from app_doc.util_upload_img import img_upload,base_img_upload
 from loguru import logger
 import datetime
@@ -107,15 +110,16 @@ class ProjectView(APIView):
         range = request.query_params.get('range',None)
         # 获取自己的文集创建的、协作的文集列表
         if range == 'self':
-            colla_list = [i.project.id for i in ProjectCollaborator.objects.filter(user=request.user)]  # 用户的协作文集列表
             project_list = Project.objects.filter(
                 Q(create_user=request.user) | \
-                Q(id__in=colla_list)
+                Q(id__in=list(get_project_access(request).colla_roles))
             ).order_by('-create_time')
             # page = PageNumberPagination()  # 实例化一个分页器
             # page_projects = page.paginate_queryset(project_list, request, view=self)  # 进行分页查询
             # serializer = ProjectSerializer(page_projects, many=True)  # 对分页后的结果进行序列化处理
-            serializer = ProjectSerializer(project_list, many=True)
+            # 批量获取文集的文档数量
+            project_data = attach_project_stats(project_list.select_related('create_user'),doc_status=None)
+            serializer = ProjectSerializer(project_data, many=True)
             resp = {
                 'code': 0,
                 'data': serializer.data,
@@ -128,44 +132,19 @@ class ProjectView(APIView):
             resp = dict()
             # 获取文集信息
             project = Project.objects.get(id=int(pro_id))
-            # 获取文集的协作用户信息
-            # print(request.auth)
-            # print(request.user)
-            if request.auth:  # 对登陆用户查询其协作文档信息
-                colla_user = ProjectCollaborator.objects.filter(project=project, user=request.user).count()
-            else:
-                colla_user = 0
-
             # 获取文集前台下载权限
             try:
                 allow_download = ProjectReport.objects.get(project=project)
             except:
                 allow_download = False
 
-            # 私密文集并且访问者非创建者非协作者
-            if (project.role == 1) and (request.user != project.create_user) and (colla_user == 0):
-                # return Response({'code': 2, 'data': []})
+            # 检查文集访问权限，访问码从请求数据中获取
+            viewcode = request.data.get('viewcode-{}'.format(project.id),0)
+            access_result = check_project_access(request,project,viewcode)
+            if access_result == ACCESS_DENY:
                 resp['code'] = 2
-            # 指定用户可见文集
-            elif project.role == 2:
-                user_list = project.role_value
-                if request.auth:  # 认证用户判断是否在许可用户列表中
-                    if (request.user.username not in user_list) and \
-                            (request.user != project.create_user) and \
-                            (colla_user == 0):  # 访问者不在指定用户之中
-                        resp['code'] = 2
-                else:  # 游客直接返回404
-                    resp['code'] = 2
-            # 访问码可见
-            elif project.role == 3:
-                # 浏览用户不为创建者、协作者
-                if request.user != project.create_user and colla_user == 0:
-                    viewcode = project.role_value
-                    viewcode_name = 'viewcode-{}'.format(project.id)
-                    r_viewcode = request.data.get(viewcode_name,0)  # 获取访问码
-                    if viewcode != r_viewcode:  # 访问码不等于文集访问码，跳转到访问码认证界面
-                        # return Response({'code': 3})
-                        resp['code'] = 3
+            elif access_result == ACCESS_VIEWCODE: # 需要访问码
+                resp['code'] = 3
             else:
                 serializer = ProjectSerializer(project)
                 resp = {'code': 0, 'data': serializer.data}
@@ -203,12 +182,8 @@ class ProjectView(APIView):
 
             # 没有搜索 and 认证用户 and 没有筛选
             if (is_kw is False) and (is_auth) and (is_role is False):
-                colla_list = [i.project.id for i in ProjectCollaborator.objects.filter(user=request.user)]  # 用户的协作文集列表
                 project_list = Project.objects.filter(
-                    Q(role__in=role_list) | \
-                    Q(role=2, role_value__contains=str(request.user.username)) | \
-                    Q(create_user=request.user) | \
-                    Q(id__in=colla_list)
+                    get_project_access(request).visible_q(role_list)
                 ).order_by("{}create_time".format(sort_str))
 
             # 没有搜索 and 认证用户 and 有筛选
@@ -219,13 +194,12 @@ class ProjectView(APIView):
                     project_list = Project.objects.filter(create_user=request.user, role=1).order_by(
                         "{}create_time".format(sort_str))
                 elif role in ['2', 2]:
-                    project_list = Project.objects.filter(role=2, role_value__contains=str(request.user.username)).order_by(
+                    project_list = Project.objects.filter(role=2,id__in=get_project_access(request).assigned_ids).order_by(
                         "{}create_time".format(sort_str))
                 elif role in ['3', 3]:
                     project_list = Project.objects.filter(role=3).order_by("{}create_time".format(sort_str))
                 elif role in ['99', 99]:
-                    colla_list = [i.project.id for i in ProjectCollaborator.objects.filter(user=request.user)]  # 用户的协作文集列表
-                    project_list = Project.objects.filter(id__in=colla_list).order_by("{}create_time".format(sort_str))
+                    project_list = Project.objects.filter(id__in=list(get_project_access(request).colla_roles)).order_by("{}create_time".format(sort_str))
                 else:
                     return Response({'code':2,'data':[]})
 
@@ -244,13 +218,9 @@ class ProjectView(APIView):
 
             # 有搜索 and 认证用户 and 没有筛选
             elif (is_kw) and (is_auth) and (is_role is False):
-                colla_list = [i.project.id for i in ProjectCollaborator.objects.filter(user=request.user)]  # 用户的协作文集
                 # 查询所有可显示的文集
                 project_list = Project.objects.filter(
-                    Q(role__in=[0, 3]) | \
-                    Q(role=2, role_value__contains=str(request.user.username)) | \
-                    Q(create_user=request.user) | \
-                    Q(id__in=colla_list),
+                    get_project_access(request).visible_q([0,3]),
                     Q(name__icontains=kw) | Q(intro__icontains=kw)
                 ).order_by('{}create_time'.format(sort_str))
 
@@ -270,7 +240,7 @@ class ProjectView(APIView):
                     project_list = Project.objects.filter(
                         Q(name__icontains=kw) | Q(intro__icontains=kw),
                         role=2,
-                        role_value__contains=str(request.user.username)
+                        id__in=get_project_access(request).assigned_ids
                     ).order_by("{}create_time".format(sort_str))
                 elif role in ['3', 3]:
                     project_list = Project.objects.filter(
@@ -278,10 +248,9 @@ class ProjectView(APIView):
                         role=3
                     ).order_by("{}create_time".format(sort_str))
                 elif role in ['99', 99]:
-                    colla_list = [i.project.id for i in ProjectCollaborator.objects.filter(user=request.user)]  # 用户的协作文集列表
                     project_list = Project.objects.filter(
                         Q(name__icontains=kw) | Q(intro__icontains=kw),
-                        id__in=colla_list
+                        id__in=list(get_project_access(request).colla_roles)
                     ).order_by("{}create_time".format(sort_str))
                 else:
                     return Response({'code':1,'data':[]})
@@ -309,7 +278,8 @@ class ProjectView(APIView):
                     return Response({'code':1,'data':[]})
 
             page = PageNumberPagination() # 实例化一个分页器
-            page_projects = page.paginate_queryset(project_list,request,view=self) # 进行分页查询
+            page_projects = page.paginate_queryset(project_list.select_related('create_user'),request,view=self) # 进行分页查询
+            page_projects = attach_project_stats(page_projects,doc_status=None) # 批量获取文集的文档数量
             serializer = ProjectSerializer(page_projects,many=True) # 对分页后的结果进行序列化处理
             resp = {
                 'code':0,
@@ -442,46 +412,22 @@ class DocView(APIView):
         if pro_id != '' and doc_id != '':
             # 获取文集信息
             project = Project.objects.get(id=int(pro_id))
-            # 获取文集的协作用户信息
-            if request.auth:
-                colla_user = ProjectCollaborator.objects.filter(project=project, user=request.user)
-                if colla_user.exists():
-                    colla_user_role = colla_user[0].role
-                    colla_user = colla_user.count()
-                else:
-                    colla_user = colla_user.count()
-            else:
-                colla_user = 0
-
-            # 私密文集且访问者非创建者、协作者 - 不能访问
-            if (project.role == 1) and (request.user != project.create_user) and (colla_user == 0):
+            # 检查文集访问权限，访问码从请求数据中获取
+            viewcode = request.data.get('viewcode-{}'.format(project.id),0)
+            access_result = check_project_access(request,project,viewcode)
+            if access_result == ACCESS_DENY:
                 return Response({'code':2})
-            # 指定用户可见文集
-            elif project.role == 2:
-                user_list = project.role_value
-                if request.user.is_authenticated:  # 认证用户判断是否在许可用户列表中
-                    if (request.user.username not in user_list) and \
-                            (request.user != project.create_user) and \
-                            (colla_user == 0):  # 访问者不在指定用户之中，也不是协作者
-                        return Response({'code': 2})
-                else:  # 游客直接返回404
-                    return Response({'code': 2})
-            # 访问码可见
-            elif project.role == 3:
-                # 浏览用户不为创建者和协作者 - 需要访问码
-                if (request.user != project.create_user) and (colla_user == 0):
-                    viewcode = project.role_value
-                    viewcode_name = 'viewcode-{}'.format(project.id)
-                    r_viewcode = request.data.get(viewcode_name,0)  # 获取访问码
-                    if viewcode != r_viewcode:  # cookie中的访问码不等于文集访问码，跳转到访问码认证界面
-                        return Response({'code':3})
+            elif access_result == ACCESS_VIEWCODE: # 需要访问码
+                return Response({'code':3})
 
             # 获取文档内容
             try:
                 doc = Doc.objects.get(id=int(doc_id), status=1)
                 if doc_format == 'json':
                     serializer = DocSerializer(doc)
-                    resp = {'code':0,'data':serializer.data}
+                    # 文档的上一篇和下一篇文档ID
+                    previous_id,next_id = get_adjacent_docs(doc.top_doc,doc.id)
+                    resp = {'code':0,'data':serializer.data,'previous':previous_id,'next':next_id}
                     return Response(resp)
                 elif doc_format == 'html':
                     logger.info(_("返回HTML"))
@@ -575,6 +521,7 @@ class DocView(APIView):
                         modify_time = datetime.datetime.now(),
                         status = status
                     )
+                    bump_toc_version(doc.top_doc) # 更新文集目录缓存
                     return Response({'code': 0,'data':_('修改成功')})
                 else:
                     return Response({'code':2,'data':_('未授权请求')})
@@ -613,6 +560,7 @@ class DocView(APIView):
                     chr_doc.update(status=3, modify_time=datetime.datetime.now())  # 修改下级文档的状态为删除
                     Doc.objects.filter(parent_doc__in=chr_doc_ids).update(status=3,
                                                                           modify_time=datetime.datetime.now())  # 修改下级文档的下级文档状态
+                    bump_toc_version(doc.top_doc) # 更新文集目录缓存
 
                     return Response({'code': 0, 'data': _('删除完成')})
                 else:
@@ -720,7 +668,7 @@ class ImageView(APIView):
             image_list = Image.objects.filter(user=request.user, group_id=g_id)  # 查询指定分组的图片
         page = PageNumberPagination()
         page_images = page.paginate_queryset(image_list,request,view=self)
-        serializer = ImageSerializer(page_images,many=True)
+        serializer = ImageSerializer(page_images,many=True,context={'request':request})
         resp = {'code':0,'data':serializer.data,'count':image_list.count()}
         return Response(resp)
 
@@ -0,0 +1,138 @@
+# coding:utf-8
+# @文件: access_utils.py
+# 文集访问权限相关方法
+# 用户可访问的文集（创建的文集、协作的文集、指定可见的文集）通过两次查询获取，
+# 在单次请求内复用，并按用户和权限版本号短时缓存
+
+from django.core.cache import cache
+from django.db.models import Q
+from app_doc.models import Project,ProjectCollaborator,ProjectRoleUser
+import time
+
+# 用户文集权限缓存有效期，秒数
+ACCESS_CACHE_TIMEOUT = 60
+# 文集权限版本号的缓存键，文集或协作者变更时更新
+ACCESS_VERSION_KEY = 'project_access_version'
+
+# 文集访问检查结果
+ACCESS_ALLOW = 0 # 允许访问
+ACCESS_DENY = 1 # 无权访问
+ACCESS_VIEWCODE = 2 # 需要访问码
+
+
+# 用户的文集权限
+class ProjectAccess():
+    def __init__(self,own_ids=(),colla_roles=None,assigned_ids=()):
+        self.own_ids = set(own_ids) # 用户创建的文集
+        self.colla_roles = colla_roles or {} # 用户协作的文集及协作模式
+        self.assigned_ids = set(assigned_ids) # 指定用户可见的文集
+
+    # 用户是否为文集的创建者或协作者
+    def is_member(self,pro_id):
+        return pro_id in self.own_ids or pro_id in self.colla_roles
+
+    # 用户在文集中的协作模式，非协作者返回 None
+    def colla_role(self,pro_id):
+        return self.colla_roles.get(pro_id)
+
+    # 用户可见的非公开文集
+    @property
+    def private_ids(self):
+        return self.own_ids | set(self.colla_roles) | self.assigned_ids
+
+    # 可见文集的查询条件，public_roles 为所有人可见的文集权限
+    def visible_q(self,public_roles=(0,3)):
+        return Q(role__in=list(public_roles)) | Q(id__in=self.private_ids)
+
+
+# 获取文集权限版本号
+def get_access_version():
+    version = cache.get(ACCESS_VERSION_KEY)
+    if version is None:
+        version = int(time.time() * 1000)
+        if cache.add(ACCESS_VERSION_KEY,version,None) is False:
+            version = cache.get(ACCESS_VERSION_KEY,version)
+    return version
+
+
+# 更新文集权限版本号，使所有用户的文集权限缓存失效
+def bump_access_version():
+    try:
+        cache.incr(ACCESS_VERSION_KEY)
+    except ValueError:
+        cache.set(ACCESS_VERSION_KEY,int(time.time() * 1000),None)
+
+
+# 从数据库读取用户的文集权限
+def load_project_access(user):
+    colla_roles = dict(
+        ProjectCollaborator.objects.filter(user=user).values_list('project_id','role')
+    )
+    own_ids,assigned_ids = set(),set()
+    projects = Project.objects.filter(
+        Q(create_user=user) | Q(role=2,projectroleuser__username=user.username)
+    ).values_list('id','create_user_id').distinct()
+    for pro_id,create_user_id in projects:
+        if create_user_id == user.id:
+            own_ids.add(pro_id)
+        else:
+            assigned_ids.add(pro_id)
+    return ProjectAccess(own_ids,colla_roles,assigned_ids)
+
+
+# 获取请求用户的文集权限
+def get_project_access(request):
+    access = getattr(request,'_project_access',None)
+    if access is not None:
+        return access
+    user = request.user
+    if user.is_authenticated:
+        cache_key = 'project_access_{}_{}'.format(user.id,get_access_version())
+        access = cache.get(cache_key)
+        if access is None:
+            access = load_project_access(user)
+            cache.set(cache_key,access,ACCESS_CACHE_TIMEOUT)
+    else:
+        access = ProjectAccess()
+    request._project_access = access
+    return access
+
+
+# 检查请求用户是否可以访问文集
+# viewcode 为请求提供的访问码，为 None 时从 Cookie 中获取
+def check_project_access(request,project,viewcode=None):
+    # 公开文集
+    if project.role == 0:
+        return ACCESS_ALLOW
+    # 文集的创建者和协作者
+    if request.user.is_authenticated and \
+            (project.create_user_id == request.user.id or get_project_access(request).is_member(project.id)):
+        return ACCESS_ALLOW
+    # 指定用户可见文集
+    if project.role == 2:
+        if project.id in get_project_access(request).assigned_ids:
+            return ACCESS_ALLOW
+        return ACCESS_DENY
+    # 访问码可见文集
+    if project.role == 3:
+        if viewcode is None:
+            viewcode = request.COOKIES.get('viewcode-{}'.format(project.id),0)
+        if project.role_value == viewcode:
+            return ACCESS_ALLOW
+        return ACCESS_VIEWCODE
+    # 私密文集
+    return ACCESS_DENY
+
+
+# 根据文集的 role_value 同步文集的指定可见用户
+def sync_project_role_users(project):
+    if project.role == 2:
+        usernames = {u.strip()[:150] for u in (project.role_value or '').split(',') if u.strip()}
+    else:
+        usernames = set()
+    ProjectRoleUser.objects.filter(project=project).exclude(username__in=usernames).delete()
+    exists = set(ProjectRoleUser.objects.filter(project=project).values_list('username',flat=True))
+    ProjectRoleUser.objects.bulk_create(
+        [ProjectRoleUser(project=project,username=u) for u in usernames - exists]
+    )
+    bump_access_version()
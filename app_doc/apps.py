@@ -3,3 +3,6 @@ from django.apps import AppConfig
 
 class AppDocConfig(AppConfig):
     name = 'app_doc'
+
+    def ready(self):
+        import app_doc.signals # 注册信号处理
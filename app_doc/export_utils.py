@@ -0,0 +1,343 @@
+# coding:utf-8
+# @文件: export_utils.py
+# 文集导出任务
+# 启用后台导出（EXPORT_JOB_ASYNC）时导出请求只创建导出任务并立即返回，由 process_export_jobs 命令在后台按导出类型限制并发执行，
+# 未启用时在请求内执行；前端轮询任务状态获取进度和文件；同一用户对同一文集、同一内容版本的相同任务排队或执行中时直接返回已有任务。
+# 导出文件按导出类型和文集修订指纹缓存在 media/export_cache 下，文集未修改时直接使用缓存文件，
+# 缓存超过大小上限时按最近使用时间淘汰
+
+from django.conf import settings
+from django.db import close_old_connections,transaction
+from django.http import HttpResponseNotModified,StreamingHttpResponse,FileResponse,HttpResponse
+from django.utils.http import content_disposition_header
+from django.utils.translation import gettext_lazy as _
+from app_doc.models import Project,Doc,ExportJob,ProjectReportFile
+from app_doc.report_utils import ReportEPUB,ReportPDF,ReportDocx,ReportMD,ReportMdBatch,validate_title
+from loguru import logger
+import datetime
+import hashlib
+import mimetypes
+import shutil
+import re
+import os
+
+# Range 请求头，只支持单个范围
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+# 导出任务状态
+JOB_QUEUED = 0 # 排队中
+JOB_RUNNING = 1 # 执行中
+JOB_DONE = 2 # 已完成
+JOB_FAILED = 3 # 失败
+
+
+# 文集的修订指纹，由文集的修改时间和文档的ID、修改时间、上级文档、排序及状态计算，文集有修改时变化
+def get_project_revision(pro_ids):
+    pro_ids = sorted(int(i) for i in pro_ids)
+    projects = list(
+        Project.objects.filter(id__in=pro_ids).order_by('id').values_list('id','name','intro','modify_time')
+    )
+    docs = list(
+        Doc.objects.filter(top_doc__in=pro_ids).order_by('id')
+        .values_list('id','modify_time','parent_doc','sort','status')
+    )
+    value = '{}\0{}'.format(projects,docs)
+    return hashlib.md5(value.encode('utf-8')).hexdigest()
+
+
+# 导出文件缓存目录，按导出类型和文集修订指纹存放
+def export_cache_dir(export_type,revision):
+    return os.path.join(settings.MEDIA_ROOT,'export_cache',export_type,revision)
+
+
+# 获取已缓存的导出文件路径，不存在时返回 None；命中时更新目录的修改时间，用于按最近使用淘汰
+def get_cached_export(export_type,revision):
+    folder = export_cache_dir(export_type,revision)
+    try:
+        names = [n for n in os.listdir(folder) if not n.endswith('.tmp')]
+    except FileNotFoundError:
+        return None
+    if not names:
+        return None
+    os.utime(folder)
+    return os.path.join(folder,names[0])
+
+
+# 将导出文件移入缓存目录，返回缓存文件路径
+def store_export_artifact(export_type,revision,file_path,filename):
+    folder = export_cache_dir(export_type,revision)
+    os.makedirs(folder,exist_ok=True)
+    cache_path = os.path.join(folder,filename)
+    os.replace(file_path,cache_path)
+    evict_export_cache(keep=folder)
+    return cache_path
+
+
+# 按最近使用时间淘汰导出文件缓存，使缓存总大小不超过 EXPORT_CACHE_MAX_SIZE，文集当前的导出文件不会被淘汰
+def evict_export_cache(max_size=None,keep=None):
+    if max_size is None:
+        max_size = settings.EXPORT_CACHE_MAX_SIZE
+    root = os.path.join(settings.MEDIA_ROOT,'export_cache')
+    protected = {
+        os.path.normpath(os.path.dirname(settings.BASE_DIR + p))
+        for p in ProjectReportFile.objects.filter(file_path__startswith='/media/export_cache/').values_list('file_path',flat=True)
+    }
+    if keep is not None:
+        protected.add(os.path.normpath(keep))
+    folders = []
+    total = 0
+    for export_type in os.listdir(root) if os.path.isdir(root) else []:
+        for revision in os.listdir(os.path.join(root,export_type)):
+            folder = os.path.join(root,export_type,revision)
+            size = sum(e.stat().st_size for e in os.scandir(folder) if e.is_file())
+            folders.append((os.stat(folder).st_mtime,size,folder))
+            total += size
+    removed = 0
+    for mtime,size,folder in sorted(folders):
+        if total <= max_size:
+            break
+        if os.path.normpath(folder) in protected:
+            continue
+        shutil.rmtree(folder,ignore_errors=True)
+        total -= size
+        removed += 1
+    return removed
+
+
+# 创建导出任务，文集未修改时直接返回已缓存的导出文件，用户的相同任务排队或执行中时返回已有任务
+def create_export_job(user,export_type,pro_ids):
+    """
+    export_type：epub、pdf、docx、md 为导出单个文集，md_batch 为批量导出文集MD文件
+    pro_ids：文集ID列表
+    """
+    pro_ids = sorted({int(i) for i in pro_ids})
+    if export_type == 'md_batch':
+        project_id,params = None,','.join(str(i) for i in pro_ids)
+    else:
+        project_id,params = pro_ids[0],''
+    revision = get_project_revision(pro_ids)
+    cached = get_cached_export(export_type,revision)
+    if cached is not None:
+        file_path = media_url(cached)
+        if export_type in REPORT_FILE_TYPES:
+            save_project_report_file(project_id,export_type,file_path)
+        return ExportJob.objects.create(
+            project_id=project_id,user=user,export_type=export_type,params=params,content_version=revision,
+            status=JOB_DONE,progress=100,file_path=file_path,finish_time=datetime.datetime.now()
+        )
+    # 任务状态只有创建者可以查询，不复用其他用户的任务
+    job = ExportJob.objects.filter(
+        user=user,project_id=project_id,export_type=export_type,params=params,
+        content_version=revision,status__in=[JOB_QUEUED,JOB_RUNNING]
+    ).order_by('id').first()
+    if job is None:
+        job = ExportJob.objects.create(
+            project_id=project_id,user=user,export_type=export_type,
+            params=params,content_version=revision
+        )
+        # 未启用后台导出时在请求内执行
+        if not settings.EXPORT_JOB_ASYNC and claim_export_job(job.id):
+            run_export_job(job)
+            job.refresh_from_db()
+    return job
+
+
+# 导出任务的状态数据
+def export_job_dict(job):
+    return {
+        'job_id':job.id,
+        'status':job.status,
+        'progress':job.progress,
+        'message':job.message,
+        'file_path':job.file_path,
+    }
+
+
+# 领取排队中的任务，返回是否领取成功
+def claim_export_job(job_id):
+    return ExportJob.objects.filter(id=job_id,status=JOB_QUEUED).update(
+        status=JOB_RUNNING,start_time=datetime.datetime.now()
+    ) == 1
+
+
+# 更新任务进度
+def set_export_progress(job_id,progress):
+    ExportJob.objects.filter(id=job_id).update(progress=progress)
+
+
+# 转换为以 /media 开头的文件相对路径
+def media_url(file_path):
+    return settings.MEDIA_URL + os.path.relpath(file_path,settings.MEDIA_ROOT).replace(os.sep,'/')
+
+
+# 保存文集的导出文件记录，删除不在缓存目录中的旧导出文件
+def save_project_report_file(project_id,file_type,file_path):
+    for r in ProjectReportFile.objects.filter(project_id=project_id,file_type=file_type).exclude(file_path=file_path):
+        if not r.file_path.startswith('/media/export_cache/') and os.path.exists(settings.BASE_DIR + r.file_path):
+            os.remove(settings.BASE_DIR + r.file_path)
+        r.delete()
+    ProjectReportFile.objects.get_or_create(
+        project_id=project_id,file_type=file_type,file_path=file_path,defaults={'file_name':file_path}
+    )
+
+
+# 导出文件的文件名
+def export_filename(job,ext):
+    if job.project_id is None:
+        return 'mrdoc_report_md.zip'
+    return '{}.{}'.format(validate_title(job.project.name),ext)
+
+
+# 各导出类型的执行方法，返回导出文件的绝对路径，导出失败时返回 None
+def export_epub(job):
+    epub_file = ReportEPUB(project_id=job.project_id,progress=lambda p:set_export_progress(job.id,p)).work()
+    return None if epub_file is None else epub_file + '.epub'
+
+
+def export_pdf(job):
+    pdf_file = ReportPDF(project_id=job.project_id,user_id=job.user_id).work()
+    return None if pdf_file is False else pdf_file
+
+
+def export_docx(job):
+    return ReportDocx(project_id=job.project_id).work()
+
+
+def export_md(job):
+    return ReportMD(project_id=job.project_id).work()
+
+
+def export_md_batch(job):
+    return ReportMdBatch(username=job.user.username,project_id_list=job.params.split(',')).work()
+
+
+EXPORTERS = {
+    'epub':(export_epub,'epub'),
+    'pdf':(export_pdf,'pdf'),
+    'docx':(export_docx,'docx'),
+    'md':(export_md,'zip'),
+    'md_batch':(export_md_batch,'zip'),
+}
+# 记录为文集导出文件（ProjectReportFile）的导出类型
+REPORT_FILE_TYPES = ('epub','pdf','docx')
+
+
+# 执行已领取的导出任务，导出文件移入缓存目录
+def run_export_job(job):
+    set_export_progress(job.id,10)
+    exporter,ext = EXPORTERS[job.export_type]
+    try:
+        file_path = exporter(job)
+        if file_path is not None:
+            file_path = media_url(store_export_artifact(
+                job.export_type,job.content_version,file_path,export_filename(job,ext)
+            ))
+            if job.export_type in REPORT_FILE_TYPES:
+                save_project_report_file(job.project_id,job.export_type,file_path)
+    except Exception:
+        logger.exception(_("执行导出任务出错"))
+        file_path = None
+    # 只更新执行中的任务，执行超时已标记为失败的任务不再改为完成
+    if file_path is None:
+        ExportJob.objects.filter(id=job.id,status=JOB_RUNNING).update(
+            status=JOB_FAILED,message=_('生成出错'),finish_time=datetime.datetime.now()
+        )
+        return False
+    return ExportJob.objects.filter(id=job.id,status=JOB_RUNNING).update(
+        status=JOB_DONE,progress=100,file_path=file_path,finish_time=datetime.datetime.now()
+    ) == 1
+
+
+# 在线程池中执行导出任务
+def run_export_job_thread(job_id):
+    close_old_connections()
+    try:
+        run_export_job(ExportJob.objects.select_related('user').get(id=job_id))
+    finally:
+        close_old_connections()
+
+
+# 领取可执行的导出任务，返回已领取的任务ID列表
+def claim_export_jobs(concurrency):
+    """
+    concurrency：{导出类型: 最大并发数}，执行中的任务数包括其他进程中执行的任务；
+    每种导出类型在一个事务内领取：先锁定排队中的任务，多个进程同时领取时依次执行，
+    锁定后再统计执行中的任务数，按剩余名额逐个将排队中的任务改为执行中
+    """
+    claimed = []
+    for export_type,limit in concurrency.items():
+        with transaction.atomic():
+            job_ids = list(
+                ExportJob.objects.select_for_update().filter(status=JOB_QUEUED,export_type=export_type)
+                .order_by('id').values_list('id',flat=True)[:limit]
+            )
+            if not job_ids:
+                continue
+            free = limit - ExportJob.objects.filter(status=JOB_RUNNING,export_type=export_type).count()
+            claimed += [i for i in job_ids[:max(free,0)] if claim_export_job(i)]
+    return claimed
+
+
+# 将执行时间超过 timeout 秒的任务标记为失败（执行任务的进程已退出）
+def fail_stale_export_jobs(timeout):
+    deadline = datetime.datetime.now() - datetime.timedelta(seconds=timeout)
+    return ExportJob.objects.filter(status=JOB_RUNNING,start_time__lt=deadline).update(
+        status=JOB_FAILED,message=_('导出超时'),finish_time=datetime.datetime.now()
+    )
+
+
+# 导出文件的 ETag，缓存文件由导出类型和文集修订指纹确定，其他文件使用文件大小和修改时间
+def export_file_etag(file_path,stat):
+    parts = file_path.strip('/').split('/')
+    if len(parts) == 5 and parts[:2] == ['media','export_cache']:
+        return '"{}-{}"'.format(parts[2],parts[3])
+    return '"{:x}-{:x}"'.format(stat.st_size,stat.st_mtime_ns)
+
+
+# 读取文件的指定范围
+def iter_file_range(path,start,length,chunk_size=64 * 1024):
+    with open(path,'rb') as f:
+        f.seek(start)
+        while length > 0:
+            data = f.read(min(chunk_size,length))
+            if not data:
+                break
+            length -= len(data)
+            yield data
+
+
+# 下载导出文件，支持 ETag 条件请求和单个范围的 Range 请求；文件不存在时抛出 FileNotFoundError
+def export_file_response(request,file_path):
+    path = settings.BASE_DIR + file_path
+    stat = os.stat(path)
+    etag = export_file_etag(file_path,stat)
+    if file_path.startswith('/media/export_cache/'):
+        os.utime(os.path.dirname(path)) # 更新最近使用时间
+    if etag in [t.strip() for t in request.headers.get('If-None-Match','').split(',')]:
+        response = HttpResponseNotModified()
+        response['ETag'] = etag
+        return response
+
+    size = stat.st_size
+    match = RANGE_RE.match(request.headers.get('Range','').strip())
+    # If-Range 与 ETag 不一致时返回完整文件
+    if match and request.headers.get('If-Range',etag) == etag and match.group(0) != 'bytes=-':
+        start,end = match.groups()
+        if start == '': # 最后 N 个字节
+            start,end = max(size - int(end),0),size - 1
+        else:
+            start,end = int(start),min(int(end),size - 1) if end else size - 1
+        if start >= size or start > end:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = 'bytes */{}'.format(size)
+            return response
+        response = StreamingHttpResponse(iter_file_range(path,start,end - start + 1),status=206)
+        response['Content-Range'] = 'bytes {}-{}/{}'.format(start,end,size)
+        response['Content-Length'] = str(end - start + 1)
+        response['Content-Type'] = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        response['Content-Disposition'] = content_disposition_header(True,os.path.basename(path))
+    else:
+        response = FileResponse(open(path,'rb'),as_attachment=True,filename=os.path.basename(path))
+    response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = etag
+    return response
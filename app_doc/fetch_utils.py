@@ -0,0 +1,107 @@
+# coding:utf-8
+# @文件: fetch_utils.py
+# 远程图片下载
+# 所有下载共用一个带连接池的会话，设置连接和读取超时及下载的总时长，边读取边检查大小和时长，超出上限立即中止；
+# 图片类型根据文件头判断，不信任远程服务器返回的 Content-Type；批量下载在线程池中并发进行
+
+from django.conf import settings
+from django.utils.translation import gettext_lazy as _
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+import threading
+import requests
+import time
+
+# 连接超时和读取超时秒数
+FETCH_TIMEOUT = (5, 15)
+# 单个图片下载的最长总秒数，防止远程服务器缓慢地持续发送数据
+FETCH_TOTAL_TIMEOUT = 30
+# 批量下载的图片数量上限
+FETCH_MAX_URLS = 50
+# 批量下载的并发数，同时也是连接池中每个主机的连接数上限
+FETCH_MAX_WORKERS = 8
+# 读取的分块大小
+FETCH_CHUNK_SIZE = 65536
+FETCH_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/86.0.4240.198 Safari/537.36"
+}
+
+
+# 远程图片下载失败
+class RemoteFetchError(Exception):
+    pass
+
+
+_fetch_session = None
+_fetch_session_lock = threading.Lock()
+
+
+# 获取进程内共用的下载会话
+def get_fetch_session():
+    global _fetch_session
+    with _fetch_session_lock:
+        if _fetch_session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=FETCH_MAX_WORKERS, pool_maxsize=FETCH_MAX_WORKERS, max_retries=0)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            session.headers.update(FETCH_HEADERS)
+            _fetch_session = session
+    return _fetch_session
+
+
+# 根据文件头判断图片格式，返回文件后缀，不是图片时返回 None
+def sniff_image_type(head):
+    if head.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'png'
+    if head.startswith(b'\xff\xd8\xff'):
+        return 'jpg'
+    if head[:6] in (b'GIF87a', b'GIF89a'):
+        return 'gif'
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'webp'
+    if head.startswith(b'BM'):
+        return 'bmp'
+    return None
+
+
+# 下载远程图片，返回 (文件内容, 文件后缀)
+# max_size 为图片大小上限（字节），超出时中止下载并抛出 RemoteFetchError；
+# total_timeout 为下载的最长总秒数，超出时中止下载并抛出 RemoteFetchError
+def fetch_image(url, max_size, timeout=FETCH_TIMEOUT, total_timeout=FETCH_TOTAL_TIMEOUT):
+    deadline = time.monotonic() + total_timeout
+    try:
+        with get_fetch_session().get(url, stream=True, timeout=timeout) as r:
+            if r.status_code != 200:
+                raise RemoteFetchError(_("远程图片请求失败：{}").format(r.status_code))
+            content_length = r.headers.get('Content-Length')
+            if content_length and content_length.isdigit() and int(content_length) > max_size:
+                raise RemoteFetchError(_("远程图片大小超出限制"))
+            data = bytearray()
+            for chunk in r.iter_content(FETCH_CHUNK_SIZE):
+                data += chunk
+                if len(data) > max_size:
+                    raise RemoteFetchError(_("远程图片大小超出限制"))
+                if time.monotonic() > deadline:
+                    raise RemoteFetchError(_("远程图片下载超时"))
+    except requests.RequestException as e:
+        raise RemoteFetchError(_("远程图片请求异常：{}").format(repr(e)))
+    file_suffix = sniff_image_type(bytes(data[:16]))
+    if file_suffix is None or file_suffix not in settings.ALLOWED_IMG:
+        raise RemoteFetchError(_("远程文件不是有效的图片"))
+    return bytes(data), file_suffix
+
+
+# 并发下载多个远程图片，返回 {url: (文件内容, 文件后缀) 或 RemoteFetchError}
+def fetch_images(urls, max_size, timeout=FETCH_TIMEOUT):
+    urls = list(dict.fromkeys(urls))
+    if not urls:
+        return {}
+
+    def fetch(url):
+        try:
+            return fetch_image(url, max_size, timeout)
+        except RemoteFetchError as e:
+            return e
+    with ThreadPoolExecutor(max_workers=min(FETCH_MAX_WORKERS, len(urls))) as executor:
+        return dict(zip(urls, executor.map(fetch, urls)))
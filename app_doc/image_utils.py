@@ -0,0 +1,227 @@
+# coding:utf-8
+# @文件: image_utils.py
+# 图片内容寻址存储
+# 上传的图片在写入磁盘时计算 SHA256，按内容哈希存放在 media/images 下，内容相同的图片只保存一份，
+# 多条图片数据共用同一个文件；缩略图在首次访问时生成 WebP 格式并缓存
+
+from django.conf import settings
+from django.urls import reverse
+from app_doc.models import Image
+from urllib.parse import quote
+from loguru import logger
+import tempfile
+import hashlib
+import os
+
+# 图片存储的文件夹（位于媒体文件夹内）
+IMAGE_STORE_DIR = 'images'
+# 缩略图缓存的文件夹（位于媒体文件夹内）
+THUMBNAIL_DIR = 'thumbnails'
+# 缩略图尺寸：s 用于图片列表，m 用于预览
+THUMBNAIL_SIZES = {
+    's': 300,
+    'm': 1200,
+}
+# 缩略图的 WebP 压缩质量
+THUMBNAIL_QUALITY = 80
+
+
+# 内容哈希对应的图片url，形如 /media/images/ab/cd/abcd...ef.png
+def image_store_url(content_hash, file_suffix):
+    return '{}{}/{}/{}/{}.{}'.format(
+        settings.MEDIA_URL, IMAGE_STORE_DIR, content_hash[:2], content_hash[2:4], content_hash, file_suffix.lower()
+    )
+
+
+# 媒体文件url对应的文件路径
+def media_file_path(file_url):
+    if not file_url.startswith(settings.MEDIA_URL):
+        return None
+    file_path = os.path.realpath(os.path.join(settings.MEDIA_ROOT, file_url[len(settings.MEDIA_URL):]))
+    if not file_path.startswith(os.path.realpath(settings.MEDIA_ROOT) + os.sep):
+        return None
+    return file_path
+
+
+# 存储中的图片url对应的内容哈希，旧图片返回 None
+def store_content_hash(file_url):
+    if file_url.startswith(settings.MEDIA_URL + IMAGE_STORE_DIR + '/'):
+        return os.path.basename(file_url).split('.')[0]
+    return None
+
+
+# 写入图片文件，返回 (图片url, 内容哈希, 是否新建了文件)
+# chunks 为文件内容的分块，边写入临时文件边计算哈希，内容相同的图片已存在时删除临时文件
+def store_image(chunks, file_suffix):
+    store_dir = os.path.join(settings.MEDIA_ROOT, IMAGE_STORE_DIR)
+    os.makedirs(store_dir, exist_ok=True)
+    file_hash = hashlib.sha256()
+    with tempfile.NamedTemporaryFile(dir=store_dir, suffix='.tmp', delete=False) as f:
+        try:
+            for chunk in chunks:
+                file_hash.update(chunk)
+                f.write(chunk)
+        except Exception:
+            f.close()
+            os.remove(f.name)
+            raise
+    content_hash = file_hash.hexdigest()
+    file_url = image_store_url(content_hash, file_suffix)
+    file_path = media_file_path(file_url)
+    if os.path.exists(file_path):
+        os.remove(f.name)
+        return file_url, content_hash, False
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    os.replace(f.name, file_path)
+    return file_url, content_hash, True
+
+
+# 保存上传的图片并写入图片数据
+def save_image(user, chunks, file_suffix, file_name, remark, group=None):
+    file_url, content_hash, created = store_image(chunks, file_suffix)
+    return Image.objects.create(
+        user=user,
+        file_path=file_url,
+        file_name=file_name,
+        remark=remark,
+        group=group,
+        content_hash=content_hash,
+    )
+
+
+# 删除图片数据，图片文件和缩略图在没有其他图片数据引用时删除
+def delete_images(images):
+    images = list(images)
+    Image.objects.filter(id__in=[i.id for i in images]).delete()
+    file_paths = {i.file_path for i in images}
+    content_hashes = {i.content_hash for i in images if i.content_hash}
+    used_paths = set(Image.objects.filter(file_path__in=file_paths).values_list('file_path', flat=True))
+    used_hashes = set(Image.objects.filter(content_hash__in=content_hashes).values_list('content_hash', flat=True))
+    for image in images:
+        if image.file_path in used_paths:
+            continue
+        remove_file(media_file_path(image.file_path))
+        for size in THUMBNAIL_SIZES:
+            remove_file(thumbnail_path(image.file_path, store_content_hash(image.file_path), size))
+        # 旧图片文件迁移后与存储中的文件为硬链接，同时删除存储中的文件
+        if image.content_hash and image.content_hash not in used_hashes:
+            file_suffix = image.file_path.split('.')[-1]
+            remove_file(media_file_path(image_store_url(image.content_hash, file_suffix)))
+
+
+# 删除存在的文件
+def remove_file(file_path):
+    if file_path and os.path.exists(file_path):
+        os.remove(file_path)
+
+
+# 缩略图的缓存文件路径，存储中的图片以内容哈希命名，旧图片以url的哈希命名
+def thumbnail_path(file_url, content_hash, size):
+    key = content_hash or hashlib.sha1(file_url.encode('utf-8')).hexdigest()
+    return os.path.join(settings.MEDIA_ROOT, THUMBNAIL_DIR, size, key[:2], key + '.webp')
+
+
+# 获取缩略图文件路径，缩略图不存在或原图已修改时重新生成；不是有效的图片时返回 None
+def get_thumbnail(file_url, size='s'):
+    from PIL import Image as PILImage
+
+    source = media_file_path(file_url)
+    if source is None or size not in THUMBNAIL_SIZES or not os.path.exists(source):
+        return None
+    if file_url.split('.')[-1].lower() not in settings.ALLOWED_IMG:
+        return None
+    target = thumbnail_path(file_url, store_content_hash(file_url), size)
+    if os.path.exists(target) and os.path.getmtime(target) >= os.path.getmtime(source):
+        return target
+    try:
+        with PILImage.open(source) as image:
+            image.thumbnail((THUMBNAIL_SIZES[size], THUMBNAIL_SIZES[size]))
+            if image.mode not in ('RGB', 'RGBA'):
+                image = image.convert('RGBA' if image.has_transparency_data else 'RGB')
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with tempfile.NamedTemporaryFile(dir=os.path.dirname(target), suffix='.tmp', delete=False) as f:
+                image.save(f, format='WEBP', quality=THUMBNAIL_QUALITY)
+            os.replace(f.name, target)
+    except Exception:
+        logger.exception("生成缩略图异常")
+        return None
+    return target
+
+
+# 缩略图url，缩略图已生成时直接返回媒体文件url，否则返回生成缩略图的地址；
+# generate 为 False 时（调用方无法访问需要登录的缩略图地址）缩略图未生成则返回原图url
+def thumbnail_url(file_url, size='s', generate=True):
+    target = thumbnail_path(file_url, store_content_hash(file_url), size)
+    if os.path.exists(target):
+        return settings.MEDIA_URL + os.path.relpath(target, settings.MEDIA_ROOT).replace(os.sep, '/')
+    if not generate:
+        return file_url
+    return '{}?path={}&size={}'.format(reverse('image_thumbnail'), quote(file_url), size)
+
+
+# 计算文件内容的 SHA256
+def file_content_hash(file_path):
+    file_hash = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+# 将旧图片文件迁移到图片存储，返回统计数据
+# 旧文件与存储中的文件建立硬链接，原有的图片url保持可用；内容重复的旧文件替换为指向同一文件的硬链接，回收其磁盘空间
+def migrate_image_files(dry_run=False, batch_size=500):
+    stats = {'images': 0, 'missing': 0, 'files': 0, 'duplicates': 0, 'reclaimed_bytes': 0}
+    file_hashes = {} # 已处理的文件路径及其内容哈希
+    stored = set() # 试运行时视为已存入存储的文件
+    last_id = 0
+    while True:
+        images = list(
+            Image.objects.filter(id__gt=last_id, content_hash__isnull=True).order_by('id')[:batch_size]
+        )
+        if not images:
+            break
+        last_id = images[-1].id
+        for image in images:
+            stats['images'] += 1
+            file_path = media_file_path(image.file_path)
+            if file_path is None or not os.path.isfile(file_path):
+                stats['missing'] += 1
+                continue
+            if file_path not in file_hashes:
+                file_hashes[file_path] = file_content_hash(file_path)
+                stats['files'] += 1
+                try:
+                    migrate_image_file(file_path, image.file_path, file_hashes[file_path], stats, stored, dry_run)
+                except OSError:
+                    logger.exception("迁移图片文件异常：{}".format(file_path))
+            image.content_hash = file_hashes[file_path]
+        if not dry_run:
+            Image.objects.bulk_update([i for i in images if i.content_hash], ['content_hash'])
+    return stats
+
+
+# 迁移单个图片文件
+def migrate_image_file(file_path, file_url, content_hash, stats, stored, dry_run):
+    store_url = image_store_url(content_hash, file_url.split('.')[-1])
+    store_path = media_file_path(store_url)
+    if store_path == file_path:
+        return
+    if not os.path.exists(store_path) and store_url not in stored:
+        # 存储中没有该内容的文件，与旧文件建立硬链接
+        stored.add(store_url)
+        if not dry_run:
+            os.makedirs(os.path.dirname(store_path), exist_ok=True)
+            os.link(file_path, store_path)
+        return
+    if os.path.exists(store_path) and os.path.samefile(file_path, store_path):
+        return
+    # 内容重复的旧文件替换为硬链接，文件没有其他硬链接时回收其磁盘空间
+    stat = os.stat(file_path)
+    stats['duplicates'] += 1
+    if stat.st_nlink == 1:
+        stats['reclaimed_bytes'] += stat.st_size
+    if not dry_run:
+        temp_path = file_path + '.tmp'
+        os.link(store_path, temp_path)
+        os.replace(temp_path, file_path)
@@ -7,212 +7,229 @@
 
 from django.utils.translation import gettext_lazy as _
 from app_doc.models import Doc,Project,Image
-from app_doc.util_upload_img import upload_generation_dir
-from app_doc.utils import libreoffice_wmf_conversion,image_trim
-from django.db import transaction
+from app_doc.image_utils import store_image,store_content_hash,media_file_path
+from app_doc.utils import submit_wmf_conversion,trim_image_bytes
+from app_doc.toc_utils import bump_toc_version
+from django.db import transaction,connection
 from django.conf import settings
 from loguru import logger
 from markdownify import markdownify
+from concurrent.futures import ThreadPoolExecutor
 import mammoth
-import shutil
 import os
-import time
 import re
 import yaml
 import sys
+import posixpath
+import zipfile
+import uuid
 
 
-# 导入Zip文集
-class ImportZipProject():
-    # 读取 Zip 压缩包
-    def read_zip(self,zip_file_path,create_user):
-        # 导入流程：
-        # 1、解压zip压缩包文件到temp文件夹
-        # 2、遍历temp文件夹内的解压后的.md文件
-        # 3、读取.md文件的文本内容
-        # 4、如果里面匹配到相对路径的静态文件，从指定文件夹里面读取
-        # 5、上传图片，写入数据库，修改.md文件里面的url路径
+# 导入时并行复制静态文件的线程数
+IMPORT_MEDIA_WORKERS = 4
+# 批量新建文档的每批数量
+IMPORT_BATCH_SIZE = 500
+# MD内容中的图片链接
+MD_MEDIA_PATTERN = re.compile(r"\!\[.*?\]\((.*?)\)")
 
-        # 新建一个临时文件夹，用于存放解压的文件
-        self.temp_dir = zip_file_path[:-4]
-        os.mkdir(self.temp_dir)
-        # 解压 zip 文件到指定临时文件夹
-        shutil.unpack_archive(zip_file_path, extract_dir=self.temp_dir)
 
-        # 处理文件夹和文件名的中文乱码
-        sys_encoding = 'gbk'
-        for root, dirs, files in os.walk(self.temp_dir):
-            for dir in dirs:
-                try:
-                    new_dir = dir.encode('cp437').decode(sys_encoding)
-                except:
-                    new_dir = dir.encode('utf-8').decode('utf-8')
-                # print(new_dir)
-                os.rename(os.path.join(root, dir), os.path.join(root, new_dir))
+# 压缩包内文件的名称，处理文件夹和文件名的中文乱码
+def zip_member_name(info):
+    name = info.filename
+    # 未设置UTF-8标记的文件名按 cp437 解码，尝试转换为 gbk
+    if not info.flag_bits & 0x800:
+        try:
+            name = name.encode('cp437').decode('gbk')
+        except UnicodeError:
+            pass
+    return posixpath.normpath(name.replace('\\','/')).lstrip('/')
 
-            for file in files:
-                try:
-                    new_file = file.encode('cp437').decode(sys_encoding)
-                except:
-                    new_file = file.encode('utf-8').decode('utf-8')
-                # print(root, new_file)
-                os.rename(os.path.join(root, file), os.path.join(root, new_file))
 
-        # 读取yaml文件
+# 导入Zip文集
+class ImportZipProject():
+    # 读取 Zip 压缩包，返回文集id或None
+    def read_zip(self,zip_file_path,create_user):
+        # 导入流程：
+        # 1、读取压缩包内的 mrdoc.yaml，将目录解析为文档树，没有 yaml 文件时导入根目录下的 .md 文件
+        # 2、读取 .md 文件的文本内容，收集其中引用的压缩包内的静态文件
+        # 3、多线程复制静态文件到媒体文件夹，内容相同的文件只保存一份
+        # 4、在同一个事务中新建文集，按目录层级批量新建文档，批量写入图片数据，修改.md文件里面的url路径
+        self.create_user = create_user
+        self.new_files = [] # 本次导入新建的静态文件，导入失败时删除
+        project_id = None
         try:
-            with open(os.path.join(self.temp_dir ,'mrdoc.yaml'),'r',encoding='utf-8') as yaml_file:
-                yaml_str = yaml.safe_load(yaml_file.read())
-                project_name = yaml_str['project_name'] \
-                    if 'project_name' in yaml_str.keys() else zip_file_path[:-4].split('/')[-1]
-                project_desc = yaml_str['project_desc'] if 'project_desc' in yaml_str.keys() else ''
-                project_role = yaml_str['project_role'] if 'project_role' in yaml_str.keys() else 1
-                editor_mode = yaml_str['editor_mode'] if 'editor_mode' in yaml_str.keys() else 1
-                project_toc = yaml_str['toc']
-                toc_item_list = []
-                for toc in project_toc:
-                    # print(toc)
-                    item = {
-                        'name': toc['name'],
-                        'file': toc['file'],
-                        'parent': 0,
-                    }
-                    toc_item_list.append(item)
-                    if 'children' in toc.keys():
-                        for b in toc['children']:
-                            item = {
-                                'name': b['name'],
-                                'file': b['file'],
-                                'parent': toc['name']
-                            }
-                            toc_item_list.append(item)
-                            if 'children' in b.keys():
-                                for c in b['children']:
-                                    item = {
-                                        'name': c['name'],
-                                        'file': c['file'],
-                                        'parent': b['name']
-                                    }
-                                    toc_item_list.append(item)
-
+            with zipfile.ZipFile(zip_file_path) as zf:
+                self.zf = zf
+                self.members = {}
+                for info in zf.infolist():
+                    if not info.is_dir():
+                        self.members[zip_member_name(info)] = info
+                meta,nodes = self.load_toc(zip_file_path[:-4].split('/')[-1])
+                media = self.load_contents(nodes)
+                media_urls = self.copy_media(media)
+            project_id = self.save(meta,nodes,media_urls)
+        except Exception:
+            logger.exception(_("解析导入文件异常"))
+            for file_path in self.new_files:
+                if os.path.exists(file_path):
+                    os.remove(file_path)
+        try:
+            os.remove(zip_file_path)
+        except Exception:
+            logger.exception(_("删除临时文件异常"))
+        return project_id
 
-        except:
+    # 读取yaml文件，返回文集信息和按目录顺序排列的文档节点
+    def load_toc(self,default_name):
+        meta = {}
+        if 'mrdoc.yaml' in self.members:
+            try:
+                meta = yaml.safe_load(self.zf.read(self.members['mrdoc.yaml']).decode('utf-8'))
+            except (yaml.YAMLError,UnicodeError):
+                logger.exception(_("yaml文件格式错误"))
+            if not isinstance(meta,dict):
+                meta = {}
+        else:
             logger.error(_("未发现yaml文件"))
-            project_name = zip_file_path[:-4].split('/')[-1]
-            project_desc = ''
-            project_role = 1
-            editor_mode = 1
-            project_toc = False
+        meta = {
+            'name': meta.get('project_name') or default_name,
+            'desc': meta.get('project_desc') or '',
+            'role': meta.get('project_role',1),
+            'editor_mode': meta.get('editor_mode',1),
+            'toc': meta.get('toc'),
+        }
+        nodes = []
+        if meta['toc']:
+            self.walk_toc(meta['toc'],None,0,nodes)
+        else:
+            # 没有目录时导入根目录下的 .md 文件
+            for name in sorted(self.members):
+                if '/' not in name and name.endswith('.md'):
+                    nodes.append({'name':name[:-3],'file':name,'parent':None,'level':0})
+        return meta,nodes
 
-        # 开启事务
-        with transaction.atomic():
-            save_id = transaction.savepoint()
-            try:
-                # 新建文集
-                project = Project.objects.create(
-                    name=project_name,
-                    intro=project_desc,
-                    role=project_role,
-                    create_user=create_user
-                )
-                if project_toc is False:
-                    # 遍历临时文件夹中的所有文件和文件夹
-                    for f in os.listdir(self.temp_dir):
-                        # 获取 .md 文件
-                        if f.endswith('.md'):
-                            # print(f)
-                            # 读取 .md 文件文本内容
-                            with open(os.path.join(self.temp_dir,f),'r',encoding='utf-8') as md_file:
-                                md_content = md_file.read()
-                                md_content = self.operat_md_media(md_content,create_user)
-                                # 新建文档
-                                doc = Doc.objects.create(
-                                    name = f[:-3],
-                                    pre_content = md_content,
-                                    top_doc = project.id,
-                                    status = 0,
-                                    editor_mode = editor_mode,
-                                    create_user = create_user
-                                )
-                else:
-                    for i in toc_item_list:
-                        with open(os.path.join(self.temp_dir,i['file']),'r',encoding='utf-8') as md_file:
-                            md_content = md_file.read()
-                            md_content = self.operat_md_media(md_content, create_user)
-                            # 新建文档
-                            doc = Doc.objects.create(
-                                name=i['name'],
-                                pre_content=md_content,
-                                top_doc=project.id,
-                                parent_doc = (Doc.objects.get(top_doc=project.id,name=i['parent'])).id \
-                                    if i['parent'] != 0 else 0,
-                                status=0,
-                                editor_mode=editor_mode,
-                                create_user=create_user
-                            )
-            except:
-                logger.exception(_("解析导入文件异常"))
-                # 回滚事务
-                transaction.savepoint_rollback(save_id)
+    # 遍历目录，子文档通过节点关联上级文档，不依赖文档名称
+    def walk_toc(self,items,parent,level,nodes):
+        for item in items:
+            if not isinstance(item,dict):
+                continue
+            node = {
+                'name': str(item.get('name','')),
+                'file': str(item.get('file','')),
+                'parent': parent,
+                'level': level,
+            }
+            nodes.append(node)
+            if item.get('children'):
+                self.walk_toc(item['children'],node,level+1,nodes)
 
-            transaction.savepoint_commit(save_id)
-        try:
-            shutil.rmtree(self.temp_dir)
-            os.remove(zip_file_path)
-            return project.id
-        except:
-            logger.exception(_("删除临时文件异常"))
+    # 读取文档的文本内容，返回所有文档引用的静态文件名称
+    def load_contents(self,nodes):
+        media = set()
+        for node in nodes:
+            info = self.members.get(posixpath.normpath(node['file']).lstrip('/'))
+            node['content'] = self.zf.read(info).decode('utf-8') if info is not None else ''
+            node['media'] = {}
+            for media_filename in set(MD_MEDIA_PATTERN.findall(node['content'])):
+                member = self.media_member(media_filename)
+                if member is not None:
+                    node['media'][media_filename] = member
+                    media.add(member)
+        return sorted(media)
+
+    # MD内容中的本地图片路径对应的压缩包内文件名称，不是压缩包内的图片时返回 None
+    def media_member(self,media_filename):
+        if media_filename.startswith("./"):
+            name = media_filename[2:]
+        elif media_filename.startswith("/"):
+            name = media_filename[1:]
+        else:
+            return None
+        # 获取文件后缀
+        if name.split('.')[-1].lower() not in settings.ALLOWED_IMG:
             return None
+        name = posixpath.normpath(name)
+        return name if name in self.members else None
 
-    # 处理MD内容中的静态文件
-    def operat_md_media(self,md_content,create_user):
-        # 查找MD内容中的静态文件
-        pattern = r"\!\[.*?\]\(.*?\)"
-        media_list = re.findall(pattern, md_content)
-        # print(media_list)
-        # 存在静态文件,进行遍历
-        if len(media_list) > 0:
-            for media in media_list:
-                media_filename = media.split("(")[-1].split(")")[0] # 媒体文件的文件名
-                # 存在本地图片路径
-                if media_filename.startswith("./") or media_filename.startswith("/"):
-                    # 获取文件后缀
-                    file_suffix = media_filename.split('.')[-1]
-                    if file_suffix.lower() not in settings.ALLOWED_IMG:
-                        continue
-                    # 判断本地图片路径是否存在
-                    if media_filename.startswith("./"):
-                        temp_media_file_path = os.path.join(self.temp_dir,media_filename[2:])
-                    else :
-                        temp_media_file_path = os.path.join(self.temp_dir, media_filename[1:])
-                    if os.path.exists(temp_media_file_path):
-                        # 如果存在，上传本地图片
-                        dir_name = upload_generation_dir() # 获取当月文件夹名称
+    # 多线程复制静态文件到媒体文件夹，返回 {压缩包内文件名称: 图片url}
+    def copy_media(self,media):
+        if not media:
+            return {}
+        with ThreadPoolExecutor(max_workers=IMPORT_MEDIA_WORKERS) as executor:
+            urls = executor.map(self.copy_media_file,media)
+            return dict(zip(media,urls))
 
-                        # 复制文件到媒体文件夹
-                        copy2_filename = dir_name + '/' + str(time.time()) + '.' + file_suffix
-                        new_media_file_path = shutil.copy2(
-                            temp_media_file_path,
-                            settings.MEDIA_ROOT + copy2_filename
-                        )
+    # 复制静态文件到图片存储，内容相同的文件只保存一份
+    def copy_media_file(self,name):
+        with self.zf.open(self.members[name]) as src:
+            file_url,content_hash,created = store_image(iter(lambda: src.read(1024 * 1024),b''),name.split('.')[-1])
+        if created:
+            self.new_files.append(media_file_path(file_url))
+        return file_url
 
-                        # 替换MD内容的静态文件链接
-                        new_media_filename = new_media_file_path.split(settings.MEDIA_ROOT,1)[-1]
-                        new_media_filename = '/media' + new_media_filename
+    # 替换MD内容的静态文件链接
+    def replace_media(self,node,media_urls):
+        if not node['media']:
+            return node['content']
 
-                        # 图片数据写入数据库
-                        Image.objects.create(
-                            user=create_user,
-                            file_path=new_media_filename,
-                            file_name=str(time.time())+'.'+file_suffix,
-                            remark=_('本地上传'),
-                        )
-                        md_content = md_content.replace(media_filename, new_media_filename)
+        def replace(match):
+            member = node['media'].get(match.group(1))
+            if member is None:
+                return match.group(0)
+            return match.group(0)[:match.start(1) - match.start(0)] + media_urls[member] + ')'
+        return MD_MEDIA_PATTERN.sub(replace,node['content'])
+
+    # 新建文集、文档和图片数据
+    def save(self,meta,nodes,media_urls):
+        levels = {}
+        for node in nodes:
+            levels.setdefault(node['level'],[]).append(node)
+        with transaction.atomic():
+            # 新建文集
+            project = Project.objects.create(
+                name=meta['name'],
+                intro=meta['desc'],
+                role=meta['role'],
+                create_user=self.create_user
+            )
+            # 按目录层级批量新建文档，每一层的查询次数固定
+            last_id = 0
+            for level in sorted(levels):
+                docs = [Doc(
+                    name=node['name'],
+                    pre_content=self.replace_media(node,media_urls),
+                    top_doc=project.id,
+                    parent_doc=node['parent']['id'] if node['parent'] is not None else 0,
+                    status=0,
+                    editor_mode=meta['editor_mode'],
+                    create_user=self.create_user
+                ) for node in levels[level]]
+                Doc.objects.bulk_create(docs,batch_size=IMPORT_BATCH_SIZE)
+                if connection.features.can_return_rows_from_bulk_insert:
+                    doc_ids = [d.id for d in docs]
                 else:
-                    pass
-            return md_content
-        # 不存在静态文件，直接返回MD内容
-        else:
-            return md_content
+                    # 数据库不返回新建的主键时（MySQL），按主键顺序读取本层新建的文档
+                    doc_ids = list(
+                        Doc.objects.filter(top_doc=project.id,id__gt=last_id).order_by('id').values_list('id',flat=True)
+                    )
+                for node,doc_id in zip(levels[level],doc_ids):
+                    node['id'] = doc_id
+                last_id = max(doc_ids)
+            # 图片数据写入数据库，已存在的图片不重复写入
+            file_urls = set(media_urls.values())
+            file_urls -= set(Image.objects.filter(
+                user=self.create_user,file_path__in=file_urls
+            ).values_list('file_path',flat=True))
+            Image.objects.bulk_create([Image(
+                user=self.create_user,
+                file_path=url,
+                file_name=url.split('/')[-1],
+                remark=_('本地上传'),
+                content_hash=store_content_hash(url),
+            ) for url in sorted(file_urls)])
+        # 批量新建的文档不触发信号，更新文集目录缓存；文档的渲染内容在读取时生成
+        bump_toc_version(project.id)
+        return project.id
 
 
 # 导入Word文档(.docx)
@@ -224,48 +241,63 @@ class ImportDocxDoc():
         self.editor_mode = int(editor_mode)
 
     # 转存docx文件中的图片
+    # 图片的转换、裁剪和写入在线程池中进行，先返回占位的图片地址，全部完成后替换为图片url
     def convert_img(self,image):
-        image = libreoffice_wmf_conversion(image, post_process=image_trim)
         if image.alt_text:
             alt = image.alt_text.replace('\n', '').replace('\r', '')
         else:
             alt = ''
         with image.open() as image_bytes:
-            file_suffix = image.content_type.split("/")[1]
-            file_time_name = str(time.time())
-            dir_name = upload_generation_dir()  # 获取当月文件夹名称
-            # 图片在媒体文件夹内的路径，形如 /202012/12542542.jpg
-            copy2_filename = dir_name + '/' + file_time_name + '.' + file_suffix
-            # 文件的绝对路径 形如/home/MrDoc/media/202012/12542542.jpg
-            new_media_file_path = settings.MEDIA_ROOT + copy2_filename
-            # 图片文件的相对url路径
-            file_url = '/media' + copy2_filename
+            data = image_bytes.read()
+        # wmf/emf 图片提交到 LibreOffice 转换服务，同一文档的图片合并为一批转换
+        conversion = submit_wmf_conversion(data,image.content_type)
+        placeholder = '{}-{}.img'.format(self.placeholder,len(self.image_tasks))
+        self.image_tasks.append((placeholder,self.executor.submit(self.save_img,data,image.content_type,conversion)))
+        return {"src": placeholder,"alt_text":alt,"alt":alt}
 
-            # 图片数据写入数据库
-            Image.objects.create(
-                user=self.create_user,
-                file_path=file_url,
-                file_name=file_time_name + '.' + file_suffix,
-                remark=_('本地上传'),
-            )
-            with open(new_media_file_path, 'wb') as f:
-                f.write(image_bytes.read())
-        return {"src": file_url,"alt_text":alt,"alt":alt}
+    # 写入图片文件到图片存储，返回图片url
+    def save_img(self,data,content_type,conversion):
+        file_suffix = content_type.split("/")[1]
+        if conversion is not None:
+            try:
+                # wmf/emf 转换得到的图片四周有大片空白，需要裁剪
+                data = trim_image_bytes(conversion.result())
+                file_suffix = 'png'
+            except Exception:
+                logger.exception(_("转换图片异常"))
+        file_url,content_hash,created = store_image([data],file_suffix)
+        return file_url
 
     # 转换docx文件内容为HTML和Markdown
     def convert_docx(self):
-        # 读取Word文件
-        with open(self.docx_file_path, "rb") as docx_file:
-            # 转化Word文档为HTML
-            result = mammoth.convert_to_html(docx_file, convert_image=mammoth.images.img_element(self.convert_img))
-            # 获取HTML内容
+        self.placeholder = 'mrdoc-docx-image-' + uuid.uuid4().hex
+        self.image_tasks = []
+        with ThreadPoolExecutor(max_workers=IMPORT_MEDIA_WORKERS) as self.executor:
+            # 读取Word文件
+            with open(self.docx_file_path, "rb") as docx_file:
+                # 转化Word文档为HTML
+                result = mammoth.convert_to_html(docx_file, convert_image=mammoth.images.img_element(self.convert_img))
+            # 获取HTML内容，等待所有图片写入完成后替换图片地址
             html = result.value
-            if self.editor_mode in [1,2]:
-                # 转化HTML为Markdown
-                md = markdownify(html, heading_style="ATX")
-                return md
-            else:
-                return html
+            images = []
+            for placeholder,task in self.image_tasks:
+                file_url = task.result()
+                html = html.replace(placeholder,file_url)
+                images.append(Image(
+                    user=self.create_user,
+                    file_path=file_url,
+                    file_name=file_url.split('/')[-1],
+                    remark=_('本地上传'),
+                    content_hash=store_content_hash(file_url),
+                ))
+        # 图片数据写入数据库
+        Image.objects.bulk_create(images)
+        if self.editor_mode in [1,2]:
+            # 转化HTML为Markdown
+            md = markdownify(html, heading_style="ATX")
+            return md
+        else:
+            return html
 
     def run(self):
         try:
@@ -0,0 +1,19 @@
+# coding:utf-8
+# @文件: backfill_doc_render.py
+# 生成文档渲染内容命令
+# 用法：python manage.py backfill_doc_render [--all] [--batch-size 500]
+
+from django.core.management.base import BaseCommand
+from app_doc.render_utils import backfill_doc_renders
+
+
+class Command(BaseCommand):
+    help = "生成缺少或已过期的文档渲染内容（HTML、纯文本和摘要）"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all',action='store_true',help="重新生成所有文档的渲染内容")
+        parser.add_argument('--batch-size',type=int,default=500,help="每批处理的文档数量")
+
+    def handle(self, *args, **options):
+        cnt = backfill_doc_renders(options['batch_size'],only_missing=not options['all'])
+        self.stdout.write("已生成{}篇文档的渲染内容".format(cnt))
@@ -0,0 +1,60 @@
+# coding:utf-8
+# @文件: benchmark_chinese_analyzer.py
+# 中文分词压测命令，对比 segment 在分词缓存为空和已缓存时的速度，以及原先 jieba 全模式分词的实现（只统计分词，不包括过滤器和写入索引）
+# 用法：python manage.py benchmark_chinese_analyzer [文件 ...] [--repeat 1] [--no-split]
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from app_doc.search.chinese_analyzer import segment,segment_cache
+import jieba
+import time
+import os
+import re
+
+# 默认使用项目中的 Markdown 文档作为语料
+DEFAULT_FILES = ('README.md','README-zh.md','CHANGES.md','DIFY_API_USAGE.md')
+
+
+# 原先的实现：jieba 全模式分词，每个词语的偏移量通过 value.find 查找（作为对比的基准）
+def reference_tokens(value):
+    count = 0
+    for w in jieba.cut(value, cut_all=True):
+        value.find(w)
+        value.find(w)
+        count += 1
+    return count
+
+
+class Command(BaseCommand):
+    help = "对 Markdown 文档分词，输出原先的实现和 segment（分词缓存为空、已缓存）的令牌数量和每秒处理的字符数"
+
+    def add_arguments(self, parser):
+        parser.add_argument('files',nargs='*',help="语料文件，默认为项目中的 Markdown 文档")
+        parser.add_argument('--repeat',type=int,default=1,help="语料重复的次数")
+        parser.add_argument('--no-split',action='store_true',help="每个文件作为一篇文档，默认按标题拆分为多篇文档")
+
+    def handle(self, *args, **options):
+        files = options['files'] or [
+            os.path.join(settings.BASE_DIR,f) for f in DEFAULT_FILES if os.path.exists(os.path.join(settings.BASE_DIR,f))
+        ]
+        docs = []
+        for file_path in files:
+            with open(file_path,encoding='utf-8') as f:
+                content = f.read()
+            docs += [content] if options['no_split'] else [d for d in re.split(r'\n(?=#)',content) if d.strip()]
+        docs = docs * max(options['repeat'],1)
+        chars = sum(len(d) for d in docs)
+        self.stdout.write("docs: {}  chars: {}".format(len(docs),chars))
+        jieba.initialize()
+
+        self.report('reference cut_all',chars,lambda: sum(reference_tokens(d) for d in docs))
+        segment_cache.clear()
+        self.report('cold cache',chars,lambda: sum(len(segment(d)) for d in docs))
+        self.report('warm cache',chars,lambda: sum(len(segment(d)) for d in docs))
+        self.stdout.write("cached chars: {}".format(segment_cache.chars))
+
+    def report(self, name, chars, func):
+        start = time.perf_counter()
+        tokens = func()
+        elapsed = time.perf_counter() - start
+        self.stdout.write("{}: {} tokens  {:.0f}k chars/s".format(name,tokens,chars / elapsed / 1000))
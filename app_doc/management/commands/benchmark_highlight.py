@@ -0,0 +1,39 @@
+# coding:utf-8
+# @文件: benchmark_highlight.py
+# 搜索结果高亮压测命令，对比 MyHighLighter 与 haystack 自带的 Highlighter（原先的实现复制自该类，查找窗口的复杂度为搜索词命中数的平方）
+# 用法：python manage.py benchmark_highlight [--query "部署 容器 应用"] [--sizes 24000 96000 240000] [--reference-max 100000]
+
+from django.core.management.base import BaseCommand
+from haystack.utils import Highlighter
+from app_doc.search.highlight import MyHighLighter,analyze_query
+import time
+
+# 测试文本中重复的句子
+SENTENCE = '使用容器部署应用时，需要先构建镜像，再通过编排工具部署到集群中。'
+
+
+class Command(BaseCommand):
+    help = "高亮不同长度的测试文本，输出 MyHighLighter 和 haystack Highlighter 的耗时"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--query',default='部署 容器 应用',help="搜索词")
+        parser.add_argument('--sizes',type=int,nargs='+',default=[24000,96000,240000],help="测试文本的字符数")
+        parser.add_argument('--max-length',type=int,default=200,help="高亮结果的最大长度")
+        parser.add_argument('--reference-max',type=int,default=100000,help="超过该字符数的文本不运行 haystack Highlighter")
+
+    def handle(self, *args, **options):
+        query = options['query']
+        analyze_query.cache_clear()
+        for size in options['sizes']:
+            text = (SENTENCE * (size // len(SENTENCE) + 1))[:size]
+            elapsed = self.measure(MyHighLighter(query,max_length=options['max_length']),text)
+            result = "{} chars: MyHighLighter {:.0f} ms".format(size,elapsed * 1000)
+            if size <= options['reference_max']:
+                elapsed = self.measure(Highlighter(query,max_length=options['max_length']),text)
+                result += ", haystack Highlighter {:.0f} ms".format(elapsed * 1000)
+            self.stdout.write(result)
+
+    def measure(self, highlighter, text):
+        start = time.perf_counter()
+        highlighter.highlight(text)
+        return time.perf_counter() - start
@@ -0,0 +1,74 @@
+# coding:utf-8
+# @文件: benchmark_image_trim.py
+# 图片空白裁剪压测命令，对比 trim_image_bytes 与原先逐像素遍历的实现
+# 用法：python manage.py benchmark_image_trim [--sizes 1000x750 4000x3000] [--repeat 3] [--skip-reference]
+
+from django.core.management.base import BaseCommand,CommandError
+from app_doc.utils import trim_image_bytes
+import io
+import time
+
+
+# 原先的实现：逐像素调用 getpixel 查找非白色区域，作为对比的基准（不写入临时文件）
+def reference_trim(data):
+    from PIL import Image
+
+    image = Image.open(io.BytesIO(data))
+    width, height = image.size
+    x_left, x_top = width, height
+    x_right = x_bottom = 0
+    for r in range(height):
+        for c in range(width):
+            pixel = image.getpixel((c, r))
+            if pixel[0] < 255 and pixel[1] < 255 and pixel[2] < 255:
+                x_top = min(x_top, r)
+                x_bottom = max(x_bottom, r)
+                x_left = min(x_left, c)
+                x_right = max(x_right, c)
+    output = io.BytesIO()
+    if x_left < x_right and x_top < x_bottom:
+        image.crop((x_left - 5, x_top - 5, x_right + 5, x_bottom + 5)).save(output, format="PNG")
+    else:
+        image.save(output, format="PNG")
+    return output.getvalue()
+
+
+# 生成白色背景、中间为深色方块的PNG图片
+def make_image(width, height):
+    from PIL import Image
+
+    image = Image.new('RGB', (width, height), (255, 255, 255))
+    image.paste((30, 30, 30), (width // 4, height // 4, width * 3 // 4, height * 3 // 4))
+    output = io.BytesIO()
+    image.save(output, format="PNG")
+    return output.getvalue()
+
+
+class Command(BaseCommand):
+    help = "裁剪不同尺寸的测试图片，输出 trim_image_bytes 和逐像素实现的耗时（包括PNG解码和编码）"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes',nargs='+',default=['1000x750','4000x3000'],help="图片尺寸，格式为 宽x高")
+        parser.add_argument('--repeat',type=int,default=3,help="每种尺寸的裁剪次数，输出最短耗时")
+        parser.add_argument('--skip-reference',action='store_true',help="不运行逐像素实现")
+
+    def handle(self, *args, **options):
+        for size in options['sizes']:
+            try:
+                width, height = [int(v) for v in size.lower().split('x')]
+            except ValueError:
+                raise CommandError("图片尺寸格式错误：{}".format(size))
+            data = make_image(width, height)
+            result = "{}: trim_image_bytes {:.3f}s".format(size, self.measure(trim_image_bytes, data, options['repeat']))
+            if not options['skip_reference']:
+                result += ", reference {:.3f}s".format(self.measure(reference_trim, data, options['repeat']))
+            self.stdout.write(result)
+
+    # 多次执行，返回最短耗时
+    def measure(self, func, data, repeat):
+        elapsed = []
+        for i in range(max(repeat, 1)):
+            start = time.perf_counter()
+            func(data)
+            elapsed.append(time.perf_counter() - start)
+        return min(elapsed)
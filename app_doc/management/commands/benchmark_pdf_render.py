@@ -0,0 +1,37 @@
+# coding:utf-8
+# @文件: benchmark_pdf_render.py
+# PDF渲染服务压测命令，需要本机安装 Chromium 和 chromedriver
+# 用法：python manage.py benchmark_pdf_render page.html [--jobs 20] [--pool-size 2]
+
+from django.conf import settings
+from django.core.management.base import BaseCommand,CommandError
+from app_doc.report_html2pdf import PdfRenderPool
+import os
+import time
+
+
+class Command(BaseCommand):
+    help = "并发渲染指定的HTML页面，输出PDF渲染服务的吞吐量和耗时"
+
+    def add_arguments(self, parser):
+        parser.add_argument('source',help="HTML文件路径或网址")
+        parser.add_argument('--jobs',type=int,default=20,help="渲染次数")
+        parser.add_argument('--pool-size',type=int,default=settings.PDF_RENDER_POOL_SIZE,help="浏览器会话数量")
+        parser.add_argument('--max-jobs',type=int,default=settings.PDF_RENDER_MAX_JOBS,help="每个会话处理的任务数")
+        parser.add_argument('--timeout',type=float,default=30,help="等待页面渲染完成的最大秒数")
+
+    def handle(self, *args, **options):
+        source = options['source']
+        if os.path.exists(source):
+            source = 'file://' + os.path.abspath(source)
+        pool = PdfRenderPool(size=options['pool_size'],max_jobs=options['max_jobs'],queue_size=options['jobs'])
+        start = time.monotonic()
+        futures = [pool.submit(source,options['timeout']) for i in range(options['jobs'])]
+        errors = [f.exception() for f in futures if f.exception() is not None]
+        elapsed = time.monotonic() - start
+        if len(errors) == len(futures):
+            raise CommandError("渲染失败：{}".format(errors[0]))
+        self.stdout.write("elapsed: {:.2f}s".format(elapsed))
+        self.stdout.write("jobs/s: {:.2f}".format((len(futures) - len(errors)) / elapsed))
+        for key,value in pool.get_stats().items():
+            self.stdout.write("{}: {}".format(key,value))
@@ -0,0 +1,79 @@
+# coding:utf-8
+# @文件: benchmark_report_md.py
+# MD文件压缩包导出压测命令，在事务内创建测试文集并在结束后回滚，测试图片写入媒体目录下的临时目录，结束后删除
+# 用法：python manage.py benchmark_report_md [--docs 5000] [--images 50] [--image-size 20480] [--content-size 2048]
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from app_doc.models import Project,Doc
+from app_doc.report_utils import ReportMD
+import tempfile
+import tracemalloc
+import shutil
+import time
+import os
+
+
+class Command(BaseCommand):
+    help = "导出包含指定数量文档和图片的测试文集，输出MD文件压缩包的导出耗时、内存峰值和文件大小"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--docs',type=int,default=5000,help="文档数量")
+        parser.add_argument('--images',type=int,default=50,help="文档共用的图片数量")
+        parser.add_argument('--image-size',type=int,default=20480,help="每张图片的字节数")
+        parser.add_argument('--content-size',type=int,default=2048,help="每篇文档的字符数")
+        parser.add_argument('--chapter-size',type=int,default=10,help="每个一级文档的下级文档数量")
+
+    def handle(self, *args, **options):
+        media_dir = tempfile.mkdtemp(prefix='benchmark_report_md_',dir=settings.MEDIA_ROOT)
+        try:
+            with transaction.atomic():
+                pro = self.create_project(media_dir,options)
+                self.run(pro)
+                transaction.set_rollback(True)
+        finally:
+            shutil.rmtree(media_dir,ignore_errors=True)
+
+    # 创建测试文集，文档分为一级文档和下级文档，每篇文档引用一张图片
+    def create_project(self, media_dir, options):
+        image_urls = []
+        for i in range(max(options['images'],1)):
+            file_path = os.path.join(media_dir,'{}.png'.format(i))
+            with open(file_path,'wb') as f:
+                f.write(os.urandom(options['image_size']))
+            image_urls.append(settings.MEDIA_URL + os.path.relpath(file_path,settings.MEDIA_ROOT).replace(os.sep,'/'))
+        user = User.objects.create_user(username='benchmark_report_md')
+        pro = Project.objects.create(name='benchmark',intro='',create_user=user)
+
+        def make_doc(i, parent_doc=0):
+            content = '# 文档{}\n\n![]({})\n\n'.format(i,image_urls[i % len(image_urls)])
+            return Doc(
+                name='文档{}'.format(i),pre_content=content + '文' * max(options['content_size'] - len(content),0),
+                top_doc=pro.id,parent_doc=parent_doc,sort=i,create_user=user,status=1
+            )
+        chapter_size = max(options['chapter_size'],1)
+        Doc.objects.bulk_create(
+            [make_doc(i) for i in range(0,options['docs'],chapter_size + 1)],batch_size=500
+        )
+        chapters = list(Doc.objects.filter(top_doc=pro.id).order_by('sort').values_list('id','sort'))
+        Doc.objects.bulk_create([
+            make_doc(sort + j,parent_doc=chapter_id)
+            for chapter_id,sort in chapters for j in range(1,chapter_size + 1) if sort + j < options['docs']
+        ],batch_size=500)
+        return pro
+
+    def run(self, pro):
+        tracemalloc.start()
+        start = time.monotonic()
+        with tempfile.TemporaryFile() as f:
+            ReportMD(pro.id).write(f)
+            size = f.tell()
+        elapsed = time.monotonic() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        self.stdout.write("docs: {}".format(Doc.objects.filter(top_doc=pro.id).count()))
+        self.stdout.write("elapsed: {:.2f}s".format(elapsed))
+        self.stdout.write("peak memory: {:.1f}MB".format(peak / 1024 / 1024))
+        self.stdout.write("zip size: {:.1f}MB".format(size / 1024 / 1024))
@@ -0,0 +1,23 @@
+# coding:utf-8
+# @文件: migrate_image_store.py
+# 已有图片迁移到按内容哈希存储的图片库
+# 用法：python manage.py migrate_image_store [--dry-run] [--batch-size 500]
+
+from django.core.management.base import BaseCommand
+from app_doc.image_utils import migrate_image_files
+
+
+class Command(BaseCommand):
+    help = "为已有图片计算内容哈希并存入图片库，内容重复的图片文件合并为硬链接，输出回收的磁盘空间"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run',action='store_true',help="只统计，不修改文件和数据")
+        parser.add_argument('--batch-size',type=int,default=500,help="每批处理的图片数据条数")
+
+    def handle(self, *args, **options):
+        stats = migrate_image_files(dry_run=options['dry_run'],batch_size=options['batch_size'])
+        self.stdout.write("images: {}".format(stats['images']))
+        self.stdout.write("missing: {}".format(stats['missing']))
+        self.stdout.write("files: {}".format(stats['files']))
+        self.stdout.write("duplicates: {}".format(stats['duplicates']))
+        self.stdout.write("reclaimed: {:.2f}MB".format(stats['reclaimed_bytes'] / 1048576))
@@ -0,0 +1,44 @@
+# coding:utf-8
+# @文件: process_export_jobs.py
+# 文集导出任务处理命令
+# 用法：python manage.py process_export_jobs [--once] [--interval 2] [--stale-timeout 3600]
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from app_doc.models import ExportJob
+from app_doc.export_utils import claim_export_jobs,run_export_job,run_export_job_thread,fail_stale_export_jobs
+from concurrent.futures import ThreadPoolExecutor
+from loguru import logger
+import time
+
+
+class Command(BaseCommand):
+    help = "在后台执行文集导出任务，各导出类型的并发数由 [export] 配置指定"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once',action='store_true',help="在当前线程中逐个执行排队中的任务后退出")
+        parser.add_argument('--interval',type=float,default=2,help="检查新任务的间隔秒数")
+        parser.add_argument('--stale-timeout',type=float,default=3600,help="执行超过该秒数的任务标记为失败")
+
+    def handle(self, *args, **options):
+        concurrency = settings.EXPORT_JOB_CONCURRENCY
+        fail_stale_export_jobs(options['stale_timeout'])
+        if options['once']:
+            job_ids = claim_export_jobs(concurrency)
+            while job_ids:
+                for job_id in job_ids:
+                    run_export_job(ExportJob.objects.select_related('user').get(id=job_id))
+                job_ids = claim_export_jobs(concurrency)
+            return
+
+        with ThreadPoolExecutor(max_workers=max(sum(concurrency.values()),1)) as executor:
+            while True:
+                close_old_connections()
+                try:
+                    for job_id in claim_export_jobs(concurrency):
+                        executor.submit(run_export_job_thread,job_id)
+                    fail_stale_export_jobs(options['stale_timeout'])
+                except Exception:
+                    logger.exception("处理文集导出任务出错")
+                time.sleep(options['interval'])
@@ -0,0 +1,48 @@
+# coding:utf-8
+# @文件: process_index_queue.py
+# 全文索引队列处理命令
+# 用法：python manage.py process_index_queue [--once] [--interval 5] [--delay 2] [--optimize-interval 3600]
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from app_doc.search.index_queue import flush_index_queue,optimize_index,get_index_queue_stats
+from loguru import logger
+import time
+
+
+class Command(BaseCommand):
+    help = "处理全文索引队列，批量更新 Whoosh 索引并定期合并索引段"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once',action='store_true',help="处理完当前队列后退出")
+        parser.add_argument('--interval',type=float,default=5,help="队列为空时的等待秒数")
+        parser.add_argument('--delay',type=float,default=2,help="条目加入队列后等待的秒数，用于合并连续的修改")
+        parser.add_argument('--batch-size',type=int,default=200,help="每次写入索引的最大条目数")
+        parser.add_argument('--optimize-interval',type=float,default=3600,help="合并索引段的间隔秒数，0 表示不合并")
+        parser.add_argument('--stats',action='store_true',help="输出队列统计数据后退出")
+
+    def handle(self, *args, **options):
+        if options['stats']:
+            for key,value in get_index_queue_stats().items():
+                self.stdout.write("{}: {}".format(key,value))
+            return
+
+        delay = 0 if options['once'] else options['delay']
+        last_optimize = time.monotonic()
+        while True:
+            close_old_connections()
+            try:
+                cnt = flush_index_queue(options['batch_size'],delay)
+                while cnt == options['batch_size']:
+                    cnt = flush_index_queue(options['batch_size'],delay)
+                if options['optimize_interval'] > 0 and \
+                        time.monotonic() - last_optimize >= options['optimize_interval']:
+                    optimize_index()
+                    last_optimize = time.monotonic()
+            except Exception:
+                if options['once']:
+                    raise
+                logger.exception("处理全文索引队列出错")
+            if options['once']:
+                break
+            time.sleep(options['interval'])
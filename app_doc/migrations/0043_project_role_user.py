@@ -0,0 +1,40 @@
+# Generated by Django 4.2.30 on 2026-10-18 04:07
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def fill_project_role_users(apps, schema_editor):
+    # 根据现有指定用户可见文集的 role_value 生成可见用户记录
+    Project = apps.get_model('app_doc', 'Project')
+    ProjectRoleUser = apps.get_model('app_doc', 'ProjectRoleUser')
+    role_users = []
+    for pro_id, role_value in Project.objects.filter(role=2).values_list('id', 'role_value'):
+        usernames = {u.strip() for u in (role_value or '').split(',') if u.strip()}
+        for username in usernames:
+            role_users.append(ProjectRoleUser(project_id=pro_id, username=username[:150]))
+    ProjectRoleUser.objects.bulk_create(role_users, batch_size=500, ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app_doc', '0042_project_index_position'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProjectRoleUser',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('username', models.CharField(db_index=True, max_length=150, verbose_name='用户名')),
+                ('project', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='app_doc.project')),
+            ],
+            options={
+                'verbose_name': '文集可见用户',
+                'verbose_name_plural': '文集可见用户',
+                'unique_together': {('project', 'username')},
+            },
+        ),
+        migrations.RunPython(fill_project_role_users, migrations.RunPython.noop),
+    ]
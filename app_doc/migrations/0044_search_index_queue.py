@@ -0,0 +1,27 @@
+# Generated by Django 4.2.30 on 2026-10-18 04:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app_doc', '0043_project_role_user'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SearchIndexQueue',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model', models.CharField(max_length=100, verbose_name='模型')),
+                ('object_id', models.IntegerField(verbose_name='对象ID')),
+                ('queue_time', models.DateTimeField(db_index=True, verbose_name='加入队列时间')),
+            ],
+            options={
+                'verbose_name': '全文索引队列',
+                'verbose_name_plural': '全文索引队列',
+                'unique_together': {('model', 'object_id')},
+            },
+        ),
+    ]
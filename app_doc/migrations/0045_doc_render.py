@@ -0,0 +1,28 @@
+# Generated by Django 4.2.30 on 2026-10-18 04:22
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app_doc', '0044_search_index_queue'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DocRender',
+            fields=[
+                ('doc', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='render', serialize=False, to='app_doc.doc')),
+                ('content_hash', models.CharField(max_length=32, verbose_name='内容哈希')),
+                ('html', models.TextField(blank=True, default='', verbose_name='HTML内容')),
+                ('text', models.TextField(blank=True, default='', verbose_name='纯文本内容')),
+                ('summary', models.CharField(blank=True, default='', max_length=300, verbose_name='摘要')),
+            ],
+            options={
+                'verbose_name': '文档渲染内容',
+                'verbose_name_plural': '文档渲染内容',
+            },
+        ),
+    ]
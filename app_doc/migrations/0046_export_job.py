@@ -0,0 +1,39 @@
+# Generated by Django 4.2.30 on 2026-10-18 04:30
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('app_doc', '0045_doc_render'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ExportJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('export_type', models.CharField(choices=[('epub', 'epub'), ('pdf', 'pdf'), ('docx', 'docx'), ('md', 'md'), ('md_batch', 'md_batch')], max_length=10, verbose_name='导出类型')),
+                ('params', models.CharField(blank=True, default='', max_length=500, verbose_name='导出参数')),
+                ('content_version', models.CharField(max_length=32, verbose_name='内容版本')),
+                ('status', models.IntegerField(choices=[(0, '排队中'), (1, '执行中'), (2, '已完成'), (3, '失败')], default=0, verbose_name='状态')),
+                ('progress', models.IntegerField(default=0, verbose_name='进度')),
+                ('message', models.CharField(blank=True, default='', max_length=250, verbose_name='消息')),
+                ('file_path', models.CharField(blank=True, default='', max_length=250, verbose_name='文件路径')),
+                ('create_time', models.DateTimeField(auto_now_add=True)),
+                ('start_time', models.DateTimeField(blank=True, null=True)),
+                ('finish_time', models.DateTimeField(blank=True, null=True)),
+                ('project', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='app_doc.project')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': '导出任务',
+                'verbose_name_plural': '导出任务',
+                'indexes': [models.Index(fields=['status', 'export_type'], name='app_doc_exp_status_ecda08_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 4.2.30 on 2026-10-18 04:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app_doc', '0046_export_job'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='content_hash',
+            field=models.CharField(blank=True, db_index=True, max_length=64, null=True, verbose_name='内容哈希'),
+        ),
+        migrations.AddIndex(
+            model_name='image',
+            index=models.Index(fields=['file_path'], name='app_doc_ima_file_pa_5dd1b3_idx'),
+        ),
+    ]
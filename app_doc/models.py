@@ -52,6 +52,20 @@ class ProjectCollaborator(models.Model):
         verbose_name_plural = verbose_name
 
 
+# 文集指定可见用户模型（由文集的 role_value 同步生成，用于按用户名查询可见文集）
+class ProjectRoleUser(models.Model):
+    project = models.ForeignKey(Project,on_delete=models.CASCADE) # 文集
+    username = models.CharField(verbose_name="用户名",max_length=150,db_index=True)
+
+    def __str__(self):
+        return self.username
+
+    class Meta:
+        verbose_name = '文集可见用户'
+        verbose_name_plural = verbose_name
+        unique_together = ('project','username')
+
+
 # 文集目录模型
 class ProjectToc(models.Model):
     project = models.ForeignKey(Project,on_delete=models.CASCADE)
@@ -231,12 +245,17 @@ class Image(models.Model):
     file_name = models.CharField(verbose_name="图片名称",max_length=250,null=True,blank=True)
     group = models.ForeignKey(ImageGroup,on_delete=models.SET_NULL,null=True,verbose_name="图片分组")
     remark = models.CharField(verbose_name="图片备注",null=True,blank=True,max_length=250,default="图片描述")
+    # 图片文件内容的 SHA256 值，内容相同的图片共用同一个文件；旧数据由 migrate_image_store 命令补充
+    content_hash = models.CharField(verbose_name="内容哈希",max_length=64,null=True,blank=True,db_index=True)
     create_time = models.DateTimeField(verbose_name='创建时间',auto_now_add=True)
     modify_time = models.DateTimeField(verbose_name='修改时间',auto_now=True)
 
     class Meta:
         verbose_name = '素材图片'
         verbose_name_plural = verbose_name
+        indexes = [
+            models.Index(fields=['file_path']),
+        ]
 
 
 # 附件模型
@@ -268,4 +287,61 @@ class MyCollect(models.Model):
 
     class Meta:
         verbose_name = '我的收藏'
-        verbose_name_plural = verbose_name
\ No newline at end of file
+        verbose_name_plural = verbose_name
+
+# 全文索引队列（对象保存或删除后加入队列，由 process_index_queue 命令批量更新索引）
+class SearchIndexQueue(models.Model):
+    model = models.CharField(verbose_name="模型",max_length=100) # 模型标识，例如 app_doc.doc
+    object_id = models.IntegerField(verbose_name="对象ID")
+    queue_time = models.DateTimeField(verbose_name="加入队列时间",db_index=True)
+
+    def __str__(self):
+        return "{}.{}".format(self.model,self.object_id)
+
+    class Meta:
+        verbose_name = '全文索引队列'
+        verbose_name_plural = verbose_name
+        unique_together = ('model','object_id')
+
+
+# 文档渲染内容（由文档内容生成的HTML和纯文本，文档保存时更新，用于列表摘要、搜索结果和导出）
+class DocRender(models.Model):
+    doc = models.OneToOneField(Doc,on_delete=models.CASCADE,primary_key=True,related_name='render')
+    content_hash = models.CharField(verbose_name="内容哈希",max_length=32)
+    html = models.TextField(verbose_name="HTML内容",blank=True,default='')
+    text = models.TextField(verbose_name="纯文本内容",blank=True,default='')
+    summary = models.CharField(verbose_name="摘要",max_length=300,blank=True,default='')
+
+    def __str__(self):
+        return str(self.doc_id)
+
+    class Meta:
+        verbose_name = '文档渲染内容'
+        verbose_name_plural = verbose_name
+
+
+# 文集导出任务（由 process_export_jobs 命令在后台执行）
+class ExportJob(models.Model):
+    project = models.ForeignKey(Project,on_delete=models.CASCADE,null=True,blank=True) # 批量导出MD时为空
+    user = models.ForeignKey(User,on_delete=models.CASCADE)
+    export_type = models.CharField(
+        verbose_name="导出类型",max_length=10,
+        choices=(('epub','epub'),('pdf','pdf'),('docx','docx'),('md','md'),('md_batch','md_batch'))
+    )
+    params = models.CharField(verbose_name="导出参数",max_length=500,blank=True,default='') # 批量导出MD的文集ID列表
+    content_version = models.CharField(verbose_name="内容版本",max_length=32)
+    status = models.IntegerField(verbose_name="状态",choices=((0,'排队中'),(1,'执行中'),(2,'已完成'),(3,'失败')),default=0)
+    progress = models.IntegerField(verbose_name="进度",default=0)
+    message = models.CharField(verbose_name="消息",max_length=250,blank=True,default='')
+    file_path = models.CharField(verbose_name="文件路径",max_length=250,blank=True,default='')
+    create_time = models.DateTimeField(auto_now_add=True)
+    start_time = models.DateTimeField(null=True,blank=True)
+    finish_time = models.DateTimeField(null=True,blank=True)
+
+    def __str__(self):
+        return "{}_{}".format(self.export_type,self.id)
+
+    class Meta:
+        verbose_name = '导出任务'
+        verbose_name_plural = verbose_name
+        indexes = [models.Index(fields=['status','export_type'])]
@@ -0,0 +1,226 @@
+# coding:utf-8
+# @文件: office_utils.py
+# LibreOffice 文件转换服务
+# 后台线程从队列中取出转换任务，同一格式的任务合并为一批，由一次 soffice 进程完成转换，
+# 避免每个文件都承担一次 LibreOffice 启动耗时；用户配置目录常驻复用，
+# 转换超时时结束进程，连续失败后重建配置目录，批量转换失败时逐个重试以隔离出错的文件
+
+from django.conf import settings
+from django.utils.translation import gettext_lazy as _
+from concurrent.futures import Future
+from loguru import logger
+import threading
+import subprocess
+import tempfile
+import hashlib
+import shutil
+import signal
+import queue
+import time
+import os
+
+# 等待更多任务合并为一批的秒数
+OFFICE_BATCH_WAIT = 0.05
+# 连续失败多少批后重建用户配置目录
+OFFICE_MAX_FAILURES = 3
+
+
+# 文件转换失败
+class OfficeConvertError(Exception):
+    pass
+
+
+# LibreOffice 文件转换服务
+class OfficeConverter():
+    def __init__(self, command=None, work_dir=None, timeout=60, batch_size=20):
+        """
+        command：soffice 命令，默认为 LIBREOFFICE_PATH 配置
+        work_dir：存放用户配置目录和临时文件的文件夹，默认为 LIBREOFFICE_WORK_DIR 配置
+        timeout：每批转换的最大秒数，超时结束 soffice 进程
+        batch_size：每批转换的文件数上限
+        """
+        self.command = command or [settings.LIBREOFFICE_PATH]
+        self.work_dir = work_dir or settings.LIBREOFFICE_WORK_DIR
+        self.profile_dir = os.path.join(self.work_dir, 'profile')
+        self.timeout = timeout
+        self.batch_size = batch_size
+        self.jobs = queue.Queue()
+        self.worker = None
+        self.lock = threading.Lock()
+        # 统计数据
+        self.batches = 0
+        self.completed = 0
+        self.failed = 0
+        self.restarts = 0
+        self.failures = 0 # 连续失败的批数
+
+    # 启动后台线程
+    def start(self):
+        with self.lock:
+            if self.worker is None:
+                self.worker = threading.Thread(target=self.run, name='office-convert', daemon=True)
+                self.worker.start()
+
+    # 提交转换任务，source 为文件内容或文件路径，suffix 为源文件后缀，返回 Future，结果为转换后的文件内容
+    def submit(self, source, suffix, fmt='png'):
+        self.start()
+        future = Future()
+        self.jobs.put((future, source, suffix.lower().lstrip('.'), fmt))
+        return future
+
+    def run(self):
+        while True:
+            batch = [self.jobs.get()]
+            # 合并等待中的任务
+            deadline = time.monotonic() + OFFICE_BATCH_WAIT
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.jobs.get(timeout=max(deadline - time.monotonic(), 0)))
+                except queue.Empty:
+                    break
+            batch = [job for job in batch if job[0].set_running_or_notify_cancel()]
+            # 按目标格式分批转换
+            groups = {}
+            for job in batch:
+                groups.setdefault(job[3], []).append(job)
+            for fmt, jobs in groups.items():
+                self.convert_jobs(jobs, fmt)
+
+    # 转换一批任务，批量转换失败时逐个重试
+    def convert_jobs(self, jobs, fmt):
+        try:
+            results = self.convert_batch([(source, suffix) for future, source, suffix, _fmt in jobs], fmt)
+        except Exception as e:
+            if len(jobs) > 1:
+                for job in jobs:
+                    self.convert_jobs([job], fmt)
+                return
+            results = [e]
+        for (future, source, suffix, _fmt), result in zip(jobs, results):
+            with self.lock:
+                if isinstance(result, Exception):
+                    self.failed += 1
+                else:
+                    self.completed += 1
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    # 调用一次 soffice 转换多个文件，返回转换后的文件内容列表，未能转换的文件为 OfficeConvertError
+    def convert_batch(self, files, fmt):
+        os.makedirs(self.work_dir, exist_ok=True)
+        batch_dir = tempfile.mkdtemp(dir=self.work_dir)
+        try:
+            # 以序号命名临时文件，同时转换的文件不会重名
+            input_paths = []
+            for i, (source, suffix) in enumerate(files):
+                input_path = os.path.join(batch_dir, '{}.{}'.format(i, suffix))
+                if isinstance(source, bytes):
+                    with open(input_path, 'wb') as f:
+                        f.write(source)
+                else:
+                    shutil.copyfile(source, input_path)
+                input_paths.append(input_path)
+            output_dir = os.path.join(batch_dir, 'output')
+            with self.lock:
+                self.batches += 1
+            try:
+                self.run_soffice(input_paths, output_dir, fmt)
+            except Exception:
+                self.batch_failed()
+                raise
+            self.failures = 0
+            results = []
+            for i in range(len(files)):
+                output_path = os.path.join(output_dir, '{}.{}'.format(i, fmt.split(':')[0]))
+                if os.path.exists(output_path):
+                    with open(output_path, 'rb') as f:
+                        results.append(f.read())
+                else:
+                    results.append(OfficeConvertError(_("文件转换失败")))
+            return results
+        finally:
+            shutil.rmtree(batch_dir, ignore_errors=True)
+
+    # 运行 soffice 进程，超时后结束整个进程组（soffice 会启动 soffice.bin 子进程）
+    def run_soffice(self, input_paths, output_dir, fmt):
+        process = subprocess.Popen(
+            self.command + [
+                '-env:UserInstallation=file://' + os.path.abspath(self.profile_dir),
+                '--headless',
+                '--norestore',
+                '--convert-to', fmt,
+                '--outdir', output_dir,
+            ] + input_paths,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            start_new_session=hasattr(os, 'killpg'),
+        )
+        try:
+            returncode = process.wait(timeout=self.timeout)
+        except subprocess.TimeoutExpired:
+            if hasattr(os, 'killpg'):
+                os.killpg(process.pid, signal.SIGKILL)
+            else:
+                process.kill()
+            process.wait()
+            raise OfficeConvertError(_("文件转换超时"))
+        if returncode != 0:
+            raise OfficeConvertError(_("文件转换失败"))
+
+    # 连续失败后重建用户配置目录
+    def batch_failed(self):
+        self.failures += 1
+        if self.failures >= OFFICE_MAX_FAILURES:
+            logger.warning(_("LibreOffice 连续转换失败，重建用户配置目录"))
+            shutil.rmtree(self.profile_dir, ignore_errors=True)
+            self.failures = 0
+            with self.lock:
+                self.restarts += 1
+
+    # 获取统计数据
+    def get_stats(self):
+        with self.lock:
+            return {
+                'queue_depth': self.jobs.qsize(),
+                'batches': self.batches,
+                'completed': self.completed,
+                'failed': self.failed,
+                'restarts': self.restarts,
+            }
+
+
+_office_converter = None
+_office_converter_lock = threading.Lock()
+
+
+# 获取进程内的文件转换服务
+def get_office_converter():
+    global _office_converter
+    with _office_converter_lock:
+        if _office_converter is None:
+            _office_converter = OfficeConverter(
+                timeout=settings.LIBREOFFICE_TIMEOUT,
+                batch_size=settings.LIBREOFFICE_BATCH_SIZE,
+            )
+    return _office_converter
+
+
+# 转换Office附件为PDF用于预览，返回PDF文件路径，同一文件只转换一次
+def office_preview(file_path):
+    suffix = file_path.split('.')[-1].lower()
+    if suffix not in settings.PREVIEW_SUFFIX_OFFICE:
+        return None
+    stat = os.stat(file_path)
+    file_key = '{}\0{}\0{}'.format(os.path.abspath(file_path), stat.st_size, stat.st_mtime)
+    preview_dir = os.path.join(settings.MEDIA_ROOT, 'office_preview')
+    preview_path = os.path.join(preview_dir, hashlib.sha1(file_key.encode('utf-8')).hexdigest() + '.pdf')
+    if os.path.exists(preview_path):
+        return preview_path
+    data = get_office_converter().submit(file_path, suffix, 'pdf').result()
+    os.makedirs(preview_dir, exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=preview_dir, suffix='.tmp', delete=False) as f:
+        f.write(data)
+    os.replace(f.name, preview_path)
+    return preview_path
@@ -0,0 +1,128 @@
+# coding:utf-8
+# @文件: render_utils.py
+# 文档渲染内容
+# 文档保存时将 Markdown 渲染为 HTML 并提取纯文本和摘要，以内容哈希判断是否需要重新渲染，
+# 列表摘要、搜索结果和导出直接读取渲染结果，无需每次请求解析 Markdown
+
+from django.utils.html import strip_tags
+from app_doc.models import Doc,DocRender
+import hashlib
+import markdown
+
+# Markdown 渲染使用的扩展
+MARKDOWN_EXTENSIONS = ['markdown.extensions.fenced_code','markdown.extensions.tables']
+# 摘要的最大长度
+SUMMARY_LENGTH = 300
+# 表格文档的摘要
+TABLE_DOC_SUMMARY = "此为表格文档，进入文档查看详细内容"
+
+
+# 文档内容的哈希值
+def doc_content_hash(doc):
+    value = '{}\0{}\0{}'.format(doc.editor_mode,doc.pre_content or '',doc.content or '')
+    return hashlib.md5(value.encode('utf-8')).hexdigest()
+
+
+# 渲染文档，返回未保存的 DocRender 对象
+def render_doc(doc):
+    if doc.editor_mode == 3: # 富文本文档
+        html = doc.content or ''
+        text = strip_tags(html)
+    elif doc.editor_mode == 4: # 表格文档
+        html = doc.content or ''
+        text = TABLE_DOC_SUMMARY
+    else: # Markdown文档
+        try:
+            html = markdown.markdown(doc.pre_content or '',extensions=MARKDOWN_EXTENSIONS)
+            text = strip_tags(html)
+        except Exception:
+            html = ''
+            text = doc.pre_content or ''
+    text = text.replace('&nbsp;','')
+    return DocRender(
+        doc_id=doc.id,
+        content_hash=doc_content_hash(doc),
+        html=html,
+        text=text,
+        summary=text[:SUMMARY_LENGTH]
+    )
+
+
+# 更新文档的渲染内容，内容未变化时不重新渲染
+def update_doc_render(doc):
+    content_hash = doc_content_hash(doc)
+    if DocRender.objects.filter(doc_id=doc.id,content_hash=content_hash).exists():
+        return False
+    save_doc_renders([render_doc(doc)])
+    return True
+
+
+# 批量获取文档的渲染内容，返回 {文档ID: DocRender}，fields 为需要读取的字段
+# 缺少渲染内容或内容哈希不一致（例如通过 queryset.update() 修改了内容）的文档在此重新渲染并保存
+def get_doc_renders(docs,fields=('summary',)):
+    docs = list(docs)
+    renders = DocRender.objects.only('doc_id','content_hash',*fields).in_bulk([d.id for d in docs])
+    stale = []
+    for d in docs:
+        render = renders.get(d.id)
+        if render is None or render.content_hash != doc_content_hash(d):
+            stale.append(render_doc(d))
+    if stale:
+        save_doc_renders(stale)
+        renders.update({r.doc_id:r for r in stale})
+    return renders
+
+
+# 批量保存文档的渲染内容
+def save_doc_renders(renders):
+    DocRender.objects.bulk_create(
+        renders,
+        update_conflicts=True,
+        unique_fields=['doc'],
+        update_fields=['content_hash','html','text','summary']
+    )
+
+
+# 为文档列表附加摘要 summary
+def attach_doc_summary(docs):
+    docs = list(docs)
+    renders = get_doc_renders(docs)
+    for d in docs:
+        d.summary = renders[d.id].summary
+    return docs
+
+
+# 为文档列表附加纯文本内容 plain_text（用于搜索结果中显示关键词上下文）
+def attach_doc_text(docs):
+    docs = list(docs)
+    renders = get_doc_renders(docs,('text',))
+    for d in docs:
+        d.plain_text = renders[d.id].text
+    return docs
+
+
+# 获取文档的HTML内容，文档没有HTML内容时读取渲染内容
+def get_doc_html(doc):
+    if doc.content is not None:
+        return doc.content
+    return get_doc_renders([doc],('html',))[doc.id].html
+
+
+# 重新生成文档的渲染内容，only_missing 为 True 时只处理缺少渲染内容或内容已变化的文档
+def backfill_doc_renders(batch_size=500,only_missing=True):
+    cnt = 0
+    last_id = 0
+    while True:
+        docs = list(
+            Doc.objects.filter(id__gt=last_id).order_by('id')
+            .only('id','editor_mode','pre_content','content')[:batch_size]
+        )
+        if not docs:
+            break
+        last_id = docs[-1].id
+        if only_missing:
+            hashes = dict(DocRender.objects.filter(doc_id__in=[d.id for d in docs]).values_list('doc_id','content_hash'))
+            docs = [d for d in docs if hashes.get(d.id) != doc_content_hash(d)]
+        save_doc_renders([render_doc(d) for d in docs])
+        cnt += len(docs)
+    return cnt
@@ -0,0 +1,422 @@
+# coding:utf-8
+# @文件: report_epub.py
+# 文集导出EPUB
+# 通过一次查询读取文集的全部文档，章节在进程池中并行处理，引用的媒体文件按内容去重后
+# 直接从原位置以流的方式写入EPUB压缩包，不在 media/report_epub 下创建临时目录；
+# 压缩包条目的顺序、时间和内容只取决于文集数据，文集未修改时导出的文件字节完全一致
+
+from django.conf import settings
+from django.utils.translation import gettext_lazy as _
+from bs4 import BeautifulSoup
+from concurrent.futures import ProcessPoolExecutor
+from html import escape
+from urllib.parse import unquote
+from loguru import logger
+import hashlib
+import mimetypes
+import shutil
+import time
+import uuid
+import zipfile
+import os
+
+# 压缩包条目的固定修改时间，保证导出结果可重现
+ZIP_DATE_TIME = (1980,1,1,0,0,0)
+# 不再压缩的媒体文件类型
+STORED_EXTENSIONS = ('.jpg','.jpeg','.png','.gif','.webp','.mp3','.mp4','.zip')
+# 章节数量达到该值时使用进程池处理章节
+EPUB_POOL_MIN_CHAPTERS = 16
+# 进程池的最大进程数
+EPUB_POOL_MAX_WORKERS = 4
+# EPUB内置的样式和封面文件，(压缩包中的路径, 源文件相对 BASE_DIR 的路径)
+EPUB_STATIC_FILES = (
+    ('OEBPS/Styles/style.css','static/report_epub/style.css'),
+    ('OEBPS/Styles/marked.css','static/mr-marked/marked.css'),
+    ('OEBPS/Images/epub_cover1.jpg','static/report_epub/epub_cover1.jpg'),
+)
+
+# 媒体文件名的缓存，{(文件路径, 大小, 修改时间): EPUB中的文件名}，在每个进程中分别缓存
+_media_names = {}
+
+
+# 媒体文件在EPUB中的文件名，以文件内容的哈希值命名，内容相同的文件只保存一份
+def epub_media_name(path):
+    stat = os.stat(path)
+    key = (path,stat.st_size,stat.st_mtime_ns)
+    name = _media_names.get(key)
+    if name is None:
+        sha1 = hashlib.sha1()
+        with open(path,'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024),b''):
+                sha1.update(chunk)
+        name = sha1.hexdigest()[:20] + os.path.splitext(path)[1].lower()
+        _media_names[key] = name
+    return name
+
+
+# 可以打包到EPUB中的文件目录，((url前缀, 目录路径), ...)，只包括媒体文件目录和静态文件目录
+def epub_file_roots():
+    static_dirs = list(getattr(settings,'STATICFILES_DIRS',[]))
+    if getattr(settings,'STATIC_ROOT',None):
+        static_dirs.append(settings.STATIC_ROOT)
+    roots = [(settings.MEDIA_URL,settings.MEDIA_ROOT)] + [(settings.STATIC_URL,d) for d in static_dirs]
+    return tuple((url,os.path.realpath(str(d))) for url,d in roots)
+
+
+# 文件url对应的文件路径，不在可打包的目录中或文件不存在时返回 None
+def epub_file_path(src,roots):
+    src_path = unquote(src.split('?')[0].split('#')[0])
+    for url,root in roots:
+        if not src_path.startswith(url):
+            continue
+        path = os.path.realpath(os.path.join(root,src_path[len(url):]))
+        if path.startswith(root + os.sep) and os.path.isfile(path):
+            return path
+    return None
+
+
+# 处理章节HTML，在进程池中执行，不访问数据库
+def render_epub_chapter(chapter):
+    """
+    chapter：(文档ID, 目录层级, 文档标题, 文档HTML内容, 可打包的文件目录)
+    返回 (章节XHTML文本, {EPUB中的媒体文件名: 媒体文件路径})
+    """
+    doc_id,level,title,html,roots = chapter
+    if level == 1:
+        html_str = "<h1 style='page-break-before: always;'>{}</h1>".format(escape(title))
+    else:
+        html_str = "<h1>{}</h1>".format(escape(title))
+    html_soup = BeautifulSoup(html_str + (html or ''),'lxml')
+
+    # 添加css样式标签
+    style_link = html_soup.new_tag(name='link',href="../Styles/style.css",rel="stylesheet",type="text/css")
+    html_soup.body.insert_before(style_link)
+    editormd_link = html_soup.new_tag(name='link',href='../Styles/marked.css',rel="stylesheet",type="text/css")
+    html_soup.body.insert_before(editormd_link)
+
+    # 添加html标签的xmlns属性
+    html_soup.html['xmlns'] = "http://www.w3.org/1999/xhtml"
+
+    # 替换iframe视频为视频URL链接文本
+    for iframe in html_soup.find_all(name='iframe'):
+        iframe_src = iframe.get('src')
+        iframe.name = 'p'
+        iframe.string = _("本格式不支持iframe视频显示，视频地址为：{}".format(iframe_src))
+
+    # 替换HTML文本中静态文件的链接为EPUB中的文件
+    media = {}
+    for tag in html_soup.find_all(lambda tag: tag.has_attr("src")):
+        # 只允许引用媒体文件目录和静态文件目录中的文件
+        path = epub_file_path(tag['src'],roots)
+        if path is None:
+            continue
+        name = epub_media_name(path)
+        media[name] = path
+        tag['src'] = '../Images/' + name
+
+    return '<?xml version="1.0" encoding="UTF-8"?>' + str(html_soup),media
+
+
+# 导出EPUB
+class ReportEPUB():
+    def __init__(self,project_id,progress=None):
+        from app_doc.models import Project
+        self.project = Project.objects.select_related('create_user').get(id=project_id)
+        # 进度回调，参数为 0-100 的进度值
+        self.progress = progress or (lambda value: None)
+
+    # 通过一次查询读取文集的已发布文档，按目录顺序排列并附加文档HTML内容
+    def load_docs(self):
+        from app_doc.models import Doc
+        from app_doc.toc_utils import order_toc_nodes
+        from app_doc.render_utils import doc_content_hash,render_doc,save_doc_renders
+        rows = Doc.objects.filter(top_doc=self.project.id,status=1).values(
+            'id','name','parent_doc','editor_mode','pre_content','content','modify_time',
+            'render__content_hash','render__html'
+        ).order_by('sort','id')
+        docs = order_toc_nodes(rows)
+
+        # 文档没有HTML内容时读取渲染内容，渲染内容缺失或已过期时重新渲染
+        stale = []
+        for d in docs:
+            if d['content'] is not None:
+                d['html'] = d['content']
+                continue
+            doc = Doc(id=d['id'],editor_mode=d['editor_mode'],pre_content=d['pre_content'],content=d['content'])
+            if d['render__content_hash'] == doc_content_hash(doc):
+                d['html'] = d['render__html']
+            else:
+                render = render_doc(doc)
+                stale.append(render)
+                d['html'] = render.html
+        if stale:
+            save_doc_renders(stale)
+        return docs
+
+    # 处理全部章节，章节较多时使用进程池并行处理，返回值的顺序与 docs 一致
+    def render_chapters(self,docs):
+        roots = epub_file_roots()
+        chapters = [(d['id'],d['level'],d['name'],d['html'],roots) for d in docs]
+        workers = min(EPUB_POOL_MAX_WORKERS,os.cpu_count() or 1)
+        if len(chapters) >= EPUB_POOL_MIN_CHAPTERS and workers > 1:
+            try:
+                with ProcessPoolExecutor(max_workers=workers) as pool:
+                    return list(pool.map(render_epub_chapter,chapters,chunksize=max(len(chapters) // (workers * 4),1)))
+            except Exception:
+                logger.exception(_("EPUB章节并行处理失败，改为逐个处理"))
+        return [render_epub_chapter(c) for c in chapters]
+
+    # 文集的最后修改时间，作为书籍日期，使导出结果只取决于文集数据
+    def get_modify_time(self,docs):
+        return max([self.project.modify_time] + [d['modify_time'] for d in docs])
+
+    # 生成目录ncx的navMap和目录页的列表
+    def generate_toc(self,docs):
+        from app_doc.toc_utils import build_toc_tree
+        play_order = {d['id']:i for i,d in enumerate(docs,start=1)}
+        tree = build_toc_tree(docs,lambda d:{'id':d['id'],'title':escape(d['name'])})
+
+        def nav_points(items):
+            return ''.join(
+                '<navPoint id="np_{num}" playOrder="{num}"><navLabel><text>{title}</text></navLabel>'
+                '<content src="Text/{id}.xhtml"/>{sub}</navPoint>'.format(
+                    num=play_order[item['id']],title=item['title'],id=item['id'],sub=nav_points(item.get('sub',[]))
+                ) for item in items
+            )
+
+        def summary_list(items):
+            return '<ul>{}</ul>'.format(''.join(
+                '<li><a href="./{id}.xhtml">{title}</a>{sub}</li>'.format(
+                    id=item['id'],title=item['title'],sub=summary_list(item['sub']) if 'sub' in item else ''
+                ) for item in items
+            ))
+
+        return '<navMap>{}</navMap>'.format(nav_points(tree)),summary_list(tree)
+
+    # 书籍标题页
+    def generate_title_html(self,modify_time):
+        return '''<?xml version="1.0" encoding="UTF-8"?>
+            <html xmlns="http://www.w3.org/1999/xhtml">
+              <head>
+                <title>书籍标题</title>
+                <meta content="text/html; charset=utf-8" http-equiv="Content-Type"/>
+                <link href="../Styles/style.css" rel="stylesheet" type="text/css"/>
+              </head>
+              <body class="bookname">
+                  <div class="main">
+                    <h1 class="title">{title}</h1>
+                    <p class="author"><b>{author} 著</b></p><br/>
+                    <p class="author">{create_time}</p>
+                    <p class="book-src">本书籍由<a href='http://mrdoc.zmister.com'>MrDoc(mrdoc.zmister.com)</a>生成</p>
+                  </div>
+            </body>
+            </html>
+        '''.format(
+            title=escape(self.project.name),
+            author=escape(str(self.project.create_user)),
+            create_time=modify_time.strftime('%Y{y}%m{m}%d{d}').format(y='年',m='月',d='日')
+        )
+
+    # 书籍简介页
+    def generate_desc_html(self):
+        return '''<?xml version="1.0" encoding="UTF-8"?>
+            <html xmlns="http://www.w3.org/1999/xhtml">
+              <head>
+                <title>简介</title>
+                <meta content="text/html; charset=utf-8" http-equiv="Content-Type"/>
+                <link href="../Styles/style.css" rel="stylesheet" type="text/css"/>
+              </head>
+              <body class="bookdesc">
+                  <div class="main">
+                    <p class="title">书籍简介</p>
+                    <p class="subtitle">{desc}</p>
+                  </div>
+            </body>
+            </html>
+        '''.format(desc=escape(self.project.intro or ''))
+
+    # 元信息container.xml
+    def generate_metainfo(self):
+        return '''<?xml version="1.0" encoding="UTF-8"?>
+            <container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container" >
+                <rootfiles>
+                    <rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml" />
+                </rootfiles>
+            </container>
+            '''
+
+    # 封面
+    def generate_cover(self):
+        return '''<?xml version="1.0" encoding="utf-8"?>
+            <!DOCTYPE html><html xmlns="http://www.w3.org/1999/xhtml" xml:lang="zh">
+            <head>
+              <title>封面</title>
+            <style type="text/css">
+            svg {padding: 0pt; margin:0pt}
+            body { text-align: center; padding:0pt; margin: 0pt; }
+            </style>
+            </head>
+            <body>
+              <div>
+                <svg xmlns="http://www.w3.org/2000/svg" height="100%" preserveAspectRatio="xMidYMid meet" version="1.1" viewBox="0 0 628 892" width="100%" xmlns:xlink="http://www.w3.org/1999/xlink">
+                  <image height="892" width="628" xlink:href="../Images/epub_cover1.jpg"/>
+                </svg>
+              </div>
+            </body>
+            </html>
+        '''
+
+    # 文档目录toc.ncx
+    def generate_toc_ncx(self,uid,nav_str):
+        return '''<?xml version='1.0' encoding='utf-8'?>
+            <ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" version="2005-1" xml:lang="zh-CN">
+              <head>
+                <meta name="dtb:uid" content="{uid}"/>
+                <meta name="dtb:depth" content="1"/>
+                <meta name="dtb:totalPageCount" content="0"/>
+                <meta name="dtb:maxPageNumber" content="0"/>
+              </head>
+              <docTitle>
+                <text>{title}</text>
+              </docTitle>
+              {nav_map}
+            </ncx>
+        '''.format(uid=uid,title=escape(self.project.name),nav_map=nav_str)
+
+    # 文档目录页toc_summary.xhtml
+    def generate_toc_html(self,toc_summary_str):
+        return '''<?xml version="1.0" encoding="UTF-8"?>
+            <html xmlns="http://www.w3.org/1999/xhtml" lang="zh-CN">
+            <head>
+                <meta charset="utf-8"/>
+                <title>目录</title>
+                <style>
+                    body{margin: 0px;padding: 0px;}h1{text-align: center;padding: 0px;margin: 0px;}ul,li{list-style: none;}ul{padding-left:0px;}li>ul{padding-left: 2em;}
+                    a{text-decoration: none;color: #4183c4;text-decoration: none;font-size: 16px;line-height: 28px;}
+                </style>
+            </head>
+            <body>
+                <h1>目&#160;&#160;&#160;&#160;录</h1>
+                %s
+            </body>
+            </html>
+        ''' % (toc_summary_str)
+
+    # content.opf
+    def generate_opf(self,uid,modify_time,docs,media_names):
+        manifest = '''<item id="book_cover" href="Text/book_cover.xhtml" media-type="application/xhtml+xml"/>
+                <item id="book_title" href="Text/book_title.xhtml" media-type="application/xhtml+xml"/>
+                <item id="book_desc" href="Text/book_desc.xhtml" media-type="application/xhtml+xml"/>
+                <item id="toc_summary" href="Text/toc_summary.xhtml" media-type="application/xhtml+xml"/>
+                <item id="style" href="Styles/style.css" media-type="text/css"/>
+                <item id="marked" href="Styles/marked.css" media-type="text/css"/>
+                '''
+        spine = '<itemref idref="book_cover" linear="no"/><itemref idref="book_title"/><itemref idref="book_desc"/><itemref idref="toc_summary"/>'
+        for d in docs:
+            manifest += '<item id="doc_{0}" href="Text/{0}.xhtml" media-type="application/xhtml+xml"/>'.format(d['id'])
+            spine += '<itemref idref="doc_{}"/>'.format(d['id'])
+        for name in media_names:
+            manifest += '<item id="img_{}" href="Images/{}" media-type="{}"/>'.format(
+                os.path.splitext(name)[0],name,mimetypes.guess_type(name)[0] or 'application/octet-stream'
+            )
+        return '''<?xml version="1.0" encoding="utf-8" ?>
+            <package version="2.0" xmlns="http://www.idpf.org/2007/opf" unique-identifier="bookid" >
+              <metadata xmlns:dc="http://purl.org/dc/elements/1.1/" xmlns:opf="http://www.idpf.org/2007/opf">
+                <dc:title>{title}</dc:title>
+                <dc:language>zh</dc:language>
+                <dc:creator>{creator}</dc:creator>
+                <dc:identifier id="bookid">{uid}</dc:identifier>
+                <dc:publisher>MrDoc制作</dc:publisher>
+                <dc:date opf:event="publication">{create_time}</dc:date>
+                <dc:description>{desc}</dc:description>
+                <meta name="cover" content="cover_img" />
+                <meta name="output encoding" content="utf-8" />
+                <meta name="primary-writing-mode" content="horizontal-lr" />
+              </metadata>
+              <manifest>
+                {manifest}
+                <item id="ncx" href="toc.ncx" media-type="application/x-dtbncx+xml"/>
+                <item id="cover_img" media-type="image/jpeg" href="Images/epub_cover1.jpg" />
+              </manifest>
+              <spine toc="ncx">
+                  {spine}
+              </spine>
+              <guide>
+                <reference type="toc" title="目录" href="Text/toc_summary.xhtml" />
+                <reference href="Text/book_cover.xhtml" type="cover" title="封面"/>
+              </guide>
+            </package>
+            '''.format(
+            title=escape(self.project.name),
+            creator=escape(str(self.project.create_user)),
+            uid=uid,
+            create_time=modify_time.strftime('%Y-%m-%d'),
+            desc=escape(self.project.intro or ''),
+            manifest=manifest,
+            spine=spine,
+        )
+
+    # 将EPUB写入文件对象，文件对象可以是不支持 seek 的流
+    def write(self,fileobj):
+        docs = self.load_docs()
+        self.progress(30)
+        chapters = self.render_chapters(docs)
+        self.progress(70)
+        modify_time = self.get_modify_time(docs)
+        uid = 'urn:uuid:{}'.format(uuid.uuid5(uuid.NAMESPACE_URL,'mrdoc-project-{}'.format(self.project.id)))
+        nav_str,toc_summary_str = self.generate_toc(docs)
+        # 合并各章节引用的媒体文件，同名即内容相同
+        media = {}
+        for xhtml,chapter_media in chapters:
+            media.update(chapter_media)
+        media.pop('epub_cover1.jpg',None)
+        media_names = sorted(media)
+
+        with zipfile.ZipFile(fileobj,'w',compression=zipfile.ZIP_DEFLATED) as epub:
+            # mimetype 必须是第一个条目且不压缩
+            write_zip_entry(epub,'mimetype',data='application/epub+zip',compress=False)
+            write_zip_entry(epub,'META-INF/container.xml',data=self.generate_metainfo())
+            write_zip_entry(epub,'OEBPS/content.opf',data=self.generate_opf(uid,modify_time,docs,media_names))
+            write_zip_entry(epub,'OEBPS/toc.ncx',data=self.generate_toc_ncx(uid,nav_str))
+            write_zip_entry(epub,'OEBPS/Text/book_cover.xhtml',data=self.generate_cover())
+            write_zip_entry(epub,'OEBPS/Text/book_title.xhtml',data=self.generate_title_html(modify_time))
+            write_zip_entry(epub,'OEBPS/Text/book_desc.xhtml',data=self.generate_desc_html())
+            write_zip_entry(epub,'OEBPS/Text/toc_summary.xhtml',data=self.generate_toc_html(toc_summary_str))
+            for d,(xhtml,chapter_media) in zip(docs,chapters):
+                write_zip_entry(epub,'OEBPS/Text/{}.xhtml'.format(d['id']),data=xhtml)
+            for arcname,path in EPUB_STATIC_FILES:
+                write_zip_entry(epub,arcname,path=os.path.join(settings.BASE_DIR,path))
+            for name in media_names:
+                write_zip_entry(epub,'OEBPS/Images/' + name,path=media[name])
+
+    # 生成EPUB文件，返回不含 .epub 后缀的文件路径，出错时返回 None
+    def work(self):
+        report_path = os.path.join(settings.MEDIA_ROOT,'report_epub')
+        os.makedirs(report_path,exist_ok=True)
+        zipfile_name = os.path.join(report_path,'{}_{}'.format(self.project.name,int(time.time())))
+        temp_name = zipfile_name + '.epub.tmp'
+        try:
+            with open(temp_name,'wb') as f:
+                self.write(f)
+            os.replace(temp_name,zipfile_name + '.epub')
+            return zipfile_name
+        except Exception:
+            logger.exception(_("生成EPUB文件出错"))
+            if os.path.exists(temp_name):
+                os.remove(temp_name)
+            return None
+
+
+# 写入压缩包条目，使用固定的修改时间和权限
+def write_zip_entry(zf,name,data=None,path=None,compress=True):
+    info = zipfile.ZipInfo(name,date_time=ZIP_DATE_TIME)
+    info.external_attr = 0o644 << 16
+    if compress and not name.lower().endswith(STORED_EXTENSIONS):
+        info.compress_type = zipfile.ZIP_DEFLATED
+    else:
+        info.compress_type = zipfile.ZIP_STORED
+    if path is None:
+        zf.writestr(info,data)
+    else:
+        with open(path,'rb') as src,zf.open(info,'w') as dst:
+            shutil.copyfileobj(src,dst,1024 * 1024)
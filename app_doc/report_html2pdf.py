@@ -3,32 +3,69 @@
 # @创建者：州的先生
 # #日期：2020/12/27
 # 博客地址：zmister.com
+# HTML转PDF渲染服务
+# 后台线程各自持有一个常驻的无头浏览器会话，导出任务进入有界队列排队，队列已满时拒绝新任务；
+# 页面设置渲染完成标记（window.mrdocPdfReady）后立即打印，页面未定义该标记时在页面加载完成后打印；
+# 浏览器会话在处理一定数量的任务或健康检查失败后重建
 
 from selenium import webdriver
 from selenium.webdriver.chrome.options import Options
 from selenium.common.exceptions import TimeoutException
 from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support.expected_conditions import staleness_of
-from webdriver_manager.chrome import ChromeDriverManager,ChromeType
 from django.conf import settings
 from django.utils.translation import gettext_lazy as _
+from concurrent.futures import Future,TimeoutError as FutureTimeoutError
+from collections import deque
+from loguru import logger
+import threading
+import queue
+import time
 import sys
 import json
 import base64
 
+# 页面渲染完成标记，由 ReportPDF 生成的HTML在 markedParse 渲染完成后设置；
+# 页面未定义该标记时以 document.readyState 为 complete 作为渲染完成
+PDF_READY_SCRIPT = (
+    "return window.mrdocPdfReady === true || "
+    "(window.mrdocPdfReady === undefined && document.readyState === 'complete')"
+)
+# 打印参数
+PDF_PRINT_OPTIONS = {
+    'landscape': False,
+    'displayHeaderFooter': False,
+    'printBackground': True,
+    'preferCSSPageSize': True,
+}
+# 统计吞吐量和耗时的最近任务数
+PDF_STATS_WINDOW = 200
+# 等待渲染结果的最长秒数，包括排队等待其他任务的时间
+PDF_RESULT_TIMEOUT = 300
 
-def convert(source: str, target: str, timeout: int = 2, compress: bool = False, power: int = 0, install_driver: bool = True):
+
+# 渲染任务队列已满
+class PdfRenderBusy(Exception):
+    pass
+
+
+def convert(source: str, target: str, timeout: int = 30, compress: bool = False, power: int = 0, install_driver: bool = True):
     '''
     Convert a given html file or website into PDF
 
     :param str source: source html file or website link
     :param str target: target location to save the PDF
-    :param int timeout: timeout in seconds. Default value is set to 2 seconds
+    :param int timeout: max seconds to wait for the page-ready hook. Default value is set to 30 seconds
     :param bool compress: whether PDF is compressed or not. Default value is False
     :param int power: power of the compression. Default value is 0. This can be 0: default, 1: prepress, 2: printer, 3: ebook, 4: screen
    '''
 
-    result = __get_pdf_from_html(source, timeout, install_driver)
+    # 队列已满时最多等待 timeout 秒，等待渲染结果超过 PDF_RESULT_TIMEOUT 秒时取消任务（未开始渲染时）并抛出异常
+    future = get_pdf_pool().submit(source, timeout, wait=timeout)
+    try:
+        result = future.result(timeout=PDF_RESULT_TIMEOUT)
+    except FutureTimeoutError:
+        future.cancel()
+        raise PdfRenderBusy(_("等待PDF渲染结果超时：{}").format(source))
 
     # if compress:
     #     __compress(result, target, power)
@@ -37,7 +74,7 @@ def convert(source: str, target: str, timeout: int = 2, compress: bool = False,
         file.write(result)
 
 
-def __send_devtools(driver, cmd, params={}):
+def _send_devtools(driver, cmd, params={}):
     resource = "/session/%s/chromium/send_command_and_get_result" % driver.session_id
     url = driver.command_executor._url + resource
     body = json.dumps({'cmd': cmd, 'params': params})
@@ -49,15 +86,15 @@ def __send_devtools(driver, cmd, params={}):
     return response.get('value')
 
 
-def __get_pdf_from_html(path: str, timeout: int, install_driver: bool, print_options={}):
+# 启动无头浏览器
+def create_driver():
     webdriver_options = Options()
     webdriver_prefs = {}
-    driver = None
 
     webdriver_options.add_argument('--no-sandbox')
     webdriver_options.add_argument('--headless')
     webdriver_options.add_argument('--disable-gpu')
-    webdriver_options.add_argument("--remote-debugging-port=9222")
+    # 不指定固定的远程调试端口，由 chromedriver 为每个浏览器分配，多个浏览器可同时运行
     webdriver_options.add_argument('--disable-dev-shm-usage')
     webdriver_options.experimental_options['prefs'] = webdriver_prefs
 
@@ -68,28 +105,171 @@ def __get_pdf_from_html(path: str, timeout: int, install_driver: bool, print_opt
         from selenium.webdriver.chrome.service import Service
         # 创建 Service 对象
         service = Service(executable_path=settings.CHROMIUM_DRIVER_PATH)
-        driver = webdriver.Chrome(service=service, options=webdriver_options)
+        return webdriver.Chrome(service=service, options=webdriver_options)
     # 使用默认的chromedriver
-    else:
-        driver = webdriver.Chrome(options=webdriver_options)
+    return webdriver.Chrome(options=webdriver_options)
 
-    driver.get(path)
 
-    try:
-        from selenium.webdriver.common.by import By
-        WebDriverWait(driver, timeout).until(staleness_of(driver.find_element(By.TAG_NAME, 'html')))
-    except TimeoutException:
-        calculated_print_options = {
-            'landscape': False,
-            'displayHeaderFooter': False,
-            'printBackground': True,
-            'preferCSSPageSize': True,
-        }
-        calculated_print_options.update(print_options)
-        result = __send_devtools(driver, "Page.printToPDF", calculated_print_options)
-        driver.quit()
+# 常驻的浏览器会话
+class BrowserSession():
+    def __init__(self):
+        self.driver = create_driver()
+        self.jobs = 0
+
+    # 健康检查
+    def healthy(self):
+        try:
+            return self.driver.execute_script('return 1') == 1
+        except Exception:
+            return False
+
+    # 打开页面，等待渲染完成标记后打印为PDF
+    def render(self, source, timeout, print_options=None):
+        self.jobs += 1
+        self.driver.get(source)
+        try:
+            WebDriverWait(self.driver, timeout, poll_frequency=0.1).until(
+                lambda driver: driver.execute_script(PDF_READY_SCRIPT)
+            )
+        except TimeoutException:
+            logger.warning(_("等待页面渲染完成超时，直接打印：{}").format(source))
+        options = dict(PDF_PRINT_OPTIONS)
+        options.update(print_options or {})
+        result = _send_devtools(self.driver, "Page.printToPDF", options)
+        # 打开空白页，释放页面占用的内存
+        self.driver.get('about:blank')
         return base64.b64decode(result['data'])
 
+    def close(self):
+        try:
+            self.driver.quit()
+        except Exception:
+            pass
+
+
+# PDF渲染服务
+class PdfRenderPool():
+    def __init__(self, size=2, max_jobs=50, queue_size=8):
+        """
+        size：浏览器会话数量，即同时渲染的任务数
+        max_jobs：每个浏览器会话处理的任务数，达到后重建会话
+        queue_size：排队的任务数上限
+        """
+        self.size = size
+        self.max_jobs = max_jobs
+        self.jobs = queue.Queue(maxsize=queue_size)
+        self.workers = []
+        self.lock = threading.Lock()
+        # 统计数据
+        self.completed = 0
+        self.failed = 0
+        self.recycled = 0
+        self.latencies = deque(maxlen=PDF_STATS_WINDOW)
+        self.finish_times = deque(maxlen=PDF_STATS_WINDOW)
+
+    # 启动后台线程
+    def start(self):
+        with self.lock:
+            while len(self.workers) < self.size:
+                worker = threading.Thread(target=self.run, name='pdf-render-{}'.format(len(self.workers)), daemon=True)
+                worker.start()
+                self.workers.append(worker)
+
+    # 提交渲染任务，返回 Future，结果为PDF文件内容；等待 wait 秒后队列仍满时抛出 PdfRenderBusy
+    def submit(self, source, timeout=30, print_options=None, wait=0):
+        self.start()
+        future = Future()
+        try:
+            self.jobs.put((future, source, timeout, print_options, time.monotonic()), timeout=wait or None, block=wait > 0)
+        except queue.Full:
+            raise PdfRenderBusy(_("PDF导出任务较多，请稍后再试"))
+        return future
+
+    # 创建浏览器会话，失败时返回 None
+    def new_session(self):
+        try:
+            return BrowserSession()
+        except Exception:
+            logger.exception(_("启动浏览器失败"))
+            return None
+
+    def run(self):
+        session = self.new_session() # 预先启动浏览器
+        while True:
+            future, source, timeout, print_options, queue_time = self.jobs.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+            # 会话达到任务数上限或健康检查失败时重建
+            if session is not None and (session.jobs >= self.max_jobs or not session.healthy()):
+                session.close()
+                session = None
+                with self.lock:
+                    self.recycled += 1
+            if session is None:
+                session = self.new_session()
+            try:
+                if session is None:
+                    raise RuntimeError(_("浏览器不可用"))
+                result = session.render(source, timeout, print_options)
+            except Exception as e:
+                if session is not None:
+                    session.close()
+                    session = None
+                with self.lock:
+                    self.failed += 1
+                future.set_exception(e)
+                continue
+            now = time.monotonic()
+            with self.lock:
+                self.completed += 1
+                self.latencies.append(now - queue_time)
+                self.finish_times.append(now)
+            future.set_result(result)
+
+    # 获取统计数据
+    def get_stats(self):
+        """
+        queue_depth：排队中的任务数
+        completed、failed、recycled：完成、失败的任务数和重建的浏览器会话数
+        throughput：最近完成的任务每分钟的吞吐量
+        p50、p95：最近完成的任务从提交到完成的耗时秒数
+        """
+        with self.lock:
+            latencies = sorted(self.latencies)
+            finish_times = list(self.finish_times)
+            stats = {
+                'workers': len(self.workers),
+                'queue_depth': self.jobs.qsize(),
+                'completed': self.completed,
+                'failed': self.failed,
+                'recycled': self.recycled,
+            }
+        if len(finish_times) > 1 and finish_times[-1] > finish_times[0]:
+            stats['throughput'] = round((len(finish_times) - 1) * 60 / (finish_times[-1] - finish_times[0]), 2)
+        else:
+            stats['throughput'] = None
+        stats['p50'] = round(latencies[int(len(latencies) * 0.5)], 3) if latencies else None
+        stats['p95'] = round(latencies[min(int(len(latencies) * 0.95), len(latencies) - 1)], 3) if latencies else None
+        return stats
+
+
+_pdf_pool = None
+_pdf_pool_lock = threading.Lock()
+
+
+# 获取进程内的PDF渲染服务
+def get_pdf_pool():
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is None:
+            _pdf_pool = PdfRenderPool(
+                size=settings.PDF_RENDER_POOL_SIZE,
+                max_jobs=settings.PDF_RENDER_MAX_JOBS,
+                queue_size=settings.PDF_RENDER_QUEUE_SIZE,
+            )
+    return _pdf_pool
+
+
 if __name__ == '__main__':
     # print(sys.argv)
     html_path, pdf_path = sys.argv[1],sys.argv[2]
@@ -12,7 +12,6 @@ import subprocess
 import datetime,time
 import re
 import os,sys
-import shutil
 
 
 from django.core.wsgi import get_wsgi_application
@@ -25,11 +24,8 @@ from app_doc.models import *
 from subprocess import Popen
 from loguru import logger
 from app_doc.report_html2pdf import convert
-import traceback
-import time
-import markdown
 import yaml
-import pathlib
+import zipfile
 from urllib.parse import unquote
 
 
@@ -40,7 +36,12 @@ def validate_title(title):
   return new_title
 
 # 导出MD文件压缩包
+# 文档和引用的媒体文件直接以流的方式写入压缩包，不创建临时目录，媒体文件只写入一次，
+# 内存占用与文集大小无关；压缩包结构与导入文集使用的结构一致
 class ReportMD():
+    # 媒体文件复制时每次读取的字节数
+    chunk_size = 1024 * 1024
+
     def __init__(self,project_id):
         # 查询文集信息
         self.pro_id = project_id
@@ -53,622 +54,150 @@ class ReportMD():
             str(datetime.date.today())
         )
 
-        # 判断MD导出临时文件夹是否存在
-        if os.path.exists(settings.MEDIA_ROOT + "/reportmd_temp") is False:
-            os.mkdir(settings.MEDIA_ROOT + "/reportmd_temp")
-
-        # 判断文集名称文件夹是否存在
-        self.project_path = settings.MEDIA_ROOT + "/reportmd_temp/{}".format(self.project_name)
-        is_fold = os.path.exists(self.project_path)
-        if is_fold is False:
-            os.mkdir(self.project_path)
-
-        # 判断是否存在静态文件文件夹
-        self.media_path = settings.MEDIA_ROOT + "/reportmd_temp/{}/media".format(self.project_name)
-        is_media = os.path.exists(self.media_path)
-        if is_media is False:
-            os.mkdir(self.media_path)
+    # 文集是否存在已发布的文档
+    def has_docs(self):
+        return Doc.objects.filter(top_doc=self.pro_id,status=1).exists()
 
-    def work(self):
+    # 依次写入压缩包条目
+    def write_entries(self,zf):
         # 初始化文集YAML数据
         project_toc_list = {}
         project_toc_list['project_name'] = validate_title(self.project_data.name)
         project_toc_list['project_desc'] = self.project_data.intro
         project_toc_list['project_role'] = self.project_data.role
         project_toc_list['toc'] = []
-        # 读取指定文集的文档数据
+        # 读取指定文集的文档数据，分批读取文档内容
         data = Doc.objects.filter(
             top_doc=self.pro_id,
             status=1
         ).order_by('sort', 'create_time').values(
             'name', 'editor_mode', 'pre_content', 'content', 'parent_doc', 'id'
-        )
-        if data.count() == 0:
-            return None
-        out = {}
+        ).iterator(chunk_size=200)
+        out = {0:{'children': []}}
+        media_files = set() # 已写入的媒体文件
         for p in data:
-            doc_pre_content = p['pre_content']
-            doc_content = p['content']
+            doc_pre_content = p.pop('pre_content')
+            doc_content = p.pop('content')
             p['name'] = validate_title(p['name'])
-            p['file'] = '{}-{}.md'.format(validate_title(p['name']), p['id'])
-            del p['pre_content']
-            del p['content']
+            p['file'] = '{}-{}.md'.format(p['name'], p['id'])
             out.setdefault(p['parent_doc'], {'children': []})
             out.setdefault(p['id'], {'children': []})
             out[p['id']].update(p)
             out[p['parent_doc']]['children'].append(out[p['id']])
 
             # 处理文档内的图片，如果使用Markdown编辑器编写则导出Markdown文本，如果使用富文本编辑器编写则导出HTML文本
-            md_content = self.operat_md_media(doc_content) \
-                if p['editor_mode'] in [3] else self.operat_md_media(doc_pre_content)
-            # 新建MD文件
-            file_path = '{}/{}-{}.md'.format(self.project_path, p['name'], p['id'])
-            with open(file_path, 'w', encoding='utf-8') as files:
-                files.write(md_content)
+            md_content,media_list = self.operat_md_media(
+                doc_content if p['editor_mode'] in [3] else doc_pre_content
+            )
+            zf.writestr(p['file'], md_content)
+            for arcname,file_path in media_list:
+                if arcname in media_files:
+                    continue
+                media_files.add(arcname)
+                with open(file_path,'rb') as src,zf.open(arcname,'w') as dst:
+                    for chunk in iter(lambda: src.read(self.chunk_size),b''):
+                        dst.write(chunk)
         project_toc_list['toc'] = out[0]['children']
 
-        # 写入层级YAML
-        with open('{}/mrdoc.yaml'.format(self.project_path), 'a+', encoding='utf-8') as toc_yaml:
-            yaml.dump(project_toc_list,toc_yaml,allow_unicode=True)
-
-        # 压缩文件
-        md_file = shutil.make_archive(
-            base_name=self.project_path,
-            format='zip',
-            root_dir=self.project_path
-        )
-        # print(md_file)
-        # 删除文件夹
-        shutil.rmtree(self.project_path)
+        # 写入层级YAML，目录按一级文档逐个序列化，避免一次序列化整个目录占用大量内存
+        with zf.open('mrdoc.yaml','w') as toc_yaml:
+            toc = project_toc_list.pop('toc')
+            toc_yaml.write(yaml.dump(project_toc_list,allow_unicode=True).encode('utf-8'))
+            if toc:
+                toc_yaml.write(b'toc:\n')
+                for item in toc:
+                    toc_yaml.write(yaml.dump([item],allow_unicode=True).encode('utf-8'))
+            else:
+                toc_yaml.write(b'toc: []\n')
 
-        return "{}.zip".format(self.project_path)
+    # 将MD文件压缩包写入文件对象，文件对象可以是不支持 seek 的流
+    def write(self,fileobj):
+        with zipfile.ZipFile(fileobj,'w',compression=zipfile.ZIP_DEFLATED) as zf:
+            self.write_entries(zf)
 
-    # 处理MD内容中的静态文件
+    # 生成MD文件压缩包，返回文件路径，文集没有文档时返回 None
+    def work(self):
+        if not self.has_docs():
+            return None
+        report_path = os.path.join(settings.MEDIA_ROOT,'reportmd_temp')
+        os.makedirs(report_path,exist_ok=True)
+        md_file = os.path.join(report_path,'{}.zip'.format(self.project_name))
+        temp_file = md_file + '.tmp'
+        try:
+            with open(temp_file,'wb') as f:
+                self.write(f)
+            os.replace(temp_file,md_file)
+        finally:
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+        return md_file
+
+    # 处理MD内容中的静态文件，返回 (替换链接后的内容, [(压缩包中的路径, 文件路径)])
     def operat_md_media(self,md_content):
+        md_content = md_content or ''
         # 查找MD内容中的静态文件
-        pattern = r"\!\[.*?\]\(.*?\)"
-        media_list = re.findall(pattern, md_content)
-        # print(media_list)
+        media_urls = []
+        for media in re.findall(r"\!\[.*?\]\(.*?\)", md_content):
+            media_urls.append(media.replace('//','/').split("(")[-1].split(")")[0]) # 媒体文件的文件名
         # 查找<img>标签形式的静态图片
-        img_pattern = r'<img[^>]*/>'
-        img_list = re.findall(img_pattern, md_content)
-        # 存在静态文件,进行遍历
-        if len(media_list) > 0:
-            for media in media_list:
-                try:
-                    media_filename = media.replace('//','/').split("(")[-1].split(")")[0] # 媒体文件的文件名
-                except:
-                    continue
-                # 对本地静态文件进行复制
-                if media_filename.startswith("/media"):
-                    # 安全拼接路径
-                    target_path = os.path.join(settings.BASE_DIR, media_filename[1:])
-                    abs_path = os.path.abspath(target_path)
-                    # 检查目标路径是否在允许范围内
-                    if (not abs_path.startswith(settings.MEDIA_ROOT)) \
-                            or '..' in os.path.relpath(abs_path,settings.MEDIA_ROOT):
-                        continue
-                    # print(media_filename)
-                    sub_folder = "/" + media_filename.split("/")[2] # 获取子文件夹的名称
-                    # print(sub_folder)
-                    is_sub_folder = os.path.exists(self.media_path+sub_folder)
-                    # 创建子文件夹
-                    if is_sub_folder is False:
-                        os.mkdir(self.media_path+sub_folder)
-                    # 替换MD内容的静态文件链接
-                    md_content = md_content.replace(media_filename, "." + media_filename)
-                    # 复制静态文件到指定文件夹
-                    try:
-                        new_file_path = pathlib.Path(settings.BASE_DIR,unquote(media_filename)[1:])
-                        shutil.copy(new_file_path, self.media_path + sub_folder)
-                    except FileNotFoundError:
-                        pass
-        if len(img_list) > 0:
-            for media in img_list:
-                try:
-                    media_filename = re.findall('src="([^"]+)"', media)[0]
-                except:
-                    continue
-                # 对本地静态文件进行复制
-                if media_filename.startswith("/media"):
-                    # 安全拼接路径
-                    target_path = os.path.join(settings.BASE_DIR, media_filename[1:])
-                    abs_path = os.path.abspath(target_path)
-                    # 检查目标路径是否在允许范围内
-                    if (not abs_path.startswith(settings.MEDIA_ROOT)) \
-                            or '..' in os.path.relpath(abs_path, settings.MEDIA_ROOT):
-                        continue
-                    # print(media_filename)
-                    sub_folder = "/" + media_filename.split("/")[2]  # 获取子文件夹的名称
-                    # print(sub_folder)
-                    is_sub_folder = os.path.exists(self.media_path + sub_folder)
-                    # 创建子文件夹
-                    if is_sub_folder is False:
-                        os.mkdir(self.media_path + sub_folder)
-                    # 替换MD内容的静态文件链接
-                    md_content = md_content.replace(media_filename, "." + media_filename)
-                    # 复制静态文件到指定文件夹
-                    try:
-                        new_file_path = pathlib.Path(settings.BASE_DIR,unquote(media_filename)[1:])
-                        shutil.copy(new_file_path, self.media_path + sub_folder)
-                    except FileNotFoundError:
-                        pass
-        return md_content
+        for media in re.findall(r'<img[^>]*/>', md_content):
+            media_urls += re.findall('src="([^"]+)"', media)[:1]
+
+        media_list = []
+        for media_filename in dict.fromkeys(media_urls):
+            # 只处理本地静态文件
+            if not media_filename.startswith("/media"):
+                continue
+            # 安全拼接路径，检查目标路径是否在允许范围内
+            file_path = os.path.abspath(os.path.join(settings.BASE_DIR, unquote(media_filename)[1:]))
+            if (not file_path.startswith(settings.MEDIA_ROOT)) \
+                    or '..' in os.path.relpath(file_path,settings.MEDIA_ROOT):
+                continue
+            # 替换MD内容的静态文件链接
+            md_content = re.sub(r'(?<![\w./])' + re.escape(media_filename), "." + media_filename, md_content)
+            if os.path.isfile(file_path):
+                media_list.append((os.path.relpath(file_path,settings.BASE_DIR).replace(os.sep,'/'),file_path))
+        return md_content,media_list
 
 
 # 批量导出文集Markdown压缩包
+# 每个文集的MD文件压缩包直接以流的方式写入合集压缩包
 class ReportMdBatch():
     def __init__(self,username,project_id_list):
         self.project_list = project_id_list
         self.username = username
-        # 判断MD导出临时文件夹是否存在
-        if os.path.exists(settings.MEDIA_ROOT + "/reportmd_temp") is False:
-            os.mkdir(settings.MEDIA_ROOT + "/reportmd_temp")
-
-        # 判断用户名+日期文件夹是否存在
         self.report_file_path = settings.MEDIA_ROOT + "/reportmd_temp/{}_{}".format(
             self.username,datetime.datetime.strftime(datetime.datetime.now(),"%y%m%d%H%M%S")
         )
-        is_fold = os.path.exists(self.report_file_path)
-        if is_fold is False:
-            os.mkdir(self.report_file_path)
 
-    def work(self):
-        # 遍历文集列表，打包每一个文集
-        project_file_list = []
-        for project_id in self.project_list:
-            report_func = ReportMD(project_id=project_id)
-            report_project_zip = report_func.work()
-            project_file_list.append(report_project_zip)
-
-        # 遍历打包好的文集列表，将其移入统一文件夹
-        for file in project_file_list:
-            shutil.move(file,self.report_file_path)
-
-        # 压缩打包文集合集文件夹
-        md_file = shutil.make_archive(
-            base_name=self.report_file_path,
-            format='zip',
-            root_dir=self.report_file_path
-        )
-        # print(md_file)
-        # 删除文件夹
-        shutil.rmtree(self.report_file_path)
+    # 将合集压缩包写入文件对象
+    def write(self,fileobj):
+        with zipfile.ZipFile(fileobj,'w') as zf:
+            for project_id in self.project_list:
+                report_func = ReportMD(project_id=project_id)
+                if not report_func.has_docs():
+                    continue
+                # 文集压缩包已经压缩，不再重复压缩
+                with zf.open('{}.zip'.format(report_func.project_name),'w',force_zip64=True) as project_zip:
+                    report_func.write(project_zip)
 
-        return "{}.zip".format(self.report_file_path)
+    # 生成合集压缩包，返回文件路径；先写入临时文件，完成后替换，导出失败时不留下不完整的文件
+    def work(self):
+        os.makedirs(settings.MEDIA_ROOT + "/reportmd_temp",exist_ok=True)
+        md_file = "{}.zip".format(self.report_file_path)
+        temp_file = md_file + '.tmp'
+        try:
+            with open(temp_file,'wb') as f:
+                self.write(f)
+            os.replace(temp_file,md_file)
+        finally:
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+        return md_file
 
 
 # 导出EPUB
-class ReportEPUB():
-    def __init__(self,project_id):
-        self.project = Project.objects.get(id=project_id)
-        self.base_path = settings.MEDIA_ROOT + '/report_epub/{}/'.format(project_id)
-
-        # 创建相关目录
-        if os.path.exists(self.base_path + '/OEBPS') is False:
-            os.makedirs(self.base_path + '/OEBPS')
-        if os.path.exists(self.base_path + '/OEBPS/Images') is False:
-            os.makedirs(self.base_path + '/OEBPS/Images')
-        if os.path.exists(self.base_path + '/OEBPS/Text') is False:
-            os.makedirs(self.base_path + '/OEBPS/Text')
-        if os.path.exists(self.base_path + '/OEBPS/Styles') is False:
-            os.makedirs(self.base_path + '/OEBPS/Styles')
-        if os.path.exists(self.base_path + '/META-INF') is False:
-            os.makedirs(self.base_path + '/META-INF')
-
-        # 复制样式文件到相关目录
-        shutil.copyfile(settings.BASE_DIR+'/static/report_epub/style.css',self.base_path + '/OEBPS/Styles/style.css')
-        # shutil.copyfile(settings.BASE_DIR+'/static/katex/katex.min.css',self.base_path + '/OEBPS/Styles/katex.css')
-        shutil.copyfile(settings.BASE_DIR+'/static/mr-marked/marked.css',self.base_path + '/OEBPS/Styles/marked.css')
-        # 复制封面图片到相关目录
-        shutil.copyfile(settings.BASE_DIR+'/static/report_epub/epub_cover1.jpg',self.base_path + '/OEBPS/Images/epub_cover1.jpg')
-
-    # 将文档内容写入HTML文件
-    def write_html(self, d, html_str):
-        # 使用BeautifulSoup解析拼接好的HTML文本
-        html_soup = BeautifulSoup(html_str, 'lxml')
-        src_tag = html_soup.find_all(lambda tag: tag.has_attr("src"))  # 查找所有包含src的标签
-        mindmap_tag = html_soup.select('svg.mindmap') # 查找所有脑图的SVG标签
-        tex_tag = html_soup.select('.editormd-tex') # 查找所有公式标签
-        flowchart_tag = html_soup.select('.flowchart') # 查找所有流程图标签
-        seque_tag = html_soup.select('.sequence-diagram') # 查找所有时序图标签
-        echart_tag = html_soup.select('.echart') # 查找所有echart图表标签
-        code_tag = html_soup.find_all(name="code") # 查找code代码标签
-        iframe_tag = html_soup.find_all(name='iframe') # 查找iframe
-
-        # 添加css样式标签
-        style_link = html_soup.new_tag(name='link',href="../Styles/style.css",rel="stylesheet",type="text/css")
-        html_soup.body.insert_before(style_link)
-        editormd_link = html_soup.new_tag(name='link',href='../Styles/marked.css',rel="stylesheet",type="text/css")
-        html_soup.body.insert_before(editormd_link)
-
-        # 添加html标签的xmlns属性
-        html_soup.html['xmlns'] = "http://www.w3.org/1999/xhtml"
-
-        # 替换iframe视频为视频URL链接文本
-        for iframe in iframe_tag:
-            iframe_src = iframe.get('src')
-            iframe.name = 'p'
-            iframe.string = _("本格式不支持iframe视频显示，视频地址为：{}".format(iframe_src))
-
-        # 替换HTML文本中静态文件的相对链接为绝对链接
-        for src in src_tag:
-            if src['src'].startswith("/"):
-                src_path = src['src'] # 媒体文件原始路径
-                src_filename = src['src'].split("/")[-1] # 媒体文件名
-                src['src'] = '../Images/' + src_filename # 媒体文件在EPUB中的路径
-                # 复制文件到epub的Images文件夹
-                try:
-                    shutil.copyfile(
-                        src= settings.BASE_DIR + src_path,
-                        dst= self.base_path + '/OEBPS/Images/' + src_filename
-                    )
-                except FileNotFoundError as e:
-                    pass
-
-        # 创建写入临时HTML文件
-        temp_file_path = self.base_path + '/OEBPS/Text/{0}.xhtml'.format(d.id)
-        with open(temp_file_path, 'a+', encoding='utf-8') as htmlfile:
-            htmlfile.write('<?xml version="1.0" encoding="UTF-8"?>' + str(html_soup))
-
-    # 生成文档HTML
-    def generate_html(self):
-        # 查询文档
-        data = Doc.objects.filter(top_doc=self.project.id, parent_doc=0, status=1).order_by("sort")
-        self.toc_list = [
-            {
-                'id': 0,
-                'link': 'Text/toc_summary.xhtml',
-                'pid': 0,
-                'title': _('目录')
-            }
-        ]
-        nav_str = '''<navMap>'''
-        toc_summary_str = '''<ul>'''
-        nav_num = 1
-        # content.opf相关
-        manifest = '''<item id="book_cover" href="Text/book_cover.xhtml" media-type="application/xhtml+xml"/>
-        <item id="book_title" href="Text/book_title.xhtml" media-type="application/xhtml+xml"/>
-        <item id="book_desc" href="Text/book_desc.xhtml" media-type="application/xhtml+xml"/>
-        <item id="toc_summary" href="Text/toc_summary.xhtml" media-type="application/xhtml+xml"/>
-        '''
-        spine = '<itemref idref="book_cover" linear="no"/><itemref idref="book_title"/><itemref idref="book_desc"/><itemref idref="toc_summary"/>'
-
-        for d in data:
-            # 拼接HTML字符串
-            html_str = "<h1 style='page-break-before: always;'>{}</h1>".format(d.name)
-            if d.content is None:
-                d.content = markdown.markdown(
-                    d.pre_content,
-                    extensions=['markdown.extensions.fenced_code','markdown.extensions.tables']
-                )
-            html_str += d.content
-            self.write_html(d=d,html_str=html_str) # 生成HTML
-            # 生成HTML的目录位置
-            toc = {
-                'id':d.id,
-                'link':'{}.xhtml'.format(d.id),
-                'pid':d.parent_doc,
-                'title':d.name
-            }
-            self.toc_list.append(toc)
-
-            # nav
-            toc_nav = '''<navPoint id="np_{nav_num}" playOrder="{nav_num}">
-                    <navLabel><text>{title}</text></navLabel>
-                    <content src="Text/{file}"/>
-                '''.format(nav_num=nav_num,title=d.name,file=toc['link'])
-            nav_str += toc_nav
-
-            # toc_summary
-            toc_summary_str += '''<li><a href="./{}">{}</a>'''.format(toc['link'],toc['title'])
-            # content.opf
-            manifest += '<item id="{}" href="Text/{}.xhtml" media-type="application/xhtml+xml"/>'.format(d.id, d.id)
-            spine += '<itemref idref="{}"/>'.format(d.id)
-
-            nav_num += 1
-
-            # 获取第二级文档
-            data_2 = Doc.objects.filter(parent_doc=d.id,status=1).order_by("sort")
-            if data_2.count() > 0:
-                toc_summary_str += '<ul>'
-            for d2 in data_2:
-                html_str = "<h1>{}</h1>".format(d2.name)
-                if d2.content is None:
-                    d2.content = markdown.markdown(
-                        d2.pre_content,
-                        extensions=['markdown.extensions.fenced_code', 'markdown.extensions.tables']
-                    )
-                html_str += d2.content
-                self.write_html(d=d2,html_str=html_str)
-                # 生成HTML的目录位置
-                toc = {
-                    'id': d2.id,
-                    'link': '{}.xhtml'.format(d2.id),
-                    'pid': d2.parent_doc,
-                    'title': d2.name
-                }
-                self.toc_list.append(toc)
-                toc_nav = '''<navPoint id="np_{nav_num}" playOrder="{nav_num}">
-                                    <navLabel><text>{title}</text></navLabel>
-                                    <content src="Text/{file}"/>
-                                '''.format(nav_num=nav_num, title=d2.name, file=toc['link'])
-                nav_str += toc_nav
-
-                # toc_summary
-                toc_summary_str += '''<li><a href="./{}">{}</a>'''.format(toc['link'], toc['title'])
-                # content.opf
-                manifest += '<item id="{}" href="Text/{}.xhtml" media-type="application/xhtml+xml"/>'.format(d2.id, d2.id)
-                spine += '<itemref idref="{}"/>'.format(d2.id)
-
-                nav_num += 1
-
-                # 获取第三级文档
-                data_3 = Doc.objects.filter(parent_doc=d2.id,status=1).order_by("sort")
-                if data_3.count() > 0:
-                    toc_summary_str += '<ul>'
-                for d3 in data_3:
-                    html_str = "<h1>{}</h1>".format(d3.name)
-                    # 如果文档没有HTML内容，将Markdown转换为HTML
-                    if d3.content is None:
-                        d3.content = markdown.markdown(
-                            d3.pre_content,
-                            extensions=['markdown.extensions.fenced_code', 'markdown.extensions.tables']
-                        )
-                    html_str += d3.content
-                    self.write_html(d=d3,html_str=html_str)
-                    # 生成HTML的目录位置
-                    toc = {
-                        'id': d3.id,
-                        'link': '{}.xhtml'.format(d3.id),
-                        'pid': d3.parent_doc,
-                        'title': d3.name
-                    }
-                    self.toc_list.append(toc)
-
-                    toc_nav = '''<navPoint id="np_{nav_num}" playOrder="{nav_num}">
-                                    <navLabel><text>{title}</text></navLabel>
-                                    <content src="Text/{file}"/>
-                                </navPoint>
-                        '''.format(nav_num=nav_num, title=d3.name, file=toc['link'])
-                    nav_str += toc_nav
-
-                    # toc_summary
-                    toc_summary_str += '''<li><a href="./{}">{}</a></li>'''.format(toc['link'], toc['title'])
-                    # content.opf
-                    manifest += '<item id="{}" href="Text/{}.xhtml" media-type="application/xhtml+xml"/>'.format(d3.id,
-                                                                                                                d3.id)
-                    spine += '<itemref idref="{}"/>'.format(d3.id)
-
-                    nav_num += 1
-
-                nav_str += "</navPoint>"
-                if data_3.count() > 0:
-                    toc_summary_str += "</ul></li>"
-                else:
-                    toc_summary_str += "</li>"
-
-            nav_str += "</navPoint>"
-            if data_2.count() > 0:
-                toc_summary_str += "</ul></li>"
-            else:
-                toc_summary_str += "</li>"
-
-        nav_str += '</navMap>'
-        toc_summary_str += '</ul>'
-
-        # print(nav_str)
-        # print(toc_summary_str)
-        self.nav_str = nav_str
-        self.toc_summary_str = toc_summary_str
-        # self.config_json['toc'] = self.toc_list
-        self.manifest = manifest
-        self.spine = spine
-
-    # 生成书籍标题的描述HTML文件
-    def generate_title_html(self):
-        title_str = '''<?xml version="1.0" encoding="UTF-8"?>
-            <html xmlns="http://www.w3.org/1999/xhtml">
-              <head>
-                <title>书籍标题</title>
-                <meta content="text/html; charset=utf-8" http-equiv="Content-Type"/>
-                <link href="../Styles/style.css" rel="stylesheet" type="text/css"/>
-              </head>
-              <body class="bookname">
-                  <div class="main">
-                    <h1 class="title"">{title}</h1>
-                    <p class="author"><b>{author} 著</b></p><br>
-                    <p class="author">{create_time}</p>
-                    <p class="book-src">本书籍由<a href='http://mrdoc.zmister.com'>MrDoc(mrdoc.zmister.com)</a>生成</p>
-                  </div>
-            </body>
-            </html>
-        '''.format(
-            title=self.project.name,
-            author=self.project.create_user,
-            create_time = time.strftime('%Y{y}%m{m}%d{d}').format(y='年',m='月',d='日')
-        )
-        with open(self.base_path+'/OEBPS/Text/book_title.xhtml','a+',encoding='utf-8') as file:
-            file.write(title_str)
-
-        desc_str = '''<?xml version="1.0" encoding="UTF-8"?>
-            <html xmlns="http://www.w3.org/1999/xhtml">
-              <head>
-                <title>简介</title>
-                <meta content="text/html; charset=utf-8" http-equiv="Content-Type"/>
-                <link href="../Styles/style.css" rel="stylesheet" type="text/css"/>
-              </head>
-              <body class="bookdesc">
-                  <div class="main">
-                    <p class="title">书籍简介</p>
-                    <p class="subtitle">{desc}</p>
-                  </div>
-            </body>
-            </html>
-        '''.format(desc=self.project.intro)
-        with open(self.base_path+'/OEBPS/Text/book_desc.xhtml','a+',encoding='utf-8') as file:
-            file.write(desc_str)
-
-    # 生成元信息container.xml文件
-    def generate_metainfo(self):
-        xml = '''<?xml version="1.0" encoding="UTF-8"?>
-            <container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container" >
-                <rootfiles>
-                    <rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml" />
-                </rootfiles>
-            </container>
-            '''
-        folder = self.base_path + '/META-INF'
-        with open(folder+'/container.xml','a+',encoding='utf-8') as metafile:
-            metafile.write(xml)
-
-    # 生成元类型mimetype文件
-    def generate_metatype(self):
-        with open(self.base_path+'/mimetype','a+',encoding='utf-8') as metatype:
-            metatype.write('application/epub+zip')
-
-    # 生成封面
-    def generate_cover(self):
-        xml_str = '''<?xml version="1.0" encoding="utf-8"?>
-            <!DOCTYPE html><html xmlns="http://www.w3.org/1999/xhtml" xml:lang="zh">
-            <head>
-              <title>封面</title>
-            <style type="text/css">
-            svg {padding: 0pt; margin:0pt}
-            body { text-align: center; padding:0pt; margin: 0pt; }
-            </style>
-            </head>
-            <body>
-              <div>
-                <svg xmlns="http://www.w3.org/2000/svg" height="100%" preserveAspectRatio="xMidYMid meet" version="1.1" viewBox="0 0 628 892" width="100%" xmlns:xlink="http://www.w3.org/1999/xlink">
-                  <image height="892" width="628" xlink:href="../Images/epub_cover1.jpg"/>
-                </svg>
-              </div>
-            </body>
-            </html>
-        '''
-        with open(self.base_path + '/OEBPS/Text/book_cover.xhtml','a+', encoding='utf-8') as cover:
-            cover.write(xml_str)
-
-    # 生成文档目录.ncx文件
-    def generate_toc_ncx(self):
-        ncx = '''
-        <?xml version='1.0' encoding='utf-8'?>
-            <ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" version="2005-1" xml:lang="zh-CN">
-              <head>
-                <meta name="dtb:uid" content="urn:uuid:12345"/>
-                <meta name="dtb:depth" content="1"/>
-                <meta name="dtb:totalPageCount" content="0"/>
-                <meta name="dtb:maxPageNumber" content="0"/>
-              </head>
-              <docTitle>
-                <text>{title}</text>
-              </docTitle>
-              {nav_map}
-            </ncx>
-        '''.format(title=self.project.name,nav_map=self.nav_str)
-
-        with open(self.base_path+'/OEBPS/toc.ncx','a+',encoding='utf-8') as file:
-            file.write(ncx)
-
-    # 生成文档目录toc_summary.html文件
-    def generate_toc_html(self):
-        summary = '''<?xml version="1.0" encoding="UTF-8"?>
-            <html lang="zh-CN">
-            <head>
-                <meta charset="utf-8">
-                <title>目录</title>
-                <style>
-                    body{margin: 0px;padding: 0px;}h1{text-align: center;padding: 0px;margin: 0px;}ul,li{list-style: none;}ul{padding-left:0px;}li>ul{padding-left: 2em;}
-                    a{text-decoration: none;color: #4183c4;text-decoration: none;font-size: 16px;line-height: 28px;}
-                </style>
-            </head>
-            <body>
-                <h1>目&nbsp;&nbsp;&nbsp;&nbsp;录</h1>
-                %s
-            </body>
-            </html>
-        ''' % (self.toc_summary_str)
-
-        with open(self.base_path+'/OEBPS/Text/toc_summary.xhtml','a+',encoding='utf-8') as file:
-            file.write(summary)
-
-    # 生成content.opf文件
-    def generate_opf(self):
-        content_info = '''<?xml version="1.0" encoding="utf-8" ?>
-            <package version="2.0" xmlns="http://www.idpf.org/2007/opf" unique-identifier="uid" >
-              <metadata xmlns:dc="http://purl.org/dc/elements/1.1/" xmlns:opf="http://www.idpf.org/2007/opf">
-                <dc:title>{title}</dc:title>
-                <dc:language>zh</dc:language>
-                <dc:creator>{creator}</dc:creator>
-                <dc:identifier id="bookid">urn:uuid:12345</dc:identifier>
-                <dc:publisher>MrDoc制作</dc:publisher>
-                <dc:date opf:event="publication">{create_time}</dc:date>
-                <dc:description>{desc}</dc:description>
-                <meta name="cover" content="cover_img" />
-                <meta name="output encoding" content="utf-8" />
-                <meta name="primary-writing-mode" content="horizontal-lr" />
-              </metadata>
-              <manifest>
-                  {manifest}
-                <item id="ncx" href="toc.ncx" media-type="application/x-dtbncx+xml"/>
-                <item id="css" href="stylesheet.css" media-type="text/css"/>
-                <item id="cover_img" media-type="image/jpeg" href="Images/epub_cover1.jpg" />
-              </manifest>
-              <spine toc="ncx">
-                  {spine}
-              </spine>
-              <guide>
-                <reference type="toc" title="目录" href="Text/toc_summary.xhtml" />
-                <reference href="Text/book_cover.xhtml" type="cover" title="封面"/>
-              </guide>
-            </package>
-            '''
-
-        with open(self.base_path+'/OEBPS/content.opf','a+',encoding='utf-8') as file:
-            file.write(
-                content_info.format(
-                    title = self.project.name,
-                    creator = self.project.create_user,
-                    create_time = str(datetime.date.today()),
-                    desc=self.project.intro,
-                    manifest=self.manifest,
-                    spine = self.spine,
-                )
-            )
-
-    # 生成epub文件
-    def generate_epub(self):
-        try:
-            # 生成ZIP压缩文件
-            zipfile_name = settings.MEDIA_ROOT + '/report_epub/{}'.format(self.project.name)+'_'+str(int(time.time()))
-            zip_name = shutil.make_archive(
-                base_name = zipfile_name,
-                format='zip',
-                root_dir= settings.MEDIA_ROOT + '/report_epub/{}'.format(self.project.id)
-            )
-            # print(zip_name)
-            # 修改zip压缩文件后缀为EPUB
-            os.rename(zip_name,zipfile_name+'.epub')
-            # 删除生成的临时文件夹
-            shutil.rmtree(self.base_path)
-            return zipfile_name
-        except Exception as e:
-            if settings.DEBUG:
-                print(traceback.print_exc())
-            return None
-
-    def work(self):
-        self.generate_html() # 生成HTML
-        self.generate_metainfo() # 生成元信息
-        self.generate_metatype() # 生成元类型
-        self.generate_toc_ncx() # 生成目录ncx
-        self.generate_toc_html() # 生成目录html
-        self.generate_cover() # 生成封面html
-        self.generate_title_html() # 生产书籍的标题页和简介页
-        self.generate_opf() # 生成content.opf
-        epub_file = self.generate_epub()
-        return epub_file
+from app_doc.report_epub import ReportEPUB
 
 
 # 导出PDF
@@ -739,7 +268,20 @@ class ReportPDF():
                     cdn:"../../static/mr-marked/",
                 }})
                 marked.renderGraphic()
-                document.querySelector("pre").setAttribute('style',"white-space: pre-wrap");
+                var pre = document.querySelector("pre");
+                if(pre){{ pre.setAttribute('style',"white-space: pre-wrap"); }}
+                // 渲染完成标记：页面加载完成且图表等异步渲染内容 500 毫秒内没有变化后设置，PDF渲染服务检测到后开始打印；
+                // 先设置为 false，表示页面会设置该标记，PDF渲染服务不按页面加载完成打印
+                window.mrdocPdfReady = false;
+                (function(){{
+                    var timer = null, loaded = false;
+                    function ready(){{ observer.disconnect(); window.mrdocPdfReady = true; }}
+                    function wait(){{ if(loaded){{ clearTimeout(timer); timer = setTimeout(ready,500); }} }}
+                    function load(){{ loaded = true; wait(); }}
+                    var observer = new MutationObserver(wait);
+                    observer.observe(document.body,{{childList:true,subtree:true,attributes:true}});
+                    if(document.readyState === 'complete'){{ load(); }}else{{ window.addEventListener('load',load); }}
+                }})();
             </script>
             </body>
             </html>
@@ -968,10 +510,11 @@ class ReportDocx():
         is_folder = os.path.exists(self.base_path)
         # 创建文件夹
         if is_folder is False:
-            os.mkdir(self.base_path)
+            os.makedirs(self.base_path)
         temp_file_name = str(datetime.datetime.today()).replace(':', '-').replace(' ', '-').replace('.', '')
         temp_file_path = self.base_path + '/{0}.docx'.format(temp_file_name)
 
         with open(temp_file_path, 'a+', encoding='utf-8') as htmlfile:
             htmlfile.write(self.doc_str + self.content_str + "</body></html>")
+        return temp_file_path
 
@@ -12,7 +12,76 @@ from whoosh.analysis.tokenizers import default_pattern
 from whoosh.lang.porter import stem
 from whoosh.analysis import Tokenizer, Token
 from whoosh.util.text import rcompile
+from collections import OrderedDict
+import hashlib
+import threading
 import jieba
+import re
+
+# 只包含空白和标点的分词结果不作为 token 令牌
+WORD_PATTERN = re.compile(r'\w')
+
+
+class SegmentCache():
+    """
+    jieba 分词结果的 LRU 缓存，以文本内容的哈希值和分词模式为键，
+    重新索引内容未变化的文档时无需再次分词。
+    缓存的条目数不超过 maxsize，分词文本的总字符数不超过 max_chars，
+    超过 max_item_chars 个字符的文本不缓存，避免少数长文档占满缓存。
+    """
+    def __init__(self, maxsize=1024, max_chars=500000, max_item_chars=100000):
+        self.maxsize = maxsize
+        self.max_chars = max_chars
+        self.max_item_chars = max_item_chars
+        self.data = OrderedDict() # {键: (分词结果, 文本字符数)}
+        self.chars = 0 # 已缓存文本的总字符数
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            item = self.data.get(key)
+            if item is None:
+                return None
+            self.data.move_to_end(key)
+            return item[0]
+
+    def set(self, key, segments, chars=0):
+        if chars > self.max_item_chars:
+            return
+        with self.lock:
+            old = self.data.pop(key, None)
+            if old is not None:
+                self.chars -= old[1]
+            self.data[key] = (segments, chars)
+            self.chars += chars
+            while len(self.data) > self.maxsize or self.chars > self.max_chars:
+                self.chars -= self.data.popitem(last=False)[1][1]
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.chars = 0
+
+
+segment_cache = SegmentCache()
+
+
+def segment(value, jieba_mode='search'):
+    """
+    使用 jieba.tokenize 对文本分词，返回 (词语, 起始偏移, 结束偏移) 元组的列表，
+    并过滤只包含空白和标点的分词结果。
+    :param jieba_mode: 'search' 为搜索引擎模式，在长词的基础上再切分出短词，用于建立索引；
+        'default' 为精确模式，用于解析搜索词，避免搜索词被过度切分。
+    """
+    key = (hashlib.md5(value.encode('utf-8')).digest(), jieba_mode)
+    segments = segment_cache.get(key)
+    if segments is None:
+        segments = tuple(
+            (w, start, end) for w, start, end in jieba.tokenize(value, mode=jieba_mode)
+            if WORD_PATTERN.search(w)
+        )
+        segment_cache.set(key, segments, len(value))
+    return segments
 
 
 class ChineseTokenizer(Tokenizer):
@@ -22,20 +91,27 @@ class ChineseTokenizer(Tokenizer):
     >>> [token.text for token in rex(u("hi there 3.141 big-time under_score"))]
     ["hi", "there", "3.141", "big", "time", "under_score"]
     """
-    def __init__(self, expression=default_pattern, gaps=False):
+    # 索引文件中保存的旧版本 tokenizer 没有该属性，使用类属性作为默认值
+    split_query = True
+
+    def __init__(self, expression=default_pattern, gaps=False, split_query=True):
         """
         :param expression: 一个正则表达式对象或字符串，默认为 rcompile(r"\w+(\.?\w+)*")。
             表达式的每一个匹配都等于一个 token 令牌。
             第0组匹配（整个匹配文本）用作 token 令牌的文本。
             如果你需要更复杂的正则表达式匹配处理，只需要编写自己的 tokenizer 令牌解析器即可。
         :param gaps: 如果为 True, tokenizer 令牌解析器会在正则表达式上进行分割，而非匹配。
+        :param split_query: 如果为 True, 建立索引时使用 jieba 搜索引擎模式分词，
+            解析搜索词时使用精确模式分词；为 False 时都使用搜索引擎模式。
         """
         self.expression = rcompile(expression)
         self.gaps = gaps
+        self.split_query = split_query
 
     def __eq__(self, other):
         if self.__class__ is other.__class__:
-            if self.expression.pattern == other.expression.pattern:
+            if self.expression.pattern == other.expression.pattern \
+                    and self.split_query == other.split_query:
                 return True
         return False
 
@@ -80,15 +156,23 @@ class ChineseTokenizer(Tokenizer):
             #         t.startchar = start_char + match.start()
             #         t.endchar = start_char + match.end()
             #     yield t
-            seglist = jieba.cut(value, cut_all=True)
-            for w in seglist:
-                t.original = t.text = w
+            # whoosh 建立索引时 mode 为 'index'，解析搜索词时 mode 为 'query'
+            if self.split_query and mode == 'query':
+                jieba_mode = 'default'
+            else:
+                jieba_mode = 'search'
+            # 使用 jieba.tokenize 返回的偏移量作为字符位置，token 令牌的序号作为位置
+            for pos, (w, start, end) in enumerate(segment(value, jieba_mode)):
+                t.text = w
                 t.boost = 1.0
+                if keeporiginal:
+                    t.original = t.text
+                t.stopped = False
                 if positions:
-                    t.pos = start_pos + value.find(w)
+                    t.pos = start_pos + pos
                 if chars:
-                    t.startchar = start_char + value.find(w)
-                    t.endchar = start_char + value.find(w) + len(w)
+                    t.startchar = start_char + start
+                    t.endchar = start_char + end
                 yield t
         else:
             # When gaps=True, iterate through the matches and
@@ -132,7 +216,7 @@ class ChineseTokenizer(Tokenizer):
 
 def ChineseAnalyzer(expression=default_pattern, stoplist=None,
                      minsize=2, maxsize=None, gaps=False, stemfn=stem,
-                     ignore=None, cachesize=50000):
+                     ignore=None, cachesize=50000, split_query=True):
     """Composes a RegexTokenizer with a lower case filter, an optional stop
     filter, and a stemming filter.
     用小写过滤器、可选的停止停用词过滤器和词干过滤器组成生成器。
@@ -147,8 +231,9 @@ def ChineseAnalyzer(expression=default_pattern, stoplist=None,
     :param ignore: 一组忽略的单词。
     :param cachesize: 缓存词干词的最大数目。 这个数字越大，词干生成的速度就越快，但占用的内存就越多。
                       使用 None 表示无缓存，使用 -1 表示无限缓存。
+    :param split_query: 如果为 True, 解析搜索词时使用 jieba 精确模式分词，避免搜索词被过度切分。
     """
-    ret = ChineseTokenizer(expression=expression, gaps=gaps)
+    ret = ChineseTokenizer(expression=expression, gaps=gaps, split_query=split_query)
     chain = ret | LowercaseFilter()
     if stoplist is not None:
         chain = chain | StopFilter(stoplist=stoplist, minsize=minsize,maxsize=maxsize)
@@ -0,0 +1,84 @@
+# coding:utf-8
+# @文件: doc_search.py
+# 基于全文索引的文档搜索
+# 文档关键词、所属文集和创建时间的筛选都在 Whoosh 索引中完成，
+# 只按页从数据库读取当前页的文档；索引不存在或读取搜索结果出错时使用调用方提供的数据库查询
+
+from haystack import connections
+from haystack.inputs import AutoQuery
+from haystack.query import SearchQuerySet
+from whoosh import index as whoosh_index
+from app_doc.models import Doc
+from loguru import logger
+import os
+
+
+# 全文索引是否存在
+def index_exists(using='default'):
+    backend = connections[using].get_backend()
+    if not backend.use_file_storage:
+        return True
+    return os.path.exists(backend.path) and whoosh_index.exists_in(backend.path)
+
+
+# 全文索引的文档搜索结果，分页时只读取当前页的文档；
+# 统计数量或读取结果时索引出错，改为使用数据库查询 fallback
+class DocSearchResults():
+    def __init__(self,sqs,fallback):
+        self.sqs = sqs
+        self.fallback = fallback
+        self.use_fallback = False
+        self._count = None
+
+    def search_failed(self):
+        logger.exception("全文索引搜索文档出错")
+        self.use_fallback = True
+
+    def count(self):
+        if self._count is None:
+            try:
+                self._count = self.sqs.count()
+            except Exception:
+                self.search_failed()
+                self._count = self.fallback.count()
+        return self._count
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self,k):
+        if not isinstance(k,slice):
+            return self[k:k+1][0]
+        if not self.use_fallback:
+            try:
+                ids = [int(r.pk) for r in self.sqs[k]]
+            except Exception:
+                self.search_failed()
+            else:
+                docs = Doc.objects.in_bulk(ids)
+                return [docs[i] for i in ids if i in docs]
+        return list(self.fallback[k])
+
+
+# 通过全文索引搜索文档
+def search_docs(kw,view_list,fallback,start_date=None,end_date=None,using='default'):
+    """
+    kw：搜索词，在文档标题和内容中搜索
+    view_list：可搜索的文集ID列表
+    fallback：索引不可用时使用的数据库查询，条件与索引搜索相同
+    start_date、end_date：文档创建时间范围，为 None 时不筛选
+    索引不存在时返回 fallback
+    """
+    if not index_exists(using):
+        return fallback
+    view_list = list(view_list)
+    sqs = SearchQuerySet(using=using).models(Doc)
+    if view_list:
+        sqs = sqs.filter(top_doc__in=view_list)
+    else:
+        sqs = sqs.none()
+    if start_date is not None:
+        sqs = sqs.filter(create_time__gte=start_date)
+    if end_date is not None:
+        sqs = sqs.filter(create_time__lte=end_date)
+    return DocSearchResults(sqs.filter(content=AutoQuery(kw)).order_by('-create_time'),fallback)
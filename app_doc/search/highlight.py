@@ -6,6 +6,27 @@
 from haystack.utils import Highlighter
 from django.utils.html import strip_tags
 from app_doc.search.chinese_analyzer import ChineseAnalyzer as StemmingAnalyzer
+from functools import lru_cache
+import bisect
+import re
+
+
+# 解析搜索词，返回 (搜索词集合, 匹配所有搜索词的正则表达式)
+# 搜索结果页的每条结果都使用同一个搜索词创建高亮器，解析结果按搜索词缓存，每次搜索只分词一次
+@lru_cache(maxsize=256)
+def analyze_query(query):
+    sa = StemmingAnalyzer()
+    query_words = frozenset(
+        [token.text.lower() for token in sa(query) if token.text.replace(" ",'') != '']
+    )
+    if not query_words:
+        return query_words, None
+    # 较长的搜索词优先匹配，同一位置只高亮最长的搜索词
+    pattern = re.compile(
+        '|'.join(re.escape(w) for w in sorted(query_words, key=lambda w: (-len(w), w))),
+        re.IGNORECASE
+    )
+    return query_words, pattern
 
 
 class MyHighLighter(Highlighter):
@@ -24,14 +45,8 @@ class MyHighLighter(Highlighter):
         if "css_class" in kwargs:
             self.css_class = kwargs["css_class"]
 
-        # self.query_words = set(
-        #     [word.lower() for word in self.query.split() if not word.startswith("-")]
-        # )
-        sa = StemmingAnalyzer()
-        self.query_words = set(
-            [token.text.lower() for token in sa(query) if token.text.replace(" ",'') != '']
-        )
-        # print(self.query_words)
+        self.query_words, self.pattern = analyze_query(query)
+        self.matches = []
 
     def highlight(self, text_block):
         self.text_block = strip_tags(text_block)
@@ -41,29 +56,30 @@ class MyHighLighter(Highlighter):
             start_offset = 0
         return self.render_html(highlight_locations, start_offset, end_offset)
 
+    # 一次遍历文本查找所有搜索词，返回 {搜索词: [偏移量]}，匹配位置保存在 self.matches 中
+    def find_highlightable_words(self):
+        word_positions = {word: [] for word in self.query_words}
+        self.matches = []
+        if self.pattern is None:
+            return word_positions
+        for match in self.pattern.finditer(self.text_block):
+            self.matches.append((match.start(), match.end()))
+            word_positions.setdefault(match.group().lower(), []).append(match.start())
+        return word_positions
+
     def find_window(self, highlight_locations):
         best_start = 0
         best_end = self.max_length
 
-        # First, make sure we have words.
-        if not len(highlight_locations):
-            return (best_start, best_end)
-
         words_found = []
-
-        # Next, make sure we found any words at all.
         for word, offset_list in highlight_locations.items():
-            if len(offset_list):
-                # Add all of the locations to the list.
-                words_found.extend(offset_list)
+            words_found.extend(offset_list)
 
         if not len(words_found):
             return (best_start, best_end)
 
         # 只有一个搜索词被发现
         if len(words_found) == 1:
-            # return (words_found[0], words_found[0] + self.max_length)  #
-            # new added
             best_start = words_found[0]
             best_end = words_found[0] + self.max_length
 
@@ -75,40 +91,27 @@ class MyHighLighter(Highlighter):
                     best_start = 0
             return (best_start, best_end)
 
-        # Sort the list so it's in ascending order.
-        words_found = sorted(words_found)
-
-        # We now have a denormalized list of all positions were a word was
-        # found. We'll iterate through and find the densest window we can by
-        # counting the number of found offsets (-1 to fit in the window).
-        highest_density = 0
+        words_found.sort()
 
-        if words_found[:-1][0] > self.max_length:
-            best_start = words_found[:-1][0]
+        if words_found[0] > self.max_length:
+            best_start = words_found[0]
             best_end = best_start + self.max_length
 
-        for count, start in enumerate(words_found[:-1]):
-            current_density = 1
-
-            for end in words_found[count + 1:]:
-                if end - start < self.max_length:
-                    current_density += 1
-                else:
-                    current_density = 0
-
-                # Only replace if we have a bigger (not equal density) so we
-                # give deference to windows earlier in the document.
-                if current_density > highest_density:
-                    # print(start)
-                    if start == 0:
-                        best_start = start
-                    else:
-                        best_start = start
-                    best_end = start + self.max_length
-                    highest_density = current_density
+        # 滑动窗口查找包含搜索词最多的位置：以每个搜索词为窗口起点，窗口终点只向后移动，
+        # 密度相同时使用靠前的窗口，窗口内至少有两个搜索词时才替换默认位置
+        highest_density = 1
+        end = 0
+        for count, start in enumerate(words_found):
+            while end < len(words_found) and words_found[end] - start < self.max_length:
+                end += 1
+            if end - count > highest_density:
+                best_start = start
+                best_end = start + self.max_length
+                highest_density = end - count
+
         if best_start < 10:
             best_start = 0
-            best_end = 200
+            best_end = self.max_length
         else:
             best_start -= 10
             best_end -= 10
@@ -116,16 +119,8 @@ class MyHighLighter(Highlighter):
         return (best_start, best_end)
 
     def render_html(self, highlight_locations=None, start_offset=None, end_offset=None):
-        # Start by chopping the block down to the proper window.
-        text = self.text_block[start_offset:end_offset]
-
-        # Invert highlight_locations to a location -> term list
-        term_list = []
-
-        for term, locations in highlight_locations.items():
-            term_list += [(loc - start_offset, term) for loc in locations]
-
-        loc_to_term = sorted(term_list)
+        text_length = len(self.text_block)
+        end_offset = min(end_offset, text_length)
 
         # Prepare the highlight template
         if self.css_class:
@@ -135,38 +130,20 @@ class MyHighLighter(Highlighter):
 
         hl_end = "</%s>" % self.html_tag
 
-        # Copy the part from the start of the string to the first match,
-        # and there replace the match with a highlighted version.
-        highlighted_chunk = ""
-        matched_so_far = 0
-        prev = 0
-        prev_str = ""
-
-        for cur, cur_str in loc_to_term:
-            # This can be in a different case than cur_str
-            actual_term = text[cur : cur + len(cur_str)]
-
-            # Handle incorrect highlight_locations by first checking for the term
-            if actual_term.lower() == cur_str:
-                if cur < prev + len(prev_str):
-                    continue
-
-                highlighted_chunk += (
-                    text[prev + len(prev_str) : cur] + hl_start + actual_term + hl_end
-                )
-                prev = cur
-                prev_str = cur_str
-
-                # Keep track of how far we've copied so far, for the last step
-                matched_so_far = cur + len(actual_term)
-
-        # Don't forget the chunk after the last term
-        highlighted_chunk += text[matched_so_far:]
-
-        if start_offset > 0:
-            highlighted_chunk = "%s" % highlighted_chunk
-
-        if end_offset < len(self.text_block):
-            highlighted_chunk = "%s..." % highlighted_chunk
-
-        return highlighted_chunk
\ No newline at end of file
+        # 只高亮完整位于窗口内的匹配，各片段拼接为列表后一次合并
+        chunks = []
+        prev = start_offset
+        for match_start, match_end in self.matches[bisect.bisect_left(self.matches, (start_offset,)):]:
+            if match_end > end_offset:
+                break
+            chunks.append(self.text_block[prev:match_start])
+            chunks.append(hl_start)
+            chunks.append(self.text_block[match_start:match_end])
+            chunks.append(hl_end)
+            prev = match_end
+        chunks.append(self.text_block[prev:end_offset])
+
+        if end_offset < text_length:
+            chunks.append("...")
+
+        return "".join(chunks)
@@ -0,0 +1,127 @@
+# coding:utf-8
+# @文件: index_queue.py
+# 全文索引队列
+# 对象保存或删除后只记录到索引队列表中，不在请求内写入 Whoosh 索引；
+# 由 process_index_queue 命令在后台合并重复的修改，批量写入索引并定期合并索引段
+
+from django.apps import apps
+from django.core.cache import cache
+from django.db.models import Count,Min
+from haystack import connections
+from haystack.exceptions import NotHandled
+from haystack.signals import BaseSignalProcessor
+from app_doc.models import SearchIndexQueue
+from loguru import logger
+from collections import defaultdict
+import datetime
+
+# 最近一次处理队列、合并索引段的时间的缓存键
+LAST_FLUSH_KEY = 'search_index_last_flush'
+LAST_OPTIMIZE_KEY = 'search_index_last_optimize'
+
+
+# 将对象加入索引队列，已在队列中的对象只更新加入时间
+def enqueue_index(model_label,object_ids):
+    now = datetime.datetime.now()
+    SearchIndexQueue.objects.bulk_create(
+        [SearchIndexQueue(model=model_label,object_id=i,queue_time=now) for i in set(object_ids)],
+        update_conflicts=True,
+        unique_fields=['model','object_id'],
+        update_fields=['queue_time'],
+    )
+
+
+# 队列式信号处理器，替代 haystack 的 RealtimeSignalProcessor
+class QueuedSignalProcessor(BaseSignalProcessor):
+    def setup(self):
+        from django.db.models import signals
+        signals.post_save.connect(self.handle_save)
+        signals.post_delete.connect(self.handle_delete)
+
+    def teardown(self):
+        from django.db.models import signals
+        signals.post_save.disconnect(self.handle_save)
+        signals.post_delete.disconnect(self.handle_delete)
+
+    # 是否为建立了索引的模型
+    def is_indexed(self,sender,instance):
+        for using in self.connection_router.for_write(instance=instance):
+            try:
+                self.connections[using].get_unified_index().get_index(sender)
+                return True
+            except NotHandled:
+                pass
+        return False
+
+    def handle_save(self,sender,instance,**kwargs):
+        if self.is_indexed(sender,instance):
+            enqueue_index(sender._meta.label_lower,[instance.pk])
+
+    # 删除对象后同样加入队列，处理时对象不存在即从索引中删除
+    def handle_delete(self,sender,instance,**kwargs):
+        self.handle_save(sender,instance,**kwargs)
+
+
+# 处理索引队列
+def flush_index_queue(batch_size=200,delay=0,using='default'):
+    """
+    处理 delay 秒之前加入队列的条目，每次最多处理 batch_size 条，返回处理的条目数。
+    每个模型的更新和删除在同一个索引写入器中完成，只提交一次；
+    处理期间再次加入队列的条目加入时间晚于本次处理的截止时间，会保留到下次处理。
+    """
+    deadline = datetime.datetime.now() - datetime.timedelta(seconds=delay)
+    rows = list(
+        SearchIndexQueue.objects.filter(queue_time__lte=deadline)
+        .order_by('queue_time').values_list('id','model','object_id')[:batch_size]
+    )
+    if not rows:
+        return 0
+
+    backend = connections[using].get_backend()
+    unified_index = connections[using].get_unified_index()
+    model_ids = defaultdict(set)
+    for row_id,model_label,object_id in rows:
+        model_ids[model_label].add(object_id)
+
+    for model_label,object_ids in model_ids.items():
+        try:
+            model = apps.get_model(model_label)
+            index = unified_index.get_index(model)
+        except (LookupError,NotHandled):
+            logger.warning("索引队列中的模型{}未建立索引，已忽略".format(model_label))
+            continue
+        # 不在 index_queryset 中的对象（已删除或未发布）从索引中删除
+        objs = list(index.index_queryset(using=using).filter(pk__in=object_ids))
+        exists_ids = {obj.pk for obj in objs}
+        remove_identifiers = ['{}.{}'.format(model_label,i) for i in object_ids - exists_ids]
+        backend.update_batch(index,objs,remove_identifiers)
+
+    SearchIndexQueue.objects.filter(id__in=[row[0] for row in rows],queue_time__lte=deadline).delete()
+    cache.set(LAST_FLUSH_KEY,datetime.datetime.now(),None)
+    return len(rows)
+
+
+# 合并索引段
+def optimize_index(using='default'):
+    connections[using].get_backend().optimize()
+    cache.set(LAST_OPTIMIZE_KEY,datetime.datetime.now(),None)
+
+
+# 获取索引队列的统计数据
+def get_index_queue_stats():
+    """
+    queue_depth：队列中待处理的条目数
+    freshness_lag：最早加入队列的条目等待的秒数，即搜索结果最多滞后的时间
+    last_flush、last_optimize：最近一次处理队列、合并索引段的时间
+    """
+    stats = SearchIndexQueue.objects.aggregate(depth=Count('id'),oldest=Min('queue_time'))
+    if stats['oldest'] is None:
+        lag = 0
+    else:
+        lag = max((datetime.datetime.now() - stats['oldest']).total_seconds(),0)
+    return {
+        'queue_depth':stats['depth'],
+        'freshness_lag':round(lag,1),
+        'last_flush':cache.get(LAST_FLUSH_KEY),
+        'last_optimize':cache.get(LAST_OPTIMIZE_KEY),
+    }
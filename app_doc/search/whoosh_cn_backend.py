@@ -271,7 +271,29 @@ class WhooshSearchBackend(BaseSearchBackend):
 
         self.index = self.index.refresh()
         writer = AsyncWriter(self.index)
+        self._write_documents(writer, index, iterable)
 
+        if len(iterable) > 0:
+            # For now, commit no matter what, as we run into locking issues otherwise.
+            writer.commit()
+
+    # 在同一个写入器中批量更新和删除文档，只提交一次（用于全文索引队列）
+    def update_batch(self, index, iterable, remove_identifiers=()):
+        if not self.setup_complete:
+            self.setup()
+
+        if len(iterable) == 0 and len(remove_identifiers) == 0:
+            return
+
+        self.index = self.index.refresh()
+        writer = AsyncWriter(self.index)
+
+        for whoosh_id in remove_identifiers:
+            writer.delete_by_term(ID, whoosh_id)
+        self._write_documents(writer, index, iterable)
+        writer.commit()
+
+    def _write_documents(self, writer, index, iterable):
         for obj in iterable:
             try:
                 doc = index.full_prepare(obj)
@@ -302,10 +324,6 @@ class WhooshSearchBackend(BaseSearchBackend):
                         extra={"data": {"index": index, "object": get_identifier(obj)}},
                     )
 
-        if len(iterable) > 0:
-            # For now, commit no matter what, as we run into locking issues otherwise.
-            writer.commit()
-
     def remove(self, obj_or_string, commit=True):
         if not self.setup_complete:
             self.setup()
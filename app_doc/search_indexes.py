@@ -11,6 +11,7 @@ from app_doc.models import *
 class DocIndex(indexes.SearchIndex,indexes.Indexable):
     text = indexes.CharField(document=True, use_template=True)
     top_doc = indexes.IntegerField(model_attr='top_doc')
+    create_time = indexes.DateTimeField(model_attr='create_time')
     modify_time = indexes.DateTimeField(model_attr='modify_time')
 
     def get_model(self):
@@ -0,0 +1,93 @@
+# coding:utf-8
+# 文档APP的信号处理
+
+from django.db.models.signals import post_init,post_save,post_delete
+from django.dispatch import receiver
+from app_doc.models import Doc,Project,ProjectCollaborator,Tag,DocTag
+from app_doc.toc_utils import bump_toc_version
+from app_doc.render_utils import update_doc_render
+from app_doc.access_utils import bump_access_version,sync_project_role_users
+from app_doc.tag_utils import bump_tag_graph_version
+
+
+# 文档保存或删除后，更新所属文集的目录缓存版本
+# 注意：queryset.update() 不会触发信号，批量更新文档后需要自行调用 bump_toc_version
+@receiver(post_save,sender=Doc)
+@receiver(post_delete,sender=Doc)
+def doc_toc_changed(sender,instance,**kwargs):
+    bump_toc_version(instance.top_doc)
+
+
+# 文档保存后，更新文档的渲染内容（内容未变化时不重新渲染）
+# 通过 queryset.update() 修改的文档在读取渲染内容时根据内容哈希重新渲染
+@receiver(post_save,sender=Doc)
+def doc_render_changed(sender,instance,raw=False,**kwargs):
+    if not raw:
+        update_doc_render(instance)
+
+
+# 文档名称和状态字段的值，未加载的字段（only/defer）为 None，不为读取字段查询数据库
+def doc_graph_state(instance):
+    return (instance.__dict__.get('name'),instance.__dict__.get('status'))
+
+
+# 文档初始化后记录名称和状态，保存时用于判断标签关系图是否变化
+@receiver(post_init,sender=Doc)
+def doc_loaded(sender,instance,**kwargs):
+    instance._saved_graph_state = doc_graph_state(instance)
+
+
+# 已有文档的名称或状态变化后，更新文档创建者的标签关系图版本（不查询数据库）；
+# 新建的文档还没有标签，不需要更新
+@receiver(post_save,sender=Doc)
+def doc_graph_changed(sender,instance,created=False,raw=False,**kwargs):
+    state = doc_graph_state(instance)
+    if not created and not raw and state != instance._saved_graph_state:
+        bump_tag_graph_version(instance.create_user_id)
+    instance._saved_graph_state = state
+
+
+# 文集权限字段的值，未加载的字段（only/defer）为 None，不为读取字段查询数据库
+def project_role_state(instance):
+    return (instance.__dict__.get('role'),instance.__dict__.get('role_value'))
+
+
+# 文集初始化后记录权限字段的值，保存时用于判断权限是否变化
+@receiver(post_init,sender=Project)
+def project_loaded(sender,instance,**kwargs):
+    instance._saved_role_state = project_role_state(instance)
+
+
+# 文集创建或权限（role、role_value）变化后，同步文集的指定可见用户并更新文集权限版本；
+# 文集的权限缓存为用户可访问的文集列表，新建文集也会改变创建者的文集列表，因此更新全局的权限版本
+# 注意：通过 queryset.update() 修改文集权限后需要自行调用 sync_project_role_users
+@receiver(post_save,sender=Project)
+def project_saved(sender,instance,created=False,update_fields=None,**kwargs):
+    if update_fields is not None and not {'role','role_value'} & set(update_fields):
+        return
+    state = project_role_state(instance)
+    if created or state != instance._saved_role_state:
+        sync_project_role_users(instance)
+        instance._saved_role_state = state
+
+
+# 文集删除、协作者变更后，更新文集权限版本
+@receiver(post_delete,sender=Project)
+@receiver(post_save,sender=ProjectCollaborator)
+@receiver(post_delete,sender=ProjectCollaborator)
+def project_access_changed(sender,instance,**kwargs):
+    bump_access_version()
+
+
+# 标签或文档标签变更后，更新标签创建者的标签关系图版本
+@receiver(post_save,sender=Tag)
+@receiver(post_delete,sender=Tag)
+def tag_graph_changed(sender,instance,**kwargs):
+    bump_tag_graph_version(instance.create_user_id)
+
+
+@receiver(post_save,sender=DocTag)
+@receiver(post_delete,sender=DocTag)
+def doc_tag_graph_changed(sender,instance,**kwargs):
+    bump_tag_graph_version(*Tag.objects.filter(id=instance.tag_id).values_list('create_user_id',flat=True))
+
@@ -0,0 +1,84 @@
+# coding:utf-8
+# @文件: stats_utils.py
+# 列表统计数据
+# 列表页面的文档数量、协作者数量、图片数量等统计数据通过一次分组聚合查询批量获取，
+# 并附加到列表对象上，避免在循环或模板过滤器中逐条查询
+
+from django.db.models import Count,F,Window
+from django.db.models.functions import RowNumber
+from app_doc.models import Doc,ProjectCollaborator,Image,DocTag
+
+
+# 分组统计数量，返回 {分组字段值: 数量}
+def group_count(queryset,field,values):
+    values = list(values)
+    if not values:
+        return {}
+    rows = queryset.filter(**{'{}__in'.format(field):values}).values(field).annotate(cnt=Count('id')).order_by()
+    return {row[field]:row['cnt'] for row in rows}
+
+
+# 批量获取文集的文档数量，doc_status 为 None 时统计所有状态的文档
+def count_project_docs(pro_ids,doc_status=1):
+    docs = Doc.objects.all()
+    if doc_status is not None:
+        docs = docs.filter(status=doc_status)
+    return group_count(docs,'top_doc',pro_ids)
+
+
+# 批量获取文集的协作者数量
+def count_project_collaborators(pro_ids):
+    return group_count(ProjectCollaborator.objects.all(),'project_id',pro_ids)
+
+
+# 批量获取文集最新修改的已发布文档，返回 {文集ID: [文档]}
+def get_projects_new_docs(pro_ids,limit=3):
+    pro_ids = list(pro_ids)
+    if not pro_ids:
+        return {}
+    docs = Doc.objects.filter(top_doc__in=pro_ids,status=1).annotate(
+        row_number=Window(RowNumber(),partition_by=F('top_doc'),order_by=F('modify_time').desc())
+    ).filter(row_number__lte=limit).only('id','name','top_doc','modify_time').order_by('top_doc','row_number')
+    new_docs = {}
+    for doc in docs:
+        new_docs.setdefault(doc.top_doc,[]).append(doc)
+    return new_docs
+
+
+# 为文集列表附加统计数据
+def attach_project_stats(projects,doc_status=1,collaborators=False,new_docs=0):
+    """
+    doc_cnt：文集的文档数量
+    colla_cnt：文集的协作者数量（collaborators 为 True 时）
+    new_docs：文集最新的文档列表（new_docs 为获取的数量，大于 0 时）
+    """
+    projects = list(projects)
+    pro_ids = [p.id for p in projects]
+    doc_cnts = count_project_docs(pro_ids,doc_status)
+    colla_cnts = count_project_collaborators(pro_ids) if collaborators else {}
+    new_doc_map = get_projects_new_docs(pro_ids,new_docs) if new_docs > 0 else {}
+    for p in projects:
+        p.doc_cnt = doc_cnts.get(p.id,0)
+        if collaborators:
+            p.colla_cnt = colla_cnts.get(p.id,0)
+        if new_docs > 0:
+            p.new_docs = new_doc_map.get(p.id,[])
+    return projects
+
+
+# 为图片分组列表附加图片数量 img_cnt
+def attach_image_group_stats(groups):
+    groups = list(groups)
+    img_cnts = group_count(Image.objects.all(),'group_id',[g.id for g in groups])
+    for g in groups:
+        g.img_cnt = img_cnts.get(g.id,0)
+    return groups
+
+
+# 为标签列表附加文档数量 doc_cnt
+def attach_tag_stats(tags):
+    tags = list(tags)
+    doc_cnts = group_count(DocTag.objects.all(),'tag_id',[t.id for t in tags])
+    for t in tags:
+        t.doc_cnt = doc_cnts.get(t.id,0)
+    return tags
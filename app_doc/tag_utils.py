@@ -0,0 +1,82 @@
+# coding:utf-8
+# @文件: tag_utils.py
+# 标签关系图数据
+# 标签的文档数量和标签之间的共现关系（同一文档包含的两个标签）通过分组查询和自连接查询获取，
+# 按标签创建者和可见文集范围缓存，标签或文档标签变更时更新标签创建者的版本号使缓存失效；
+# 文档名称或状态变化时更新文档创建者的版本号，通过 queryset.update() 修改的文档在缓存过期后生效
+
+from django.core.cache import cache
+from django.db.models import Count,F
+from app_doc.models import Tag,DocTag
+import hashlib
+import time
+
+# 标签关系图缓存有效期，秒数
+TAG_GRAPH_CACHE_TIMEOUT = 600
+
+
+# 标签关系图版本号的缓存键
+def tag_graph_version_key(user_id):
+    return 'tag_graph_version_{}'.format(int(user_id))
+
+
+# 获取标签创建者的标签关系图版本号
+def get_tag_graph_version(user_id):
+    key = tag_graph_version_key(user_id)
+    version = cache.get(key)
+    if version is None:
+        version = int(time.time() * 1000)
+        if cache.add(key, version, None) is False:
+            version = cache.get(key, version)
+    return version
+
+
+# 更新标签创建者的标签关系图版本号，使其标签关系图缓存失效
+def bump_tag_graph_version(*user_ids):
+    for user_id in set(user_ids):
+        try:
+            key = tag_graph_version_key(user_id)
+        except (TypeError, ValueError):
+            continue
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, int(time.time() * 1000), None)
+
+
+# 从数据库读取标签关系图
+def load_tag_graph(user_id,pro_ids):
+    """
+    user_id：标签创建者，pro_ids：可见的文集ID列表，只统计其中已发布的文档，
+    返回 {'nodes': 节点列表, 'links': 关系列表}：
+    节点包含 id、name、value（标签的文档数量），按标签ID排序；
+    关系包含 source、target（标签ID，source 小于 target）、doc_id、doc_name、pro_id，
+    同一文档中的每对标签为一条关系
+    """
+    doc_tags = DocTag.objects.filter(tag__create_user=user_id,doc__status=1,doc__top_doc__in=list(pro_ids))
+    doc_cnts = dict(doc_tags.values('tag_id').annotate(cnt=Count('id')).order_by().values_list('tag_id','cnt'))
+    tags = Tag.objects.filter(create_user=user_id).values_list('id','name').order_by('id')
+    nodes = [{'id':tag_id,'name':name,'value':doc_cnts.get(tag_id,0)} for tag_id,name in tags]
+    # 文档标签表自连接，获取同一文档的标签对
+    pairs = doc_tags.filter(
+        doc__doctag__tag__create_user=user_id,doc__doctag__tag_id__gt=F('tag_id')
+    ).values_list('tag_id','doc__doctag__tag_id','doc_id','doc__name','doc__top_doc').distinct().order_by(
+        'tag_id','doc_id','doc__doctag__tag_id'
+    )
+    links = [
+        {'source':source,'target':target,'doc_id':doc_id,'doc_name':doc_name,'pro_id':pro_id}
+        for source,target,doc_id,doc_name,pro_id in pairs
+    ]
+    return {'nodes':nodes,'links':links}
+
+
+# 获取标签关系图，按标签创建者的版本号和可见文集范围缓存
+def get_tag_graph(user_id,pro_ids):
+    pro_ids = sorted(set(pro_ids))
+    scope = hashlib.sha1(','.join(map(str,pro_ids)).encode('utf-8')).hexdigest()
+    cache_key = 'tag_graph_{}_{}_{}'.format(int(user_id),get_tag_graph_version(user_id),scope)
+    graph = cache.get(cache_key)
+    if graph is None:
+        graph = load_tag_graph(user_id,pro_ids)
+        cache.set(cache_key,graph,TAG_GRAPH_CACHE_TIMEOUT)
+    return graph
@@ -1,23 +1,29 @@
 # coding:utf-8
 # 文档自定义模板过滤器
 from app_doc.models import *
+from app_doc.image_utils import thumbnail_url
 from django import template
 from django.utils.translation import gettext_lazy as _
 from django.utils.html import strip_tags
+from functools import lru_cache
 import markdown
 
 register = template.Library()
 
 
-# 获取文集下的文档数量
+# 获取文集下的文档数量，传入已附加统计数据的文集时不再查询
 @register.filter(name='get_doc_count')
 def get_doc_count(value):
-    return Doc.objects.filter(top_doc=int(value),status=1).count()
+    if hasattr(value,'doc_cnt'):
+        return value.doc_cnt
+    return Doc.objects.filter(top_doc=int(getattr(value,'id',value)),status=1).count()
 
 # 获取文集下最新的文档及其修改时间
 @register.filter(name='get_new_doc')
 def get_new_doc(value):
-    new_doc = Doc.objects.filter(top_doc=int(value),status=1).order_by('-modify_time')[:3]
+    if hasattr(value,'new_docs'):
+        return value.new_docs
+    new_doc = Doc.objects.filter(top_doc=int(getattr(value,'id',value)),status=1).order_by('-modify_time')[:3]
     if new_doc is None:
         new_doc = _('它还没有文档……')
     return new_doc
@@ -47,9 +53,16 @@ def get_report_status_pdf(value):
 # 获取图片分组的图片数量
 @register.filter(name='img_group_cnt')
 def get_img_group_cnt(value):
-    cnt = Image.objects.filter(group_id=value).count()
+    if hasattr(value,'img_cnt'):
+        return value.img_cnt
+    cnt = Image.objects.filter(group_id=getattr(value,'id',value)).count()
     return cnt
 
+# 获取图片的缩略图url
+@register.filter(name='img_thumb')
+def get_img_thumb(value,size='s'):
+    return thumbnail_url(value,size)
+
 # 获取文集的协作用户数
 @register.filter(name='project_collaborator_cnt')
 def get_project_collaborator_cnt(value):
@@ -58,12 +71,15 @@ def get_project_collaborator_cnt(value):
 
 # 获取标签的文档数量
 @register.filter(name='tag_doc_cnt')
-def get_img_group_cnt(value):
-    cnt = DocTag.objects.filter(tag=value).count()
+def get_tag_doc_cnt(value):
+    if hasattr(value,'doc_cnt'):
+        return value.doc_cnt
+    cnt = DocTag.objects.filter(tag=getattr(value,'id',value)).count()
     return cnt
 
-# 获取文集简介的纯文本
+# 获取文集简介的纯文本，相同的简介只解析一次
 @register.filter(name='project_desc')
+@lru_cache(maxsize=1024)
 def get_project_desc(value):
     value = strip_tags(markdown.markdown(value))[:201]
     return value
\ No newline at end of file
@@ -0,0 +1,23 @@
+# coding:utf-8
+# @文件: test_utils.py
+# 测试的公共方法
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+
+# 检查请求的查询次数不随条目数量增加，测试类需要提供 add_items 方法添加条目
+class ConstantQueriesMixin:
+    def assertConstantQueries(self,request):
+        # 首次请求会加载系统设置、文集权限等缓存数据，不计入比较
+        request()
+        with CaptureQueriesContext(connection) as before:
+            resp = request()
+        self.assertEqual(resp.status_code,200)
+        for i in range(3):
+            self.add_items()
+        request()
+        with CaptureQueriesContext(connection) as after:
+            resp = request()
+        self.assertEqual(len(after),len(before))
+        return resp
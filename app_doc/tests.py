@@ -1,3 +1,1061 @@
-from django.test import TestCase
+from django.test import TestCase,RequestFactory,override_settings
+from django.conf import settings
+import os
+from django.core.cache import cache
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.apps import apps
+from haystack import connections,connection_router
+from haystack.query import SearchQuerySet
+from unittest import mock
+from django.core.management import call_command
+import io
+import shutil
+import yaml
+import zipfile
+import tempfile
+import threading
+import time
+import sys
+import base64
+import hashlib
+from app_doc.models import Project,Doc,ProjectCollaborator,ImageGroup,Image,Tag,DocTag,SearchIndexQueue,DocRender,\
+    ExportJob,ProjectReportFile
+from app_doc.render_utils import attach_doc_summary,get_doc_html
+from app_doc.report_epub import ReportEPUB
+from app_doc.report_utils import ReportMD,ReportMdBatch
+from app_doc.import_utils import ImportZipProject
+from app_doc.utils import trim_image_bytes
+from app_doc.office_utils import OfficeConverter,OfficeConvertError,office_preview
+from app_doc.image_utils import delete_images,thumbnail_url,media_file_path
+from app_doc.util_upload_img import img_upload,base_img_upload,url_img_upload,url_imgs_upload
+from app_doc.fetch_utils import fetch_image,fetch_images,RemoteFetchError
+from http.server import ThreadingHTTPServer,BaseHTTPRequestHandler
+from django.core.files.uploadedfile import SimpleUploadedFile
+from app_admin.models import SysSetting
+from app_doc.report_html2pdf import PdfRenderPool,PdfRenderBusy,convert
+from app_doc.search.index_queue import flush_index_queue,get_index_queue_stats,QueuedSignalProcessor
+from app_doc.search.chinese_analyzer import ChineseAnalyzer,SegmentCache,segment_cache
+from app_doc.search.highlight import MyHighLighter,analyze_query
+from app_doc.access_utils import get_project_access,check_project_access,ACCESS_ALLOW,ACCESS_DENY,ACCESS_VIEWCODE
+from app_doc.test_utils import ConstantQueriesMixin
+from app_doc.tag_utils import load_tag_graph,get_tag_graph,get_tag_graph_version
+from app_doc.toc_utils import get_toc_nodes,bump_toc_version,get_adjacent_docs
+from app_doc.templatetags.doc_filter import get_doc_next,get_doc_previous
+from app_doc.views import get_pro_toc
 
 # Create your tests here.
+
+
+# 文集目录
+class ProjectTocTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='toc_user',password='toc_pwd')
+        self.pro = Project.objects.create(name='toc',intro='',create_user=self.user)
+        self.doc1 = self.create_doc('doc1',sort=1)
+        self.doc2 = self.create_doc('doc2',sort=2)
+        self.doc1_1 = self.create_doc('doc1_1',parent=self.doc1)
+        self.doc1_1_1 = self.create_doc('doc1_1_1',parent=self.doc1_1)
+        # 超出三级的文档不显示在目录中
+        self.create_doc('doc1_1_1_1',parent=self.doc1_1_1)
+        # 草稿文档不显示在目录中
+        self.create_doc('draft',status=0)
+
+    def create_doc(self,name,parent=None,sort=9999,status=1):
+        return Doc.objects.create(
+            name=name,
+            top_doc=self.pro.id,
+            parent_doc=parent.id if parent else 0,
+            sort=sort,
+            status=status,
+            create_user=self.user
+        )
+
+    def test_toc_tree(self):
+        toc_list,toc_cnt = get_pro_toc(self.pro.id)
+        self.assertEqual(toc_cnt,4)
+        self.assertEqual([d['name'] for d in toc_list],['doc1','doc2'])
+        self.assertNotIn('sub',toc_list[1])
+        self.assertEqual(toc_list[0]['sub'][0]['name'],'doc1_1')
+        self.assertEqual(toc_list[0]['sub'][0]['sub'][0]['name'],'doc1_1_1')
+        self.assertNotIn('sub',toc_list[0]['sub'][0]['sub'][0])
+
+    def test_toc_cache(self):
+        get_toc_nodes(self.pro.id)
+        with self.assertNumQueries(0):
+            get_toc_nodes(self.pro.id)
+        # 保存文档后目录缓存失效
+        self.doc2.name = 'doc2_new'
+        self.doc2.save()
+        with self.assertNumQueries(1):
+            nodes = get_toc_nodes(self.pro.id)
+        self.assertIn('doc2_new',[n['name'] for n in nodes])
+        # 批量更新后需要手动更新目录版本
+        Doc.objects.filter(id=self.doc2.id).update(status=0)
+        bump_toc_version(self.pro.id)
+        self.assertNotIn(self.doc2.id,[n['id'] for n in get_toc_nodes(self.pro.id)])
+
+    def test_reading_order(self):
+        self.assertEqual(get_adjacent_docs(self.pro.id,self.doc1.id),(None,self.doc1_1.id))
+        self.assertEqual(get_adjacent_docs(self.pro.id,self.doc1_1_1.id),(self.doc1_1.id,self.doc2.id))
+        self.assertEqual(get_adjacent_docs(self.pro.id,self.doc2.id),(self.doc1_1_1.id,None))
+        with self.assertNumQueries(0):
+            self.assertEqual(get_doc_previous(self.doc2),self.doc1_1_1.id)
+            self.assertEqual(get_doc_next(self.doc1_1),self.doc1_1_1.id)
+
+
+# 文集访问权限
+class ProjectAccessTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.owner = User.objects.create_user(username='owner',password='pwd')
+        self.user = User.objects.create_user(username='ann',password='pwd')
+        self.private = Project.objects.create(name='private',intro='',role=1,create_user=self.owner)
+        # 用户名为指定用户的子串时不可见
+        self.assigned = Project.objects.create(name='assigned',intro='',role=2,role_value='anna,ann',create_user=self.owner)
+        self.other = Project.objects.create(name='other',intro='',role=2,role_value='anna',create_user=self.owner)
+        self.viewcode = Project.objects.create(name='viewcode',intro='',role=3,role_value='1234',create_user=self.owner)
+
+    def get_request(self,user,**cookies):
+        request = RequestFactory().get('/')
+        request.user = user
+        request.COOKIES.update(cookies)
+        return request
+
+    def test_check_project_access(self):
+        request = self.get_request(self.user)
+        with self.assertNumQueries(2):
+            self.assertEqual(check_project_access(request,self.private),ACCESS_DENY)
+            self.assertEqual(check_project_access(request,self.assigned),ACCESS_ALLOW)
+            self.assertEqual(check_project_access(request,self.other),ACCESS_DENY)
+            self.assertEqual(check_project_access(request,self.viewcode),ACCESS_VIEWCODE)
+        request = self.get_request(self.user,**{'viewcode-{}'.format(self.viewcode.id):'1234'})
+        self.assertEqual(check_project_access(request,self.viewcode),ACCESS_ALLOW)
+        # 文集创建者
+        self.assertEqual(check_project_access(self.get_request(self.owner),self.private),ACCESS_ALLOW)
+
+    def test_access_cache(self):
+        get_project_access(self.get_request(self.user))
+        with self.assertNumQueries(0):
+            get_project_access(self.get_request(self.user))
+        # 添加协作者后权限缓存失效
+        ProjectCollaborator.objects.create(project=self.private,user=self.user,role=1)
+        access = get_project_access(self.get_request(self.user))
+        self.assertEqual(access.colla_role(self.private.id),1)
+        # 修改文集权限后同步指定可见用户
+        self.other.role_value = 'anna,ann'
+        self.other.save()
+        access = get_project_access(self.get_request(self.user))
+        visible = set(Project.objects.filter(access.visible_q([0])).values_list('id',flat=True))
+        self.assertEqual(visible,{self.private.id,self.assigned.id,self.other.id})
+
+    def test_save_without_role_change(self):
+        get_project_access(self.get_request(self.user))
+        # 权限未变化时只更新文集，权限缓存仍然有效
+        with self.assertNumQueries(1):
+            self.other.name = 'renamed'
+            self.other.save()
+        pro = Project.objects.only('id','name').get(id=self.assigned.id)
+        with self.assertNumQueries(1):
+            pro.save(update_fields=['name'])
+        with self.assertNumQueries(0):
+            get_project_access(self.get_request(self.user))
+        # 重新读取的文集修改权限后同步指定可见用户
+        pro = Project.objects.get(id=self.private.id)
+        pro.role,pro.role_value = 2,'ann'
+        pro.save()
+        self.assertIn(pro.id,get_project_access(self.get_request(self.user)).assigned_ids)
+
+
+# 列表统计数据，列表页面的查询次数不随条目数量增加
+class ListingStatsTest(ConstantQueriesMixin,TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='stats_user',password='stats_pwd')
+        self.client.login(username='stats_user',password='stats_pwd')
+        self.add_items()
+
+    # 添加文集、图片分组和标签各一项
+    def add_items(self):
+        pro = Project.objects.create(name='stats',intro='',create_user=self.user)
+        for i in range(4):
+            doc = Doc.objects.create(name='doc{}'.format(i),top_doc=pro.id,status=1,create_user=self.user)
+        ProjectCollaborator.objects.create(project=pro,user=User.objects.create_user(username='colla{}'.format(pro.id)))
+        group = ImageGroup.objects.create(user=self.user,group_name='group')
+        Image.objects.create(user=self.user,file_path='/media/a.png',group=group)
+        tag = Tag.objects.create(name='tag',create_user=self.user)
+        DocTag.objects.create(tag=tag,doc=doc)
+        return pro
+
+    def test_project_list(self):
+        self.assertConstantQueries(lambda: self.client.get('/',HTTP_USER_AGENT='t'))
+        resp = self.client.get('/',HTTP_USER_AGENT='t')
+        project = resp.context['projects'][0]
+        self.assertEqual(project.doc_cnt,4)
+        self.assertEqual([d.name for d in project.new_docs],['doc3','doc2','doc1'])
+
+    def test_manage_project(self):
+        self.assertConstantQueries(lambda: self.client.post('/manage_project/',{'limit':20}))
+        data = self.client.post('/manage_project/',{'limit':20}).json()['data']
+        self.assertEqual([(d['doc_total'],d['colla_total']) for d in data],[(4,1)] * 4)
+
+    def test_manage_image(self):
+        self.assertConstantQueries(lambda: self.client.get('/manage_image/',HTTP_USER_AGENT='t'))
+        self.assertConstantQueries(lambda: self.client.get('/manage_image_group/',HTTP_USER_AGENT='t'))
+        groups = self.client.get('/manage_image_group/',HTTP_USER_AGENT='t').context['groups']
+        self.assertEqual([g.img_cnt for g in groups],[1] * 7)
+
+    def test_manage_doc_tag(self):
+        self.assertConstantQueries(lambda: self.client.get('/manage_doc_tag/',HTTP_USER_AGENT='t'))
+        tags = self.client.get('/manage_doc_tag/',HTTP_USER_AGENT='t').context['tags']
+        self.assertEqual([t.doc_cnt for t in tags],[1] * 4)
+
+
+# 标签关系图
+class TagGraphTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='tag_user',password='tag_pwd')
+        self.pro = Project.objects.create(name='tags',intro='',role=0,create_user=self.user)
+        self.tags = [Tag.objects.create(name=name,create_user=self.user) for name in 'abc']
+        a,b,c = self.tags
+        self.docs = []
+        for status,doc_tags in [(1,[a,b,c]),(1,[a,b]),(0,[a,c])]:
+            doc = Doc.objects.create(name='doc',top_doc=self.pro.id,status=status,create_user=self.user)
+            for t in doc_tags:
+                DocTag.objects.create(tag=t,doc=doc)
+            self.docs.append(doc)
+        # 其他用户的标签不计入
+        other = User.objects.create_user(username='tag_other')
+        DocTag.objects.create(tag=Tag.objects.create(name='d',create_user=other),doc=self.docs[0])
+
+    def test_load_tag_graph(self):
+        a,b,c = [t.id for t in self.tags]
+        d1,d2 = self.docs[0].id,self.docs[1].id
+        graph = load_tag_graph(self.user.id,[self.pro.id])
+        self.assertEqual([(n['id'],n['value']) for n in graph['nodes']],[(a,2),(b,2),(c,1)])
+        self.assertEqual(
+            [(l['source'],l['target'],l['doc_id']) for l in graph['links']],
+            [(a,b,d1),(a,c,d1),(a,b,d2),(b,c,d1)]
+        )
+        graph = load_tag_graph(self.user.id,[])
+        self.assertEqual([n['value'] for n in graph['nodes']],[0,0,0])
+        self.assertEqual(graph['links'],[])
+
+    def test_doc_change(self):
+        graph = get_tag_graph(self.user.id,[self.pro.id])
+        self.assertEqual({l['doc_name'] for l in graph['links']},{'doc'})
+        # 内容变化不更新版本号
+        version = get_tag_graph_version(self.user.id)
+        doc = Doc.objects.get(id=self.docs[1].id)
+        doc.pre_content = 'content'
+        doc.save()
+        self.assertEqual(get_tag_graph_version(self.user.id),version)
+        # 名称或状态变化后重新读取标签关系图
+        doc.name = 'renamed'
+        doc.save()
+        graph = get_tag_graph(self.user.id,[self.pro.id])
+        self.assertIn((self.docs[1].id,'renamed'),{(l['doc_id'],l['doc_name']) for l in graph['links']})
+        doc.status = 0
+        doc.save()
+        graph = get_tag_graph(self.user.id,[self.pro.id])
+        self.assertNotIn(self.docs[1].id,{l['doc_id'] for l in graph['links']})
+
+    def test_tag_docs(self):
+        url = '/tag_docs/{}/'.format(self.tags[0].id)
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as before:
+            resp = self.client.get(url)
+        self.assertEqual(len(resp.context['tag_links_list']),4)
+        self.assertEqual(len(resp.context['docs']),2)
+        # 缓存命中时不查询文档标签关系
+        with CaptureQueriesContext(connection) as cached:
+            self.client.get(url)
+        self.assertEqual(len(cached),len(before))
+        # 文档标签变更后更新标签关系图，查询次数不随标签和文档数量增加
+        for i in range(5):
+            doc = Doc.objects.create(name='new',top_doc=self.pro.id,status=1,create_user=self.user)
+            for t in self.tags + [Tag.objects.create(name='t{}'.format(i),create_user=self.user)]:
+                DocTag.objects.create(tag=t,doc=doc)
+        with CaptureQueriesContext(connection) as after:
+            resp = self.client.get(url)
+        self.assertEqual(len(after),len(before) + 3)
+        self.assertEqual(len(resp.context['tag_nodes_list']),8)
+        self.assertEqual(len(resp.context['tag_links_list']),4 + 5 * 6)
+
+
+# 在测试中使用全文索引队列（默认配置在请求内实时更新索引），测试结束后恢复
+def use_index_queue(testcase):
+    processor = apps.get_app_config('haystack').signal_processor
+    if isinstance(processor,QueuedSignalProcessor):
+        return
+    processor.teardown()
+    testcase.addCleanup(processor.setup)
+    testcase.addCleanup(QueuedSignalProcessor(connections,connection_router).teardown)
+
+
+# 全文索引队列
+class SearchIndexQueueTest(TestCase):
+    def setUp(self):
+        use_index_queue(self)
+        # 使用内存索引，避免写入站点的索引文件
+        patcher = mock.patch.dict(connections.connections_info['default'],{'STORAGE':'ram'})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(connections.reload,'default')
+        self.backend = connections.reload('default').get_backend()
+        self.backend.setup()
+        self.backend.clear()
+        self.user = User.objects.create_user(username='index_user',password='index_pwd')
+        self.pro = Project.objects.create(name='index',intro='',create_user=self.user)
+
+    def doc_count(self):
+        return self.backend.index.refresh().doc_count()
+
+    def test_queue_flush(self):
+        doc = Doc.objects.create(name='doc',pre_content='全文索引',top_doc=self.pro.id,status=1,create_user=self.user)
+        doc.save()
+        Doc.objects.create(name='draft',top_doc=self.pro.id,status=0,create_user=self.user)
+        # 保存文档只加入队列，重复保存合并为一条
+        self.assertEqual(get_index_queue_stats()['queue_depth'],2)
+        self.assertEqual(self.doc_count(),0)
+        # 加入队列未满 delay 秒的条目暂不处理
+        self.assertEqual(flush_index_queue(delay=60),0)
+        self.assertEqual(flush_index_queue(),2)
+        self.assertEqual(self.doc_count(),1)
+        self.assertEqual(SearchIndexQueue.objects.count(),0)
+        # 删除文档后从索引中删除
+        doc.status = 3
+        doc.save()
+        flush_index_queue()
+        self.assertEqual(self.doc_count(),0)
+        self.assertIsNotNone(get_index_queue_stats()['last_flush'])
+
+
+# 文档搜索
+class DocSearchTest(TestCase):
+    def setUp(self):
+        use_index_queue(self)
+        cache.clear()
+        patcher = mock.patch.dict(connections.connections_info['default'],{'STORAGE':'ram'})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(connections.reload,'default')
+        backend = connections.reload('default').get_backend()
+        backend.setup()
+        backend.clear()
+        self.user = User.objects.create_user(username='search_user',password='search_pwd')
+        self.public = Project.objects.create(name='public',intro='',role=0,create_user=self.user)
+        self.private = Project.objects.create(name='private',intro='',role=1,create_user=self.user)
+        self.doc = Doc.objects.create(name='部署说明',pre_content='使用容器部署应用',top_doc=self.public.id,status=1,create_user=self.user)
+        Doc.objects.create(name='部署草稿',pre_content='容器部署',top_doc=self.public.id,status=0,create_user=self.user)
+        self.private_doc = Doc.objects.create(name='私密部署',pre_content='容器部署',top_doc=self.private.id,status=1,create_user=self.user)
+        tag = Tag.objects.create(name='运维',create_user=self.user)
+        DocTag.objects.create(tag=tag,doc=self.doc)
+        DocTag.objects.create(tag=Tag.objects.create(name='运维部署',create_user=self.user),doc=self.doc)
+        flush_index_queue()
+
+    def search(self,**params):
+        resp = self.client.get('/search/',params,HTTP_USER_AGENT='t')
+        return [d.id for d in resp.context['datas']]
+
+    def test_index_search(self):
+        self.assertEqual(self.search(kw='部署',type='doc'),[self.doc.id])
+        self.client.login(username='search_user',password='search_pwd')
+        self.assertEqual(self.search(kw='部署',type='doc'),[self.private_doc.id,self.doc.id])
+        self.assertEqual(self.search(kw='部署',type='doc',d_type='day',d_range='2000-01-01|2000-01-02'),[])
+
+    def test_fallback_search(self):
+        with mock.patch('app_doc.search.doc_search.index_exists',return_value=False):
+            self.assertEqual(self.search(kw='容器',type='doc'),[self.doc.id])
+        # 读取当前页的搜索结果时索引出错，使用数据库查询
+        with mock.patch.object(SearchQuerySet,'__getitem__',side_effect=RuntimeError):
+            self.assertEqual(self.search(kw='容器',type='doc'),[self.doc.id])
+        with mock.patch.object(SearchQuerySet,'count',side_effect=RuntimeError):
+            self.assertEqual(self.search(kw='容器',type='doc'),[self.doc.id])
+
+    def test_tag_search(self):
+        self.assertEqual(self.search(kw='运维',type='tag'),[self.doc.id])
+
+
+# 中文分词
+class ChineseAnalyzerTest(TestCase):
+    def tokens(self,value,mode='index'):
+        return [(t.text,t.pos,t.startchar,t.endchar) for t in ChineseAnalyzer()(value,positions=True,chars=True,mode=mode)]
+
+    def test_positions(self):
+        # 重复出现的词语使用各自的偏移量，标点和空白不作为令牌
+        self.assertEqual(self.tokens('部署，部署'),[('部署',0,0,2),('部署',1,3,5)])
+
+    def test_query_mode(self):
+        self.assertIn('华人',[t[0] for t in self.tokens('中华人民共和国')])
+        self.assertEqual([t[0] for t in self.tokens('中华人民共和国',mode='query')],['中华人民共和国'])
+
+    def test_segment_cache(self):
+        segment_cache.clear()
+        self.tokens('使用容器部署应用')
+        with mock.patch('jieba.tokenize') as tokenize:
+            self.tokens('使用容器部署应用')
+        tokenize.assert_not_called()
+
+    def test_segment_cache_bound(self):
+        cache = SegmentCache(maxsize=10,max_chars=10,max_item_chars=6)
+        # 超过单条字符数上限的文本不缓存
+        cache.set('long',('x',),7)
+        self.assertIsNone(cache.get('long'))
+        # 总字符数超过上限时淘汰最久未使用的条目
+        cache.set('a',('a',),4)
+        cache.set('b',('b',),4)
+        cache.get('a')
+        cache.set('c',('c',),4)
+        self.assertEqual([cache.get(k) for k in 'abc'],[('a',),None,('c',)])
+        self.assertEqual(cache.chars,8)
+        cache.set('a',('a2',),2)
+        self.assertEqual(cache.chars,6)
+
+
+# 搜索结果高亮
+class HighLighterTest(TestCase):
+    def test_highlight(self):
+        hl = MyHighLighter('容器部署',max_length=20)
+        text = '<p>' + '无关内容' * 20 + '使用容器部署应用，Docker 容器</p>' + '结尾' * 20
+        result = hl.highlight(text)
+        self.assertTrue(result.startswith('无关内容无关'))
+        self.assertTrue(result.endswith('...'))
+        self.assertIn('<span class="highlighted">容器</span><span class="highlighted">部署</span>',result)
+        # 不区分大小写，优先高亮较长的搜索词
+        self.assertEqual(
+            MyHighLighter('git gitlab').highlight('GIT GitLab'),
+            '<span class="highlighted">GIT</span> <span class="highlighted">GitLab</span>'
+        )
+        self.assertEqual(MyHighLighter('不存在').highlight('文本'),'文本')
+
+    def test_window(self):
+        hl = MyHighLighter('部署',max_length=50)
+        # 选择搜索词最密集的窗口
+        hl.text_block = '部署' + '文' * 100 + '部署文部署文部署' + '文' * 100
+        self.assertEqual(hl.find_window(hl.find_highlightable_words()),(92,142))
+        # 搜索词分散时使用第一个搜索词的位置
+        hl.text_block = '文' * 60 + '部署' + '文' * 60 + '部署'
+        self.assertEqual(hl.find_window(hl.find_highlightable_words()),(50,100))
+
+    def test_analyze_once(self):
+        analyze_query.cache_clear()
+        with mock.patch('app_doc.search.highlight.StemmingAnalyzer',wraps=ChineseAnalyzer) as analyzer:
+            for i in range(20):
+                MyHighLighter('容器部署').highlight('使用容器部署应用')
+        self.assertEqual(analyzer.call_count,1)
+
+
+# 文档渲染内容
+class DocRenderTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='render_user',password='render_pwd')
+        self.pro = Project.objects.create(name='render',intro='',create_user=self.user)
+        self.doc = Doc.objects.create(name='doc',pre_content='# 标题\n\n**正文**&nbsp;内容',top_doc=self.pro.id,create_user=self.user)
+
+    def test_render_on_save(self):
+        render = DocRender.objects.get(doc=self.doc)
+        self.assertEqual(render.summary,'标题\n正文内容')
+        self.assertIn('<strong>正文</strong>',get_doc_html(self.doc))
+        # 内容未变化时不重新渲染（更新文档、检查渲染内容）
+        with self.assertNumQueries(2):
+            self.doc.save()
+
+    def test_stale_render(self):
+        Doc.objects.filter(id=self.doc.id).update(pre_content='新的内容')
+        docs = Doc.objects.filter(id=self.doc.id)
+        self.assertEqual(attach_doc_summary(docs)[0].summary,'新的内容')
+        # 重新渲染后不再更新
+        with self.assertNumQueries(2):
+            attach_doc_summary(Doc.objects.filter(id=self.doc.id))
+
+    def test_backfill(self):
+        DocRender.objects.all().delete()
+        call_command('backfill_doc_render',stdout=open(os.devnull,'w'))
+        self.assertEqual(DocRender.objects.get(doc=self.doc).summary,'标题\n正文内容')
+
+
+# 导出EPUB
+class ReportEPUBTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='epub_user',password='epub_pwd')
+        self.pro = Project.objects.create(name='epub',intro='简介 & 说明',create_user=self.user)
+        # 站点目录中媒体文件目录和静态文件目录以外的文件不打包
+        img = '<img src="/static/report_epub/style.css"><img src="/config/config.ini"><img src="/static/../manage.py">'
+        d1 = Doc.objects.create(name='第一章',pre_content='正文',content=img,top_doc=self.pro.id,create_user=self.user,status=1)
+        Doc.objects.create(name='第一节',pre_content='## 小节',top_doc=self.pro.id,parent_doc=d1.id,create_user=self.user,status=1)
+        Doc.objects.create(name='第二章',pre_content='正文',content=img,top_doc=self.pro.id,create_user=self.user,status=1)
+        Doc.objects.create(name='草稿',pre_content='草稿',top_doc=self.pro.id,create_user=self.user,status=0)
+
+    def export(self):
+        f = io.BytesIO()
+        ReportEPUB(self.pro.id).write(f)
+        return f.getvalue()
+
+    def test_epub(self):
+        data = self.export()
+        self.assertEqual(data,self.export())
+        epub = zipfile.ZipFile(io.BytesIO(data))
+        names = epub.namelist()
+        self.assertEqual(names[0],'mimetype')
+        self.assertEqual(epub.getinfo('mimetype').compress_type,zipfile.ZIP_STORED)
+        self.assertEqual(len([n for n in names if n.startswith('OEBPS/Text/') and n[11].isdigit()]),3)
+        # 两个文档引用的同一文件只保存一份
+        self.assertEqual(len([n for n in names if n.endswith('.css') and n.startswith('OEBPS/Images/')]),1)
+        self.assertEqual([n for n in names if n.endswith(('.ini','.py'))],[])
+        ncx = epub.read('OEBPS/toc.ncx').decode('utf-8')
+        self.assertEqual(ncx.count('<navPoint'),ncx.count('</navPoint>'))
+
+    def test_process_pool(self):
+        data = self.export()
+        with mock.patch('app_doc.report_epub.EPUB_POOL_MIN_CHAPTERS',1),mock.patch('os.cpu_count',return_value=2):
+            with mock.patch('app_doc.report_epub.logger') as log:
+                self.assertEqual(self.export(),data)
+        log.exception.assert_not_called()
+
+
+# PDF渲染服务（使用模拟的浏览器会话）
+class PdfRenderPoolTest(TestCase):
+    class FakeSession():
+        created = 0
+
+        def __init__(self):
+            PdfRenderPoolTest.FakeSession.created += 1
+            self.jobs = 0
+
+        def healthy(self):
+            return True
+
+        def render(self,source,timeout,print_options=None):
+            self.jobs += 1
+            if source == 'error':
+                raise RuntimeError(source)
+            return source.encode()
+
+        def close(self):
+            pass
+
+    def setUp(self):
+        self.FakeSession.created = 0
+        patcher = mock.patch('app_doc.report_html2pdf.BrowserSession',self.FakeSession)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_render_and_recycle(self):
+        pool = PdfRenderPool(size=1,max_jobs=2,queue_size=10)
+        futures = [pool.submit('page{}'.format(i)) for i in range(5)]
+        self.assertEqual([f.result(5) for f in futures],[b'page0',b'page1',b'page2',b'page3',b'page4'])
+        with self.assertRaises(RuntimeError):
+            pool.submit('error').result(5)
+        stats = pool.get_stats()
+        self.assertEqual((stats['completed'],stats['failed'],stats['recycled']),(5,1,2))
+        self.assertIsNotNone(stats['p95'])
+
+    def test_back_pressure(self):
+        pool = PdfRenderPool(size=0,queue_size=2)
+        pool.submit('page')
+        pool.submit('page')
+        with self.assertRaises(PdfRenderBusy):
+            pool.submit('page')
+
+    @mock.patch('app_doc.report_html2pdf.PDF_RESULT_TIMEOUT',0.1)
+    def test_convert_timeout(self):
+        # 等待渲染结果超时后取消任务，不写入文件
+        pool = PdfRenderPool(size=0,queue_size=2)
+        target = os.path.join(tempfile.mkdtemp(),'a.pdf')
+        self.addCleanup(shutil.rmtree,os.path.dirname(target),True)
+        with mock.patch('app_doc.report_html2pdf.get_pdf_pool',return_value=pool):
+            with self.assertRaises(PdfRenderBusy):
+                convert('page',target)
+        self.assertTrue(pool.jobs.get_nowait()[0].cancelled())
+        self.assertFalse(os.path.exists(target))
+
+
+# 文集导出任务
+@override_settings(EXPORT_JOB_ASYNC=True)
+class ExportJobTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='export_user',password='export_pwd')
+        self.pro = Project.objects.create(name='export',intro='',create_user=self.user)
+        Doc.objects.create(name='doc',pre_content='正文',top_doc=self.pro.id,create_user=self.user,status=1)
+        self.client.login(username='export_user',password='export_pwd')
+
+    def tearDown(self):
+        for path in ExportJob.objects.filter(status=2).values_list('file_path',flat=True):
+            shutil.rmtree(os.path.dirname(settings.BASE_DIR + path),ignore_errors=True)
+
+    def test_export_job(self):
+        data = self.client.post('/genera_project_file/',{'pro_id':self.pro.id,'types':'epub'}).json()['data']
+        self.assertEqual(data['status'],0)
+        # 相同内容版本的任务在排队中时返回已有任务
+        self.assertEqual(self.client.post('/genera_project_file/',{'pro_id':self.pro.id,'types':'epub'}).json()['data']['job_id'],data['job_id'])
+        call_command('process_export_jobs','--once')
+        job = self.client.get('/export_job_status/',{'job_id':data['job_id']}).json()['data']
+        self.assertEqual((job['status'],job['progress']),(2,100))
+        self.assertEqual(ProjectReportFile.objects.get(project=self.pro,file_type='epub').file_path,job['file_path'])
+        # 文集未修改时直接使用缓存的导出文件
+        cached = self.client.post('/genera_project_file/',{'pro_id':self.pro.id,'types':'epub'}).json()['data']
+        self.assertEqual((cached['status'],cached['file_path']),(2,job['file_path']))
+        # 文集修改后重新导出
+        Doc.objects.create(name='doc2',pre_content='正文',top_doc=self.pro.id,create_user=self.user,status=1)
+        self.assertEqual(self.client.post('/genera_project_file/',{'pro_id':self.pro.id,'types':'epub'}).json()['data']['status'],0)
+
+    def test_report_file_download(self):
+        cache.clear()
+        SysSetting.objects.create(name='enable_project_report',value='on',types='basic')
+        self.client.post('/genera_project_file/',{'pro_id':self.pro.id,'types':'epub'})
+        call_command('process_export_jobs','--once')
+        url = self.client.post('/report_project_file/',{'pro_id':self.pro.id,'types':'epub'}).json()['data']
+        response = self.client.get(url)
+        content = b''.join(response.streaming_content)
+        etag = response['ETag']
+        self.assertEqual(content[:2],b'PK')
+        self.assertEqual(self.client.get(url,HTTP_IF_NONE_MATCH=etag).status_code,304)
+        response = self.client.get(url,HTTP_RANGE='bytes=10-19',HTTP_IF_RANGE=etag)
+        self.assertEqual(response.status_code,206)
+        self.assertEqual(b''.join(response.streaming_content),content[10:20])
+        self.assertEqual(response['Content-Range'],'bytes 10-19/{}'.format(len(content)))
+        self.assertEqual(b''.join(self.client.get(url,HTTP_RANGE='bytes=-5').streaming_content),content[-5:])
+        self.assertEqual(self.client.get(url,HTTP_RANGE='bytes={}-'.format(len(content))).status_code,416)
+
+    @override_settings(EXPORT_JOB_ASYNC=False)
+    def test_export_in_request(self):
+        # 未启用后台导出时在请求内完成导出
+        data = self.client.post('/genera_project_file/',{'pro_id':self.pro.id,'types':'epub'}).json()['data']
+        self.assertEqual(data['status'],2)
+        self.assertEqual(ProjectReportFile.objects.get(project=self.pro,file_type='epub').file_path,data['file_path'])
+
+    def test_evict_export_cache(self):
+        from app_doc.export_utils import store_export_artifact,evict_export_cache
+        folders = []
+        for i in range(3):
+            path = os.path.join(settings.MEDIA_ROOT,'export_test_{}.tmp'.format(i))
+            with open(path,'wb') as f:
+                f.write(b'x' * 100)
+            folders.append(os.path.dirname(store_export_artifact('test','rev{}'.format(i),path,'f.bin')))
+            os.utime(folders[-1],(i,i))
+        self.addCleanup(shutil.rmtree,os.path.dirname(folders[0]),True)
+        ProjectReportFile.objects.create(project=self.pro,file_type='epub',file_name='f',file_path='/media/export_cache/test/rev0/f.bin')
+        # 被引用的 rev0 不淘汰，淘汰最久未使用的 rev1
+        self.assertEqual(evict_export_cache(max_size=200),1)
+        self.assertEqual([os.path.exists(f) for f in folders],[True,False,True])
+
+    def test_concurrency(self):
+        for i in range(3):
+            Doc.objects.create(name='doc',top_doc=self.pro.id,create_user=self.user)
+            self.client.post('/genera_project_file/',{'pro_id':self.pro.id,'types':'epub'})
+        from app_doc.export_utils import claim_export_jobs
+        self.assertEqual(len(claim_export_jobs({'epub':2})),2)
+        self.assertEqual(claim_export_jobs({'epub':2}),[])
+        self.assertEqual(ExportJob.objects.filter(status=0).count(),1)
+
+    def test_stale_job_stays_failed(self):
+        from app_doc.export_utils import create_export_job,claim_export_jobs,fail_stale_export_jobs,run_export_job
+        job = create_export_job(self.user,'epub',[self.pro.id])
+        self.addCleanup(shutil.rmtree,os.path.join(settings.MEDIA_ROOT,'export_cache','epub',job.content_version),True)
+        self.assertEqual(claim_export_jobs({'epub':1}),[job.id])
+        # 执行超时被标记为失败的任务执行结束后不改为完成
+        self.assertEqual(fail_stale_export_jobs(-1),1)
+        self.assertFalse(run_export_job(ExportJob.objects.get(id=job.id)))
+        self.assertEqual(ExportJob.objects.get(id=job.id).status,3)
+
+    def test_same_export_two_users(self):
+        from app_doc.export_utils import create_export_job
+        other = User.objects.create_user(username='collaborator',password='colla_pwd')
+        job = create_export_job(self.user,'epub',[self.pro.id])
+        self.assertEqual(create_export_job(self.user,'epub',[self.pro.id]).id,job.id)
+        # 其他用户的相同导出创建自己的任务，可以查询任务状态
+        other_job = create_export_job(other,'epub',[self.pro.id])
+        self.assertNotEqual(other_job.id,job.id)
+        self.client.login(username='collaborator',password='colla_pwd')
+        self.assertTrue(self.client.get('/export_job_status/',{'job_id':other_job.id}).json()['status'])
+
+    def test_status_permission(self):
+        job = ExportJob.objects.create(project=self.pro,user=self.user,export_type='md',content_version='v')
+        User.objects.create_user(username='other',password='other_pwd')
+        self.client.login(username='other',password='other_pwd')
+        self.assertFalse(self.client.get('/export_job_status/',{'job_id':job.id}).json()['status'])
+
+
+# 导出MD文件压缩包
+class ReportMDTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='md_user',password='md_pwd')
+        self.pro = Project.objects.create(name='md',intro='简介',create_user=self.user)
+        media_dir = os.path.join(settings.MEDIA_ROOT,'report_md_test')
+        os.makedirs(media_dir,exist_ok=True)
+        self.addCleanup(shutil.rmtree,media_dir,True)
+        with open(os.path.join(media_dir,'a.png'),'wb') as f:
+            f.write(b'png')
+        img = '![](/media/report_md_test/a.png)'
+        d1 = Doc.objects.create(name='第一章',pre_content=img + img,top_doc=self.pro.id,create_user=self.user,status=1)
+        Doc.objects.create(name='第一节',pre_content=img,top_doc=self.pro.id,parent_doc=d1.id,create_user=self.user,status=1)
+        self.d1 = d1
+
+    def test_write(self):
+        f = io.BytesIO()
+        ReportMD(self.pro.id).write(f)
+        zf = zipfile.ZipFile(f)
+        self.assertEqual(zf.namelist().count('media/report_md_test/a.png'),1)
+        self.assertEqual(zf.read('media/report_md_test/a.png'),b'png')
+        self.assertEqual(
+            zf.read('第一章-{}.md'.format(self.d1.id)).decode('utf-8'),
+            '![](./media/report_md_test/a.png)![](./media/report_md_test/a.png)'
+        )
+        toc = yaml.safe_load(zf.read('mrdoc.yaml'))
+        self.assertEqual(toc['toc'][0]['children'][0]['name'],'第一节')
+
+    def test_batch(self):
+        f = io.BytesIO()
+        ReportMdBatch('md_user',[self.pro.id]).write(f)
+        zf = zipfile.ZipFile(f)
+        inner = zipfile.ZipFile(io.BytesIO(zf.read(zf.namelist()[0])))
+        self.assertIn('mrdoc.yaml',inner.namelist())
+        # 导出失败时不留下不完整的文件
+        report = ReportMdBatch('md_user',[self.pro.id])
+        with mock.patch.object(ReportMdBatch,'write',side_effect=OSError):
+            with self.assertRaises(OSError):
+                report.work()
+        self.assertFalse(os.path.exists(report.report_file_path + '.zip'))
+        self.assertFalse(os.path.exists(report.report_file_path + '.zip.tmp'))
+        md_file = report.work()
+        self.addCleanup(os.remove,md_file)
+        self.assertTrue(zipfile.is_zipfile(md_file))
+
+
+# 导入Zip文集
+class ImportZipProjectTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='import_user',password='import_pwd')
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree,media_root,True)
+        override = self.settings(MEDIA_ROOT=media_root)
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def make_zip(self,chapters):
+        fd,path = tempfile.mkstemp(suffix='.zip')
+        os.close(fd)
+        toc = []
+        with zipfile.ZipFile(path,'w') as zf:
+            zf.writestr('media/a.png',b'png%d' % chapters)
+            zf.writestr('media/b.png',b'png%d' % chapters) # 内容与 a.png 相同
+            for i in range(chapters):
+                zf.writestr('c{}.md'.format(i),'![](./media/a.png)')
+                zf.writestr('s{}.md'.format(i),'![](/media/b.png) ![](http://x.com/a.png)')
+                # 各章节下的小节同名
+                toc.append({'name':'章节{}'.format(i),'file':'c{}.md'.format(i),'children':[{'name':'小节','file':'s{}.md'.format(i)}]})
+            zf.writestr('mrdoc.yaml',yaml.dump({'project_name':'导入','toc':toc},allow_unicode=True))
+        return path
+
+    def import_zip(self,chapters):
+        path = self.make_zip(chapters)
+        with CaptureQueriesContext(connection) as ctx:
+            pro_id = ImportZipProject().read_zip(path,self.user)
+        self.assertFalse(os.path.exists(path))
+        return pro_id,len(ctx.captured_queries)
+
+    def test_import(self):
+        pro_id,_ = self.import_zip(2)
+        self.assertEqual(Project.objects.get(id=pro_id).name,'导入')
+        # 同名的小节关联到各自的章节
+        for i in range(2):
+            chapter = Doc.objects.get(top_doc=pro_id,name='章节{}'.format(i))
+            self.assertEqual(Doc.objects.get(top_doc=pro_id,parent_doc=chapter.id).name,'小节')
+        # 内容相同的图片只保存一份
+        image = Image.objects.get(user=self.user)
+        section = Doc.objects.filter(top_doc=pro_id,name='小节').first()
+        self.assertEqual(section.pre_content,'![]({}) ![](http://x.com/a.png)'.format(image.file_path))
+
+    def test_query_count(self):
+        _,small = self.import_zip(2)
+        _,large = self.import_zip(30)
+        self.assertEqual(small,large)
+        self.assertEqual(Image.objects.filter(user=self.user).count(),2)
+
+
+# 裁剪图片空白
+class ImageTrimTest(TestCase):
+    def make_image(self,mode,background,color):
+        from PIL import Image as PILImage
+        image = PILImage.new('RGBA',(100,80),background)
+        image.paste(color,(30,20,40,50))
+        output = io.BytesIO()
+        image.convert(mode).save(output,format='PNG')
+        return output.getvalue()
+
+    def trimmed_size(self,data):
+        from PIL import Image as PILImage
+        return PILImage.open(io.BytesIO(trim_image_bytes(data))).size
+
+    def test_modes(self):
+        for mode in ['RGB','RGBA','L','LA','P','1']:
+            data = self.make_image(mode,(255,255,255,255),(0,0,0,255))
+            self.assertEqual(self.trimmed_size(data),(20,40),mode)
+        # 透明背景视为空白
+        data = self.make_image('RGBA',(0,0,0,0),(0,0,0,255))
+        self.assertEqual(self.trimmed_size(data),(20,40))
+        # 含有 255 通道值的彩色内容不被裁掉
+        data = self.make_image('RGB',(255,255,255,255),(255,0,0,255))
+        self.assertEqual(self.trimmed_size(data),(20,40))
+
+    def test_untouched(self):
+        # 空白图片和无法识别的内容原样返回
+        blank = self.make_image('RGB',(255,255,255,255),(255,255,255,255))
+        self.assertIs(trim_image_bytes(blank),blank)
+        self.assertEqual(trim_image_bytes(b'not image'),b'not image')
+
+
+# 模拟 soffice --convert-to 的转换命令
+FAKE_SOFFICE = """
+import os,sys,time
+args = sys.argv[1:]
+fmt = args[args.index('--convert-to') + 1]
+outdir = args[args.index('--outdir') + 1]
+os.makedirs(outdir,exist_ok=True)
+for path in args[args.index('--outdir') + 2:]:
+    data = open(path,'rb').read()
+    if data == b'hang':
+        time.sleep(10)
+    if data != b'bad':
+        name = os.path.splitext(os.path.basename(path))[0] + '.' + fmt
+        open(os.path.join(outdir,name),'wb').write(b'converted:' + data)
+"""
+
+
+# LibreOffice 文件转换服务
+class OfficeConverterTest(TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree,self.work_dir,True)
+        script = os.path.join(self.work_dir,'soffice.py')
+        with open(script,'w') as f:
+            f.write(FAKE_SOFFICE)
+        self.converter = OfficeConverter(command=[sys.executable,script],work_dir=self.work_dir,timeout=2)
+
+    def test_batch(self):
+        futures = [self.converter.submit('{}'.format(i).encode(),'emf') for i in range(5)]
+        self.assertEqual([f.result() for f in futures],[b'converted:%d' % i for i in range(5)])
+        # 同时提交的文件由一次进程完成转换
+        self.assertEqual(self.converter.get_stats()['batches'],1)
+        # 临时文件已删除
+        self.assertEqual(sorted(os.listdir(self.work_dir)),['soffice.py'])
+
+    def test_default_work_dir(self):
+        # 默认的工作目录不在可公开访问的媒体目录下
+        work_dir = os.path.abspath(OfficeConverter().work_dir)
+        self.assertNotEqual(os.path.commonpath([work_dir,settings.MEDIA_ROOT]),settings.MEDIA_ROOT)
+
+    def test_failure(self):
+        futures = [self.converter.submit(data,'wmf') for data in [b'ok',b'bad',b'hang']]
+        self.assertEqual(futures[0].result(),b'converted:ok')
+        self.assertRaises(OfficeConvertError,futures[1].result)
+        self.assertRaises(OfficeConvertError,futures[2].result)
+        # 超时的批次逐个重试，正常的文件不受影响
+        stats = self.converter.get_stats()
+        self.assertEqual((stats['completed'],stats['failed']),(1,2))
+
+    def test_preview(self):
+        file_path = os.path.join(self.work_dir,'a.docx')
+        with open(file_path,'wb') as f:
+            f.write(b'docx')
+        with mock.patch('app_doc.office_utils._office_converter',self.converter),self.settings(MEDIA_ROOT=self.work_dir):
+            preview_path = office_preview(file_path)
+            with open(preview_path,'rb') as f:
+                self.assertEqual(f.read(),b'converted:docx')
+            # 同一文件只转换一次
+            self.assertEqual(office_preview(file_path),preview_path)
+            self.assertEqual(self.converter.get_stats()['batches'],1)
+            self.assertIsNone(office_preview(os.path.join(self.work_dir,'soffice.py')))
+
+
+# 图片内容寻址存储
+class ImageStoreTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='image_user',password='image_pwd')
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree,self.media_root,True)
+        override = self.settings(MEDIA_ROOT=self.media_root)
+        override.enable()
+        self.addCleanup(override.disable)
+        from PIL import Image as PILImage
+        output = io.BytesIO()
+        PILImage.new('RGB',(800,600),(10,20,30)).save(output,format='PNG')
+        self.png = output.getvalue()
+
+    def test_dedup(self):
+        r1 = img_upload(SimpleUploadedFile('a.png',self.png),'',self.user)
+        r2 = img_upload(SimpleUploadedFile('b.png',self.png),'',self.user)
+        r3 = base_img_upload('data:image/png;base64,' + base64.b64encode(self.png).decode(),'',self.user)
+        # 内容相同的图片共用同一个文件
+        self.assertEqual(r1['url'],r2['url'])
+        self.assertEqual(r1['url'],r3['url'])
+        self.assertTrue(r1['url'].startswith('/media/images/'))
+        images = list(Image.objects.filter(user=self.user))
+        self.assertEqual(len(images),3)
+        self.assertEqual({i.content_hash for i in images},{hashlib.sha256(self.png).hexdigest()})
+        # 最后一条图片数据删除后才删除文件
+        file_path = media_file_path(r1['url'])
+        delete_images(images[:2])
+        self.assertTrue(os.path.exists(file_path))
+        delete_images(images[2:])
+        self.assertFalse(os.path.exists(file_path))
+
+    def test_thumbnail(self):
+        from PIL import Image as PILImage
+        url = img_upload(SimpleUploadedFile('a.png',self.png),'',self.user)['url']
+        # 未登录时跳转到登录页，其他用户的图片返回404
+        self.assertEqual(self.client.get(thumbnail_url(url)).status_code,302)
+        User.objects.create_user(username='other_user',password='other_pwd')
+        self.client.login(username='other_user',password='other_pwd')
+        self.assertEqual(self.client.get(thumbnail_url(url)).status_code,404)
+        self.client.login(username='image_user',password='image_pwd')
+        resp = self.client.get(thumbnail_url(url))
+        self.assertEqual(resp['Content-Type'],'image/webp')
+        self.assertEqual(PILImage.open(io.BytesIO(b''.join(resp.streaming_content))).size,(300,225))
+        # 已生成的缩略图直接使用媒体文件url
+        self.assertTrue(thumbnail_url(url).startswith('/media/thumbnails/s/'))
+        self.assertEqual(self.client.get('/image_thumbnail/?path=/media/../manage.py').status_code,404)
+
+    def test_migrate(self):
+        os.makedirs(os.path.join(self.media_root,'202001'))
+        for name in ['a.png','b.png']:
+            with open(os.path.join(self.media_root,'202001',name),'wb') as f:
+                f.write(self.png)
+            Image.objects.create(user=self.user,file_path='/media/202001/' + name,file_name=name)
+        Image.objects.create(user=self.user,file_path='/media/202001/missing.png',file_name='missing.png')
+        out = io.StringIO()
+        call_command('migrate_image_store',stdout=out)
+        self.assertIn('duplicates: 1',out.getvalue())
+        self.assertIn('missing: 1',out.getvalue())
+        # 原有的图片url仍可访问，且与存储中的文件为同一文件
+        store_path = media_file_path(img_upload(SimpleUploadedFile('c.png',self.png),'',self.user)['url'])
+        for name in ['a.png','b.png']:
+            self.assertTrue(os.path.samefile(os.path.join(self.media_root,'202001',name),store_path))
+        self.assertEqual(Image.objects.filter(content_hash__isnull=True).count(),1)
+
+
+# 远程图片下载的本地测试服务器
+class FetchTestHandler(BaseHTTPRequestHandler):
+    png = b''
+
+    def do_GET(self):
+        if self.path.startswith('/slow'):
+            time.sleep(0.3)
+        if self.path == '/big':
+            # 不返回 Content-Length，只能在读取时检查大小
+            self.send_response(200)
+            self.send_header('Content-Type','image/png')
+            self.end_headers()
+            self.wfile.write(self.png)
+            for i in range(64):
+                self.wfile.write(b'\0' * 65536)
+            return
+        if self.path == '/trickle':
+            # 持续缓慢发送数据，每次发送不超过读取超时
+            self.send_response(200)
+            self.end_headers()
+            self.wfile.write(self.png)
+            for i in range(20):
+                time.sleep(0.1)
+                self.wfile.write(b'\0' * 65536)
+            return
+        if self.path == '/text':
+            body = b'<html></html>'
+        elif self.path == '/missing':
+            self.send_response(404)
+            self.end_headers()
+            return
+        else:
+            body = self.png
+        self.send_response(200)
+        # 服务器返回错误的类型，按文件头判断
+        self.send_header('Content-Type','text/plain')
+        self.send_header('Content-Length',str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handle(self):
+        try:
+            super().handle()
+        except ConnectionError:
+            # 客户端超出大小限制后断开连接
+            pass
+
+    def log_message(self, *args):
+        pass
+
+
+class RemoteFetchTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='fetch_user',password='fetch_pwd')
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree,self.media_root,True)
+        override = self.settings(MEDIA_ROOT=self.media_root)
+        override.enable()
+        self.addCleanup(override.disable)
+        from PIL import Image as PILImage
+        output = io.BytesIO()
+        PILImage.new('RGB',(20,20),(10,20,30)).save(output,format='PNG')
+        FetchTestHandler.png = output.getvalue()
+        self.server = ThreadingHTTPServer(('127.0.0.1',0),FetchTestHandler)
+        threading.Thread(target=self.server.serve_forever,daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.base_url = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+
+    def test_fetch_image(self):
+        data,suffix = fetch_image(self.base_url + '/a.png',1048576)
+        self.assertEqual(data,FetchTestHandler.png)
+        self.assertEqual(suffix,'png')
+        with self.assertRaises(RemoteFetchError):
+            fetch_image(self.base_url + '/text',1048576)
+        with self.assertRaises(RemoteFetchError):
+            fetch_image(self.base_url + '/missing',1048576)
+        # 大小超出限制
+        with self.assertRaises(RemoteFetchError):
+            fetch_image(self.base_url + '/a.png',10)
+        with self.assertRaises(RemoteFetchError):
+            fetch_image(self.base_url + '/big',1048576)
+        # 读取超时
+        with self.assertRaises(RemoteFetchError):
+            fetch_image(self.base_url + '/slow',1048576,timeout=(1,0.1))
+        # 下载总时长超出限制
+        start = time.monotonic()
+        with self.assertRaises(RemoteFetchError):
+            fetch_image(self.base_url + '/trickle',1048576 * 4,timeout=(1,1),total_timeout=0.3)
+        self.assertLess(time.monotonic() - start,1)
+
+    def test_fetch_images(self):
+        urls = [self.base_url + '/slow/{}.png'.format(i) for i in range(6)] + [self.base_url + '/text']
+        start = time.time()
+        results = fetch_images(urls,1048576)
+        # 并发下载，总耗时接近单个请求的耗时
+        self.assertLess(time.time() - start,1.2)
+        self.assertEqual(results[urls[0]],(FetchTestHandler.png,'png'))
+        self.assertIsInstance(results[urls[-1]],RemoteFetchError)
+
+    def test_url_img_upload(self):
+        url = self.base_url + '/a.png'
+        result = url_img_upload(url,'',self.user)
+        self.assertEqual(result['code'],0)
+        self.assertEqual(result['data']['originalURL'],url)
+        self.assertTrue(os.path.exists(media_file_path(result['data']['url'])))
+        self.assertEqual(url_img_upload(self.base_url + '/text','',self.user)['code'],1)
+        # 批量上传时拒绝本地地址
+        result = url_imgs_upload([url,'not a url'],self.user)
+        self.assertEqual(result['code'],1)
+        self.assertEqual(result['data']['errFiles'],[url,'not a url'])
+        with mock.patch('app_doc.util_upload_img.validate_url',side_effect=lambda u: u):
+            result = url_imgs_upload([url,self.base_url + '/text'],self.user)
+        self.assertEqual(result['code'],0)
+        self.assertIn(url,result['data']['succMap'])
+        self.assertEqual(result['data']['errFiles'],[self.base_url + '/text'])
+        # 图片数量超出上限时不下载
+        with mock.patch('app_doc.util_upload_img.fetch_images') as fetch:
+            result = url_imgs_upload([url] * 51,self.user)
+        self.assertEqual(result['code'],1)
+        fetch.assert_not_called()
@@ -0,0 +1,163 @@
+# coding:utf-8
+# @文件: toc_utils.py
+# 文集目录相关方法
+# 文集目录通过一次查询读取文集的全部文档，在内存中组装为目录树，
+# 并按文集的目录版本号缓存，文档变更时更新版本号使缓存失效
+
+from django.core.cache import cache
+from django.db.models import Case,When,F,Value,TextField
+from app_doc.models import Doc
+import time
+
+# 文集目录的最大层级
+TOC_MAX_LEVEL = 3
+# 文集目录缓存有效期，秒数
+TOC_CACHE_TIMEOUT = 86400
+
+
+# 文集目录版本号的缓存键
+def toc_version_key(pro_id):
+    return 'project_toc_version_{}'.format(int(pro_id))
+
+
+# 获取文集目录的版本号
+def get_toc_version(pro_id):
+    key = toc_version_key(pro_id)
+    version = cache.get(key)
+    if version is None:
+        # 以时间戳作为初始版本号，避免版本号缓存被淘汰后与旧版本重复
+        version = int(time.time() * 1000)
+        if cache.add(key, version, None) is False:
+            version = cache.get(key, version)
+    return version
+
+
+# 更新文集目录的版本号，使文集目录缓存失效
+def bump_toc_version(*pro_ids):
+    for pro_id in set(pro_ids):
+        try:
+            key = toc_version_key(pro_id)
+        except (TypeError, ValueError):
+            continue
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, int(time.time() * 1000), None)
+
+
+# 更新指定文档所属文集的目录版本号
+def bump_toc_version_by_docs(doc_ids):
+    pro_ids = Doc.objects.filter(id__in=list(doc_ids)).values_list('top_doc',flat=True).distinct()
+    bump_toc_version(*pro_ids)
+
+
+# 从数据库读取文集目录节点
+def load_toc_nodes(pro_id,published=True):
+    """
+    通过一次查询读取文集的文档，返回按目录顺序（深度优先）排列的节点列表，
+    每个节点包含 level 层级字段，超出 TOC_MAX_LEVEL 层级的文档不会被包含。
+    published 为 False 时不筛选文档状态（用于导入文集后的预览）。
+    """
+    docs = Doc.objects.filter(top_doc=pro_id)
+    if published:
+        docs = docs.filter(status=1)
+    docs = docs.annotate(
+        # 链接文档的链接地址保存在 pre_content 字段中
+        link = Case(When(editor_mode=5,then=F('pre_content')),default=Value(''),output_field=TextField())
+    ).values(
+        'id','name','parent_doc','open_children','editor_mode','modify_time','link'
+    ).order_by('sort','id')
+    return order_toc_nodes(docs)
+
+
+# 将文档按目录顺序（深度优先）排列
+def order_toc_nodes(docs):
+    """
+    docs：已按 (sort, id) 排序的文档字典，需包含 id 和 parent_doc 字段，
+    返回添加了 level 层级字段的节点列表，超出 TOC_MAX_LEVEL 层级及上级文档不存在的文档不会被包含。
+    """
+    # 按上级文档分组
+    children = {}
+    for doc in docs:
+        children.setdefault(doc['parent_doc'],[]).append(doc)
+
+    nodes = []
+    stack = [(doc,1) for doc in reversed(children.get(0,[]))]
+    while stack:
+        doc,level = stack.pop()
+        doc['level'] = level
+        nodes.append(doc)
+        if level < TOC_MAX_LEVEL:
+            for sub in reversed(children.get(doc['id'],[])):
+                stack.append((sub,level + 1))
+    return nodes
+
+
+# 获取文集目录节点（已发布文档），优先从缓存读取
+def get_toc_nodes(pro_id):
+    cache_key = 'project_toc_{}_{}'.format(int(pro_id),get_toc_version(pro_id))
+    nodes = cache.get(cache_key)
+    if nodes is None:
+        nodes = load_toc_nodes(pro_id)
+        cache.set(cache_key,nodes,TOC_CACHE_TIMEOUT)
+    return nodes
+
+
+# 获取文集文档的阅读顺序，返回 (文档ID列表, 文档ID→位置字典)
+def get_reading_order(pro_id):
+    cache_key = 'project_toc_order_{}_{}'.format(int(pro_id),get_toc_version(pro_id))
+    order = cache.get(cache_key)
+    if order is None:
+        # 目录节点按深度优先排列，即为文档的阅读顺序
+        doc_ids = [node['id'] for node in get_toc_nodes(pro_id)]
+        order = (doc_ids,{doc_id:i for i,doc_id in enumerate(doc_ids)})
+        cache.set(cache_key,order,TOC_CACHE_TIMEOUT)
+    return order
+
+
+# 获取文档的上一篇和下一篇文档ID，返回 (上一篇ID, 下一篇ID)，不存在时为 None
+def get_adjacent_docs(pro_id,doc_id):
+    doc_ids,positions = get_reading_order(pro_id)
+    try:
+        index = positions.get(int(doc_id))
+    except (TypeError, ValueError):
+        index = None
+    if index is None:
+        return (None,None)
+    previous_id = doc_ids[index - 1] if index > 0 else None
+    next_id = doc_ids[index + 1] if index < len(doc_ids) - 1 else None
+    return (previous_id,next_id)
+
+
+# 将目录节点列表组装为目录树
+def build_toc_tree(nodes,make_item,children_key='sub'):
+    """
+    nodes：load_toc_nodes 返回的节点列表
+    make_item：将节点转换为目录条目字典的函数
+    children_key：下级文档列表的键名，仅在存在下级文档时添加（条目中已有该键时直接使用）
+    """
+    tree = []
+    parents = [] # 当前路径上的 (层级, 条目)
+    for node in nodes:
+        item = make_item(node)
+        while parents and parents[-1][0] >= node['level']:
+            parents.pop()
+        if parents:
+            parents[-1][1].setdefault(children_key,[]).append(item)
+        else:
+            tree.append(item)
+        parents.append((node['level'],item))
+    return tree
+
+
+# 文档排序、导入预览等页面使用的目录条目
+def sort_toc_item(node):
+    item = {
+        'id': node['id'],
+        'field': node['name'],
+        'title': node['name'],
+        'level': node['level']
+    }
+    if node['level'] == 1:
+        item['spread'] = True
+    return item
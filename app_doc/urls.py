@@ -14,6 +14,7 @@ urlpatterns = [
     path('del_project/',views.del_project,name='del_project'), # 删除文集
     path('report_project_md/',views.report_md,name='report_md'), # 导出文集MD文件
     path('genera_project_file/',views.genera_project_file,name='genera_project_file'), # 个人中心生成文集文件（epub\docx\pdf等）
+    path('export_job_status/',views.export_job_status,name='export_job_status'), # 查询文集导出任务的状态
     path('report_project_file/',views.report_file,name='report_file'), # 导出文集文件(epub、docx等)
     path('modify_pro_role/<int:pro_id>/',views.modify_project_role,name="modify_pro_role"),# 修改文集权限
     path('modify_pro_download/<int:pro_id>/', views.modify_project_download, name="modify_pro_download"),  # 修改文集前台下载权限
@@ -53,6 +54,7 @@ urlpatterns = [
     path('modify_doctemp/<int:doctemp_id>/',views.modify_doctemp,name="modify_doctemp"), # 修改文档模板
     #################文件管理相关
     path('manage_image/',views.manage_image,name="manage_image"), # 图片管理
+    path('image_thumbnail/',views.image_thumbnail,name="image_thumbnail"), # 图片缩略图
     path('manage_image_group/',views.manage_img_group,name="manage_img_group"), # 图片分组管理
     path('manage_attachment/',views.manage_attachment,name='manage_attachment'), # 附件管理
     ##############文档标签
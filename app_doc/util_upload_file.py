@@ -1,7 +1,7 @@
 # coding:utf-8
 
 from django.utils.translation import gettext_lazy as _
-from app_admin.models import SysSetting
+from app_admin.setting_utils import get_setting
 from app_doc.models import Attachment
 from app_admin.utils import is_zip_bomb
 import os
@@ -43,20 +43,15 @@ def handle_attachment_upload(attachment, user, request):
 
     # 限制附件大小
     try:
-        allow_attachment_size = SysSetting.objects.get(types='doc', name='attachment_size')
-        allow_attach_size = int(allow_attachment_size.value) * 1048576
+        allow_attach_size = int(get_setting('attachment_size',types='doc')) * 1048576
     except Exception:
         allow_attach_size = 52428800  # 默认50MB
     if attachment.size > allow_attach_size:
         return {'status': False, 'data': _('文件大小超出限制')}
 
     # 限制附件格式
-    try:
-        attachment_suffix_list = SysSetting.objects.get(types='doc', name='attachment_suffix')
-        attachment_suffix_list = attachment_suffix_list.value.split(',')
-        if attachment_suffix_list == ['']:
-            attachment_suffix_list = ['zip']
-    except Exception:
+    attachment_suffix_list = (get_setting('attachment_suffix',types='doc') or '').split(',')
+    if attachment_suffix_list == ['']:
         attachment_suffix_list = ['zip']
     if attachment_name.split('.')[-1].lower() not in attachment_suffix_list:
         return {'status': False, 'data': _('不支持的格式')}
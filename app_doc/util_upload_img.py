@@ -5,11 +5,12 @@ from django.views.decorators.csrf import csrf_exempt
 from django.contrib.auth.decorators import login_required # 登录需求装饰器
 from django.utils.translation import gettext_lazy as _
 import datetime,time,json,base64,os,uuid
-from app_doc.models import Image,ImageGroup,Attachment
+from app_doc.models import ImageGroup,Attachment
 from app_doc.utils import validate_url
-from app_admin.models import SysSetting
+from app_doc.image_utils import save_image
+from app_doc.fetch_utils import fetch_image,fetch_images,RemoteFetchError,FETCH_MAX_URLS
+from app_admin.setting_utils import get_setting
 from loguru import logger
-import requests
 import random
 
 
@@ -62,12 +63,17 @@ def ice_save_file(file_obj,user):
     if file_suffix.lower() not in allow_suffix:         
         return {"error": _("文件格式不允许")}    
     # 接下来构造一个文件名，时间和随机10位字符串构成
-    relative_path = upload_generation_dir()
     name_time = time.strftime("%Y-%m-%d_%H%M%S_")
     name_join = ""
     name_rand = name_join.join(random.sample('zyxwvutsrqponmlkjihgfedcba',10) )
 
     file_name =  name_time +  name_rand + "." + file_suffix
+    if file_suffix.lower() in is_images:
+        # 图片按内容哈希存储，内容相同的图片共用同一个文件
+        image = save_image(user, file_obj.chunks(), file_suffix, file_name, _("iceEditor上传"))
+        return {"error":0, "name": str(file_obj),'url':image.file_path}
+
+    relative_path = upload_generation_dir()
     path_file = relative_path + file_name
     path_file = settings.MEDIA_ROOT + path_file
     #file_Url 是文件的url下发路径
@@ -76,22 +82,13 @@ def ice_save_file(file_obj,user):
     with open(path_file, 'wb') as f:
         for chunk in file_obj.chunks():
             f.write(chunk) # 保存文件
-        if file_suffix.lower()  in is_images:
-            Image.objects.create(
-                user=user,
-                file_path=file_url,
-                file_name=file_name,
-                remark=_("iceEditor上传")
-            )
-        
-        else :
-            #文件上传，暂时不屏蔽，如果需要正常使用此功能，是需要在iceeditor中修改的，mrdoc使用的是自定义脚本上传
-            Attachment.objects.create(
-                user=user,
-                file_path=file_url,
-                file_name=file_name,
-                file_size=str(round(len(chunk)/1024,2))+"KB"
-            )
+        #文件上传，暂时不屏蔽，如果需要正常使用此功能，是需要在iceeditor中修改的，mrdoc使用的是自定义脚本上传
+        Attachment.objects.create(
+            user=user,
+            file_path=file_url,
+            file_name=file_name,
+            file_size=str(round(len(chunk)/1024,2))+"KB"
+        )
         return  {"error":0, "name": str(file_obj),'url':file_url}
 
     return {"error": _("文件存储异常")}
@@ -99,42 +96,22 @@ def ice_save_file(file_obj,user):
 
 # ice_url图片上传
 def ice_url_img_upload(url,user):
-
-    relative_path = upload_generation_dir()
     name_time = time.strftime("%Y-%m-%d_%H%M%S_")
     name_join = ""
     name_rand = name_join.join(random.sample('zyxwvutsrqponmlkjihgfedcba',10) )
-    file_name =  name_time +  name_rand + '.png'  # 日期时间_随机字符串命名
-    path_file = os.path.join(relative_path, file_name)
-    path_file = settings.MEDIA_ROOT + path_file
-    # print('文件路径：', path_file)
-    file_url = (settings.MEDIA_URL + relative_path + file_name).replace("//","/")
-    # print("文件URL：", file_url)
-    header = {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/86.0.4240.198 Safari/537.36"
-    }
-    r = requests.get(url, headers=header, stream=True)
-
-    if r.status_code == 200:
-        # 判断是否为允许上传的图片类型
-        remote_type = r.headers['Content-Type'].split("/")[1]
-        if remote_type not in settings.ALLOWED_IMG:
-            logger.error("上传了不允许的URL图片：{}".format(url))
-            resp_data = {
-                'error': 0,
-                'name': {},
-                'file':{}
-            }
-            return resp_data
-        with open(path_file, 'wb') as f:
-            f.write(r.content)  # 保存文件
-        Image.objects.create(
-            user=user,
-            file_path=file_url,
-            file_name=file_name,
-            remark=_('iceurl粘贴上传'),
-        )
-    resp_data = {"error":0, "name": file_name,'url':file_url}        
+    try:
+        data,remote_type = fetch_image(url,get_img_size_limit())
+    except RemoteFetchError as e:
+        logger.error("上传URL图片失败：{} {}".format(url,e))
+        resp_data = {
+            'error': 0,
+            'name': {},
+            'file':{}
+        }
+        return resp_data
+    file_name =  name_time +  name_rand + '.' + remote_type  # 日期时间_随机字符串命名
+    image = save_image(user, [data], remote_type, file_name, _('iceurl粘贴上传'))
+    resp_data = {"error":0, "name": file_name,'url':image.file_path}
     return resp_data
 
 
@@ -148,8 +125,14 @@ def upload_img(request):
     img = request.FILES.get("editormd-image-file", None) # 编辑器上传
     manage_upload = request.FILES.get('manage_upload',None) # 图片管理上传
     try:
-        url_img = json.loads(request.body.decode())['url']
-        url_img = validate_url(url_img)
+        body = json.loads(request.body.decode())
+    except:
+        body = {}
+    # 批量上传图片URL地址，用于粘贴文档中的外部图片
+    if isinstance(body,dict) and isinstance(body.get('urls'),list):
+        return JsonResponse(url_imgs_upload(body['urls'],request.user))
+    try:
+        url_img = validate_url(body['url'])
         if url_img is False:
             return JsonResponse({"success": 0, "message": _("无效的URL！")})
     except:
@@ -208,33 +191,23 @@ def img_upload(files, dir_name, user, group_id=None):
         return {"success": 0, "message": _("图片格式不正确")}
 
     # 判断图片的大小
-    try:
-        allow_image_size = SysSetting.objects.get(types='doc', name='img_size')
-        allow_img_size = int(allow_image_size.value) * 1048576
-    except Exception as e:
-        # print(repr(e))
-        allow_img_size = 10485760
+    allow_img_size = get_img_size_limit()
     if files.size > allow_img_size:
         return {"success": 0, "message": _("图片大小超出{}MB".format(allow_img_size / 1048576))}
 
-    relative_path = upload_generation_dir(dir_name)
+    # 图片按内容哈希存储，dir_name 参数不再使用
     file_name = files.name.replace(file_suffix,'').replace('.','') + '_' +str(int(time.time())) + '.' + file_suffix
-    path_file=os.path.join(relative_path, file_name)
-    path_file = settings.MEDIA_ROOT + path_file
-    # print('文件路径：',path_file)
-    file_url = (settings.MEDIA_URL + relative_path + file_name).replace("//",'/')
-    # print("文件URL：",file_url)
-    with open(path_file, 'wb') as f:
-        for chunk in files.chunks():
-            f.write(chunk) # 保存文件
-    Image.objects.create(
-        user=user,
-        file_path=file_url,
-        file_name=file_name,
-        remark=_('本地上传'),
-        group = group_id,
-    )
-    return {"success": 1, "url": file_url,'message':_('上传图片成功')}
+    image = save_image(user, files.chunks(), file_suffix, file_name, _('本地上传'), group=group_id)
+    return {"success": 1, "url": image.file_path,'message':_('上传图片成功')}
+
+# 图片大小上限（字节）
+def get_img_size_limit():
+    try:
+        return int(get_setting('img_size',types='doc')) * 1048576
+    except Exception as e:
+        # print(repr(e))
+        return 10485760
+
 
 # 解析image/png获取扩展名
 def getImageExtensionName(temps):
@@ -254,73 +227,31 @@ def base_img_upload(files,dir_name, user):
     extensionName = getImageExtensionName(temps)
 
     files_base = base64.b64decode(files_str) # 进行base64编码
-    relative_path = upload_generation_dir(dir_name)
     file_name = str(datetime.datetime.today()).replace(':', '').replace(' ', '_').replace('.', '_') + str(random.random()) +  extensionName # 日期时间
-    path_file = os.path.join(relative_path, file_name)
-    path_file = settings.MEDIA_ROOT + path_file
-    # print('文件路径：', path_file)
-    file_url = (settings.MEDIA_URL + relative_path + file_name).replace("//","/")
-    # print("文件URL：", file_url)
-    with open(path_file, 'wb') as f:
-        f.write(files_base)  # 保存文件
-    Image.objects.create(
-        user = user,
-        file_path = file_url,
-        file_name=file_name,
-        remark = _('粘贴上传'),
-    )
-    return {"success": 1, "url": file_url, 'message': _('上传图片成功')}
+    image = save_image(user, [files_base], extensionName[1:], file_name, _('粘贴上传'))
+    return {"success": 1, "url": image.file_path, 'message': _('上传图片成功')}
 
 
 # url图片上传
 def url_img_upload(url,dir_name,user):
-
-    relative_path = upload_generation_dir(dir_name)
-    file_name = str(datetime.datetime.today()).replace(':', '').replace(' ', '_').split('.')[0] + str(random.random()) + '.png'  # 日期时间
-    path_file = os.path.join(relative_path, file_name)
-    path_file = settings.MEDIA_ROOT + path_file
-    # print('文件路径：', path_file)
-    file_url = (settings.MEDIA_URL + relative_path + file_name).replace("//","/")
-    # print("文件URL：", file_url)
-    header = {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/86.0.4240.198 Safari/537.36"
-    }
     try:
-        r = requests.get(url, headers=header, stream=True)
-        if r.status_code == 200:
-            # 判断是否为允许上传的图片类型
-            remote_type = r.headers['Content-Type'].split("/")[1]
-            if remote_type not in settings.ALLOWED_IMG:
-                logger.error("上传了不允许的URL图片：{}".format(url))
-                resp_data = {
-                    'msg': '',
-                    'code': 1,
-                    'data': {}
-                }
-                return resp_data
-            with open(path_file, 'wb') as f:
-                f.write(r.content)  # 保存文件
-            Image.objects.create(
-                user=user,
-                file_path=file_url,
-                file_name=file_name,
-                remark=_('粘贴上传'),
-            )
-
-            resp_data = {
-                 'msg': '',
-                 'code': 0,
-                 'data' : {
-                   'originalURL': url,
-                   'url': file_url
-                 }
-                }
-        else:
-            resp_data = {
-                'msg': '',
-                'code': 1,
-                'data': {}
+        data,remote_type = fetch_image(url,get_img_size_limit())
+        file_url = save_url_img(data,remote_type,user)
+        resp_data = {
+             'msg': '',
+             'code': 0,
+             'data' : {
+               'originalURL': url,
+               'url': file_url
+             }
             }
+    except RemoteFetchError as e:
+        logger.error("上传URL图片失败：{} {}".format(url,e))
+        resp_data = {
+            'msg': '',
+            'code': 1,
+            'data': {}
+        }
     except Exception as e:
         logger.error("上传URL图片异常：{}".format(repr(e)))
         resp_data = {
@@ -329,4 +260,50 @@ def url_img_upload(url,dir_name,user):
             'data': {}
         }
     return resp_data
-    # return {"success": 1, "url": file_url, 'message': '上传图片成功'}
\ No newline at end of file
+    # return {"success": 1, "url": file_url, 'message': '上传图片成功'}
+
+
+# 批量url图片上传，并发下载全部图片，返回原地址和新地址的对应关系及失败的地址；图片数量超出上限时不下载
+def url_imgs_upload(urls,user):
+    if len(urls) > FETCH_MAX_URLS:
+        return {
+            'msg': _('图片数量超出限制：{}').format(FETCH_MAX_URLS),
+            'code': 1,
+            'data': {
+                'succMap': {},
+                'errFiles': [],
+            }
+        }
+    valid_urls = []
+    err_urls = []
+    for url in urls:
+        if isinstance(url,str) and validate_url(url) is not False:
+            valid_urls.append(url)
+        else:
+            err_urls.append(url)
+    succ_map = {}
+    for url,result in fetch_images(valid_urls,get_img_size_limit()).items():
+        if isinstance(result,RemoteFetchError):
+            logger.error("上传URL图片失败：{} {}".format(url,result))
+            err_urls.append(url)
+            continue
+        try:
+            succ_map[url] = save_url_img(result[0],result[1],user)
+        except Exception as e:
+            logger.error("上传URL图片异常：{}".format(repr(e)))
+            err_urls.append(url)
+    return {
+        'msg': '',
+        'code': 0 if succ_map or not err_urls else 1,
+        'data': {
+            'succMap': succ_map,
+            'errFiles': err_urls,
+        }
+    }
+
+
+# 保存下载的url图片，返回图片地址
+def save_url_img(data,remote_type,user):
+    file_name = str(datetime.datetime.today()).replace(':', '').replace(' ', '_').split('.')[0] + str(random.random()) + '.' + remote_type  # 日期时间
+    image = save_image(user, [data], remote_type, file_name, _('粘贴上传'))
+    return image.file_path
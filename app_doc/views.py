@@ -1,6 +1,6 @@
 # coding:utf-8
 from django.shortcuts import render,redirect
-from django.http.response import JsonResponse,Http404,HttpResponseNotAllowed,HttpResponse
+from django.http.response import JsonResponse,Http404,HttpResponseNotAllowed,HttpResponse,FileResponse
 from django.http import QueryDict
 from django.http import HttpResponseForbidden
 from django.contrib.auth.decorators import login_required # 登录需求装饰器
@@ -9,6 +9,7 @@ from django.views.decorators.http import require_http_methods,require_GET,requir
 from django.core.paginator import Paginator,PageNotAnInteger,EmptyPage,InvalidPage # 后端分页
 from django.core.exceptions import PermissionDenied,ObjectDoesNotExist
 from django.core.serializers import serialize
+from django.urls import reverse
 from app_doc.models import Project,Doc,DocTemp
 from django.contrib.auth.models import User
 from rest_framework.views import APIView # 视图
@@ -17,13 +18,23 @@ from rest_framework.pagination import PageNumberPagination # 分页
 from rest_framework.authentication import SessionAuthentication # 认证
 from django.db.models import Q
 from django.db import transaction
-from django.utils.html import strip_tags,escape
+from django.utils.html import escape
 from django.utils.translation import gettext_lazy as _
 from loguru import logger
 from app_api.serializers_app import *
 from app_doc.report_utils import *
 from app_doc.utils import check_user_project_writer_role
-from app_admin.models import UserOptions,SysSetting
+from app_doc.access_utils import get_project_access,check_project_access,sync_project_role_users,bump_access_version,\
+    ACCESS_ALLOW,ACCESS_DENY,ACCESS_VIEWCODE
+from app_doc.toc_utils import get_toc_nodes,build_toc_tree,sort_toc_item,bump_toc_version,bump_toc_version_by_docs
+from app_doc.stats_utils import attach_project_stats,attach_image_group_stats,attach_tag_stats
+from app_doc.tag_utils import get_tag_graph
+from app_doc.search.doc_search import search_docs
+from app_doc.render_utils import attach_doc_summary,attach_doc_text
+from app_doc.export_utils import create_export_job,export_job_dict,export_file_response
+from app_doc.image_utils import get_thumbnail,delete_images
+from app_admin.models import UserOptions
+from app_admin.setting_utils import get_setting
 from app_admin.decorators import check_headers,allow_report_file
 from app_admin.utils import is_zip_bomb
 from app_api.auth_app import AppAuth,AppMustAuth # 自定义认证
@@ -35,7 +46,6 @@ import random
 import os.path
 import base64
 import hashlib
-import markdown
 import tempfile
 
 
@@ -94,83 +104,29 @@ def validateTitle(title):
 
 # 文档文本生成摘要（不带markdown标记和html标签）
 def remove_markdown_tag(docs):
-    for doc in docs:
-        try:
-            if doc.editor_mode == 3: # 富文本文档
-                doc.content = strip_tags(doc.content)[:201]
-            elif doc.editor_mode == 4:
-                doc.pre_content = "此为表格文档，进入文档查看详细内容"
-            else: # 其他文档
-                doc.pre_content = strip_tags(markdown.markdown(doc.pre_content))[:201]
-        except Exception as e:
-            doc.pre_content = doc.pre_content[:201]
+    # 摘要读取文档的渲染内容，不再逐篇解析 Markdown
+    for doc in attach_doc_summary(docs):
+        if doc.editor_mode == 3: # 富文本文档
+            doc.content = doc.summary[:201]
+        else: # 其他文档
+            doc.pre_content = doc.summary[:201]
 
 # 获取文集的文档目录
 def get_pro_toc(pro_id):
-    # 查询存在上级文档的文档
-    parent_id_list = Doc.objects.filter(
-        top_doc=pro_id,
-        status=1
-    ).exclude(parent_doc=0).values_list('parent_doc',flat=True)
-    # 获取存在上级文档的上级文档ID
-    # print(parent_id_list)
-    doc_list = []
-    n = 0
-    # 获取一级文档
-    top_docs = Doc.objects.filter(top_doc=pro_id, parent_doc=0, status=1).values('id', 'name','open_children','editor_mode').order_by('sort')
-    # 遍历一级文档
-    for doc in top_docs:
-        top_item = {
-            'id': doc['id'],
-            'name': doc['name'],
-            'open_children':doc['open_children'],
-            'editor_mode':doc['editor_mode']
+    # 目录节点由 toc_utils 一次查询获取并缓存
+    nodes = get_toc_nodes(pro_id)
+    def make_item(node):
+        item = {
+            'id': node['id'],
+            'name': node['name'],
+            'open_children': node['open_children'],
+            'editor_mode': node['editor_mode']
         }
-        # 如果一级文档存在下级文档，查询其二级文档
-        if doc['id'] in parent_id_list:
-            # 获取二级文档
-            sec_docs = Doc.objects.filter(
-                top_doc=pro_id,
-                parent_doc=doc['id'],
-                status=1
-            ).values('id', 'name','open_children','editor_mode').order_by('sort')
-            top_item['sub'] = []
-            for doc in sec_docs:
-                sec_item = {
-                    'id': doc['id'],
-                    'name': doc['name'],
-                    'open_children': doc['open_children'],
-                    'editor_mode': doc['editor_mode']
-                }
-                # 如果二级文档存在下级文档，查询第三级文档
-                if doc['id'] in parent_id_list:
-                    # 获取三级文档
-                    thr_docs = Doc.objects.filter(
-                        top_doc=pro_id,
-                        parent_doc=doc['id'],
-                        status=1
-                    ).values('id','name','editor_mode').order_by('sort')
-                    sec_item['sub'] = []
-                    for doc in thr_docs:
-                        item = {
-                            'id': doc['id'],
-                            'name': doc['name'],
-                            'editor_mode': doc['editor_mode']
-                        }
-                        sec_item['sub'].append(item)
-                        n += 1
-                    top_item['sub'].append(sec_item)
-                    n += 1
-                else:
-                    top_item['sub'].append(sec_item)
-                    n += 1
-            doc_list.append(top_item)
-            n += 1
-        # 如果一级文档没有下级文档，直接保存
-        else:
-            doc_list.append(top_item)
-            n += 1
-    return (doc_list,n)
+        if node['editor_mode'] == 5:
+            item['pre_content'] = node['link']
+        return item
+    doc_list = build_toc_tree(nodes,make_item)
+    return (doc_list,len(nodes))
 
 
 # 文集列表（首页）
@@ -184,13 +140,9 @@ def project_list(request):
     if sort in [0,'0']:
         sort_str = ''
     elif sort == '':
-        try:
-            index_project_sort = SysSetting.objects.get(name='index_project_sort')
-            if index_project_sort.value == '-1':
-                sort_str = '-'
-            else:
-                sort_str = ''
-        except:
+        if get_setting('index_project_sort') == '-1':
+            sort_str = '-'
+        else:
             sort_str = ''
     else:
         sort_str = '-'
@@ -216,12 +168,8 @@ def project_list(request):
 
     # 没有搜索 and 认证用户 and 没有筛选
     if (is_kw is False) and (is_auth) and (is_role is False):
-        colla_list = [i.project.id for i in ProjectCollaborator.objects.filter(user=request.user)] # 用户的协作文集列表
         project_list = Project.objects.filter(
-            Q(role__in=role_list) | \
-            Q(role=2,role_value__contains=str(request.user.username)) | \
-            Q(create_user=request.user) | \
-            Q(id__in=colla_list)
+            get_project_access(request).visible_q(role_list)
         ).order_by('-is_top',"{}create_time".format(sort_str))
 
     # 没有搜索 and 认证用户 and 有筛选
@@ -232,13 +180,12 @@ def project_list(request):
             project_list = Project.objects.filter(create_user=request.user,role=1).order_by(
                 '-is_top',"{}create_time".format(sort_str))
         elif role in ['2',2]:
-            project_list = Project.objects.filter(role=2,role_value__contains=str(request.user.username)).order_by(
+            project_list = Project.objects.filter(role=2,id__in=get_project_access(request).assigned_ids).order_by(
                 '-is_top',"{}create_time".format(sort_str))
         elif role in ['3',3]:
             project_list = Project.objects.filter(role=3).order_by('-is_top',"{}create_time".format(sort_str))
         elif role in ['99',99]:
-            colla_list = [i.project.id for i in ProjectCollaborator.objects.filter(user=request.user)] # 用户的协作文集列表
-            project_list = Project.objects.filter(id__in=colla_list).order_by('-is_top',"{}create_time".format(sort_str))
+            project_list = Project.objects.filter(id__in=list(get_project_access(request).colla_roles)).order_by('-is_top',"{}create_time".format(sort_str))
         else:
             return render(request,'404.html')
 
@@ -257,13 +204,9 @@ def project_list(request):
 
     # 有搜索 and 认证用户 and 没有筛选
     elif (is_kw) and (is_auth) and (is_role is False):
-        colla_list = [i.project.id for i in ProjectCollaborator.objects.filter(user=request.user)] # 用户的协作文集
         # 查询所有可显示的文集
         project_list = Project.objects.filter(
-            Q(role__in=[0, 3]) | \
-            Q(role=2, role_value__contains=str(request.user.username)) | \
-            Q(create_user=request.user) | \
-            Q(id__in=colla_list),
+            get_project_access(request).visible_q([0,3]),
             Q(name__icontains=kw) | Q(intro__icontains=kw)
         ).order_by('-is_top','{}create_time'.format(sort_str))
 
@@ -283,7 +226,7 @@ def project_list(request):
             project_list = Project.objects.filter(
                 Q(name__icontains=kw) | Q(intro__icontains=kw),
                 role=2,
-                role_value__contains=str(request.user.username)
+                id__in=get_project_access(request).assigned_ids
             ).order_by('-is_top',"{}create_time".format(sort_str))
         elif role in ['3',3]:
             project_list = Project.objects.filter(
@@ -291,10 +234,9 @@ def project_list(request):
                 role=3
             ).order_by('-is_top',"{}create_time".format(sort_str))
         elif role in ['99',99]:
-            colla_list = [i.project.id for i in ProjectCollaborator.objects.filter(user=request.user)] # 用户的协作文集列表
             project_list = Project.objects.filter(
                 Q(name__icontains=kw) | Q(intro__icontains=kw),
-                id__in=colla_list
+                id__in=list(get_project_access(request).colla_roles)
             ).order_by('-is_top',"{}create_time".format(sort_str))
         else:
             return render(request,'404.html')
@@ -330,6 +272,8 @@ def project_list(request):
         projects = paginator.page(1)
     except EmptyPage:
         projects = paginator.page(paginator.num_pages)
+    # 批量获取当前页文集的文档数量和最新文档
+    projects.object_list = attach_project_stats(projects.object_list,new_docs=3)
     return render(request, 'app_doc/pro_list.html', locals())
 
 
@@ -392,10 +336,7 @@ def project_index(request,pro_id):
             is_collect_pro = False
 
         # 获取文集的协作用户信息
-        if request.user.is_authenticated: # 对登陆用户查询其协作文档信息
-            colla_user = ProjectCollaborator.objects.filter(project=project,user=request.user).count()
-        else:
-            colla_user = 0
+        colla_user = 1 if project.id in get_project_access(request).colla_roles else 0
 
         # 获取文集前台下载权限
         try:
@@ -403,28 +344,12 @@ def project_index(request,pro_id):
         except ObjectDoesNotExist:
             allow_download = False
 
-        # 私密文集并且访问者非创建者非协作者
-        if (project.role == 1) and (request.user != project.create_user) and (colla_user == 0):
-            return render(request,'404.html')
-        # 指定用户可见文集
-        elif project.role == 2:
-            user_list = project.role_value
-            if request.user.is_authenticated: # 认证用户判断是否在许可用户列表中
-                if (request.user.username not in user_list) and \
-                        (request.user != project.create_user) and \
-                        (colla_user == 0): # 访问者不在指定用户之中
-                    return render(request, '404.html')
-            else:# 游客直接返回404
-                return render(request, '404.html')
-        # 访问码可见
-        elif project.role == 3:
-            # 浏览用户不为创建者、协作者
-            if request.user != project.create_user and colla_user == 0:
-                viewcode = project.role_value
-                viewcode_name = 'viewcode-{}'.format(project.id)
-                r_viewcode = request.COOKIES[viewcode_name] if viewcode_name in request.COOKIES.keys() else 0 # 从cookie中获取访问码
-                if viewcode != r_viewcode: # cookie中的访问码不等于文集访问码，跳转到访问码认证界面
-                    return redirect('/check_viewcode/?to={}'.format(request.path))
+        # 检查文集访问权限
+        access_result = check_project_access(request,project)
+        if access_result == ACCESS_DENY:
+            return render(request, '404.html')
+        elif access_result == ACCESS_VIEWCODE: # 跳转到访问码认证界面
+            return redirect('/check_viewcode/?to={}'.format(request.path))
 
         # 获取搜索词
         kw = request.GET.get('kw','')
@@ -526,6 +451,7 @@ def modify_project_role(request,pro_id):
                             modify_time=datetime.datetime.now()
                         )
                     pro = Project.objects.get(id=int(pro_id))
+                    sync_project_role_users(pro) # 同步文集的指定可见用户
                     # return render(request, 'app_doc/manage/manage_project_role.html', locals())
                     return JsonResponse({'status':True,'data':'ok'})
                 except:
@@ -634,15 +560,16 @@ def manage_project(request):
         except EmptyPage:
             pros = paginator.page(paginator.num_pages)
         table_data = []
-        for project in pros:
+        # 批量获取当前页文集的文档数量和协作者数量
+        for project in attach_project_stats(pros,doc_status=None,collaborators=True):
             item = {
                 'id':project.id,
                 'name':project.name,
                 'intro':project.intro,
-                'doc_total':Doc.objects.filter(top_doc=project.id).count(),
+                'doc_total':project.doc_cnt,
                 'role':project.role,
                 'role_value':project.role_value,
-                'colla_total':ProjectCollaborator.objects.filter(project=project).count(),
+                'colla_total':project.colla_cnt,
                 'create_time':project.create_time,
                 'modify_time':project.modify_time
             }
@@ -650,7 +577,7 @@ def manage_project(request):
         resp_data = {
             "code": 0,
             "msg": "ok",
-            "count": project_list.count(),
+            "count": paginator.count,
             "data": table_data
         }
         return JsonResponse(resp_data)
@@ -671,58 +598,8 @@ def manage_project_doc_sort(request,pro_id):
         pro_colla = ProjectCollaborator.objects.filter(project=pro,user=request.user,role=1)
         # 文集的创建者和文集高级权限协作者允许操作
         if (pro.create_user == request.user) or pro_colla.count() > 0:
-            # 查询存在上级文档的文档
-            parent_id_list = Doc.objects.filter(top_doc=pro_id, status=1).exclude(parent_doc=0).values_list(
-                'parent_doc', flat=True)
-            # 获取存在上级文档的上级文档ID
-            doc_list = []
-            # 获取一级文档
-            top_docs = Doc.objects.filter(top_doc=pro_id, parent_doc=0, status=1).values('id', 'name').order_by('sort')
-            # 遍历一级文档
-            for doc in top_docs:
-                top_item = {
-                    'id': doc['id'],
-                    'field': doc['name'],
-                    'title': doc['name'],
-                    'spread': True,
-                    'level': 1
-                }
-                # 如果一级文档存在下级文档，查询其二级文档
-                if doc['id'] in parent_id_list:
-                    # 获取二级文档
-                    sec_docs = Doc.objects.filter(top_doc=pro_id, parent_doc=doc['id'], status=1).values('id',
-                                                                                                         'name').order_by(
-                        'sort')
-                    top_item['children'] = []
-                    for doc in sec_docs:
-                        sec_item = {
-                            'id': doc['id'],
-                            'field': doc['name'],
-                            'title': doc['name'],
-                            'level': 2
-                        }
-                        # 如果二级文档存在下级文档，查询第三级文档
-                        if doc['id'] in parent_id_list:
-                            # 获取三级文档
-                            thr_docs = Doc.objects.filter(top_doc=pro_id, parent_doc=doc['id'], status=1).values('id',
-                                                                                                                 'name').order_by(
-                                'sort')
-                            sec_item['children'] = []
-                            for doc in thr_docs:
-                                item = {
-                                    'id': doc['id'],
-                                    'field': doc['name'],
-                                    'title': doc['name'],
-                                    'level': 3
-                                }
-                                sec_item['children'].append(item)
-                            top_item['children'].append(sec_item)
-                        else:
-                            top_item['children'].append(sec_item)
-                    doc_list.append(top_item)
-                # 如果一级文档没有下级文档，直接保存
-                else:
-                    doc_list.append(top_item)
+            # 文集的文档目录
+            doc_list = build_toc_tree(get_toc_nodes(pro_id),sort_toc_item,'children')
             return render(request,'app_doc/manage/manage_project_doc_sort.html',locals())
         else:
             return render(request, '403.html')
@@ -763,7 +640,8 @@ def manage_project_doc_sort(request,pro_id):
                             for c2 in c1['children']:
                                 Doc.objects.filter(id=c2['id']).update(sort=n2, parent_doc=c1['id'])
                                 n2 += 10
-
+            # 更新文集目录缓存
+            bump_toc_version(pro.id)
             return JsonResponse({'status': True, 'data': 'ok'})
         else:
             return JsonResponse({'status':False,'data':_('无权操作')})
@@ -873,6 +751,7 @@ def manage_project_collaborator(request,pro_id):
                 user = User.objects.get(username=username)
                 pro_colla = ProjectCollaborator.objects.filter(project=project[0], user=user)
                 pro_colla.update(role=role)
+                bump_access_version()
                 return JsonResponse({'status':True,'data':_('修改成功')})
             except:
                 logger.exception(_("修改协作权限出错"))
@@ -992,15 +871,9 @@ def doc(request,pro_id,doc_id):
             # 获取文集的文档目录
             toc_list,toc_cnt = get_pro_toc(pro_id)
             # 获取文集的协作用户信息
-            if request.user.is_authenticated:
-                colla_user = ProjectCollaborator.objects.filter(project=project,user=request.user)
-                if colla_user.exists():
-                    colla_user_role = colla_user[0].role
-                    colla_user = colla_user.count()
-                else:
-                    colla_user = colla_user.count()
-            else:
-                colla_user = 0
+            access = get_project_access(request)
+            colla_user_role = access.colla_role(project.id)
+            colla_user = 0 if colla_user_role is None else 1
 
             # 获取文集收藏状态
             if request.user.is_authenticated:
@@ -1012,29 +885,12 @@ def doc(request,pro_id,doc_id):
             else:
                 is_collect_pro,is_collect_doc = False,False
 
-            # 私密文集且访问者非创建者、协作者 - 不能访问
-            if (project.role == 1) and (request.user != project.create_user) and (colla_user == 0):
+            # 检查文集访问权限
+            access_result = check_project_access(request,project)
+            if access_result == ACCESS_DENY:
                 return render(request, '404.html')
-            # 指定用户可见文集
-            elif project.role == 2:
-                user_list = project.role_value
-                if request.user.is_authenticated:  # 认证用户判断是否在许可用户列表中
-                    if (request.user.username not in user_list) and \
-                            (request.user != project.create_user) and \
-                            (colla_user == 0):  # 访问者不在指定用户之中，也不是协作者
-                        return render(request, '404.html')
-                else:  # 游客直接返回404
-                    return render(request, '404.html')
-            # 访问码可见
-            elif project.role == 3:
-                # 浏览用户不为创建者和协作者 - 需要访问码
-                if (request.user != project.create_user) and (colla_user == 0):
-                    viewcode = project.role_value
-                    viewcode_name = 'viewcode-{}'.format(project.id)
-                    r_viewcode = request.COOKIES[
-                        viewcode_name] if viewcode_name in request.COOKIES.keys() else 0  # 从cookie中获取访问码
-                    if viewcode != r_viewcode:  # cookie中的访问码不等于文集访问码，跳转到访问码认证界面
-                        return redirect('/check_viewcode/?to={}'.format(request.path))
+            elif access_result == ACCESS_VIEWCODE: # 跳转到访问码认证界面
+                return redirect('/check_viewcode/?to={}'.format(request.path))
 
             # 获取文档内容
             try:
@@ -1085,15 +941,9 @@ def doc_id(request,doc_id):
         # 获取文集的文档目录
         toc_list,toc_cnt = get_pro_toc(pro_id)
         # 获取文集的协作用户信息
-        if request.user.is_authenticated:
-            colla_user = ProjectCollaborator.objects.filter(project=project,user=request.user)
-            if colla_user.exists():
-                colla_user_role = colla_user[0].role
-                colla_user = colla_user.count()
-            else:
-                colla_user = colla_user.count()
-        else:
-            colla_user = 0
+        access = get_project_access(request)
+        colla_user_role = access.colla_role(project.id)
+        colla_user = 0 if colla_user_role is None else 1
 
         # 获取文集收藏状态
         if request.user.is_authenticated:
@@ -1105,29 +955,12 @@ def doc_id(request,doc_id):
         else:
             is_collect_pro,is_collect_doc = False,False
 
-        # 私密文集且访问者非创建者、协作者 - 不能访问
-        if (project.role == 1) and (request.user != project.create_user) and (colla_user == 0):
+        # 检查文集访问权限
+        access_result = check_project_access(request,project)
+        if access_result == ACCESS_DENY:
             return render(request, '404.html')
-        # 指定用户可见文集
-        elif project.role == 2:
-            user_list = project.role_value
-            if request.user.is_authenticated:  # 认证用户判断是否在许可用户列表中
-                if (request.user.username not in user_list) and \
-                        (request.user != project.create_user) and \
-                        (colla_user == 0):  # 访问者不在指定用户之中，也不是协作者
-                    return render(request, '404.html')
-            else:  # 游客直接返回404
-                return render(request, '404.html')
-        # 访问码可见
-        elif project.role == 3:
-            # 浏览用户不为创建者和协作者 - 需要访问码
-            if (request.user != project.create_user) and (colla_user == 0):
-                viewcode = project.role_value
-                viewcode_name = 'viewcode-{}'.format(project.id)
-                r_viewcode = request.COOKIES[
-                    viewcode_name] if viewcode_name in request.COOKIES.keys() else 0  # 从cookie中获取访问码
-                if viewcode != r_viewcode:  # cookie中的访问码不等于文集访问码，跳转到访问码认证界面
-                    return redirect('/check_viewcode/?to={}'.format(request.path))
+        elif access_result == ACCESS_VIEWCODE: # 跳转到访问码认证界面
+            return redirect('/check_viewcode/?to={}'.format(request.path))
 
         # 获取文档内容
         try:
@@ -1344,6 +1177,8 @@ def modify_doc(request,doc_id):
                                 open_children = open_children,
                                 show_children = show_children
                             )
+                            # 更新文集目录缓存
+                            bump_toc_version(doc.top_doc)
                             # 更新文档标签
                             doc_tag_list = doc_tags.split(",") if doc_tags != "" else []
                             # print(doc_tags,doc_tag_list)
@@ -1420,6 +1255,7 @@ def del_doc(request):
                     chr_doc_ids = chr_doc.values_list('id',flat=True) # 提取下级文档的ID
                     chr_doc.update(status=3,modify_time=datetime.datetime.now()) # 修改下级文档的状态为删除
                     Doc.objects.filter(parent_doc__in=list(chr_doc_ids)).update(status=3,modify_time=datetime.datetime.now()) # 修改下级文档的下级文档状态
+                    bump_toc_version(doc.top_doc) # 更新文集目录缓存
 
                     return JsonResponse({'status': True, 'data': _('删除完成')})
                 else:
@@ -1434,6 +1270,8 @@ def del_doc(request):
                     else:
                         Doc.objects.filter(id__in=docs,create_user=request.user).update(status=3,modify_time=datetime.datetime.now())
                         Doc.objects.filter(parent_doc__in=docs).update(status=3,modify_time=datetime.datetime.now())
+                    # 更新文集目录缓存
+                    bump_toc_version_by_docs(docs)
                     return JsonResponse({'status': True, 'data': _('删除完成')})
                 except:
                     return JsonResponse({'status': False, 'data': _('非法请求')})
@@ -1604,6 +1442,8 @@ def move_doc(request):
             Doc.objects.filter(id=int(doc_id)).update(parent_doc=int(parent_id),top_doc=int(pro_id))
             # 修改其子文档为顶级文档
             Doc.objects.filter(parent_doc=doc_id).update(parent_doc=0)
+            # 更新源文集和目标文集的目录缓存
+            bump_toc_version(doc.top_doc,pro_id)
             return JsonResponse({'status':True,'data':{'pro_id':pro_id,'doc_id':doc_id}})
         except:
             logger.exception(_("移动文档异常"))
@@ -1619,6 +1459,8 @@ def move_doc(request):
             # 遍历子文档，如果其存在下级文档，那么继续修改所属文集
             for child in child_doc:
                 Doc.objects.filter(parent_doc=child.id).update(top_doc=int(pro_id))
+            # 更新源文集和目标文集的目录缓存
+            bump_toc_version(doc.top_doc,pro_id)
             return JsonResponse({'status': True, 'data':{'pro_id':pro_id,'doc_id':doc_id}})
         except:
             logger.exception(_("移动包含下级的文档异常"))
@@ -2208,63 +2050,13 @@ def get_pro_doc_tree(request):
     pro_id = request.POST.get('pro_id', None)
     is_page = request.POST.get('is_page', False)
     if pro_id:
-        # 查询存在上级文档的文档
-        parent_id_list = Doc.objects.filter(top_doc=pro_id,status=1).exclude(parent_doc=0).values_list('parent_doc',flat=True)
-        # 获取存在上级文档的上级文档ID
-        # print(parent_id_list)
-        doc_list = []
-        # 获取一级文档
-        top_docs = Doc.objects.filter(top_doc=pro_id,parent_doc=0,status=1).values('id','name','modify_time').order_by('sort')
-        # 遍历一级文档
-        for doc in top_docs:
-            top_item = {
-                'id':doc['id'],
-                'field':doc['name'],
-                'title':doc['name'],
-                'name':doc['name'],
-                'lable':doc['name'],
-                'modify_time':doc['modify_time'],
-                'spread':True,
-                'level':1
-            }
-            # 如果一级文档存在下级文档，查询其二级文档
-            if doc['id'] in parent_id_list:
-                # 获取二级文档
-                sec_docs = Doc.objects.filter(top_doc=pro_id,parent_doc=doc['id'],status=1).values('id','name','modify_time').order_by('sort')
-                top_item['children'] = []
-                for doc in sec_docs:
-                    sec_item = {
-                        'id': doc['id'],
-                        'field': doc['name'],
-                        'title': doc['name'],
-                        'name': doc['name'],
-                        'lable': doc['name'],
-                        'modify_time': doc['modify_time'],
-                        'level':2
-                    }
-                    # 如果二级文档存在下级文档，查询第三级文档
-                    if doc['id'] in parent_id_list:
-                        # 获取三级文档
-                        thr_docs = Doc.objects.filter(top_doc=pro_id,parent_doc=doc['id'],status=1).values('id','name','modify_time').order_by('sort')
-                        sec_item['children'] = []
-                        for doc in thr_docs:
-                            item = {
-                                'id': doc['id'],
-                                'field': doc['name'],
-                                'title': doc['name'],
-                                'name': doc['name'],
-                                'lable': doc['name'],
-                                'modify_time': doc['modify_time'],
-                                'level': 3
-                            }
-                            sec_item['children'].append(item)
-                        top_item['children'].append(sec_item)
-                    else:
-                        top_item['children'].append(sec_item)
-                doc_list.append(top_item)
-            # 如果一级文档没有下级文档，直接保存
-            else:
-                doc_list.append(top_item)
+        def make_item(node):
+            item = sort_toc_item(node)
+            item['name'] = node['name']
+            item['lable'] = node['name']
+            item['modify_time'] = node['modify_time']
+            return item
+        doc_list = build_toc_tree(get_toc_nodes(pro_id),make_item,'children')
         doc_list = jsonXssFilter(doc_list)
         if is_page is False:
             return JsonResponse({'status':True,'data':doc_list})
@@ -2309,13 +2101,10 @@ def report_md(request):
         try:
             if user.is_superuser is False:
                 Project.objects.get(id=int(pro_id),create_user=user)
-            project_md = ReportMD(
-                project_id=int(pro_id)
-            )
-            md_file_path = project_md.work() # 生成并获取MD文件压缩包绝对路径
-            md_file_filename = os.path.split(md_file_path)[-1] # 提取文件名
-            md_file = "/media/reportmd_temp/"+ md_file_filename # 拼接相对链接
-            return JsonResponse({'status':True,'data':md_file})
+            else:
+                Project.objects.get(id=int(pro_id))
+            job = create_export_job(user,'md',[pro_id]) # 创建导出任务，前端轮询任务状态获取文件
+            return JsonResponse({'status':True,'data':export_job_dict(job)})
         except ObjectDoesNotExist as e:
             return JsonResponse({'status': False, 'data': _('文集不存在')})
         except Exception as e:
@@ -2326,20 +2115,14 @@ def report_md(request):
         for project in project_list:
             try:
                 Project.objects.get(id=project,create_user=request.user)
-            except ObjectDoesNotExist:
+            except (ObjectDoesNotExist,ValueError):
                 return JsonResponse({'status':False,'data':_('无权限')})
-        project_md = ReportMdBatch(
-            project_id_list = project_list,
-            username = request.user.username
-        )
         try:
-            md_file_path = project_md.work()  # 生成并获取MD文件压缩包绝对路径
+            job = create_export_job(user,'md_batch',project_list)
         except:
             logger.exception("文集导出异常")
             return JsonResponse({'status': False, 'data': _('文集导出异常')})
-        md_file_filename = os.path.split(md_file_path)[-1]  # 提取文件名
-        md_file = "/media/reportmd_temp/" + md_file_filename  # 拼接相对链接
-        return JsonResponse({'status': True, 'data': md_file})
+        return JsonResponse({'status': True, 'data': export_job_dict(job)})
 
     else:
         return JsonResponse({'status':False,'data':_('无效参数')})
@@ -2350,129 +2133,18 @@ def report_md(request):
 @require_http_methods(["POST"])
 def genera_project_file(request):
     report_type = request.POST.get('types',None) # 获取前端传入到导出文件类型参数
-    # 导出EPUB文件
     pro_id = request.POST.get('pro_id')
     try:
         project = Project.objects.get(id=int(pro_id))
-        # 获取文集的协作用户信息
-        if request.user.is_authenticated:
-            colla_user = ProjectCollaborator.objects.filter(project=project, user=request.user)
-            if colla_user.exists():
-                colla_user_role = colla_user[0].role
-                colla_user = colla_user.count()
-            else:
-                colla_user = colla_user.count()
-        else:
-            colla_user = 0
-
-        # 公开的文集 - 可以直接导出
-        if project.role == 0:
-            allow_export = True
-
-        # 私密文集 - 非创建者和协作者不可导出
-        elif (project.role == 1):
-            if (request.user != project.create_user) and (colla_user == 0):
-                allow_export = False
-            else:
-                allow_export = True
-
-        # 指定用户可见文集 - 指定用户、文集创建者和协作者可导出
-        elif project.role == 2:
-            user_list = project.role_value
-            if request.user.is_authenticated:  # 认证用户判断是否在许可用户列表中
-                if (request.user.username not in user_list) and \
-                        (request.user != project.create_user) and \
-                        (colla_user == 0):  # 访问者不在指定用户之中，也不是协作者
-                    allow_export = False
-                else:
-                    allow_export = True
-            else:  # 游客直接返回404
-                allow_export = False
-
-        # 访问码可见文集 - 文集创建者、协作者和通过验证即可导出
-        elif project.role == 3:
-            # 浏览用户不为创建者和协作者 - 需要访问码
-            if (request.user != project.create_user) and (colla_user == 0):
-                viewcode = project.role_value
-                viewcode_name = 'viewcode-{}'.format(project.id)
-                r_viewcode = request.COOKIES[
-                    viewcode_name] if viewcode_name in request.COOKIES.keys() else 0  # 从cookie中获取访问码
-                if viewcode != r_viewcode:  # cookie中的访问码不等于文集访问码，不可导出
-                    allow_export = False
-                else:
-                    allow_export = True
-            else:
-                allow_export = True
-        else:
-            allow_export = False
+        # 可以访问文集即可导出（访问码可见文集需通过访问码验证）
+        allow_export = check_project_access(request,project) == ACCESS_ALLOW
 
         # 允许被导出
         if allow_export:
-            # 导出EPUB
-            if report_type in ['epub']:
-                try:
-                    report_project = ReportEPUB(
-                        project_id=project.id
-                    ).work()
-                    # print(report_project)
-                    report_file_path = report_project.split('media', maxsplit=1)[-1] # 导出文件的路径
-                    epub_file = '/media' + report_file_path + '.epub' # 文件相对路径
-                    # 查询文集是否存在导出文件
-                    report_cnt = ProjectReportFile.objects.filter(project=project,file_type='epub')
-                    # 存在文件删除
-                    if report_cnt.count() != 0:
-                        for r in report_cnt:
-                            is_exist = os.path.exists(settings.BASE_DIR + r.file_path)
-                            if is_exist:
-                                os.remove(settings.BASE_DIR + r.file_path)
-                        report_cnt.delete()  # 删除数据库记录
-
-                    # 创建数据库记录
-                    ProjectReportFile.objects.create(
-                        project=project,
-                        file_type='epub',
-                        file_name=epub_file,
-                        file_path=epub_file
-                    )
-
-                    return JsonResponse({'status': True, 'data': epub_file})
-                except Exception as e:
-                    logger.exception(_("生成EPUB出错"))
-                    return JsonResponse({'status': False, 'data': _('生成出错')})
-            # 导出PDF
-            elif report_type in ['pdf']:
-                try:
-                    report_project = ReportPDF(
-                        project_id=project.id,
-                        user_id=request.user.id
-                    ).work()
-                    if report_project is False:
-                        return JsonResponse({'status':False,'data':_('生成出错')})
-                    report_file_path = report_project.split('media', maxsplit=1)[-1]  # 导出文件的路径
-                    pdf_file = '/media' + report_file_path  # 文件相对路径
-                    # 查询文集是否存在导出文件
-                    report_cnt = ProjectReportFile.objects.filter(project=project, file_type='pdf')
-                    # 存在文件删除
-                    if report_cnt.count() != 0:
-                        for r in report_cnt:
-                            is_exist = os.path.exists(settings.BASE_DIR + r.file_path)
-                            if is_exist:
-                                os.remove(settings.BASE_DIR + r.file_path)
-                        report_cnt.delete()  # 删除数据库记录
-
-                    # 创建数据库记录
-                    ProjectReportFile.objects.create(
-                        project=project,
-                        file_type='pdf',
-                        file_name=pdf_file,
-                        file_path=pdf_file
-                    )
-
-                    return JsonResponse({'status': True, 'data': pdf_file})
-
-                except Exception as e:
-                    logger.exception(_("生成出错"))
-                    return JsonResponse({'status': False, 'data': _('生成出错')})
+            # 创建EPUB、PDF、DOCX导出任务，任务完成后记录文集导出文件
+            if report_type in ['epub','pdf','docx']:
+                job = create_export_job(request.user,report_type,[project.id])
+                return JsonResponse({'status': True, 'data': export_job_dict(job)})
             else:
                 return JsonResponse({'status': False, 'data': _('不支持的类型')})
         # 不允许被导出
@@ -2487,101 +2159,81 @@ def genera_project_file(request):
         return JsonResponse({'status':False,'data':_('系统异常')})
 
 
+# 查询文集导出任务的状态和进度
+@login_required()
+@require_GET
+def export_job_status(request):
+    try:
+        job = ExportJob.objects.get(id=int(request.GET.get('job_id','')))
+    except (ObjectDoesNotExist,ValueError):
+        return JsonResponse({'status':False,'data':_('任务不存在')})
+    if job.user_id != request.user.id and request.user.is_superuser is False:
+        return JsonResponse({'status':False,'data':_('无权限')})
+    return JsonResponse({'status':True,'data':export_job_dict(job)})
+
+
 # 获取文集前台导出文件
+# POST 返回文件下载地址，GET 下载文件（支持 ETag 和 Range 请求）
 @allow_report_file
-@require_http_methods(["POST"])
+@require_http_methods(["GET","POST"])
 def report_file(request):
-    report_type = request.POST.get('types',None) # 获取前端传入到导出文件类型参数
+    params = request.POST if request.method == 'POST' else request.GET
+    report_type = params.get('types',None) # 获取前端传入到导出文件类型参数
 
-    pro_id = request.POST.get('pro_id')
+    pro_id = params.get('pro_id')
     try:
         project = Project.objects.get(id=int(pro_id))
 
-        # 获取文集的协作用户信息
-        if request.user.is_authenticated:
-            colla_user = ProjectCollaborator.objects.filter(project=project, user=request.user)
-            if colla_user.exists():
-                colla_user_role = colla_user[0].role
-                colla_user = colla_user.count()
-            else:
-                colla_user = colla_user.count()
-        else:
-            colla_user = 0
-
-        # 公开的文集 - 可以直接导出
-        if project.role == 0:
-            allow_export = True
-
-        # 私密文集 - 非创建者和协作者不可导出
-        elif (project.role == 1):
-            if (request.user != project.create_user) and (colla_user == 0):
-                allow_export = False
-            else:
-                allow_export = True
-
-        # 指定用户可见文集 - 指定用户、文集创建者和协作者可导出
-        elif project.role == 2:
-            user_list = project.role_value
-            if request.user.is_authenticated:  # 认证用户判断是否在许可用户列表中
-                if (request.user.username not in user_list) and \
-                        (request.user != project.create_user) and \
-                        (colla_user == 0):  # 访问者不在指定用户之中，也不是协作者
-                    allow_export = False
-                else:
-                    allow_export = True
-            else:  # 游客直接返回404
-                allow_export = False
-        # 访问码可见文集 - 文集创建者、协作者和通过验证即可导出
-        elif project.role == 3:
-            # 浏览用户不为创建者和协作者 - 需要访问码
-            if (request.user != project.create_user) and (colla_user == 0):
-                viewcode = project.role_value
-                viewcode_name = 'viewcode-{}'.format(project.id)
-                r_viewcode = request.COOKIES[
-                    viewcode_name] if viewcode_name in request.COOKIES.keys() else 0  # 从cookie中获取访问码
-                if viewcode != r_viewcode:  # cookie中的访问码不等于文集访问码，不可导出
-                    allow_export = False
-                else:
-                    allow_export = True
-            else:
-                allow_export = True
-        else:
-            allow_export = False
-            # return JsonResponse({'status':False,'data':'不存在的文集权限'})
+        # 可以访问文集即可导出（访问码可见文集需通过访问码验证）
+        allow_export = check_project_access(request,project) == ACCESS_ALLOW
         if allow_export:
-            # 导出EPUB文件
-            if report_type in ['epub']:
-                try:
-                    try:
-                        report_project = ProjectReportFile.objects.get(project=project,file_type='epub')
-                    except ObjectDoesNotExist:
-                        return JsonResponse({'status':False,'data':_('无可用文件,请联系文集创建者')})
-                    # print(report_project)
-                    return JsonResponse({'status': True, 'data': report_project.file_path})
-                except Exception as e:
-                    return JsonResponse({'status': False, 'data': _('导出出错')})
-            # 导出PDF
-            elif report_type in ['pdf']:
+            # 导出EPUB、PDF文件
+            if report_type in ['epub','pdf']:
                 try:
-                    try:
-                        report_project = ProjectReportFile.objects.get(project=project,file_type='pdf')
-                    except ObjectDoesNotExist:
+                    report_project = ProjectReportFile.objects.filter(project=project,file_type=report_type).order_by('-id').first()
+                    if report_project is None:
                         return JsonResponse({'status':False,'data':_('无可用文件,请联系文集创建者')})
-                    # print(report_project)
-                    return JsonResponse({'status': True, 'data': report_project.file_path})
+                    if request.method == 'GET':
+                        return export_file_response(request,report_project.file_path)
+                    download_url = "{}?pro_id={}&types={}".format(reverse('report_file'),project.id,report_type)
+                    return JsonResponse({'status': True, 'data': download_url})
+                except FileNotFoundError:
+                    raise Http404
                 except Exception as e:
+                    logger.exception(_("获取文集前台导出文件出错"))
                     return JsonResponse({'status': False, 'data': _('导出出错')})
             else:
                 return JsonResponse({'status': False, 'data': _('不支持的类型')})
         else:
             return JsonResponse({'status':False,'data':_('无权限导出')})
-    except ObjectDoesNotExist:
+    except (ObjectDoesNotExist,ValueError,TypeError):
         return JsonResponse({'status':False,'data':_('文集不存在')})
+    except Http404:
+        raise
     except Exception as e:
         logger.exception(_("获取文集前台导出文件出错"))
         return JsonResponse({'status':False,'data':_('系统异常')})
 
 
+# 图片缩略图，首次访问时生成并缓存，普通用户只能获取自己图片素材的缩略图，超级管理员可以获取所有图片素材的缩略图
+@login_required()
+@require_GET
+def image_thumbnail(request):
+    file_path = request.GET.get('path','')
+    size = request.GET.get('size','s')
+    images = Image.objects.filter(file_path=file_path)
+    if not request.user.is_superuser:
+        images = images.filter(user=request.user)
+    if not images.exists():
+        raise Http404
+    thumbnail = get_thumbnail(file_path,size)
+    if thumbnail is None:
+        raise Http404
+    response = FileResponse(open(thumbnail,'rb'),content_type='image/webp')
+    response['Cache-Control'] = 'max-age=86400'
+    return response
+
+
 # 图片素材管理
 @login_required()
 @require_http_methods(['GET',"POST"])
@@ -2589,7 +2241,7 @@ def manage_image(request):
     # 获取图片
     if request.method == 'GET':
         try:
-            groups = ImageGroup.objects.filter(user=request.user) # 获取所有分组
+            groups = attach_image_group_stats(ImageGroup.objects.filter(user=request.user)) # 获取所有分组及其图片数量
             all_img_cnt = Image.objects.filter(user=request.user).count()
             no_group_cnt = Image.objects.filter(user=request.user,group_id=None).count() # 获取所有未分组的图片数量
             g_id = int(request.GET.get('group', 0))  # 图片分组id
@@ -2623,11 +2275,7 @@ def manage_image(request):
                     img = Image.objects.get(id=img_id)
                     if img.user != request.user:
                         return JsonResponse({'status': False, 'data': _('未授权请求')})
-                    file_path = settings.BASE_DIR+img.file_path
-                    is_exist = os.path.exists(file_path)
-                    if is_exist:
-                        os.remove(file_path)
-                    img.delete() # 删除记录
+                    delete_images([img]) # 删除记录，没有其他图片引用时删除文件
                 elif range == 'multi':
                     imgs = img_id.split(',')
                     for i in imgs:
@@ -2635,11 +2283,7 @@ def manage_image(request):
                         if img.user != request.user:
                             logger.error(_("图片{}非法删除".format(i)))
                             break
-                        file_path = settings.BASE_DIR + img.file_path
-                        is_exist = os.path.exists(file_path)
-                        if is_exist:
-                            os.remove(file_path)
-                        img.delete()  # 删除记录
+                        delete_images([img])  # 删除记录，没有其他图片引用时删除文件
 
                 return JsonResponse({'status':True,'data':_('删除完成')})
             # 移动图片分组
@@ -2694,7 +2338,7 @@ def manage_image(request):
 @logger.catch()
 def manage_img_group(request):
     if request.method == 'GET':
-        groups = ImageGroup.objects.filter(user=request.user)
+        groups = attach_image_group_stats(ImageGroup.objects.filter(user=request.user))
         return render(request,'app_doc/manage/manage_image_group.html',locals())
     # 操作分组
     elif request.method == 'POST':
@@ -2830,8 +2474,7 @@ def manage_attachment(request):
                 # 限制附件大小
                 # 获取系统设置的附件文件大小，如果不存在，默认50MB
                 try:
-                    allow_attachment_size = SysSetting.objects.get(types='doc',name='attachment_size')
-                    allow_attach_size = int(allow_attachment_size.value) * 1048576
+                    allow_attach_size = int(get_setting('attachment_size',types='doc')) * 1048576
                 except Exception as e:
                     # print(repr(e))
                     allow_attach_size = 52428800
@@ -2840,12 +2483,8 @@ def manage_attachment(request):
 
                 # 限制附件格式
                 if settings.CHECK_ATTACHMENT_SUFFIX:
-                    try:
-                        attachment_suffix_list = SysSetting.objects.get(types='doc', name='attachment_suffix')
-                        attachment_suffix_list = attachment_suffix_list.value.split(',')
-                        if attachment_suffix_list == ['']:
-                            attachment_suffix_list = ['zip']
-                    except ObjectDoesNotExist:
+                    attachment_suffix_list = (get_setting('attachment_suffix',types='doc') or '').split(',')
+                    if attachment_suffix_list == ['']:
                         attachment_suffix_list = ['zip']
                     allow_attachment = False
                     if attachment_name.split('.')[-1].lower() in attachment_suffix_list:
@@ -2949,37 +2588,30 @@ def search(request):
         # 搜索文档
         if search_type == 'doc':
             if is_auth:
-                colla_list = [i.project.id for i in ProjectCollaborator.objects.filter(user=request.user)]  # 用户的协作文集
-                open_list = [i.id for i in Project.objects.filter(
-                    Q(role=0) | Q(create_user=request.user)
-                )]  # 公开文集
-
-                view_list = list(set(open_list).union(set(colla_list)))  # 合并上述两个文集ID列表
-
-                data_list = Doc.objects.filter(
-                    Q(top_doc__in=view_list),  # 包含用户可浏览到的文集
-                    Q(create_time__gte=start_date, create_time__lte=end_date),  # 筛选创建时间
-                    Q(name__icontains=kw) | Q(content__icontains=kw) | Q(pre_content__icontains=kw)  # 筛选文档标题和内容中包含搜索词
-                ).order_by('-create_time')
+                # 用户可浏览的文集（公开、创建、协作和指定可见的文集）
+                view_list = Project.objects.filter(get_project_access(request).visible_q([0])).values_list('id',flat=True)
             else:
-                view_list = [i.id for i in Project.objects.filter(role=0)]
-                data_list = Doc.objects.filter(
-                    Q(top_doc__in=view_list),
-                    Q(create_time__gte=start_date, create_time__lte=end_date),  # 筛选创建时间
-                    Q(name__icontains=kw) | Q(content__icontains=kw) | Q(pre_content__icontains=kw)  # 筛选文档标题和内容中包含搜索词
-                ).order_by('-create_time')
+                view_list = Project.objects.filter(role=0).values_list('id',flat=True)
+
+            # 通过全文索引搜索，索引不存在或出错时在数据库中匹配文档标题和内容
+            fallback = Doc.objects.filter(
+                Q(top_doc__in=view_list),  # 包含用户可浏览到的文集
+                Q(status=1),
+                Q(create_time__gte=start_date, create_time__lte=end_date),  # 筛选创建时间
+                Q(name__icontains=kw) | Q(content__icontains=kw) | Q(pre_content__icontains=kw)  # 筛选文档标题和内容中包含搜索词
+            ).order_by('-create_time')
+            if is_date_range:
+                data_list = search_docs(kw,view_list,fallback,start_date,end_date)
+            else:
+                data_list = search_docs(kw,view_list,fallback)
 
         # 搜索文集
         elif search_type == 'pro':
             # 认证用户
             if is_auth:
-                colla_list = [i.project.id for i in ProjectCollaborator.objects.filter(user=request.user)]  # 用户的协作文集
                 # 查询所有可显示的文集
                 data_list = Project.objects.filter(
-                    Q(role=0) | \
-                    Q(role=2, role_value__contains=str(request.user.username)) | \
-                    Q(create_user=request.user) | \
-                    Q(id__in=colla_list),
+                    get_project_access(request).visible_q([0]),
                     Q(create_time__gte=start_date, create_time__lte=end_date),  # 筛选创建时间
                     Q(name__icontains=kw) | Q(intro__icontains=kw)  # 筛选文集名称和简介包含搜索词
                 ).order_by('-create_time')
@@ -2995,35 +2627,18 @@ def search(request):
         elif search_type == 'tag':
             # 认证用户
             if is_auth:
-                colla_list = [i.project.id for i in ProjectCollaborator.objects.filter(user=request.user)]  # 用户的协作文集
-                open_list = [i.id for i in Project.objects.filter(
-                    Q(role=0) | Q(create_user=request.user)
-                )]  # 公开文集和自己创建的文集
-
-                view_list = list(set(open_list).union(set(colla_list)))  # 合并上述两个文集ID列表
-
-                tag_list = Tag.objects.filter(name__icontains=kw) # 查询符合条件的标签
-                tag_doc_list = [i.doc.id for i in DocTag.objects.filter(tag__in=tag_list)] # 获取符合条件的标签文档
-
-                data_list = Doc.objects.filter(
-                    Q(top_doc__in=view_list),  # 包含用户可浏览到的文集
-                    Q(id__in=tag_doc_list), # 包含符合条件标签的文档ID列表
-                    Q(create_time__gte=start_date, create_time__lte=end_date),  # 筛选创建时间
-                ).order_by('-create_time')
+                # 用户可浏览的文集（公开、创建、协作和指定可见的文集）
+                view_list = Project.objects.filter(get_project_access(request).visible_q([0])).values_list('id',flat=True)
             # 游客
             else:
-                open_list = [i.id for i in Project.objects.filter(Q(role=0))]  # 公开文集
-
-                view_list = list(set(open_list))
+                view_list = Project.objects.filter(role=0).values_list('id',flat=True)  # 公开文集
 
-                tag_list = Tag.objects.filter(name__icontains=kw)  # 查询符合条件的标签
-                tag_doc_list = [i.doc.id for i in DocTag.objects.filter(tag__in=tag_list)]  # 获取符合条件的标签文档
-
-                data_list = Doc.objects.filter(
-                    Q(top_doc__in=view_list),  # 包含用户可浏览到的文集
-                    Q(id__in=tag_doc_list),  # 包含符合条件标签的文档ID列表
-                    Q(create_time__gte=start_date, create_time__lte=end_date),  # 筛选创建时间
-                ).order_by('-create_time')
+            # 通过文档标签关联查询包含符合条件标签的文档
+            data_list = Doc.objects.filter(
+                Q(top_doc__in=view_list),  # 包含用户可浏览到的文集
+                Q(doctag__tag__name__icontains=kw), # 包含符合条件的标签
+                Q(create_time__gte=start_date, create_time__lte=end_date),  # 筛选创建时间
+            ).distinct().order_by('-create_time')
 
         else:
             return render(request, 'app_doc/search.html')
@@ -3037,6 +2652,9 @@ def search(request):
             datas = paginator.page(1)
         except EmptyPage:
             datas = paginator.page(paginator.num_pages)
+        # 文档搜索结果读取渲染后的纯文本，用于显示搜索词的上下文
+        if search_type in ['doc','tag']:
+            datas.object_list = attach_doc_text(datas.object_list)
         return render(request, 'app_doc/search_result.html', locals())
 
     # 否则跳转到搜索首页
@@ -3096,7 +2714,7 @@ def manage_overview(request):
 @require_http_methods(['GET','POST'])
 def manage_doc_tag(request):
     if request.method == 'GET':
-        tags = Tag.objects.filter(create_user=request.user)
+        tags = attach_tag_stats(Tag.objects.filter(create_user=request.user))
         return render(request,'app_doc/manage/manage_doc_tag.html',locals())
     # 操作标签
     elif request.method == 'POST':
@@ -3164,101 +2782,60 @@ def tag_docs(request,tag_id):
             # 判断是否为标签的创建者
             if request.user == tag.create_user:
                 # 获取标签的所有文档
-                view_list = [i.id for i in Project.objects.filter(create_user=request.user)]
+                view_list = list(Project.objects.filter(create_user=request.user).values_list('id',flat=True))
                 docs = DocTag.objects.filter(tag=tag,doc__status=1)
             else:
                 # 获取有权限的文档
-                colla_list = [i.project.id for i in ProjectCollaborator.objects.filter(user=request.user)]  # 用户的协作文集
-                open_list = [i.id for i in Project.objects.filter(
+                colla_list = ProjectCollaborator.objects.filter(user=request.user).values_list('project_id',flat=True)  # 用户的协作文集
+                open_list = Project.objects.filter(
                     Q(role=0) | Q(create_user=tag.create_user)
-                )]  # 公开文集
+                ).values_list('id',flat=True)  # 公开文集
 
                 view_list = list(set(open_list).union(set(colla_list)))  # 合并上述两个文集ID列表
-                # 查询可浏览文集的文档
-                doc_list = [i for i in Doc.objects.filter(top_doc__in=view_list,status=1)]
-                # 筛选可浏览的文档的标签文档
-                docs = DocTag.objects.filter(tag=tag,doc__in=doc_list)
+                # 筛选可浏览文集中已发布文档的标签文档
+                docs = DocTag.objects.filter(tag=tag,doc__top_doc__in=view_list,doc__status=1)
 
         else:
             # 查询标签创建者的公开文集
-            open_list = [i.id for i in Project.objects.filter(
+            view_list = list(Project.objects.filter(
                 role=0,create_user=tag.create_user
-            )]
-            view_list = open_list
-            doc_list = [i for i in Doc.objects.filter(top_doc__in=view_list,status=1)]
-            docs = DocTag.objects.filter(tag=tag,doc__in=doc_list)
+            ).values_list('id',flat=True))
+            docs = DocTag.objects.filter(tag=tag,doc__top_doc__in=view_list,doc__status=1)
 
-        # 获取文档的其他标签信息
-        current_link_list = [] # 文档的所有标签ID列表
-        for doc in docs:
-            other_tags = [str(i.tag.id) for i in DocTag.objects.filter(~Q(tag=tag), doc=doc.doc)]
-            current_link_list.extend(other_tags)
+        docs = docs.select_related('doc')
 
+        # 标签关系图数据从缓存读取
+        tag_graph = get_tag_graph(tag.create_user_id,view_list)
         # 标签的节点列表
-        tag_nodes_list = [
-            # {'id':str(tag.id),'name':tag.name,'symbolSize':50,'value':docs.count(),'itemStyle':{'color':random.choice(color_list)}}
-        ]
-        # 标签的关系列表
-        tag_links_list = []
+        tag_nodes_list = []
         # 标签分类列表
         tag_cate = []
-
-        # 添加用户创建的所有标签到节点列表
-        for t in Tag.objects.filter(create_user=tag.create_user):
-            tag_cate.append({'name':t.name})
-            if t.name == tag.name:
-                item = {
-                    'id': str(t.id),
-                    'name': t.name,
-                    'symbolSize': 50,
-                    'value': DocTag.objects.filter(tag=t,doc__status=1,doc__top_doc__in=view_list).count(),
-                    'itemStyle': {'color': random.choice(color_list)}
-                }
-            else:
-                item = {
-                    'id':str(t.id),
-                    'name':t.name,
-                    'symbolSize':25,
-                    'value':DocTag.objects.filter(tag=t,doc__status=1,doc__top_doc__in=view_list).count(),
-                    'itemStyle':{'color':random.choice(color_list)}
+        for node in tag_graph['nodes']:
+            tag_cate.append({'name':node['name']})
+            tag_nodes_list.append({
+                'id': str(node['id']),
+                'name': node['name'],
+                'symbolSize': 50 if node['id'] == tag.id else 25,
+                'value': node['value'],
+                'itemStyle': {'color': random.choice(color_list)}
+            })
+        # 标签的关系列表
+        tag_links_list = [
+            {
+                'source': str(link['source']),
+                'target': str(link['target']),
+                'value': link['doc_name'],
+                'id': link['doc_id'],
+                'pid': link['pro_id'],
+                'label':{
+                    'normal':{
+                        'show':'true',
+                        'formatter':"{c}",
+                        'fontsize':'10px',
+                    }
                 }
-            tag_nodes_list.append(item)
-            # 查询非主标签的关联标签
-            sub_tags = DocTag.objects.filter(tag=t,doc__status=1,doc__top_doc__in=view_list) # 获取包含t标签的文档
-            for sub_tag in sub_tags:
-                sub_docs = DocTag.objects.filter(doc=sub_tag.doc,doc__top_doc__in=view_list) # 获取包含文档的标签
-                for sub_doc in sub_docs:
-                    if str(sub_tag.tag.id) != str(sub_doc.tag.id):
-                        item = {
-                            'source': str(sub_tag.tag.id),
-                            'target': str(sub_doc.tag.id),
-                            'value' : sub_doc.doc.name,
-                            'id': sub_doc.doc.id,
-                            'pid': sub_doc.doc.top_doc,
-                            'label':{
-                                'normal':{
-                                    'show':'true',
-                                    'formatter':"{c}",
-                                    'fontsize':'10px',
-                                }
-                            }
-                        }
-                        item_1 = {
-                            'source': str(sub_doc.tag.id),
-                            'target': str(sub_tag.tag.id),
-                            'value': sub_doc.doc.name,
-                            'id':sub_doc.doc.id,
-                            'pid': sub_doc.doc.top_doc,
-                            'label': {
-                                'normal': {
-                                    'show': 'true',
-                                    'formatter': "{c}",
-                                    'fontsize': '10px',
-                                }
-                            }
-                        }
-                        if item_1 not in tag_links_list:
-                            tag_links_list.append(item)
+            } for link in tag_graph['links']
+        ]
 
         return render(request, 'app_doc/tag_docs.html', locals())
     except Exception as e:
@@ -3275,39 +2852,16 @@ def tag_doc(request,tag_id,doc_id):
             # 获取文档的文集信息，以判断是否有权限访问
             project = Project.objects.get(id=int(doc.top_doc))
             # 获取文集的协作用户信息
-            if request.user.is_authenticated:
-                colla_user = ProjectCollaborator.objects.filter(project=project,user=request.user)
-                if colla_user.exists():
-                    colla_user_role = colla_user[0].role
-                    colla_user = colla_user.count()
-                else:
-                    colla_user = colla_user.count()
-            else:
-                colla_user = 0
+            access = get_project_access(request)
+            colla_user_role = access.colla_role(project.id)
+            colla_user = 0 if colla_user_role is None else 1
 
-            # 私密文集且访问者非创建者、协作者 - 不能访问
-            if (project.role == 1) and (request.user != project.create_user) and (colla_user == 0):
+            # 检查文集访问权限
+            access_result = check_project_access(request,project)
+            if access_result == ACCESS_DENY:
                 return render(request, '404.html')
-            # 指定用户可见文集
-            elif project.role == 2:
-                user_list = project.role_value
-                if request.user.is_authenticated:  # 认证用户判断是否在许可用户列表中
-                    if (request.user.username not in user_list) and \
-                            (request.user != project.create_user) and \
-                            (colla_user == 0):  # 访问者不在指定用户之中，也不是协作者
-                        return render(request, '404.html')
-                else:  # 游客直接返回404
-                    return render(request, '404.html')
-            # 访问码可见
-            elif project.role == 3:
-                # 浏览用户不为创建者和协作者 - 需要访问码
-                if (request.user != project.create_user) and (colla_user == 0):
-                    viewcode = project.role_value
-                    viewcode_name = 'viewcode-{}'.format(project.id)
-                    r_viewcode = request.COOKIES[
-                        viewcode_name] if viewcode_name in request.COOKIES.keys() else 0  # 从cookie中获取访问码
-                    if viewcode != r_viewcode:  # cookie中的访问码不等于文集访问码，跳转到访问码认证界面
-                        return redirect('/check_viewcode/?to={}'.format(request.path))
+            elif access_result == ACCESS_VIEWCODE: # 跳转到访问码认证界面
+                return redirect('/check_viewcode/?to={}'.format(request.path))
 
             # 获取文档内容
             try:
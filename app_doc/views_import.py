@@ -28,6 +28,8 @@ from app_doc.report_utils import *
 from app_admin.decorators import check_headers,allow_report_file
 from app_doc.import_utils import *
 from app_doc.views import get_pro_toc,html_filter,jsonXssFilter
+from app_doc.access_utils import sync_project_role_users
+from app_doc.toc_utils import load_toc_nodes,build_toc_tree,sort_toc_item,bump_toc_version,bump_toc_version_by_docs
 from app_api.auth_app import AppAuth,AppMustAuth # 自定义认证
 import datetime
 import traceback
@@ -66,58 +68,8 @@ def import_project(request):
                         project = import_file.read_zip(temp_file_path,request.user) # 返回文集id或None
                         if project:
                             pro = Project.objects.get(id=project)
-                            docs = Doc.objects.filter(top_doc=project).values_list('id','name')
-                            # 查询存在上级文档的文档
-                            parent_id_list = Doc.objects.filter(top_doc=project).exclude(
-                                parent_doc=0).values_list('parent_doc', flat=True)
-                            # 获取存在上级文档的上级文档ID
-                            doc_list = []
-                            # 获取一级文档
-                            top_docs = Doc.objects.filter(
-                                top_doc=project,
-                                parent_doc=0).values('id','name').order_by('sort')
-                            for doc in top_docs:
-                                top_item = {
-                                    'id': doc['id'],
-                                    'field': doc['name'],
-                                    'title': doc['name'],
-                                    'spread': True,
-                                    'level': 1
-                                }
-                                # 如果一级文档存在下级文档，查询其二级文档
-                                if doc['id'] in parent_id_list:
-                                    sec_docs = Doc.objects.filter(
-                                        top_doc=project,
-                                        parent_doc=doc['id']).values('id','name').order_by('sort')
-                                    top_item['children'] = []
-                                    for doc in sec_docs:
-                                        sec_item = {
-                                            'id': doc['id'],
-                                            'field': doc['name'],
-                                            'title': doc['name'],
-                                            'level': 2
-                                        }
-                                        # 如果二级文档存在下级文档，查询第三级文档
-                                        if doc['id'] in parent_id_list:
-                                            thr_docs = Doc.objects.filter(
-                                                top_doc=project,
-                                                parent_doc=doc['id'],).values('id','name').order_by('sort')
-                                            sec_item['children'] = []
-                                            for doc in thr_docs:
-                                                item = {
-                                                    'id': doc['id'],
-                                                    'field': doc['name'],
-                                                    'title': doc['name'],
-                                                    'level': 3
-                                                }
-                                                sec_item['children'].append(item)
-                                            top_item['children'].append(sec_item)
-                                        else:
-                                            top_item['children'].append(sec_item)
-                                    doc_list.append(top_item)
-                                # 如果一级文档没有下级文档，直接保存
-                                else:
-                                    doc_list.append(top_item)
+                            # 导入的文档为草稿状态，不使用已发布文档的目录缓存
+                            doc_list = build_toc_tree(load_toc_nodes(project,published=False),sort_toc_item,'children')
 
                             return JsonResponse({
                                 'status':True,
@@ -273,7 +225,8 @@ class ImportLocalDoc(APIView):
                         n2 = 10
                         for c2 in c1['children']:
                             Doc.objects.filter(id=c2['id']).update(sort=n2, parent_doc=c1['id'], status=1)
-
+        # 更新文集目录缓存
+        bump_toc_version_by_docs([data['id'] for data in sort_data])
         return Response({'code':0,'data':'ok'})
 
 
@@ -305,6 +258,7 @@ def project_doc_sort(request):
         intro = desc,
         role = role
     )
+    sync_project_role_users(Project.objects.get(id=project_id))
     # 文档排序
     n = 10
     # 第一级文档
@@ -322,7 +276,8 @@ def project_doc_sort(request):
                     n2 = 10
                     for c2 in c1['children']:
                         Doc.objects.filter(id=c2['id']).update(sort=n2,parent_doc=c1['id'],status=doc_status)
-
+    # 更新文集目录缓存
+    bump_toc_version(project_id)
     return JsonResponse({'status':True,'data':'ok'})
 
 
@@ -4,6 +4,14 @@
 python /app/MrDoc/manage.py migrate &&
 # 重建全文搜索索引
 nohup echo y |python /app/MrDoc/manage.py rebuild_index &
+# 生成缺少的文档渲染内容
+nohup python /app/MrDoc/manage.py backfill_doc_render &
+# 处理全文索引队列
+nohup python /app/MrDoc/manage.py process_index_queue &
+export MRDOC_INDEX_WORKER=1
+# 执行文集导出任务
+nohup python /app/MrDoc/manage.py process_export_jobs &
+export MRDOC_EXPORT_WORKER=1
 # 启动uwsgi
 uwsgi --ini /app/MrDoc/config/uwsgi.ini
 # 直接 runserver 方式运行
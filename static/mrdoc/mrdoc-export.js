@@ -0,0 +1,43 @@
+/*
+    ########################################################
+    ### 文集导出任务通用JavaScript函数和变量定义 ###
+    ########################################################
+*/
+
+// 导出任务的最长等待时间（毫秒）
+var exportJobTimeout = 10 * 60 * 1000;
+
+// 轮询导出任务状态，任务完成后执行回调，任务出错或超过最长等待时间时停止轮询并提示
+function waitExportJob(job,callback,deadline){
+    var $ = window.jQuery || layui.jquery;
+    var layer = layui.layer;
+    deadline = deadline || new Date().getTime() + exportJobTimeout;
+    if(job.status == 2){
+        layer.closeAll('loading');
+        callback(job);
+        return;
+    }
+    if(job.status == 3){
+        layer.closeAll('loading');
+        layer.msg("文集导出异常，请稍后重试");
+        return;
+    }
+    if(new Date().getTime() > deadline){
+        layer.closeAll('loading');
+        layer.msg("导出任务等待超时，请稍后重新导出");
+        return;
+    }
+    setTimeout(function(){
+        $.get("/export_job_status/",{'job_id':job.job_id},function(r){
+            if(r.status){
+                waitExportJob(r.data,callback,deadline);
+            }else{
+                layer.closeAll('loading');
+                layer.msg(r.data);
+            }
+        }).fail(function(){
+            layer.closeAll('loading');
+            layer.msg("服务器异常");
+        })
+    },2000)
+};